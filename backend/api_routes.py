@@ -5,22 +5,32 @@
 # ==============================================================================
 
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional, List, Dict, Any, Literal
+from typing import Optional, List, Dict, Any, Literal, AsyncIterator, Tuple
+import json
 import base64
 import io
 from PIL import Image
 import uuid
 import time
+import asyncio
 
 # 导入现有模块
-from image_enhancer import advanced_image_processing_pipeline
-from pix2text import Pix2Text
+from image_enhancer import advanced_image_processing_pipeline, load_image_fast, prepare_image_base64
+from ocr_cache import ocr_cache
+from ocr_service import schedule_background_ocr, ocr_metrics, OCR_SKIPPED_PLACEHOLDER
+from question_splitter import split_question_images
+from task_scheduler import scheduler
+from cancellation import cancel_stats
 from main import (
     extract_text_with_pix2text, 
     call_qwen_vl_max, 
     SESSIONS,
-    p2t
+    p2t,
+    ocr_batcher,
+    SOLVE_MODEL,
+    SOLVE_NEEDS_LOCAL_OCR
 )
 
 # 创建路由器
@@ -74,6 +84,8 @@ class QuestionResult(BaseModel):
     question_text: str
     answer: Optional[Dict[str, Any]] = None
     review: Optional[Dict[str, Any]] = None
+    region: Optional[List[int]] = None  # 多题拆分时该题在原图中的位置 [x, y, w, h]
+    error: Optional[str] = None
 
 
 class SolveResponse(BaseModel):
@@ -148,10 +160,12 @@ def build_prompt(mode: str, question_count: str, options: SolveOptions) -> str:
     return base_prompt
 
 
-def process_image_input(image_base64: str) -> tuple:
+def process_image_input(image_base64: str, run_ocr: bool = True) -> tuple:
     """
     处理图片输入
     返回：(ocr_text, pil_image)
+    
+    run_ocr=False 时只解码图片，ocr_text 为占位说明（解题模型自带强OCR）
     """
     try:
         # Base64解码
@@ -159,7 +173,7 @@ def process_image_input(image_base64: str) -> tuple:
         image = Image.open(io.BytesIO(image_bytes))
         
         # OCR识别
-        ocr_text = extract_text_with_pix2text(image)
+        ocr_text = extract_text_with_pix2text(image) if run_ocr else OCR_SKIPPED_PLACEHOLDER
         
         return ocr_text, image
         
@@ -226,6 +240,109 @@ def call_ai_for_solve(
     return ai_response
 
 
+def build_question_result(index: int, content_text: str, ai_content: str, mode: str,
+                          region: Optional[List[int]] = None) -> QuestionResult:
+    """组装单题结果"""
+    return QuestionResult(
+        question_index=index,
+        question_text=content_text[:200] + "..." if len(content_text) > 200 else content_text,
+        answer={
+            "content": ai_content,
+            "steps": [],  # 可以进一步解析AI回答提取步骤
+            "final_answer": ""
+        } if mode == "solve" else None,
+        review={
+            "is_correct": None,  # 需要解析AI回答判断
+            "score": None,
+            "errors": [],
+            "suggestions": []
+        } if mode == "review" else None,
+        region=region
+    )
+
+
+def image_to_base64(image: Image.Image) -> str:
+    """PIL图片编码为PNG Base64"""
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def decode_image(image_base64: str) -> Image.Image:
+    """Base64解码为PIL图片（JPEG草稿模式快速解码 + EXIF方向校正）"""
+    try:
+        return load_image_fast(Image.open(io.BytesIO(base64.b64decode(image_base64))))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"图片处理失败: {str(e)}")
+
+
+async def split_image_questions(image_base64: str) -> List[Tuple[Tuple[int, int, int, int], Image.Image]]:
+    """检测并裁剪图片中的各道题目（CPU操作放到线程池）"""
+    image = decode_image(image_base64)
+    return await asyncio.to_thread(split_question_images, image)
+
+
+async def solve_question_crop(index: int, region: Tuple[int, int, int, int], crop: Image.Image,
+                              mode: str, options: SolveOptions) -> Tuple[QuestionResult, str, str]:
+    """
+    单题流水线：OCR → 构建提示词 → 调用AI（并发上限由全局调度器控制）
+
+    Returns:
+        (单题结果, 题目文本, AI回答)
+    """
+    crop_base64 = image_to_base64(crop)
+    if SOLVE_NEEDS_LOCAL_OCR:
+        content_text = await scheduler.run_ocr(extract_text_with_pix2text, crop)
+    else:
+        content_text = OCR_SKIPPED_PLACEHOLDER
+        schedule_background_ocr(extract_text_with_pix2text, crop)
+
+    prompt = build_prompt(mode, "single", options)
+    try:
+        ai_response = await scheduler.run_model(call_ai_for_solve, content_text, crop_base64, prompt)
+    except Exception as e:
+        print(f"!!! [多题拆分] 第{index}题解答失败: {e}")
+        result = build_question_result(index, content_text, "", mode, list(region))
+        result.error = str(e)
+        return result, content_text, ""
+
+    ai_content = ai_response['content']
+    print(f"[多题拆分] ✓ 第{index}题完成，回答长度: {len(ai_content)} 字符")
+    return build_question_result(index, content_text, ai_content, mode, list(region)), content_text, ai_content
+
+
+async def iter_question_results(questions: List[Tuple[Tuple[int, int, int, int], Image.Image]],
+                                mode: str, options: SolveOptions) -> AsyncIterator[Tuple[QuestionResult, str, str]]:
+    """并发解答各道题目，按完成先后依次产出结果"""
+    tasks = [
+        asyncio.create_task(solve_question_crop(i + 1, region, crop, mode, options))
+        for i, (region, crop) in enumerate(questions)
+    ]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def store_fanout_session(solved: List[Tuple[QuestionResult, str, str]],
+                         image_base64: str, mode: str) -> str:
+    """多题拆分结果写入会话（用于后续追问）"""
+    session_id = str(uuid.uuid4())
+    history = []
+    for result, content_text, ai_content in sorted(solved, key=lambda item: item[0].question_index):
+        history.append({"role": "user", "content": f"第{result.question_index}题：{content_text}"})
+        history.append({"role": "assistant", "content": ai_content})
+    SESSIONS[session_id] = {
+        "history": history,
+        "title": "API调用",
+        "image_base_64": image_base64,
+        "mode": mode
+    }
+    return session_id
+
+
 # ==============================================================================
 # API路由端点
 # ==============================================================================
@@ -260,10 +377,49 @@ async def unified_solve_api(request: SolveRequest):
         else:
             detected_type = request.input_type
         
+        # 图片先快速解码 + 内容裁剪，拆题、OCR和发送给模型的都是压缩后的图片
+        if detected_type == "image":
+            request.content.image_base64 = await asyncio.to_thread(
+                prepare_image_base64, request.content.image_base64
+            )
+        
+        # 2. 多题图片：按题拆分，逐题并发OCR + 解答
+        if detected_type == "image" and request.question_count != "single":
+            questions = await split_image_questions(request.content.image_base64)
+            if len(questions) > 1:
+                print(f"[多题拆分] 检测到 {len(questions)} 道题，并发解答...")
+                solved = [item async for item in iter_question_results(questions, request.mode, request.options)]
+                solved.sort(key=lambda item: item[0].question_index)
+                session_id = request.session_id or store_fanout_session(
+                    solved, request.content.image_base64, request.mode
+                )
+                processing_time = (time.time() - start_time) * 1000
+                print(f"【统一API】多题处理完成，耗时 {processing_time:.2f}ms")
+                return SolveResponse(
+                    success=True,
+                    session_id=session_id,
+                    results=[result for result, _, _ in solved],
+                    metadata={
+                        "mode": request.mode,
+                        "input_type": detected_type,
+                        "question_count": "multiple",
+                        "split_questions": len(questions),
+                        "processing_time_ms": round(processing_time, 2),
+                        "ocr_confidence": 0.95,
+                        "detail_level": request.options.detail_level
+                    }
+                )
+        
         # 2. 处理输入内容
         if detected_type == "image":
             print("[输入处理] 处理图片输入...")
-            ocr_text, pil_image = process_image_input(request.content.image_base64)
+            ocr_text, pil_image = await asyncio.to_thread(
+                process_image_input, request.content.image_base64, SOLVE_NEEDS_LOCAL_OCR
+            )
+            if not SOLVE_NEEDS_LOCAL_OCR:
+                # 模型自带强OCR：本地OCR转入后台，只用于写入OCR缓存
+                print(f"[输入处理] ⚡ {SOLVE_MODEL} 自带强OCR，本地OCR转入后台")
+                schedule_background_ocr(extract_text_with_pix2text, pil_image)
             content_text = ocr_text
             image_base64 = request.content.image_base64
             print(f"[OCR结果] 识别了 {len(ocr_text)} 个字符")
@@ -316,22 +472,8 @@ async def unified_solve_api(request: SolveRequest):
         # 7. 构建响应
         processing_time = (time.time() - start_time) * 1000
         
-        # 简单解析结果（实际项目中可以更智能地拆分多题）
-        result = QuestionResult(
-            question_index=1,
-            question_text=content_text[:200] + "..." if len(content_text) > 200 else content_text,
-            answer={
-                "content": ai_response['content'],
-                "steps": [],  # 可以进一步解析AI回答提取步骤
-                "final_answer": ""
-            } if request.mode == "solve" else None,
-            review={
-                "is_correct": None,  # 需要解析AI回答判断
-                "score": None,
-                "errors": [],
-                "suggestions": []
-            } if request.mode == "review" else None
-        )
+        # 单题（或无法拆分的整页）结果
+        result = build_question_result(1, content_text, ai_response['content'], request.mode)
         
         response = SolveResponse(
             success=True,
@@ -362,6 +504,46 @@ async def unified_solve_api(request: SolveRequest):
         raise HTTPException(status_code=500, detail=f"处理失败: {str(e)}")
 
 
+@router.post("/solve/stream")
+async def unified_solve_stream_api(request: SolveRequest):
+    """
+    多题图片流式解题/批改接口（NDJSON）
+
+    每完成一道题立即返回一行 {"type": "question", "result": {...}}，
+    全部完成后返回 {"type": "done", "session_id": ..., "metadata": {...}}。
+    无法拆分的图片按整页作为一道题处理。
+    """
+    if detect_input_type(request.content) != "image":
+        raise HTTPException(status_code=400, detail="流式接口仅支持图片输入，文字题目请使用 /api/solve")
+
+    start_time = time.time()
+    request.content.image_base64 = await asyncio.to_thread(prepare_image_base64, request.content.image_base64)
+    questions = await split_image_questions(request.content.image_base64)
+    print(f"[多题流式] 检测到 {len(questions)} 道题")
+
+    async def generate():
+        solved = []
+        async for item in iter_question_results(questions, request.mode, request.options):
+            solved.append(item)
+            yield json.dumps({"type": "question", "result": item[0].dict()}, ensure_ascii=False) + "\n"
+
+        session_id = request.session_id or store_fanout_session(
+            solved, request.content.image_base64, request.mode
+        )
+        yield json.dumps({
+            "type": "done",
+            "session_id": session_id,
+            "metadata": {
+                "mode": request.mode,
+                "split_questions": len(questions),
+                "processing_time_ms": round((time.time() - start_time) * 1000, 2),
+                "detail_level": request.options.detail_level
+            }
+        }, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
 @router.post("/question_bank")
 async def search_question_bank(request: QuestionBankRequest):
     """
@@ -425,10 +607,17 @@ async def health_check():
         "version": "V22.1",
         "api": "统一智能解题API",
         "services": {
-            "pix2text": p2t is not None,
+            "pix2text": p2t.is_ready,
+            "local_ocr_on_solve": SOLVE_NEEDS_LOCAL_OCR,
             "dashscope": True,
             "image_enhancer": True
-        }
+        },
+        "ocr_engine": p2t.get_status(),
+        "ocr_batching": ocr_batcher.get_stats(),
+        "ocr_cache": ocr_cache.get_stats(),
+        "ocr_metrics": ocr_metrics.get_stats(),
+        "scheduler": scheduler.get_stats(),
+        "cancellation": cancel_stats.get_stats()
     }
 
 
@@ -440,6 +629,7 @@ async def api_info():
         "version": "V22.1",
         "endpoints": {
             "/api/solve": "统一解题/批改接口（支持图片和文字，单题和多题）",
+            "/api/solve/stream": "多题图片流式解题/批改（NDJSON，逐题返回）",
             "/api/question_bank": "题库检索接口",
             "/api/health": "健康检查",
             "/api/": "API信息（当前页面）"
@@ -15,7 +15,7 @@ from pydantic import BaseModel
 from typing import Optional
 import jwt
 from datetime import datetime, timedelta
-from database import UserManager
+from database_async import AsyncUserManager
 
 # ==============================================================================
 # 配置
@@ -165,7 +165,7 @@ async def register(request: RegisterRequest):
         }
     """
     # 调用数据库管理器
-    result = UserManager.register(request.account, request.password)
+    result = await AsyncUserManager.register(request.account, request.password)
     
     if result["success"]:
         # 注册成功，自动登录，生成令牌
@@ -208,7 +208,7 @@ async def login(request: LoginRequest):
         }
     """
     # 调用数据库管理器
-    result = UserManager.login(request.account, request.password)
+    result = await AsyncUserManager.login(request.account, request.password)
     
     if result["success"]:
         # 登录成功，生成令牌
@@ -264,7 +264,7 @@ async def get_current_user_info(user: dict = Depends(get_current_user)):
             "account": "用户账号"
         }
     """
-    user_info = UserManager.get_user_info(user["user_id"])
+    user_info = await AsyncUserManager.get_user_info(user["user_id"])
     
     if user_info:
         return user_info
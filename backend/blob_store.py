@@ -0,0 +1,474 @@
+# ==============================================================================
+# blob_store.py - 题目图片的内容寻址存储
+# 功能：图片按 SHA-256 存放在本地分片目录中，相同图片只存一份；
+#       数据库 / JSON 只保存引用（blob:<sha256>），图片通过 /blobs/{digest} 流式返回；
+#       保存时生成一次缩略图，列表接口只返回缩略图
+#       图片地址是短期签名URL，只由已校验归属的列表/详情接口签发，/blobs/ 本身不接受无签名访问
+# 技术：两级分片目录 + 原子写入 + 引用计数（计数归零时删除文件）+ 强ETag + HMAC签名
+#       引用计数的读-改-写用分片目录锁文件上的 flock 串行化，多个 worker 进程共享同一目录
+# ==============================================================================
+
+import io
+import os
+import re
+import json
+import base64
+import hashlib
+import hmac
+import secrets
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from PIL import Image, ImageOps
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse, Response
+
+try:
+    import fcntl
+except ImportError:  # Windows 开发环境：只有进程内锁，只能单进程运行
+    fcntl = None
+
+
+# 存储根目录
+BLOB_DIR = Path(os.getenv("BLOB_DIR", str(Path(__file__).parent / "image_blobs")))
+
+# 数据库 / JSON 中保存的引用前缀
+BLOB_REF_PREFIX = "blob:"
+
+# 图片的URL前缀（由 blob_router 提供）
+BLOB_URL_PREFIX = "/blobs/"
+
+# 缩略图最长边（像素）和JPEG质量：列表卡片只需要这么大
+THUMBNAIL_MAX_SIZE = int(os.getenv("THUMBNAIL_MAX_SIZE", "256"))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "60"))
+
+# 尚未迁移的旧数据（内联base64）缩略图的缓存条数
+LEGACY_THUMBNAIL_CACHE_SIZE = int(os.getenv("LEGACY_THUMBNAIL_CACHE_SIZE", "256"))
+
+# 图片URL的签名密钥：多个 worker 进程必须一致，未配置时在存储目录下生成一次并共享
+BLOB_URL_SECRET = os.getenv("BLOB_URL_SECRET", "")
+
+# 签名URL的有效期（秒）：过期时间按此粒度取整，同一时段内同一张图的URL不变，浏览器缓存仍然有效
+BLOB_URL_TTL_SECONDS = int(os.getenv("BLOB_URL_TTL_SECONDS", "3600"))
+
+_DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# 按文件头识别图片格式
+_MAGIC_TYPES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+    (b"RIFF", "image/webp"),
+)
+
+
+def detect_content_type(data: bytes) -> str:
+    for magic, content_type in _MAGIC_TYPES:
+        if data.startswith(magic):
+            return content_type
+    return "application/octet-stream"
+
+
+def decode_image_base64(image_base64: str) -> bytes:
+    """解码base64图片（兼容 data:image/...;base64, 前缀）"""
+    if image_base64.startswith("data:") and "," in image_base64:
+        image_base64 = image_base64.split(",", 1)[1]
+    return base64.b64decode(image_base64)
+
+
+def make_thumbnail(data: bytes, max_size: int = THUMBNAIL_MAX_SIZE,
+                   quality: int = THUMBNAIL_QUALITY) -> bytes:
+    """生成JPEG缩略图（JPEG原图用draft模式按比例解码，不解码全分辨率）"""
+    img = Image.open(io.BytesIO(data))
+    if img.format == "JPEG":
+        img.draft("RGB", (max_size, max_size))
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+class BlobStore:
+    """
+    内容寻址存储
+
+    - 文件路径：<root>/<前2位>/<3-4位>/<sha256>，元数据在同目录的 <sha256>.json
+    - put() 对相同内容只写一次文件，引用计数 +1
+    - release() 引用计数 -1，归零时删除文件（连同缩略图）
+    - ensure_thumbnail() 为原图生成一次缩略图，缩略图本身也是一个blob，由原图持有引用
+    """
+
+    def __init__(self, root: Path = BLOB_DIR):
+        self.root = Path(root)
+        self._lock = threading.Lock()
+
+    # ---------------- 路径 ----------------
+
+    @staticmethod
+    def is_valid_digest(digest: str) -> bool:
+        return bool(_DIGEST_PATTERN.match(digest or ""))
+
+    def path_for(self, digest: str) -> Path:
+        if not self.is_valid_digest(digest):
+            raise ValueError(f"无效的图片摘要: {digest!r}")
+        return self.root / digest[:2] / digest[2:4] / digest
+
+    @contextmanager
+    def _locked(self, digest: str):
+        """
+        串行化同一摘要的元数据读-改-写：进程内锁 + 分片目录下 .lock 文件的 flock
+
+        元数据文件是原子替换的（inode 会变），所以锁在分片目录固定的 .lock 文件上
+        """
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            lock_path = self.path_for(digest).parent / ".lock"
+            lock_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(lock_path, "a+b") as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _meta_path(self, digest: str) -> Path:
+        return self.path_for(digest).with_suffix(".json")
+
+    def _read_meta(self, digest: str) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(self._meta_path(digest).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, digest: str, meta: Dict[str, Any]):
+        self._atomic_write(self._meta_path(digest), json.dumps(meta).encode("utf-8"))
+
+    @staticmethod
+    def _atomic_write(path: Path, data: bytes):
+        """先写临时文件再重命名，避免读到写了一半的文件"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    # ---------------- 读写 ----------------
+
+    def put(self, data: bytes, content_type: Optional[str] = None) -> str:
+        """保存内容并增加一次引用，返回 sha256 摘要"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest)
+
+        with self._locked(digest):
+            meta = self._read_meta(digest)
+            if meta is None or not path.exists():
+                self._atomic_write(path, data)
+                meta = {
+                    "size": len(data),
+                    "content_type": content_type or detect_content_type(data),
+                    "created_at": datetime.now().isoformat(),
+                    "refs": 0,
+                }
+            meta["refs"] += 1
+            self._write_meta(digest, meta)
+        return digest
+
+    def get(self, digest: str) -> Optional[bytes]:
+        try:
+            return self.path_for(digest).read_bytes()
+        except (OSError, ValueError):
+            return None
+
+    def metadata(self, digest: str) -> Optional[Dict[str, Any]]:
+        if not self.is_valid_digest(digest) or not self.path_for(digest).exists():
+            return None
+        return self._read_meta(digest)
+
+    def release(self, digest: str) -> bool:
+        """减少一次引用，归零时删除文件；返回文件是否被删除"""
+        if not self.is_valid_digest(digest):
+            return False
+        with self._locked(digest):
+            meta = self._read_meta(digest)
+            if meta is None:
+                return False
+            meta["refs"] -= 1
+            if meta["refs"] > 0:
+                self._write_meta(digest, meta)
+                return False
+            for path in (self.path_for(digest), self._meta_path(digest)):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+        if meta.get("thumbnail") not in (None, digest):
+            self.release(meta["thumbnail"])
+        print(f"🗑️ [图片存储] 引用归零，已删除: {digest[:12]}...")
+        return True
+
+    def ensure_thumbnail(self, digest: str) -> Optional[str]:
+        """返回原图的缩略图摘要，没有时生成（每张原图只生成一次）"""
+        meta = self.metadata(digest)
+        if meta is None:
+            return None
+        thumb = meta.get("thumbnail")
+        if thumb and self.path_for(thumb).exists():
+            return thumb
+
+        data = self.get(digest)
+        try:
+            thumb_data = make_thumbnail(data)
+        except Exception as e:
+            print(f"⚠️ [图片存储] 缩略图生成失败 {digest[:12]}...: {e}")
+            return None
+        thumb = self.put(thumb_data, "image/jpeg")
+        if thumb == digest:
+            # 原图本身已足够小，缩略图就是原图（元数据中记录自身，不额外持有引用）
+            self.release(thumb)
+
+        with self._locked(digest):
+            meta = self._read_meta(digest)
+            duplicate = meta is None or meta.get("thumbnail") == thumb
+            if not duplicate:
+                meta["thumbnail"] = thumb
+                self._write_meta(digest, meta)
+        if duplicate and thumb != digest:
+            # 并发生成了同一张缩略图（或原图已被删除），撤销本次引用
+            self.release(thumb)
+        return thumb
+
+
+# 全局存储实例
+blob_store = BlobStore()
+
+
+# ==============================================================================
+# 引用工具函数（数据库 / JSON 中保存 blob:<sha256>）
+# ==============================================================================
+
+def is_blob_ref(value: Optional[str]) -> bool:
+    return bool(value) and value.startswith(BLOB_REF_PREFIX)
+
+
+def ref_digest(value: Optional[str]) -> Optional[str]:
+    """从引用中取出摘要；不是引用时返回 None"""
+    return value[len(BLOB_REF_PREFIX):] if is_blob_ref(value) else None
+
+
+# ==============================================================================
+# 签名URL：图片地址只由已校验归属的接口签发，持有地址即有权在有效期内读取
+# （<img> 标签无法携带 Authorization 头，所以不在 /blobs/ 上做登录校验）
+# ==============================================================================
+
+_url_secret: Optional[bytes] = None
+_url_secret_lock = threading.Lock()
+
+
+def _load_url_secret() -> bytes:
+    """签名密钥：优先读环境变量；否则读取（首次时生成）存储目录下的 .url_secret"""
+    global _url_secret
+    if _url_secret is not None:
+        return _url_secret
+    with _url_secret_lock:
+        if _url_secret is None:
+            if BLOB_URL_SECRET:
+                _url_secret = BLOB_URL_SECRET.encode("utf-8")
+            else:
+                path = blob_store.root / ".url_secret"
+                path.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    # O_EXCL：多个进程同时启动时只有一个能写入，其余读取它写入的密钥
+                    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                    with os.fdopen(fd, "w") as f:
+                        f.write(secrets.token_hex(32))
+                except FileExistsError:
+                    pass
+                secret = ""
+                for _ in range(50):
+                    secret = path.read_text().strip()
+                    if secret:
+                        break
+                    time.sleep(0.01)
+                if not secret:
+                    raise RuntimeError(f"图片URL签名密钥为空: {path}")
+                _url_secret = secret.encode("utf-8")
+    return _url_secret
+
+
+def sign_blob(digest: str, expires: int) -> str:
+    message = f"{digest}:{expires}".encode("utf-8")
+    return hmac.new(_load_url_secret(), message, hashlib.sha256).hexdigest()
+
+
+def verify_blob_signature(digest: str, expires: int, signature: str) -> bool:
+    """签名正确且未过期"""
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(sign_blob(digest, expires), signature or "")
+
+
+def signed_blob_url(digest: str, ttl: int = BLOB_URL_TTL_SECONDS) -> str:
+    """
+    摘要 → 签名URL
+
+    过期时间取整到 ttl 的整数倍（有效期在 ttl ~ 2*ttl 之间），同一时段内URL不变
+    """
+    expires = (int(time.time()) // ttl + 2) * ttl
+    return f"{BLOB_URL_PREFIX}{digest}?expires={expires}&sig={sign_blob(digest, expires)}"
+
+
+def blob_url(value: Optional[str]) -> Optional[str]:
+    """引用 → 图片签名URL（调用方负责确认当前用户可以访问该图片）"""
+    digest = ref_digest(value)
+    return signed_blob_url(digest) if digest else None
+
+
+def store_image_base64(image_base64: Optional[str]) -> Optional[str]:
+    """保存base64图片（可带data URI前缀）并生成缩略图，返回引用；已是引用或为空时原样返回"""
+    if not image_base64 or is_blob_ref(image_base64):
+        return image_base64
+    digest = blob_store.put(decode_image_base64(image_base64))
+    blob_store.ensure_thumbnail(digest)
+    return BLOB_REF_PREFIX + digest
+
+
+def resolve_image_base64(value: Optional[str]) -> str:
+    """
+    引用 → 不带前缀的base64（兼容旧数据：data URI 去掉前缀，纯base64原样返回）
+    """
+    if not value:
+        return ""
+    digest = ref_digest(value)
+    if digest:
+        data = blob_store.get(digest)
+        return base64.b64encode(data).decode("ascii") if data else ""
+    if value.startswith("data:image"):
+        return value.split(",", 1)[1] if "," in value else value
+    return value
+
+
+# 旧数据（内联base64，尚未迁移）的缩略图缓存：按内容摘要为键，不持有原图字符串
+_legacy_thumbnails: "OrderedDict[str, str]" = OrderedDict()
+_legacy_thumbnails_lock = threading.Lock()
+
+
+def _legacy_thumbnail_base64(image_base64: str) -> str:
+    key = hashlib.sha256(image_base64.encode("ascii", "ignore")).hexdigest()
+    with _legacy_thumbnails_lock:
+        if key in _legacy_thumbnails:
+            _legacy_thumbnails.move_to_end(key)
+            return _legacy_thumbnails[key]
+    try:
+        thumb = base64.b64encode(make_thumbnail(decode_image_base64(image_base64))).decode("ascii")
+    except Exception:
+        thumb = ""
+    with _legacy_thumbnails_lock:
+        _legacy_thumbnails[key] = thumb
+        while len(_legacy_thumbnails) > LEGACY_THUMBNAIL_CACHE_SIZE:
+            _legacy_thumbnails.popitem(last=False)
+    return thumb
+
+
+def _thumbnail_digest(value: Optional[str]) -> Optional[str]:
+    """元数据中记录的缩略图摘要（缩略图在保存/迁移时生成，这里不生成）"""
+    meta = blob_store.metadata(ref_digest(value) or "")
+    return meta.get("thumbnail") if meta else None
+
+
+def thumbnail_base64(value: Optional[str]) -> str:
+    """图片引用（或旧数据的内联图片）→ 缩略图base64（没有缩略图时返回空字符串）"""
+    if not value:
+        return ""
+    if not is_blob_ref(value):
+        return _legacy_thumbnail_base64(value)
+    thumb = _thumbnail_digest(value)
+    data = blob_store.get(thumb) if thumb else None
+    return base64.b64encode(data).decode("ascii") if data else ""
+
+
+def thumbnail_url(value: Optional[str]) -> Optional[str]:
+    """图片引用 → 缩略图URL（不生成缩略图，仅在已存在时返回）"""
+    thumb = _thumbnail_digest(value)
+    return signed_blob_url(thumb) if thumb else None
+
+
+def list_image_fields(value: Optional[str]) -> Dict[str, Any]:
+    """
+    列表接口中的图片字段：只返回缩略图和原图地址，原图在打开错题时按地址单独获取
+
+    旧数据（内联base64，尚未迁移到图片存储）没有原图地址，仍返回完整 image_base64
+    """
+    if not value:
+        return {"thumbnail_base64": "", "thumbnail_url": None, "image_url": None}
+    if not is_blob_ref(value):
+        return {
+            "thumbnail_base64": thumbnail_base64(value),
+            "thumbnail_url": None,
+            "image_url": None,
+            "image_base64": resolve_image_base64(value),
+        }
+    return {
+        "thumbnail_base64": thumbnail_base64(value),
+        "thumbnail_url": thumbnail_url(value),
+        "image_url": blob_url(value),
+    }
+
+
+def release_image(value: Optional[str]) -> bool:
+    """释放一次引用（不是引用时忽略）"""
+    digest = ref_digest(value)
+    return blob_store.release(digest) if digest else False
+
+
+# ==============================================================================
+# 图片接口
+# ==============================================================================
+
+blob_router = APIRouter(tags=["图片存储"])
+
+
+@blob_router.get(BLOB_URL_PREFIX + "{digest}")
+def get_blob(digest: str, request: Request, expires: int = 0, sig: str = ""):
+    """
+    按摘要返回图片（流式），只接受列表/详情接口签发的未过期签名URL
+
+    内容由摘要唯一确定：ETag 即摘要；只允许浏览器私有缓存到签名过期
+    """
+    if not verify_blob_signature(digest, expires, sig):
+        raise HTTPException(status_code=403, detail="图片地址无效或已过期")
+
+    meta = blob_store.metadata(digest)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="图片不存在")
+
+    etag = f'"{digest}"'
+    max_age = max(int(expires - time.time()), 0)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={max_age}, immutable",
+    }
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+
+    return FileResponse(
+        blob_store.path_for(digest),
+        media_type=meta.get("content_type", "application/octet-stream"),
+        headers=headers,
+    )
@@ -0,0 +1,183 @@
+# ==============================================================================
+# cancellation.py - 客户端断开时取消请求中的工作
+# 功能：检测客户端断开（关闭App、小程序请求超时），取消排队中的OCR任务、
+#       中止流式大模型响应（关闭上游HTTP流），跳过后续的错题保存
+# 技术：后台轮询 request.is_disconnected() + 线程安全的取消令牌
+# ==============================================================================
+
+import os
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List
+
+from fastapi import Request
+
+
+# 检测客户端断开的轮询间隔（秒）
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "0.5"))
+
+
+class RequestCancelled(Exception):
+    """客户端已断开，请求中的后续工作被放弃"""
+
+    def __init__(self, stage: str):
+        super().__init__(f"客户端已断开，{stage}已取消")
+        self.stage = stage
+
+
+# ==============================================================================
+# 节省工作量统计
+# ==============================================================================
+
+class CancellationStats:
+    """
+    按接口统计因客户端断开而节省的工作
+
+    - requests: 受保护的请求总数
+    - disconnected: 处理过程中客户端断开的请求数
+    - ocr_jobs_cancelled: 仍在排队、被直接取消的OCR任务数
+    - model_streams_aborted: 中途关闭的大模型流式响应数
+    - model_chars_discarded: 中止前已生成（但无人接收）的字符数
+    - persist_skipped: 跳过的错题保存次数
+    """
+
+    COUNTERS = ("requests", "disconnected", "ocr_jobs_cancelled",
+                "model_streams_aborted", "model_chars_discarded", "persist_skipped")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def record(self, endpoint: str, key: str, n: int = 1):
+        with self._lock:
+            counters = self._stats.setdefault(endpoint, dict.fromkeys(self.COUNTERS, 0))
+            counters[key] = counters.get(key, 0) + n
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {endpoint: dict(counters) for endpoint, counters in self._stats.items()}
+
+
+# 全局统计（各入口共用）
+cancel_stats = CancellationStats()
+
+
+# ==============================================================================
+# 取消令牌
+# ==============================================================================
+
+class CancelToken:
+    """
+    单个请求的取消令牌
+
+    - 工作线程通过 cancelled 检查是否需要放弃（线程安全）
+    - add_callback 注册取消时要执行的动作（如取消排队中的OCR Future）
+    - run() 在事件循环中等待一个协程，取消时立即放弃等待
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self._flag = threading.Event()
+        self._event = asyncio.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], Any]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._flag.is_set()
+
+    def cancel(self):
+        """标记取消并执行已注册的回调（只执行一次）"""
+        with self._lock:
+            if self._flag.is_set():
+                return
+            self._flag.set()
+            callbacks, self._callbacks = self._callbacks, []
+        self._event.set()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"⚠️ [请求取消] 取消回调执行失败: {e}")
+
+    def add_callback(self, callback: Callable[[], Any]):
+        """注册取消回调；已取消时立即执行"""
+        with self._lock:
+            if not self._flag.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def record(self, key: str, n: int = 1):
+        """记录本接口节省的工作量"""
+        cancel_stats.record(self.endpoint, key, n)
+
+    def raise_if_cancelled(self, stage: str):
+        if self.cancelled:
+            raise RequestCancelled(stage)
+
+    async def run(self, awaitable: Awaitable[Any], stage: str = "处理") -> Any:
+        """等待协程完成；客户端先断开时取消该协程并抛出 RequestCancelled"""
+        task = asyncio.ensure_future(awaitable)
+        waiter = asyncio.ensure_future(self._event.wait())
+        try:
+            await asyncio.wait({task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            waiter.cancel()
+
+        if task.done():
+            return task.result()
+        task.cancel()
+        # 被放弃的任务可能仍以异常结束，取走结果避免 "exception was never retrieved" 警告
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        raise RequestCancelled(stage)
+
+
+@asynccontextmanager
+async def disconnect_guard(request: Request, endpoint: str,
+                           poll_interval: float = DISCONNECT_POLL_SECONDS) -> AsyncIterator[CancelToken]:
+    """
+    在请求处理期间后台检测客户端是否断开，断开时触发取消令牌
+
+    用法：
+        async with disconnect_guard(http_request, "miniapp") as cancel_token:
+            result = await cancel_token.run(some_coroutine, "模型调用")
+    """
+    token = CancelToken(endpoint)
+    token.record("requests")
+
+    async def _watch():
+        while not token.cancelled:
+            if await request.is_disconnected():
+                print(f"🔌 [请求取消] {endpoint} 客户端已断开，取消剩余工作")
+                token.record("disconnected")
+                token.cancel()
+                return
+            await asyncio.sleep(poll_interval)
+
+    watcher = asyncio.ensure_future(_watch())
+    try:
+        yield token
+    finally:
+        watcher.cancel()
+
+
+def iterate_until_cancelled(stream: Iterable[Any], cancel_token: CancelToken,
+                            stage: str = "模型生成") -> Iterator[Any]:
+    """
+    逐块读取流式响应；请求取消时关闭上游流（释放HTTP连接）并抛出 RequestCancelled
+    """
+    try:
+        for chunk in stream:
+            if cancel_token.cancelled:
+                cancel_token.record("model_streams_aborted")
+                raise RequestCancelled(stage)
+            yield chunk
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
@@ -10,7 +10,7 @@
 """
 
 import os
-from typing import Dict, Any, Literal
+from typing import Dict, Any, Literal, Optional
 from dotenv import load_dotenv
 
 # 加载环境变量
@@ -24,11 +24,15 @@ load_dotenv()
 #ACTIVE_MODEL_KEY = "qwen-vl-max"  # 默认使用闭源基准模型
 
 # 可选模型列表（取消注释以切换）:
- ACTIVE_MODEL_KEY = "qwen3-vl-32b-thinking"
+ACTIVE_MODEL_KEY = "qwen3-vl-32b-thinking"
 # ACTIVE_MODEL_KEY = "qwen3-vl-32b-instruct"
 # ACTIVE_MODEL_KEY = "qwen3-vl-235b-a22b-thinking"
 # ACTIVE_MODEL_KEY = "qwen3-vl-235b-a22b-instruct"
 
+# 解题模型（/chat、/api/solve、小程序、多页作业）：默认仍为 qwen-vl-max，
+# 与上面评测框架使用的 ACTIVE_MODEL_KEY 无关；设置环境变量 SOLVE_MODEL 才会切换
+SOLVE_MODEL = os.getenv("SOLVE_MODEL", "qwen-vl-max")
+
 # ==============================================================================
 # 模型配置字典
 # ==============================================================================
@@ -167,6 +171,29 @@ def get_active_model_config() -> Dict[str, Any]:
     return config
 
 
+def get_solve_model_config() -> Dict[str, Any]:
+    """
+    获取解题模型（SOLVE_MODEL）的配置
+
+    登记在 MODEL_CONFIGS 中的模型按其 type 调用；未登记的模型名按 dashscope_api 调用
+    """
+    return MODEL_CONFIGS.get(SOLVE_MODEL, {"type": "dashscope_api", "model_name": SOLVE_MODEL})
+
+
+def model_needs_local_ocr(model_key: Optional[str] = None) -> bool:
+    """
+    判断调用该模型解题前是否需要先做本地OCR
+    
+    标记了 ocr_enhanced 的模型（235B-A22B系列）直接读原图即可，
+    本地Pix2Text识别只会拖慢首次回答；未登记的模型（如qwen-vl-max）仍需OCR辅助。
+    
+    Args:
+        model_key: 模型KEY，默认使用 ACTIVE_MODEL_KEY
+    """
+    config = MODEL_CONFIGS.get(model_key or ACTIVE_MODEL_KEY, {})
+    return not config.get("ocr_enhanced", False)
+
+
 def get_knowledge_extraction_config() -> Dict[str, Any]:
     """获取知识点提取模型配置"""
     config = KNOWLEDGE_EXTRACTION_CONFIGS[KNOWLEDGE_EXTRACTION_MODEL].copy()
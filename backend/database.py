@@ -3,7 +3,7 @@
 沐梧AI解题系统 - MySQL数据库连接模块 (V25.1)
 ==============================================================================
 功能：
-- 数据库连接池管理
+- 数据库连接池管理（线程安全、有界、空闲校验）
 - 用户认证（注册/登录）
 - 数据CRUD操作
 - 错题与题目管理
@@ -18,13 +18,22 @@
 
 import pymysql
 from pymysql import cursors
+from pymysql.constants import CLIENT
 from contextlib import contextmanager
 from typing import Dict, List, Optional, Any
+import base64
 import hashlib
+import json
 import uuid
 import os
+import time
+import threading
+from collections import OrderedDict, deque
 from datetime import datetime
 
+from blob_store import store_image_base64, list_image_fields, release_image
+from query_profiler import find_caller, profile_connection
+
 # ==============================================================================
 # 数据库配置
 # ==============================================================================
@@ -40,93 +49,312 @@ DB_CONFIG = {
     'autocommit': True,  # 自动提交
     'connect_timeout': 10,  # 连接超时（秒）
     'read_timeout': 30,  # 读取超时（秒）
-    'write_timeout': 30  # 写入超时（秒）
+    'write_timeout': 30,  # 写入超时（秒）
+}
+
+# 多语句连接的配置：只给 execute_batch 专用的连接池使用（错题保存的整个事务一次往返），
+# 普通查询的连接不开启 MULTI_STATEMENTS
+BATCH_DB_CONFIG = {
+    **DB_CONFIG,
+    'client_flag': CLIENT.MULTI_STATEMENTS
 }
 
 # ==============================================================================
 # 连接池管理
 # ==============================================================================
 
+# 连接池上限（同时借出的连接数不超过此值）
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+# 启动后在后台预热的连接数
+DB_POOL_WARM_SIZE = int(os.getenv("DB_POOL_WARM_SIZE", "3"))
+# 池满时等待空闲连接的最长时间（秒）
+DB_POOL_CHECKOUT_TIMEOUT = float(os.getenv("DB_POOL_CHECKOUT_TIMEOUT", "10"))
+# 连接空闲超过此时间才在借出前 ping 一次（秒）
+DB_POOL_VALIDATE_IDLE_SECONDS = float(os.getenv("DB_POOL_VALIDATE_IDLE_SECONDS", "30"))
+# 连接最长使用寿命，超过后关闭重建（需小于 MySQL wait_timeout）
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "3600"))
+# 多语句连接池上限（只用于 execute_batch）
+DB_BATCH_POOL_SIZE = int(os.getenv("DB_BATCH_POOL_SIZE", "4"))
+
+# 连接失效类异常：出现时连接不再放回池中
+_BROKEN_CONNECTION_ERRORS = (pymysql.err.OperationalError, pymysql.err.InterfaceError)
+
+
+class PoolTimeoutError(TimeoutError):
+    """连接池已满，且在等待时间内没有连接被归还"""
+
+
+class _PooledConnection:
+    """池中连接的元数据"""
+
+    __slots__ = ("conn", "created_at", "last_used")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
 class DatabasePool:
     """
-    数据库连接池（简化版）
-    实际生产环境建议使用 DBUtils.PooledDB
+    线程安全的有界连接池
+
+    - 借出的连接总数不超过 pool_size，池满时在等待队列中排队（超时抛出 PoolTimeoutError）
+    - 只有空闲超过 validate_idle_seconds 的连接才在借出前 ping，避免每次查询多一次往返
+    - 超过 max_lifetime 的连接在借出/归还时关闭重建
+    - 不在导入时建连：start_warmup() 在后台线程中预热连接
     """
-    
-    def __init__(self, config: Dict[str, Any], pool_size: int = 5):
+
+    def __init__(
+        self,
+        config: Dict[str, Any],
+        pool_size: int = DB_POOL_SIZE,
+        warm_size: int = DB_POOL_WARM_SIZE,
+        checkout_timeout: float = DB_POOL_CHECKOUT_TIMEOUT,
+        validate_idle_seconds: float = DB_POOL_VALIDATE_IDLE_SECONDS,
+        max_lifetime: float = DB_POOL_MAX_LIFETIME,
+    ):
         self.config = config
         self.pool_size = pool_size
-        self._connections = []
-        self._initialize_pool()
-    
-    def _initialize_pool(self):
-        """初始化连接池"""
+        self.warm_size = min(warm_size, pool_size)
+        self.checkout_timeout = checkout_timeout
+        self.validate_idle_seconds = validate_idle_seconds
+        self.max_lifetime = max_lifetime
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle: deque = deque()
+        self._in_use: Dict[int, _PooledConnection] = {}
+        # 已占用的名额（空闲 + 借出 + 正在建立的连接）
+        self._slots = 0
+        self._waiters = 0
+        self._closed = False
+        self._stats = {
+            "checkouts": 0,
+            "created": 0,
+            "discarded": 0,
+            "validations": 0,
+            "timeouts": 0,
+            "waits": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+        }
+
+    # ---------------- 建立/关闭连接 ----------------
+
+    def _connect(self) -> _PooledConnection:
+        conn = pymysql.connect(**self.config)
+        with self._lock:
+            self._stats["created"] += 1
+        return _PooledConnection(conn)
+
+    def _discard(self, pooled: _PooledConnection):
+        """关闭连接并释放名额（调用方不能持有锁）"""
         try:
-            for _ in range(self.pool_size):
-                conn = pymysql.connect(**self.config)
-                self._connections.append(conn)
-            print(f"✅ 数据库连接池初始化成功 ({self.pool_size}个连接)")
-        except Exception as e:
-            print(f"❌ 数据库连接池初始化失败: {e}")
-            raise
-    
-    def get_connection(self):
-        """获取一个连接（带健康检查）"""
-        # 尝试从池中获取连接
-        while self._connections:
-            conn = self._connections.pop()
-            try:
-                # 检查连接是否仍然有效
-                conn.ping(reconnect=True)
-                return conn
-            except Exception as e:
-                print(f"⚠️  连接失效，已丢弃: {e}")
+            pooled.conn.close()
+        except Exception:
+            pass
+        with self._available:
+            self._slots -= 1
+            self._stats["discarded"] += 1
+            self._available.notify()
+
+    def _expired(self, pooled: _PooledConnection, now: float) -> bool:
+        return now - pooled.created_at > self.max_lifetime
+
+    # ---------------- 借出/归还 ----------------
+
+    def get_connection(self, timeout: Optional[float] = None):
+        """
+        借出一个连接
+
+        优先复用空闲连接；没有空闲连接且未达上限时新建；
+        否则等待其他线程归还，超过 timeout 抛出 PoolTimeoutError
+        """
+        timeout = self.checkout_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        waited_since: Optional[float] = None
+
+        while True:
+            pooled = None
+            create = False
+            with self._available:
+                while True:
+                    if self._closed:
+                        raise RuntimeError("数据库连接池已关闭")
+                    if self._idle:
+                        pooled = self._idle.pop()
+                        break
+                    if self._slots < self.pool_size:
+                        self._slots += 1
+                        create = True
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeoutError(
+                            f"数据库连接池已满（{self.pool_size}个连接），等待 {timeout:.1f}s 后超时"
+                        )
+                    if waited_since is None:
+                        waited_since = time.monotonic()
+                    self._waiters += 1
+                    try:
+                        self._available.wait(remaining)
+                    finally:
+                        self._waiters -= 1
+
+            if create:
                 try:
-                    conn.close()
-                except:
-                    pass
-        
-        # 池耗尽或所有连接失效时创建新连接
-        print("🔄 创建新的数据库连接...")
-        return pymysql.connect(**self.config)
-    
-    def return_connection(self, conn):
-        """归还连接到池（检查连接健康）"""
-        try:
-            # 检查连接是否健康
-            conn.ping(reconnect=False)
-            
-            if len(self._connections) < self.pool_size:
-                self._connections.append(conn)
+                    pooled = self._connect()
+                except Exception:
+                    with self._available:
+                        self._slots -= 1
+                        self._available.notify()
+                    raise
             else:
-                conn.close()
-        except Exception as e:
-            # 连接已失效，直接关闭
-            print(f"⚠️  归还的连接已失效，已丢弃: {e}")
+                now = time.monotonic()
+                if self._expired(pooled, now):
+                    self._discard(pooled)
+                    continue
+                if now - pooled.last_used > self.validate_idle_seconds:
+                    try:
+                        with self._lock:
+                            self._stats["validations"] += 1
+                        pooled.conn.ping(reconnect=False)
+                    except Exception as e:
+                        print(f"⚠️  空闲连接已失效，已丢弃: {e}")
+                        self._discard(pooled)
+                        continue
+
+            with self._lock:
+                self._in_use[id(pooled.conn)] = pooled
+                self._stats["checkouts"] += 1
+                if waited_since is not None:
+                    wait_ms = (time.monotonic() - waited_since) * 1000
+                    self._stats["waits"] += 1
+                    self._stats["wait_ms_total"] += wait_ms
+                    self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], wait_ms)
+            return pooled.conn
+
+    def return_connection(self, conn, broken: bool = False):
+        """
+        归还连接（不做 ping）
+
+        broken=True 或连接已关闭/超过寿命时直接丢弃，名额让给等待者
+        """
+        with self._lock:
+            pooled = self._in_use.pop(id(conn), None)
+        if pooled is None:
+            # 不是本池借出的连接
             try:
                 conn.close()
-            except:
+            except Exception:
                 pass
-    
+            return
+
+        now = time.monotonic()
+        if broken or self._closed or not conn.open or self._expired(pooled, now):
+            self._discard(pooled)
+            return
+
+        pooled.last_used = now
+        with self._available:
+            self._idle.append(pooled)
+            self._available.notify()
+
+    # ---------------- 预热/关闭 ----------------
+
+    def warm_up(self):
+        """建立 warm_size 个空闲连接（失败不抛出，查询时会按需重试建连）"""
+        created = 0
+        for _ in range(self.warm_size):
+            with self._lock:
+                if self._closed or self._slots >= self.warm_size:
+                    break
+                self._slots += 1
+            try:
+                pooled = self._connect()
+            except Exception as e:
+                with self._available:
+                    self._slots -= 1
+                    self._available.notify()
+                print(f"⚠️ 数据库连接池预热失败: {e}")
+                break
+            with self._available:
+                self._idle.append(pooled)
+                self._available.notify()
+            created += 1
+        if created:
+            print(f"✅ 数据库连接池预热完成 ({created}个连接，上限{self.pool_size})")
+
+    def start_warmup(self) -> threading.Thread:
+        """在后台线程中预热，不阻塞启动"""
+        thread = threading.Thread(target=self.warm_up, name="db-pool-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def get_stats(self) -> Dict[str, Any]:
+        """连接池指标"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "pool_size": self.pool_size,
+                "open": self._slots,
+                "idle": len(self._idle),
+                "in_use": len(self._in_use),
+                "waiters": self._waiters,
+            })
+        stats["wait_ms_avg"] = round(stats["wait_ms_total"] / stats["waits"], 2) if stats["waits"] else 0.0
+        stats["wait_ms_total"] = round(stats["wait_ms_total"], 2)
+        stats["wait_ms_max"] = round(stats["wait_ms_max"], 2)
+        return stats
+
     def close_all(self):
-        """关闭所有连接"""
-        for conn in self._connections:
-            conn.close()
-        self._connections.clear()
+        """关闭所有空闲连接；借出中的连接在归还时关闭"""
+        with self._available:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._available.notify_all()
+        for pooled in idle:
+            self._discard(pooled)
 
 
 # 全局连接池实例
 _db_pool: Optional[DatabasePool] = None
+_db_batch_pool: Optional[DatabasePool] = None
+_db_pool_lock = threading.Lock()
 
 
-def init_database_pool():
-    """初始化全局数据库连接池"""
+def init_database_pool(warm_up: bool = True) -> DatabasePool:
+    """创建全局数据库连接池（不阻塞建连，预热在后台线程进行）"""
     global _db_pool
-    if _db_pool is None:
-        _db_pool = DatabasePool(DB_CONFIG)
+    with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = DatabasePool(DB_CONFIG)
+            if warm_up:
+                _db_pool.start_warmup()
     return _db_pool
 
 
+def init_batch_pool() -> DatabasePool:
+    """创建多语句连接池（首次 execute_batch 时按需建连，不预热）"""
+    global _db_batch_pool
+    with _db_pool_lock:
+        if _db_batch_pool is None:
+            _db_batch_pool = DatabasePool(BATCH_DB_CONFIG, pool_size=DB_BATCH_POOL_SIZE, warm_size=0)
+    return _db_batch_pool
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    """全局连接池指标（连接池尚未创建时返回空字典）"""
+    return _db_pool.get_stats() if _db_pool is not None else {}
+
+
+def get_batch_pool_stats() -> Dict[str, Any]:
+    """多语句连接池指标（尚未创建时返回空字典）"""
+    return _db_batch_pool.get_stats() if _db_batch_pool is not None else {}
+
+
 @contextmanager
 def get_db_connection():
     """
@@ -138,14 +366,39 @@ def get_db_connection():
             cursor.execute("SELECT * FROM user")
             results = cursor.fetchall()
     """
-    if _db_pool is None:
-        init_database_pool()
-    
-    conn = _db_pool.get_connection()
-    try:
+    # 调用方要在进入 _checkout 之前解析，否则统计里记到的是 _checkout 所在的这一层
+    with _checkout(_db_pool or init_database_pool(), find_caller()) as conn:
+        yield conn
+
+
+@contextmanager
+def get_batch_connection():
+    """
+    上下文管理器：获取开启了 MULTI_STATEMENTS 的连接，只用于 execute_batch
+
+    用法:
+        with get_batch_connection() as conn:
+            execute_batch(conn.cursor(), statements)
+    """
+    with _checkout(_db_batch_pool or init_batch_pool(), find_caller()) as conn:
         yield conn
+
+
+@contextmanager
+def _checkout(pool: DatabasePool, caller: str):
+    """从指定连接池借出连接，用完归还（出现连接类异常时丢弃）；caller 为借出连接的方法"""
+    checkout_start = time.perf_counter()
+    conn = pool.get_connection()
+    checkout_wait_ms = (time.perf_counter() - checkout_start) * 1000
+    broken = False
+    try:
+        # 借出的连接经 query_profiler 包装，记录每条语句的耗时和调用方法
+        yield profile_connection(conn, checkout_wait_ms, caller)
+    except _BROKEN_CONNECTION_ERRORS:
+        broken = True
+        raise
     finally:
-        _db_pool.return_connection(conn)
+        pool.return_connection(conn, broken=broken)
 
 
 # ==============================================================================
@@ -173,6 +426,523 @@ def generate_subject_id() -> str:
     return str(uuid.uuid4())
 
 
+# ==============================================================================
+# 知识点标签（knowledge_tag / subject_knowledge_tag）
+# ==============================================================================
+# subject.knowledge_points 仍保存JSON原文用于展示；筛选和统计走规范化的标签表
+
+# knowledge_tag.tag_name 的长度上限
+KNOWLEDGE_TAG_MAX_LENGTH = 100
+
+# 按知识点筛选：精确匹配标签（走 uk_tag_subject / uk_subject_tag 索引），不再 LIKE 扫描JSON文本
+KNOWLEDGE_TAG_CONDITION = """ AND EXISTS (
+    SELECT 1 FROM subject_knowledge_tag skt
+    JOIN knowledge_tag kt ON kt.tag_id = skt.tag_id
+    WHERE skt.subject_id = s.subject_id AND kt.tag_name = %s
+)"""
+
+
+def normalize_knowledge_points(knowledge_points: Any) -> List[str]:
+    """知识点（列表或JSON字符串）→ 去空白、去重、保持顺序的标签名列表"""
+    if not knowledge_points:
+        return []
+    if isinstance(knowledge_points, str):
+        try:
+            knowledge_points = json.loads(knowledge_points)
+        except ValueError:
+            return []
+        if isinstance(knowledge_points, str):
+            knowledge_points = [knowledge_points]
+    if not isinstance(knowledge_points, (list, tuple)):
+        return []
+
+    tags: List[str] = []
+    for kp in knowledge_points:
+        name = str(kp).strip()[:KNOWLEDGE_TAG_MAX_LENGTH] if kp is not None else ""
+        if name and name not in tags:
+            tags.append(name)
+    return tags
+
+
+def build_knowledge_tag_statements(
+    subject_id: str,
+    knowledge_points: Any,
+    subject_name: Optional[str] = None,
+    replace: bool = False
+) -> List[tuple]:
+    """
+    写入题目知识点标签的语句（同步/异步共用），返回 [(sql, params), ...]
+
+    - 标签按 (tag_name, subject) 去重插入
+    - 关联行通过一条 INSERT ... SELECT 写入
+    - replace=True 时先删除该题目原有的关联（更新知识点时使用）
+    """
+    tags = normalize_knowledge_points(knowledge_points)
+    subject = subject_name or "未分类"
+    statements: List[tuple] = []
+
+    if replace:
+        statements.append(("DELETE FROM subject_knowledge_tag WHERE subject_id = %s", [subject_id]))
+    if not tags:
+        return statements
+
+    values = ", ".join(["(%s, %s)"] * len(tags))
+    params: List[Any] = []
+    for tag in tags:
+        params.extend([tag, subject])
+    statements.append((
+        f"INSERT IGNORE INTO knowledge_tag (tag_name, subject) VALUES {values}",
+        params
+    ))
+
+    placeholders = ", ".join(["%s"] * len(tags))
+    statements.append((
+        f"""INSERT IGNORE INTO subject_knowledge_tag (subject_id, tag_id)
+            SELECT %s, tag_id FROM knowledge_tag
+            WHERE subject = %s AND tag_name IN ({placeholders})""",
+        [subject_id, subject, *tags]
+    ))
+    return statements
+
+
+def link_knowledge_tags(
+    cursor,
+    subject_id: str,
+    knowledge_points: Any,
+    subject_name: Optional[str] = None,
+    replace: bool = False
+) -> int:
+    """在当前连接中写入题目的知识点标签关联（与题目写入同一连接），返回标签数"""
+    for query, params in build_knowledge_tag_statements(subject_id, knowledge_points, subject_name, replace):
+        cursor.execute(query, params)
+    return len(normalize_knowledge_points(knowledge_points))
+
+
+def build_bulk_knowledge_tag_statements(items: List[tuple]) -> List[tuple]:
+    """
+    多道题目的知识点标签语句（与题目数量无关，固定两条），返回 [(sql, params), ...]
+
+    items: [(subject_id, knowledge_points, subject_name), ...]
+    """
+    tag_rows = []
+    link_rows = []
+    for subject_id, knowledge_points, subject_name in items:
+        subject = subject_name or "未分类"
+        for tag in normalize_knowledge_points(knowledge_points):
+            if (tag, subject) not in tag_rows:
+                tag_rows.append((tag, subject))
+            link_rows.append((subject_id, tag, subject))
+    if not link_rows:
+        return []
+
+    tag_values = ", ".join(["(%s, %s)"] * len(tag_rows))
+    link_values = " UNION ALL ".join(["SELECT %s AS subject_id, %s AS tag_name, %s AS subject"] * len(link_rows))
+    return [
+        (
+            f"INSERT IGNORE INTO knowledge_tag (tag_name, subject) VALUES {tag_values}",
+            [value for row in tag_rows for value in row]
+        ),
+        (
+            f"""INSERT IGNORE INTO subject_knowledge_tag (subject_id, tag_id)
+                SELECT v.subject_id, kt.tag_id
+                FROM ({link_values}) v
+                JOIN knowledge_tag kt ON kt.tag_name = v.tag_name AND kt.subject = v.subject""",
+            [value for row in link_rows for value in row]
+        ),
+    ]
+
+
+def build_top_knowledge_points_query(user_id: str, limit: int = 10) -> tuple:
+    """用户错题中出现最多的知识点（读取 user_knowledge_counter，同步/异步共用），返回 (sql, params)"""
+    query = """
+        SELECT kt.tag_name, SUM(c.total) AS count
+        FROM user_knowledge_counter c
+        JOIN knowledge_tag kt ON kt.tag_id = c.tag_id
+        WHERE c.user_id = %s AND c.subject_type = 'mistake' AND c.total > 0
+        GROUP BY kt.tag_name
+        ORDER BY count DESC, kt.tag_name
+        LIMIT %s
+    """
+    return query, [user_id, limit]
+
+
+def backfill_knowledge_tags(batch_size: int = 200) -> int:
+    """
+    为已有题目补写知识点标签（后台任务，可重复执行）
+
+    按 subject_id 分批扫描有知识点、但还没有任何标签关联的题目，返回处理的题目数
+    """
+    processed = 0
+    last_id = ""
+    while True:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """SELECT s.subject_id, s.subject_name, s.knowledge_points
+                   FROM subject s
+                   WHERE s.subject_id > %s
+                   AND s.knowledge_points IS NOT NULL AND s.knowledge_points <> ''
+                   AND NOT EXISTS (
+                       SELECT 1 FROM subject_knowledge_tag skt WHERE skt.subject_id = s.subject_id
+                   )
+                   ORDER BY s.subject_id
+                   LIMIT %s""",
+                (last_id, batch_size)
+            )
+            rows = cursor.fetchall()
+            for row in rows:
+                if link_knowledge_tags(cursor, row['subject_id'], row['knowledge_points'], row['subject_name']):
+                    processed += 1
+        if len(rows) < batch_size:
+            break
+        last_id = rows[-1]['subject_id']
+
+    if processed:
+        print(f"✅ [知识点标签] 已为 {processed} 道题目补写标签")
+    return processed
+
+
+# ==============================================================================
+# 列表分页（游标 = 最后一条的 created_at + subject_id）
+# ==============================================================================
+
+# 错题列表的窄投影：只取列表需要的列，三个解析字段合并成一列（批改保存时 solve/explanation 内容相同）
+MISTAKE_LIST_COLUMNS = """
+    s.subject_id, s.subject_title, s.subject_desc, s.image_url, s.answer,
+    COALESCE(NULLIF(s.solve, ''), NULLIF(s.explanation, ''), s.mistake_analysis) AS ai_analysis,
+    s.knowledge_points, s.subject_name, s.grade, s.difficulty, s.user_mistake_text,
+    s.review_count, s.last_review_at, s.created_at,
+    (SELECT ue.user_answer FROM user_exam ue
+     WHERE ue.subject_id = s.subject_id AND ue.user_info = %s
+     ORDER BY ue.answered_at DESC LIMIT 1) AS user_answer
+"""
+
+# 题目归属条件：同一用户对同一题可能有多条 user_exam 记录，用 EXISTS（半连接）代替 JOIN，
+# 每道题只返回一行，游标分页不会重复或跳过
+OWNED_BY_USER_CONDITION = """ AND EXISTS (
+    SELECT 1 FROM user_exam ue WHERE ue.subject_id = s.subject_id AND ue.user_info = %s
+)"""
+
+# 游标条件：严格排在上一页最后一条之后（配合 idx_type_created 索引）
+KEYSET_CONDITION = " AND (s.created_at < %s OR (s.created_at = %s AND s.subject_id < %s))"
+KEYSET_ORDER = " ORDER BY s.created_at DESC, s.subject_id DESC LIMIT %s"
+
+
+def encode_page_cursor(created_at: Any, subject_id: str) -> str:
+    """(created_at, subject_id) → 不透明的游标字符串"""
+    if isinstance(created_at, datetime):
+        created_at = created_at.isoformat()
+    raw = f"{created_at}|{subject_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_page_cursor(page_cursor: str) -> tuple:
+    """游标字符串 → (created_at, subject_id)；格式错误时抛出 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(page_cursor + "=" * (-len(page_cursor) % 4)).decode("utf-8")
+        created_at, subject_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), subject_id
+    except Exception:
+        raise ValueError(f"无效的分页游标: {page_cursor!r}")
+
+
+def keyset_params(page_cursor: Optional[str]) -> list:
+    """游标 → KEYSET_CONDITION 的参数"""
+    created_at, subject_id = decode_page_cursor(page_cursor)
+    return [created_at, created_at, subject_id]
+
+
+def next_page_cursor(items: List[Dict[str, Any]], limit: int,
+                     id_key: str = "subject_id") -> Optional[str]:
+    """本页已满时返回下一页游标，否则返回 None（没有更多数据）"""
+    if len(items) < limit or not items:
+        return None
+    last = items[-1]
+    return encode_page_cursor(last["created_at"], last[id_key])
+
+
+def build_subject_count_query(
+    user_id: str,
+    subject_type: str,
+    subject_name: Optional[str] = None,
+    grade: Optional[str] = None,
+    knowledge_point: Optional[str] = None
+) -> tuple:
+    """
+    列表总数查询（同步/异步共用），返回 (sql, params)
+
+    与列表查询使用同一个归属条件（OWNED_BY_USER_CONDITION）和筛选条件，
+    同一道题经多张试卷关联也只算一次，total 与逐页翻完得到的条目数一致
+    """
+    query = """
+        SELECT COUNT(*) AS total
+        FROM subject s
+        WHERE s.subject_type = %s
+    """ + OWNED_BY_USER_CONDITION
+    params: List[Any] = [subject_type, user_id]
+    if subject_name:
+        query += " AND s.subject_name = %s"
+        params.append(subject_name)
+    if grade:
+        query += " AND s.grade = %s"
+        params.append(grade)
+    if knowledge_point:
+        query += KNOWLEDGE_TAG_CONDITION
+        params.append(knowledge_point)
+    return query, params
+
+
+def count_user_subjects(
+    cursor,
+    user_id: str,
+    subject_type: str,
+    subject_name: Optional[str] = None,
+    grade: Optional[str] = None,
+    knowledge_point: Optional[str] = None
+) -> int:
+    """用户题目数（列表接口的 total），口径与列表相同"""
+    cursor.execute(*build_subject_count_query(user_id, subject_type, subject_name, grade, knowledge_point))
+    return int(cursor.fetchone()['total'])
+
+
+def build_mistake_list_query(
+    user_id: str,
+    subject_name: Optional[str] = None,
+    grade: Optional[str] = None,
+    knowledge_point: Optional[str] = None,
+    limit: int = 100,
+    page_cursor: Optional[str] = None
+) -> tuple:
+    """错题列表查询（同步/异步管理器共用），返回 (sql, params)"""
+    query = f"""
+        SELECT {MISTAKE_LIST_COLUMNS}
+        FROM subject s
+        WHERE s.subject_type = 'mistake'
+    """ + OWNED_BY_USER_CONDITION
+    params: List[Any] = [user_id, user_id]
+
+    if subject_name:
+        query += " AND s.subject_name = %s"
+        params.append(subject_name)
+
+    if grade:
+        query += " AND s.grade = %s"
+        params.append(grade)
+
+    if knowledge_point:
+        query += KNOWLEDGE_TAG_CONDITION
+        params.append(knowledge_point)
+
+    if page_cursor:
+        query += KEYSET_CONDITION
+        params.extend(keyset_params(page_cursor))
+
+    query += KEYSET_ORDER
+    params.append(limit)
+    return query, params
+
+
+def format_mistake_row(m: Dict[str, Any]) -> Dict[str, Any]:
+    """把错题查询结果（subject + user_exam）格式化为列表接口返回格式（图片只返回缩略图和原图地址）"""
+    return {
+        "subject_id": m['subject_id'],
+        "question_text": m.get('subject_desc') or m.get('subject_title') or "错题",
+        **list_image_fields(m.get('image_url')),
+        "user_mistake_text": m.get('user_mistake_text') or m.get('user_answer') or "",
+        "correct_answer": m.get('answer') or "",
+        "ai_analysis": m.get('ai_analysis') or m.get('solve') or m.get('explanation') or m.get('mistake_analysis') or "",
+        "knowledge_points": json.loads(m['knowledge_points']) if m.get('knowledge_points') else [],
+        "subject_name": m.get('subject_name') or "未分类",
+        "grade": m.get('grade') or "未分类",
+        "difficulty": m.get('difficulty') or "中等",
+        "review_count": m.get('review_count') or 0,
+        "last_review_at": m['last_review_at'].isoformat() if m.get('last_review_at') else None,
+        "created_at": m['created_at'].isoformat() if m.get('created_at') else "",
+    }
+
+
+# ==============================================================================
+# 错题统计计数（user_subject_counter / user_knowledge_counter，由触发器维护）
+# ==============================================================================
+
+# 对账每批处理的用户数（每批一个只读快照事务，基础表不加锁）
+STATS_RECONCILE_BATCH_USERS = int(os.getenv("STATS_RECONCILE_BATCH_USERS", "200"))
+# 对账的 MySQL 命名锁：多个进程同时到点时只有一个执行
+STATS_RECONCILE_LOCK_NAME = "muwu_stats_reconcile"
+
+# 对账：在一致性快照中按基础表重算一批用户的计数，只修正与计数表不一致的行
+# （统计接口不再聚合基础表，偏差在这里修复）。{users} 为该批用户的 IN 占位符；
+# 与列表的 OWNED_BY_USER_CONDITION 口径一致，按 (用户, 题目) 去重计数
+_RECONCILE_COUNTERS = (
+    {
+        "table": "user_subject_counter",
+        "keys": ("user_id", "subject_type", "subject_name", "grade"),
+        "values": ("total", "reviews"),
+        "expected": """SELECT ue.user_info AS user_id,
+                              COALESCE(s.subject_type, 'practice') AS subject_type,
+                              COALESCE(s.subject_name, '未分类') AS subject_name,
+                              COALESCE(s.grade, '未分类') AS grade,
+                              COUNT(*) AS total,
+                              COALESCE(SUM(s.review_count), 0) AS reviews
+                       FROM (SELECT DISTINCT user_info, subject_id FROM user_exam
+                             WHERE user_info IN ({users})) ue
+                       JOIN subject s ON s.subject_id = ue.subject_id
+                       GROUP BY ue.user_info, COALESCE(s.subject_type, 'practice'),
+                                COALESCE(s.subject_name, '未分类'), COALESCE(s.grade, '未分类')""",
+    },
+    {
+        "table": "user_knowledge_counter",
+        "keys": ("user_id", "subject_type", "tag_id"),
+        "values": ("total",),
+        "expected": """SELECT ue.user_info AS user_id,
+                              COALESCE(s.subject_type, 'practice') AS subject_type,
+                              skt.tag_id,
+                              COUNT(*) AS total
+                       FROM (SELECT DISTINCT user_info, subject_id FROM user_exam
+                             WHERE user_info IN ({users})) ue
+                       JOIN subject s ON s.subject_id = ue.subject_id
+                       JOIN subject_knowledge_tag skt ON skt.subject_id = s.subject_id
+                       GROUP BY ue.user_info, COALESCE(s.subject_type, 'practice'), skt.tag_id""",
+    },
+)
+
+
+def build_mistake_counter_query(user_id: str) -> tuple:
+    """用户错题的计数行（每个 学科 × 年级 一行，同步/异步共用），返回 (sql, params)"""
+    query = """
+        SELECT subject_name, grade, total, reviews
+        FROM user_subject_counter
+        WHERE user_id = %s AND subject_type = 'mistake' AND total > 0
+    """
+    return query, [user_id]
+
+
+def summarize_mistake_counters(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """把计数行汇总为总数、按学科、按年级的统计"""
+    by_subject: Dict[str, Dict[str, int]] = {}
+    grades: Dict[str, int] = {}
+    total = reviews = 0
+    for row in rows:
+        total += row['total']
+        reviews += row['reviews']
+        bucket = by_subject.setdefault(row['subject_name'], {"count": 0, "reviews": 0})
+        bucket["count"] += row['total']
+        bucket["reviews"] += row['reviews']
+        grades[row['grade']] = grades.get(row['grade'], 0) + row['total']
+
+    return {
+        "overall": {
+            "total_mistakes": total,
+            "subject_count": len(by_subject),
+            "grade_count": len(grades),
+            "total_reviews": reviews,
+        },
+        "by_subject": [
+            {
+                "subject_name": name,
+                "count": bucket["count"],
+                "avg_reviews": bucket["reviews"] / bucket["count"],
+            }
+            for name, bucket in sorted(by_subject.items(), key=lambda x: x[1]["count"], reverse=True)
+        ],
+        "grades": grades,
+    }
+
+
+def _reconcile_user_batch(conn, user_ids: List[str]) -> int:
+    """
+    对账一批用户，返回修正的计数行数
+
+    读取在只读一致性快照中进行（普通快照读，不给基础表加共享锁，不阻塞保存错题）；
+    修正时以快照中读到的旧值为条件，期间已被触发器改动的行跳过，留给下次对账
+    """
+    users = ", ".join(["%s"] * len(user_ids))
+    cursor = conn.cursor()
+    snapshots = []
+    cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY")
+    try:
+        for counter in _RECONCILE_COUNTERS:
+            columns = counter["keys"] + counter["values"]
+            cursor.execute(counter["expected"].format(users=users), user_ids)
+            expected = {tuple(r[k] for k in counter["keys"]): tuple(r[v] for v in counter["values"])
+                        for r in cursor.fetchall()}
+            cursor.execute(
+                f"SELECT {', '.join(columns)} FROM {counter['table']} WHERE user_id IN ({users})", user_ids
+            )
+            current = {tuple(r[k] for k in counter["keys"]): tuple(r[v] for v in counter["values"])
+                       for r in cursor.fetchall()}
+            snapshots.append((counter, expected, current))
+    finally:
+        conn.commit()
+
+    repaired = 0
+    for counter, expected, current in snapshots:
+        zero = (0,) * len(counter["values"])
+        updates, inserts = [], []
+        for key in expected.keys() | current.keys():
+            want = expected.get(key, zero)
+            have = current.get(key)
+            if have is None:
+                if want != zero:
+                    inserts.append(key + want)
+            elif have != want:
+                updates.append(want + key + have)
+        if updates:
+            assignments = ", ".join(f"{v} = %s" for v in counter["values"])
+            conditions = " AND ".join(f"{c} = %s" for c in counter["keys"] + counter["values"])
+            cursor.executemany(f"UPDATE {counter['table']} SET {assignments} WHERE {conditions}", updates)
+            repaired += cursor.rowcount
+        if inserts:
+            columns = counter["keys"] + counter["values"]
+            # IGNORE：快照之后触发器已插入该行时跳过
+            cursor.executemany(
+                f"INSERT IGNORE INTO {counter['table']} ({', '.join(columns)}) "
+                f"VALUES ({', '.join(['%s'] * len(columns))})",
+                inserts
+            )
+            repaired += cursor.rowcount
+    return repaired
+
+
+def reconcile_stat_counters(conn=None, batch_users: int = STATS_RECONCILE_BATCH_USERS) -> int:
+    """
+    对账任务：按基础表重算计数表，修复偏差（如外键级联删除不触发触发器造成的偏差）
+
+    按用户分批（用户ID键集分页），每批一个短的只读快照；conn 为空时从连接池借出。
+    返回修正的计数行数（0 表示没有偏差）
+    """
+    if conn is None:
+        with get_db_connection() as pooled:
+            cursor = pooled.cursor()
+            # 多个进程都开启定期对账时，同一时间只有一个在执行
+            cursor.execute("SELECT GET_LOCK(%s, 0) AS locked", (STATS_RECONCILE_LOCK_NAME,))
+            if not cursor.fetchone()['locked']:
+                print("⏭️ [统计对账] 其他进程正在对账，跳过本次")
+                return 0
+            try:
+                return reconcile_stat_counters(pooled, batch_users)
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (STATS_RECONCILE_LOCK_NAME,))
+
+    repaired = 0
+    last_user = ""
+    cursor = conn.cursor()
+    while True:
+        cursor.execute(
+            "SELECT user_id FROM user WHERE user_id > %s ORDER BY user_id LIMIT %s",
+            (last_user, batch_users)
+        )
+        user_ids = [row['user_id'] for row in cursor.fetchall()]
+        if not user_ids:
+            break
+        last_user = user_ids[-1]
+        repaired += _reconcile_user_batch(conn, user_ids)
+
+    if repaired:
+        print(f"🔧 [统计对账] 修正计数行数: {repaired}")
+    return repaired
+
+
 # ==============================================================================
 # 用户管理
 # ==============================================================================
@@ -323,10 +1093,80 @@ class SubjectManager:
                 (subject_id, subject_title, subject_desc, image_url, solve, answer,
                  subject_type, subject_name, knowledge_points, difficulty, grade)
             )
+            link_knowledge_tags(cursor, subject_id, knowledge_points, subject_name)
             
             print(f"✅ 题目创建成功: {subject_id} ({subject_type or '普通题目'})")
             return subject_id
     
+    @staticmethod
+    def create_subjects_bulk(
+        user_id: str,
+        exam_id: str,
+        subjects: List[Dict[str, Any]],
+        status: Optional[str] = None
+    ) -> List[str]:
+        """
+        批量创建题目并关联到用户和试卷（一个事务，往返次数与题目数量无关）
+        
+        Args:
+            user_id: 用户ID
+            exam_id: 试卷ID
+            subjects: 题目字典列表（列名见 SUBJECT_COLUMNS，knowledge_points 可以是列表）
+            status: user_exam 的状态（可选，不传使用表默认值）
+        
+        Returns:
+            subject_id 列表（与 subjects 顺序一致）
+        """
+        if not subjects:
+            return []
+        
+        rows = []
+        tag_items = []
+        for subject in subjects:
+            row = dict(subject)
+            knowledge_points = row.get("knowledge_points")
+            if isinstance(knowledge_points, (list, tuple)):
+                row["knowledge_points"] = json.dumps(list(knowledge_points), ensure_ascii=False) if knowledge_points else None
+            row.setdefault("subject_id", generate_subject_id())
+            rows.append(row)
+            tag_items.append((row["subject_id"], knowledge_points, row.get("subject_name")))
+        
+        # executemany 要求每行列相同：取所有行的列并集，缺失的列写 NULL
+        columns = [c for c in SUBJECT_COLUMNS if any(c in row for row in rows)]
+        unknown = {c for row in rows for c in row} - set(columns)
+        if unknown:
+            raise ValueError(f"未知的题目字段: {sorted(unknown)}")
+        subject_ids = [row["subject_id"] for row in rows]
+        
+        link_columns = ["id", "user_info", "subject_id", "exam_id"] + (["status"] if status else [])
+        link_rows = [
+            [str(uuid.uuid4()), user_id, subject_id, exam_id] + ([status] if status else [])
+            for subject_id in subject_ids
+        ]
+        
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            conn.begin()
+            try:
+                # executemany 会把多行 INSERT ... VALUES 合并为一条语句发送
+                cursor.executemany(
+                    f"INSERT INTO subject ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})",
+                    [[row.get(c) for c in columns] for row in rows]
+                )
+                cursor.executemany(
+                    f"INSERT INTO user_exam ({', '.join(link_columns)}) VALUES ({', '.join(['%s'] * len(link_columns))})",
+                    link_rows
+                )
+                for query, params in build_bulk_knowledge_tag_statements(tag_items):
+                    cursor.execute(query, params)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        
+        print(f"✅ 批量创建题目成功: {len(subject_ids)} 道")
+        return subject_ids
+    
     @staticmethod
     def get_subject(subject_id: str) -> Optional[Dict[str, Any]]:
         """获取题目详情"""
@@ -441,6 +1281,30 @@ class ExamManager:
 # 对话历史管理 (V25.2新增)
 # ==============================================================================
 
+# 对话查询（同步/异步管理器和 db_benchmark 共用）
+CHAT_HISTORY_QUERY = """SELECT id, write_id, role, content, image_url, message_type, created_at
+                        FROM chat_history
+                        WHERE session_id = %s
+                        ORDER BY created_at ASC
+                        LIMIT %s"""
+
+# 最近的 limit 条（倒序取出，调用方再反转为升序）
+CHAT_RECENT_HISTORY_QUERY = """SELECT id, write_id, role, content, image_url, message_type, created_at
+                               FROM chat_history
+                               WHERE session_id = %s
+                               ORDER BY created_at DESC, id DESC
+                               LIMIT %s"""
+
+CHAT_USER_SESSIONS_QUERY = """SELECT session_id, title, mode, subject, grade, created_at, updated_at
+                              FROM chat_session
+                              WHERE user_id = %s AND is_deleted = 0
+                              ORDER BY updated_at DESC
+                              LIMIT %s"""
+
+CHAT_SESSION_INFO_QUERY = """SELECT * FROM chat_session
+                             WHERE session_id = %s AND is_deleted = 0"""
+
+
 class ChatManager:
     """对话历史管理类"""
     
@@ -521,14 +1385,7 @@ class ChatManager:
         with get_db_connection() as conn:
             cursor = conn.cursor()
             
-            cursor.execute(
-                """SELECT id, role, content, image_url, message_type, created_at
-                   FROM chat_history
-                   WHERE session_id = %s
-                   ORDER BY created_at ASC
-                   LIMIT %s""",
-                (session_id, limit)
-            )
+            cursor.execute(CHAT_HISTORY_QUERY, (session_id, limit))
             
             return cursor.fetchall()
     
@@ -547,14 +1404,7 @@ class ChatManager:
         with get_db_connection() as conn:
             cursor = conn.cursor()
             
-            cursor.execute(
-                """SELECT session_id, title, mode, subject, grade, created_at, updated_at
-                   FROM chat_session
-                   WHERE user_id = %s AND is_deleted = 0
-                   ORDER BY updated_at DESC
-                   LIMIT %s""",
-                (user_id, limit)
-            )
+            cursor.execute(CHAT_USER_SESSIONS_QUERY, (user_id, limit))
             
             return cursor.fetchall()
     
@@ -603,15 +1453,184 @@ class ChatManager:
         with get_db_connection() as conn:
             cursor = conn.cursor()
             
-            cursor.execute(
-                """SELECT * FROM chat_session 
-                   WHERE session_id = %s AND is_deleted = 0""",
-                (session_id,)
-            )
+            cursor.execute(CHAT_SESSION_INFO_QUERY, (session_id,))
             
             return cursor.fetchone()
 
 
+# ==============================================================================
+# 错题持久化（单事务、一次往返）
+# ==============================================================================
+
+# 用户 → 错题本试卷ID 映射的缓存上限（用户数）
+MISTAKE_BOOK_CACHE_SIZE = int(os.getenv("MISTAKE_BOOK_CACHE_SIZE", "10000"))
+
+# 允许写入的 subject 列（调用方传入的字典只能包含这些列）
+SUBJECT_COLUMNS = (
+    "subject_id", "subject_title", "subject_desc", "image_url", "solve", "answer",
+    "explanation", "knowledge_points", "subject_type", "subject_name", "grade",
+    "difficulty", "user_mistake_text", "mistake_analysis", "created_at",
+)
+
+
+class MistakeBookCache:
+    """
+    用户错题本试卷ID的LRU缓存（对应 user_mistake_book 表，user_id 唯一）
+
+    命中时保存错题不再查询错题本；映射只在首次保存时创建，之后不会变化
+    """
+
+    def __init__(self, max_size: int = MISTAKE_BOOK_CACHE_SIZE):
+        self.max_size = max_size
+        self._items: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str) -> Optional[str]:
+        with self._lock:
+            exam_id = self._items.get(user_id)
+            if exam_id is not None:
+                self._items.move_to_end(user_id)
+            return exam_id
+
+    def put(self, user_id: str, exam_id: str):
+        with self._lock:
+            self._items[user_id] = exam_id
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._items.pop(user_id, None)
+
+
+# 全局缓存（同步/异步保存共用）
+mistake_book_cache = MistakeBookCache()
+
+MISTAKE_BOOK_QUERY = "SELECT exam_id FROM user_mistake_book WHERE user_id = %s"
+
+
+def prepare_mistake_subject(subject: Dict[str, Any], knowledge_points: Optional[List[str]]) -> Dict[str, Any]:
+    """补全错题的 subject 行：生成ID、默认类型、知识点JSON；校验列名"""
+    row = {key: value for key, value in subject.items() if value is not None}
+    unknown = set(row) - set(SUBJECT_COLUMNS)
+    if unknown:
+        raise ValueError(f"未知的题目字段: {sorted(unknown)}")
+    row.setdefault("subject_id", generate_subject_id())
+    row.setdefault("subject_type", "mistake")
+    if knowledge_points and "knowledge_points" not in row:
+        row["knowledge_points"] = json.dumps(knowledge_points, ensure_ascii=False)
+    return row
+
+
+def build_mistake_persist_statements(
+    user_id: str,
+    subject: Dict[str, Any],
+    exam_id: str,
+    knowledge_points: Optional[List[str]] = None,
+    user_answer: Optional[str] = None,
+    status: str = "incorrect",
+    new_book_title: Optional[str] = None
+) -> List[tuple]:
+    """
+    保存一道错题的全部语句（同步/异步共用），返回 [(sql, params), ...]
+
+    START TRANSACTION → [新建错题本 + 映射] → subject → 知识点标签 → user_exam → COMMIT
+    new_book_title 不为空表示该用户还没有错题本，在同一事务中创建
+    """
+    statements: List[tuple] = [("START TRANSACTION", [])]
+
+    if new_book_title:
+        statements.append((
+            """INSERT INTO exam (exam_id, exam_title, exam_type, exam_content, subject, grade)
+               VALUES (%s, %s, 'mistake_book', '自动收集的错题', %s, %s)""",
+            [exam_id, new_book_title, subject.get("subject_name"), subject.get("grade")]
+        ))
+        statements.append((
+            "INSERT INTO user_mistake_book (user_id, exam_id) VALUES (%s, %s)",
+            [user_id, exam_id]
+        ))
+
+    columns = list(subject)
+    statements.append((
+        f"INSERT INTO subject ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})",
+        [subject[c] for c in columns]
+    ))
+    statements.extend(build_knowledge_tag_statements(
+        subject["subject_id"], knowledge_points, subject.get("subject_name")
+    ))
+    statements.append((
+        """INSERT INTO user_exam (id, user_info, subject_id, exam_id, user_answer, status)
+           VALUES (%s, %s, %s, %s, %s, %s)""",
+        [str(uuid.uuid4()), user_id, subject["subject_id"], exam_id, user_answer, status]
+    ))
+    statements.append(("COMMIT", []))
+    return statements
+
+
+def join_statements(statements: List[tuple]) -> tuple:
+    """多条 (sql, params) 拼成一次发送的 (sql, params)"""
+    return ";\n".join(query for query, _ in statements), [p for _, params in statements for p in params]
+
+
+def execute_batch(cursor, statements: List[tuple]):
+    """
+    多条语句一次发送（一次网络往返），逐个读取结果；任一条出错时抛出异常
+
+    cursor 必须来自 get_batch_connection()（普通连接未开启 MULTI_STATEMENTS）
+    """
+    cursor.execute(*join_statements(statements))
+    while cursor.nextset():
+        pass
+
+
+def persist_mistake(
+    user_id: str,
+    subject: Dict[str, Any],
+    knowledge_points: Optional[List[str]] = None,
+    user_answer: Optional[str] = None,
+    status: str = "incorrect",
+    book_title: Optional[str] = None
+) -> str:
+    """
+    在一个事务中保存错题（题目、知识点标签、错题本关联），返回 subject_id
+
+    - 错题本通过 user_mistake_book 映射查找（缓存命中时不查询），
+      整个事务一次发送，通常只需一次数据库往返
+    - 用户首次保存时在同一事务中创建错题本；并发首次保存撞上唯一键时重新查询映射后重试
+    """
+    row = prepare_mistake_subject(subject, knowledge_points)
+
+    with get_batch_connection() as conn:
+        cursor = conn.cursor()
+        for attempt in range(2):
+            exam_id = mistake_book_cache.get(user_id)
+            if exam_id is None:
+                cursor.execute(MISTAKE_BOOK_QUERY, (user_id,))
+                found = cursor.fetchone()
+                exam_id = found['exam_id'] if found else None
+            new_book_title = None if exam_id else (book_title or f"{user_id}_错题本")
+            exam_id = exam_id or generate_exam_id()
+
+            try:
+                execute_batch(cursor, build_mistake_persist_statements(
+                    user_id, row, exam_id, knowledge_points, user_answer, status, new_book_title
+                ))
+            except pymysql.IntegrityError:
+                conn.rollback()
+                # 缓存的错题本已失效，或并发请求已创建错题本：重新查询映射后重试一次
+                mistake_book_cache.invalidate(user_id)
+                if attempt:
+                    raise
+                continue
+            except Exception:
+                conn.rollback()
+                raise
+
+            mistake_book_cache.put(user_id, exam_id)
+            return row["subject_id"]
+
+
 # ==============================================================================
 # 错题本管理增强 (V25.2新增)
 # ==============================================================================
@@ -632,7 +1651,8 @@ class MistakeManager:
         subject_name: str = "未分类",
         grade: str = "未分类",
         difficulty: str = "中等",
-        mistake_analysis: Optional[str] = None
+        mistake_analysis: Optional[str] = None,
+        image_base64: Optional[str] = None
     ) -> str:
         """
         保存错题到错题本
@@ -650,64 +1670,41 @@ class MistakeManager:
             grade: 年级
             difficulty: 难度
             mistake_analysis: 错题分析
+            image_base64: 题目图片base64（存入图片存储，image_url 只保存引用）
         
         Returns:
             subject_id: 题目ID
         """
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            
-            subject_id = generate_subject_id()
-            exam_id = generate_exam_id()
-            
-            # 转换知识点为JSON格式
-            import json
-            knowledge_points_json = json.dumps(knowledge_points, ensure_ascii=False) if knowledge_points else None
-            
-            # 1. 创建题目
-            cursor.execute(
-                """INSERT INTO subject (
-                    subject_id, subject_title, subject_desc, image_url, 
-                    answer, explanation, knowledge_points,
-                    subject_type, subject_name, grade, difficulty,
-                    user_mistake_text, mistake_analysis, solve
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
-                (
-                    subject_id, subject_title, subject_desc, image_url,
-                    correct_answer, explanation, knowledge_points_json,
-                    'mistake', subject_name, grade, difficulty,
-                    user_mistake_text, mistake_analysis, explanation  # solve字段也存解析
-                )
-            )
-            
-            # 2. 创建错题本试卷（如果不存在）
-            cursor.execute(
-                """SELECT exam_id FROM exam 
-                   WHERE exam_type = 'mistake_book' AND exam_title = %s
-                   LIMIT 1""",
-                (f"{user_id}_错题本",)
-            )
-            existing_exam = cursor.fetchone()
-            
-            if existing_exam:
-                exam_id = existing_exam['exam_id']
-            else:
-                cursor.execute(
-                    """INSERT INTO exam (exam_id, exam_title, exam_type, exam_content, subject, grade)
-                       VALUES (%s, %s, 'mistake_book', '自动收集的错题', %s, %s)""",
-                    (exam_id, f"{user_id}_错题本", subject_name, grade)
-                )
-            
-            # 3. 关联用户-试卷-题目
-            record_id = str(uuid.uuid4())
-            cursor.execute(
-                """INSERT INTO user_exam (id, user_info, subject_id, exam_id, user_answer, status)
-                   VALUES (%s, %s, %s, %s, %s, 'incorrect')""",
-                (record_id, user_id, subject_id, exam_id, user_mistake_text)
+        stored_image = store_image_base64(image_base64) if image_base64 else None
+        if stored_image:
+            image_url = stored_image
+
+        try:
+            subject_id = persist_mistake(
+                user_id,
+                {
+                    "subject_title": subject_title,
+                    "subject_desc": subject_desc,
+                    "image_url": image_url,
+                    "answer": correct_answer,
+                    "explanation": explanation,
+                    "solve": explanation,  # solve字段也存解析
+                    "subject_name": subject_name,
+                    "grade": grade,
+                    "difficulty": difficulty,
+                    "user_mistake_text": user_mistake_text,
+                    "mistake_analysis": mistake_analysis,
+                },
+                knowledge_points=knowledge_points,
+                user_answer=user_mistake_text
             )
-            
-            print(f"✅ 错题保存成功: {subject_id} - {subject_title[:30]}")
-            return subject_id
+        except Exception:
+            # 保存失败时撤销本次图片引用，避免引用计数泄漏
+            release_image(stored_image)
+            raise
+        
+        print(f"✅ 错题保存成功: {subject_id} - {subject_title[:30]}")
+        return subject_id
     
     @staticmethod
     def get_user_mistakes(
@@ -715,10 +1712,11 @@ class MistakeManager:
         subject_name: Optional[str] = None,
         grade: Optional[str] = None,
         knowledge_point: Optional[str] = None,
-        limit: int = 100
+        limit: int = 100,
+        page_cursor: Optional[str] = None
     ) -> List[Dict[str, Any]]:
         """
-        获取用户的错题列表（支持筛选）
+        获取用户的错题列表（支持筛选和游标分页）
         
         Args:
             user_id: 用户ID
@@ -726,71 +1724,77 @@ class MistakeManager:
             grade: 年级（可选）
             knowledge_point: 知识点（可选）
             limit: 返回数量限制
+            page_cursor: 上一页返回的游标（可选，不传为第一页）
         
         Returns:
-            错题列表
+            错题列表（按创建时间倒序）
         """
+        query, params = build_mistake_list_query(
+            user_id, subject_name, grade, knowledge_point, limit, page_cursor
+        )
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            
-            query = """
-                SELECT DISTINCT s.*, ue.user_answer, ue.answered_at
-                FROM subject s
-                JOIN user_exam ue ON s.subject_id = ue.subject_id
-                WHERE ue.user_info = %s 
-                AND s.subject_type = 'mistake'
-            """
-            params = [user_id]
-            
-            if subject_name:
-                query += " AND s.subject_name = %s"
-                params.append(subject_name)
-            
-            if grade:
-                query += " AND s.grade = %s"
-                params.append(grade)
-            
-            if knowledge_point:
-                query += " AND s.knowledge_points LIKE %s"
-                params.append(f"%{knowledge_point}%")
-            
-            query += " ORDER BY ue.answered_at DESC LIMIT %s"
-            params.append(limit)
-            
             cursor.execute(query, params)
             raw_mistakes = cursor.fetchall()
-            
-            # 【修复】格式化返回数据，确保包含完整图片和解析
-            import json
-            formatted_mistakes = []
-            for m in raw_mistakes:
-                # 提取完整的图片base64（移除data URI前缀）
-                image_data = ""
-                if m.get('image_url'):
-                    if m['image_url'].startswith('data:image'):
-                        # 移除 "data:image/jpeg;base64," 前缀
-                        image_data = m['image_url'].split(',', 1)[1] if ',' in m['image_url'] else m['image_url']
-                    else:
-                        image_data = m['image_url']
+        
+        # 【修复】格式化返回数据，确保包含完整图片和解析
+        return [format_mistake_row(m) for m in raw_mistakes]
+    
+    @staticmethod
+    def count_user_mistakes(
+        user_id: str,
+        subject_name: Optional[str] = None,
+        grade: Optional[str] = None,
+        knowledge_point: Optional[str] = None
+    ) -> int:
+        """错题总数：与错题列表相同的归属和筛选条件"""
+        with get_db_connection() as conn:
+            return count_user_subjects(conn.cursor(), user_id, 'mistake', subject_name, grade, knowledge_point)
+    
+    @staticmethod
+    def migrate_inline_images(batch_size: int = 20) -> int:
+        """
+        把旧数据中内联在 subject.image_url 的 data URI 图片迁移到图片存储（同时生成缩略图）
+
+        分批读取，避免一次拉取全部大字段；返回迁移条数
+        """
+        migrated = 0
+        last_id = ""
+        while True:
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """SELECT subject_id, image_url FROM subject
+                       WHERE image_url LIKE 'data:image%%' AND subject_id > %s
+                       ORDER BY subject_id
+                       LIMIT %s""",
+                    (last_id, batch_size)
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    break
                 
-                formatted_mistakes.append({
-                    "subject_id": m['subject_id'],
-                    "question_text": m.get('subject_desc') or m.get('subject_title') or "错题",
-                    "image_base64": image_data,
-                    "image_url": m.get('image_url'),  # 保留原始URL
-                    "user_mistake_text": m.get('user_mistake_text') or m.get('user_answer') or "",
-                    "correct_answer": m.get('answer') or "",
-                    "ai_analysis": m.get('solve') or m.get('explanation') or m.get('mistake_analysis') or "",
-                    "knowledge_points": json.loads(m['knowledge_points']) if m.get('knowledge_points') else [],
-                    "subject_name": m.get('subject_name') or "未分类",
-                    "grade": m.get('grade') or "未分类",
-                    "difficulty": m.get('difficulty') or "中等",
-                    "review_count": m.get('review_count') or 0,
-                    "last_review_at": m['last_review_at'].isoformat() if m.get('last_review_at') else None,
-                    "created_at": m['created_at'].isoformat() if m.get('created_at') else "",
-                })
-            
-            return formatted_mistakes
+                for row in rows:
+                    last_id = row['subject_id']
+                    try:
+                        image_ref = store_image_base64(row['image_url'])
+                    except Exception as e:
+                        # 旧版本截断保存的图片无法解码，保留原值
+                        print(f"⚠️ [图片存储] 题目 {last_id} 的图片无法迁移: {e}")
+                        continue
+                    try:
+                        cursor.execute(
+                            "UPDATE subject SET image_url = %s WHERE subject_id = %s",
+                            (image_ref, last_id)
+                        )
+                    except Exception:
+                        release_image(image_ref)
+                        raise
+                    migrated += 1
+        
+        if migrated:
+            print(f"✅ [图片存储] 已迁移 {migrated} 道题目的内联图片")
+        return migrated
     
     @staticmethod
     def update_review_status(subject_id: str) -> bool:
@@ -808,45 +1812,24 @@ class MistakeManager:
             
             return cursor.rowcount > 0
     
+    @staticmethod
+    def get_top_knowledge_points(user_id: str, limit: int = 10) -> List[tuple]:
+        """用户错题中出现最多的知识点，返回 [(知识点, 错题数), ...]"""
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(*build_top_knowledge_points_query(user_id, limit))
+            return [(row['tag_name'], int(row['count'])) for row in cursor.fetchall()]
+    
     @staticmethod
     def get_mistake_stats(user_id: str) -> Dict[str, Any]:
-        """获取用户错题统计"""
+        """获取用户错题统计（读取计数表，不聚合题目表）"""
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            
-            # 总体统计
-            cursor.execute(
-                """SELECT 
-                    COUNT(*) as total_mistakes,
-                    COUNT(DISTINCT s.subject_name) as subject_count,
-                    COUNT(DISTINCT s.grade) as grade_count,
-                    SUM(s.review_count) as total_reviews
-                FROM subject s
-                JOIN user_exam ue ON s.subject_id = ue.subject_id
-                WHERE ue.user_info = %s AND s.subject_type = 'mistake'""",
-                (user_id,)
-            )
-            overall = cursor.fetchone()
-            
-            # 按学科统计
-            cursor.execute(
-                """SELECT 
-                    s.subject_name,
-                    COUNT(*) as count,
-                    AVG(s.review_count) as avg_reviews
-                FROM subject s
-                JOIN user_exam ue ON s.subject_id = ue.subject_id
-                WHERE ue.user_info = %s AND s.subject_type = 'mistake'
-                GROUP BY s.subject_name
-                ORDER BY count DESC""",
-                (user_id,)
-            )
-            by_subject = cursor.fetchall()
-            
-            return {
-                "overall": overall,
-                "by_subject": by_subject
-            }
+            cursor.execute(*build_mistake_counter_query(user_id))
+            stats = summarize_mistake_counters(cursor.fetchall())
+            cursor.execute(*build_top_knowledge_points_query(user_id))
+            stats["top_knowledge_points"] = [(row['tag_name'], int(row['count'])) for row in cursor.fetchall()]
+            return stats
 
 
 # ==============================================================================
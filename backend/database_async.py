@@ -0,0 +1,506 @@
+"""
+==============================================================================
+沐梧AI解题系统 - 异步MySQL数据访问层
+==============================================================================
+功能：
+- 基于 aiomysql 的独立异步连接池（与 database.DatabasePool 互不占用）
+- UserManager / ChatManager / MistakeManager 的异步版本，接口与同步版本一致
+- 在 async 接口中使用，数据库往返期间不阻塞事件循环，
+  一个 worker 可以同时处理大模型流式响应和大量数据库请求
+
+用法：
+    from database_async import AsyncChatManager
+    history = await AsyncChatManager.get_session_history(session_id, limit=10)
+==============================================================================
+"""
+
+import os
+import asyncio
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import aiomysql
+import pymysql
+
+from database import (
+    DB_CONFIG,
+    BATCH_DB_CONFIG,
+    DB_POOL_MAX_LIFETIME,
+    hash_password,
+    generate_user_id,
+    generate_exam_id,
+    format_mistake_row,
+    build_mistake_list_query,
+    build_subject_count_query,
+    build_top_knowledge_points_query,
+    build_mistake_counter_query,
+    summarize_mistake_counters,
+    mistake_book_cache,
+    prepare_mistake_subject,
+    build_mistake_persist_statements,
+    join_statements,
+    MISTAKE_BOOK_QUERY,
+    CHAT_HISTORY_QUERY,
+    CHAT_RECENT_HISTORY_QUERY,
+    CHAT_USER_SESSIONS_QUERY,
+    CHAT_SESSION_INFO_QUERY,
+)
+from blob_store import store_image_base64, release_image
+
+# ==============================================================================
+# 连接池
+# ==============================================================================
+
+# 异步连接池大小（连接不占线程，可以比同步连接池大）
+ASYNC_DB_POOL_MIN_SIZE = int(os.getenv("ASYNC_DB_POOL_MIN_SIZE", "2"))
+ASYNC_DB_POOL_MAX_SIZE = int(os.getenv("ASYNC_DB_POOL_MAX_SIZE", "20"))
+# 多语句连接池上限（只用于 execute_batch_async）
+ASYNC_DB_BATCH_POOL_SIZE = int(os.getenv("ASYNC_DB_BATCH_POOL_SIZE", "5"))
+
+_async_pool: Optional[aiomysql.Pool] = None
+_async_batch_pool: Optional[aiomysql.Pool] = None
+_async_pool_lock = asyncio.Lock()
+
+
+async def _create_pool(minsize: int, maxsize: int, client_flag: int = 0) -> aiomysql.Pool:
+    return await aiomysql.create_pool(
+        host=DB_CONFIG['host'],
+        port=DB_CONFIG['port'],
+        user=DB_CONFIG['user'],
+        password=DB_CONFIG['password'],
+        db=DB_CONFIG['database'],
+        charset=DB_CONFIG['charset'],
+        autocommit=DB_CONFIG['autocommit'],
+        client_flag=client_flag,
+        connect_timeout=DB_CONFIG['connect_timeout'],
+        cursorclass=aiomysql.DictCursor,
+        minsize=minsize,
+        maxsize=maxsize,
+        pool_recycle=int(DB_POOL_MAX_LIFETIME),
+    )
+
+
+async def init_async_pool() -> aiomysql.Pool:
+    """创建全局异步连接池（首次使用时自动调用）"""
+    global _async_pool
+    async with _async_pool_lock:
+        if _async_pool is None:
+            _async_pool = await _create_pool(ASYNC_DB_POOL_MIN_SIZE, ASYNC_DB_POOL_MAX_SIZE)
+            print(f"✅ 异步数据库连接池初始化成功 (上限{ASYNC_DB_POOL_MAX_SIZE}个连接)")
+    return _async_pool
+
+
+async def init_async_batch_pool() -> aiomysql.Pool:
+    """创建开启 MULTI_STATEMENTS 的异步连接池（首次 execute_batch_async 时自动调用）"""
+    global _async_batch_pool
+    async with _async_pool_lock:
+        if _async_batch_pool is None:
+            _async_batch_pool = await _create_pool(
+                0, ASYNC_DB_BATCH_POOL_SIZE, client_flag=BATCH_DB_CONFIG['client_flag']
+            )
+    return _async_batch_pool
+
+
+async def close_async_pool():
+    """关闭全局异步连接池（服务关闭时调用）"""
+    global _async_pool, _async_batch_pool
+    async with _async_pool_lock:
+        for pool in (_async_pool, _async_batch_pool):
+            if pool is not None:
+                pool.close()
+                await pool.wait_closed()
+        _async_pool = _async_batch_pool = None
+
+
+def _pool_stats(pool: Optional[aiomysql.Pool]) -> Dict[str, Any]:
+    if pool is None:
+        return {}
+    return {
+        "pool_size": pool.maxsize,
+        "open": pool.size,
+        "idle": pool.freesize,
+        "in_use": pool.size - pool.freesize,
+    }
+
+
+def get_async_pool_stats() -> Dict[str, Any]:
+    """异步连接池指标（尚未创建时返回空字典）"""
+    return _pool_stats(_async_pool)
+
+
+def get_async_batch_pool_stats() -> Dict[str, Any]:
+    """异步多语句连接池指标（尚未创建时返回空字典）"""
+    return _pool_stats(_async_batch_pool)
+
+
+@asynccontextmanager
+async def get_async_cursor() -> AsyncIterator[aiomysql.DictCursor]:
+    """
+    异步上下文管理器：获取一个游标（连接用完自动归还）
+
+    用法:
+        async with get_async_cursor() as cursor:
+            await cursor.execute("SELECT * FROM user")
+            results = await cursor.fetchall()
+    """
+    pool = _async_pool or await init_async_pool()
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            yield cursor
+
+
+@asynccontextmanager
+async def get_async_batch_cursor() -> AsyncIterator[aiomysql.DictCursor]:
+    """获取多语句连接上的游标，只用于 execute_batch_async"""
+    pool = _async_batch_pool or await init_async_batch_pool()
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            yield cursor
+
+
+# ==============================================================================
+# 用户管理
+# ==============================================================================
+
+class AsyncUserManager:
+    """用户管理类（异步版）"""
+
+    @staticmethod
+    async def register(account: str, password: str) -> Dict[str, Any]:
+        """用户注册，返回 {"success": bool, "user_id": str, "message": str}"""
+        async with get_async_cursor() as cursor:
+            # 检查账号是否已存在
+            await cursor.execute("SELECT user_id FROM user WHERE account = %s", (account,))
+            if await cursor.fetchone():
+                return {"success": False, "message": "账号已存在"}
+
+            # 创建新用户
+            user_id = generate_user_id()
+            pwd_hash = hash_password(password)
+            temp_uuid = str(uuid.uuid4())
+
+            try:
+                await cursor.execute(
+                    "INSERT INTO user (user_id, account, pwd, temp_uuid) VALUES (%s, %s, %s, %s)",
+                    (user_id, account, pwd_hash, temp_uuid)
+                )
+
+                print(f"✅ 用户注册成功: {account} (ID: {user_id})")
+                return {"success": True, "user_id": user_id, "message": "注册成功"}
+
+            except Exception as e:
+                print(f"❌ 用户注册失败: {e}")
+                return {"success": False, "message": f"注册失败: {str(e)}"}
+
+    @staticmethod
+    async def login(account: str, password: str) -> Dict[str, Any]:
+        """用户登录，返回 {"success": bool, "user_id": str, "account": str, "nickname": str, "message": str}"""
+        async with get_async_cursor() as cursor:
+            pwd_hash = hash_password(password)
+            await cursor.execute(
+                "SELECT user_id, account FROM user WHERE account = %s AND pwd = %s",
+                (account, pwd_hash)
+            )
+
+            user = await cursor.fetchone()
+            if user:
+                print(f"✅ 用户登录成功: {account} (ID: {user['user_id']})")
+                return {
+                    "success": True,
+                    "user_id": user['user_id'],
+                    "account": user['account'],
+                    "nickname": user['account'],  # 使用account作为昵称
+                    "message": "登录成功"
+                }
+            else:
+                return {"success": False, "message": "账号或密码错误"}
+
+    @staticmethod
+    async def get_user_info(user_id: str) -> Optional[Dict[str, Any]]:
+        """获取用户信息，返回 {"user_id": str, "account": str} 或 None"""
+        async with get_async_cursor() as cursor:
+            await cursor.execute(
+                "SELECT user_id, account FROM user WHERE user_id = %s",
+                (user_id,)
+            )
+            return await cursor.fetchone()
+
+
+# ==============================================================================
+# 对话历史管理
+# ==============================================================================
+
+class AsyncChatManager:
+    """对话历史管理类（异步版）"""
+
+    @staticmethod
+    async def create_session(
+        user_id: str,
+        title: str = "新对话",
+        mode: str = "solve",
+        subject: str = "未分类",
+        grade: str = "未分类"
+    ) -> str:
+        """创建新的对话会话，返回 session_id"""
+        session_id = str(uuid.uuid4())
+
+        async with get_async_cursor() as cursor:
+            await cursor.execute(
+                """INSERT INTO chat_session (session_id, user_id, title, mode, subject, grade)
+                   VALUES (%s, %s, %s, %s, %s, %s)""",
+                (session_id, user_id, title, mode, subject, grade)
+            )
+
+        print(f"✅ 对话会话创建成功: {session_id}")
+        return session_id
+
+    @staticmethod
+    async def add_message(
+        session_id: str,
+        role: str,
+        content: str,
+        image_url: Optional[str] = None,
+        image_base64: Optional[str] = None,
+        message_type: str = "text"
+    ) -> int:
+        """添加一条对话消息，返回 message_id"""
+        async with get_async_cursor() as cursor:
+            await cursor.execute(
+                """INSERT INTO chat_history (session_id, role, content, image_url, image_base64, message_type)
+                   VALUES (%s, %s, %s, %s, %s, %s)""",
+                (session_id, role, content, image_url, image_base64, message_type)
+            )
+            return cursor.lastrowid
+
+    @staticmethod
+    async def get_session_history(session_id: str, limit: int = 100) -> List[Dict[str, Any]]:
+        """获取会话的历史消息（按时间升序）"""
+        async with get_async_cursor() as cursor:
+            await cursor.execute(CHAT_HISTORY_QUERY, (session_id, limit))
+            return await cursor.fetchall()
+
+    @staticmethod
+    async def get_recent_history(session_id: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """获取会话最近的 limit 条消息（按时间升序，用作对话上下文）"""
+        async with get_async_cursor() as cursor:
+            await cursor.execute(CHAT_RECENT_HISTORY_QUERY, (session_id, limit))
+            rows = await cursor.fetchall()
+            return list(reversed(rows))
+
+    @staticmethod
+    async def get_user_sessions(user_id: str, limit: int = 50) -> List[Dict[str, Any]]:
+        """获取用户的所有会话列表（按更新时间降序）"""
+        async with get_async_cursor() as cursor:
+            await cursor.execute(CHAT_USER_SESSIONS_QUERY, (user_id, limit))
+            return await cursor.fetchall()
+
+    @staticmethod
+    async def update_session_title(session_id: str, title: str) -> bool:
+        """更新会话标题"""
+        async with get_async_cursor() as cursor:
+            await cursor.execute(
+                "UPDATE chat_session SET title = %s WHERE session_id = %s",
+                (title, session_id)
+            )
+            return cursor.rowcount > 0
+
+    @staticmethod
+    async def delete_session(session_id: str, soft_delete: bool = True) -> bool:
+        """删除会话（soft_delete=True 标记删除，False 物理删除并级联删除历史消息）"""
+        async with get_async_cursor() as cursor:
+            if soft_delete:
+                await cursor.execute(
+                    "UPDATE chat_session SET is_deleted = 1 WHERE session_id = %s",
+                    (session_id,)
+                )
+            else:
+                await cursor.execute(
+                    "DELETE FROM chat_session WHERE session_id = %s",
+                    (session_id,)
+                )
+            return cursor.rowcount > 0
+
+    @staticmethod
+    async def get_session_info(session_id: str) -> Optional[Dict[str, Any]]:
+        """获取会话详情"""
+        async with get_async_cursor() as cursor:
+            await cursor.execute(CHAT_SESSION_INFO_QUERY, (session_id,))
+            return await cursor.fetchone()
+
+
+# ==============================================================================
+# 错题持久化（单事务、一次往返，同 database.persist_mistake）
+# ==============================================================================
+
+async def execute_batch_async(cursor: aiomysql.DictCursor, statements: List[tuple]):
+    """多条语句一次发送，逐个读取结果；任一条出错时抛出异常（cursor 来自 get_async_batch_cursor）"""
+    await cursor.execute(*join_statements(statements))
+    while await cursor.nextset():
+        pass
+
+
+async def persist_mistake_async(
+    user_id: str,
+    subject: Dict[str, Any],
+    knowledge_points: Optional[List[str]] = None,
+    user_answer: Optional[str] = None,
+    status: str = "incorrect",
+    book_title: Optional[str] = None
+) -> str:
+    """在一个事务中保存错题（参数同 database.persist_mistake），返回 subject_id"""
+    row = prepare_mistake_subject(subject, knowledge_points)
+
+    async with get_async_batch_cursor() as cursor:
+        for attempt in range(2):
+            exam_id = mistake_book_cache.get(user_id)
+            if exam_id is None:
+                await cursor.execute(MISTAKE_BOOK_QUERY, (user_id,))
+                found = await cursor.fetchone()
+                exam_id = found['exam_id'] if found else None
+            new_book_title = None if exam_id else (book_title or f"{user_id}_错题本")
+            exam_id = exam_id or generate_exam_id()
+
+            try:
+                await execute_batch_async(cursor, build_mistake_persist_statements(
+                    user_id, row, exam_id, knowledge_points, user_answer, status, new_book_title
+                ))
+            except pymysql.IntegrityError:
+                await cursor.connection.rollback()
+                # 缓存的错题本已失效，或并发请求已创建错题本：重新查询映射后重试一次
+                mistake_book_cache.invalidate(user_id)
+                if attempt:
+                    raise
+                continue
+            except Exception:
+                await cursor.connection.rollback()
+                raise
+
+            mistake_book_cache.put(user_id, exam_id)
+            return row["subject_id"]
+
+
+# ==============================================================================
+# 错题本管理
+# ==============================================================================
+
+class AsyncMistakeManager:
+    """错题本管理类（异步版）"""
+
+    @staticmethod
+    async def save_mistake(
+        user_id: str,
+        subject_title: str,
+        subject_desc: str,
+        image_url: Optional[str] = None,
+        user_mistake_text: Optional[str] = None,
+        correct_answer: Optional[str] = None,
+        explanation: Optional[str] = None,
+        knowledge_points: Optional[List[str]] = None,
+        subject_name: str = "未分类",
+        grade: str = "未分类",
+        difficulty: str = "中等",
+        mistake_analysis: Optional[str] = None,
+        image_base64: Optional[str] = None
+    ) -> str:
+        """保存错题到错题本（参数同 MistakeManager.save_mistake），返回 subject_id"""
+        stored_image = None
+        if image_base64:
+            stored_image = await asyncio.to_thread(store_image_base64, image_base64)
+            image_url = stored_image
+
+        try:
+            subject_id = await persist_mistake_async(
+                user_id,
+                {
+                    "subject_title": subject_title,
+                    "subject_desc": subject_desc,
+                    "image_url": image_url,
+                    "answer": correct_answer,
+                    "explanation": explanation,
+                    "solve": explanation,  # solve字段也存解析
+                    "subject_name": subject_name,
+                    "grade": grade,
+                    "difficulty": difficulty,
+                    "user_mistake_text": user_mistake_text,
+                    "mistake_analysis": mistake_analysis,
+                },
+                knowledge_points=knowledge_points,
+                user_answer=user_mistake_text
+            )
+        except Exception:
+            # 保存失败时撤销本次图片引用，避免引用计数泄漏
+            await asyncio.to_thread(release_image, stored_image)
+            raise
+
+        print(f"✅ 错题保存成功: {subject_id} - {subject_title[:30]}")
+        return subject_id
+
+    @staticmethod
+    async def get_user_mistakes(
+        user_id: str,
+        subject_name: Optional[str] = None,
+        grade: Optional[str] = None,
+        knowledge_point: Optional[str] = None,
+        limit: int = 100,
+        page_cursor: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """获取用户的错题列表（支持按学科/年级/知识点筛选和游标分页）"""
+        query, params = build_mistake_list_query(
+            user_id, subject_name, grade, knowledge_point, limit, page_cursor
+        )
+
+        async with get_async_cursor() as cursor:
+            await cursor.execute(query, params)
+            raw_mistakes = await cursor.fetchall()
+
+        # 格式化时要读取图片存储中的文件，放到线程池中执行
+        return await asyncio.to_thread(lambda: [format_mistake_row(m) for m in raw_mistakes])
+
+    @staticmethod
+    async def count_user_mistakes(
+        user_id: str,
+        subject_name: Optional[str] = None,
+        grade: Optional[str] = None,
+        knowledge_point: Optional[str] = None
+    ) -> int:
+        """错题总数：与错题列表相同的归属和筛选条件"""
+        async with get_async_cursor() as cursor:
+            await cursor.execute(*build_subject_count_query(user_id, 'mistake', subject_name, grade, knowledge_point))
+            row = await cursor.fetchone()
+            return int(row['total'] or 0)
+
+    @staticmethod
+    async def update_review_status(subject_id: str) -> bool:
+        """更新错题的复习状态"""
+        async with get_async_cursor() as cursor:
+            await cursor.execute(
+                """UPDATE subject
+                   SET review_count = review_count + 1,
+                       last_review_at = CURRENT_TIMESTAMP
+                   WHERE subject_id = %s""",
+                (subject_id,)
+            )
+            return cursor.rowcount > 0
+
+    @staticmethod
+    async def get_top_knowledge_points(user_id: str, limit: int = 10) -> List[tuple]:
+        """用户错题中出现最多的知识点，返回 [(知识点, 错题数), ...]"""
+        async with get_async_cursor() as cursor:
+            await cursor.execute(*build_top_knowledge_points_query(user_id, limit))
+            return [(row['tag_name'], int(row['count'])) for row in await cursor.fetchall()]
+
+    @staticmethod
+    async def get_mistake_stats(user_id: str) -> Dict[str, Any]:
+        """获取用户错题统计（读取计数表；两条查询在两个连接上并发执行）"""
+        async def _counters():
+            async with get_async_cursor() as cursor:
+                await cursor.execute(*build_mistake_counter_query(user_id))
+                return await cursor.fetchall()
+
+        rows, top_knowledge_points = await asyncio.gather(
+            _counters(), AsyncMistakeManager.get_top_knowledge_points(user_id)
+        )
+        stats = summarize_mistake_counters(rows)
+        stats["top_knowledge_points"] = top_knowledge_points
+        return stats
@@ -0,0 +1,269 @@
+-- ==============================================================================
+-- 沐梧AI解题系统 - 数据库表结构升级脚本 (V25.3)
+-- ==============================================================================
+-- 新功能：
+-- 1. 错题/题目列表的游标分页（按 created_at, subject_id 倒序）所需的复合索引
+-- 2. 用户题目计数表（列表接口的 total 直接读取计数，不再 COUNT 整个连接）
+-- 3. 知识点标签的统计索引（按知识点筛选/统计走 knowledge_tag / subject_knowledge_tag）
+-- 4. 错题统计计数（复习次数、知识点计数、learning_stats 按天记录），统计接口只读计数行
+-- 5. 用户错题本映射（保存错题时按 user_id 主键查找错题本，不再 LIKE 匹配试卷标题）
+-- 6. 对话历史的写入ID（后台批量写入时按 write_id 去重，重放日志不产生重复消息）
+-- ==============================================================================
+-- 执行顺序：database_schema_upgrade.sql → database_schema_v25.2.sql → 本脚本
+-- ==============================================================================
+
+USE edu;
+
+-- ==============================================================================
+-- 1. 列表查询的复合索引
+-- ==============================================================================
+-- 注意：索引已存在时会报错1061(Duplicate key name)，可以忽略
+
+-- 按用户查关联题目（列表、权限校验、删除）
+ALTER TABLE user_exam ADD INDEX idx_user_subject (user_info, subject_id);
+
+-- 游标分页：按题目类型过滤后按 (created_at, subject_id) 倒序翻页
+ALTER TABLE subject ADD INDEX idx_type_created (subject_type, created_at, subject_id);
+
+-- ==============================================================================
+-- 2. 用户题目计数表
+-- ==============================================================================
+-- 按 用户 × 题目类型 × 学科 × 年级 计数；带学科/年级筛选的总数 = 对应行求和
+CREATE TABLE IF NOT EXISTS user_subject_counter (
+    user_id VARCHAR(64) NOT NULL COMMENT '用户ID',
+    subject_type VARCHAR(50) NOT NULL COMMENT '题目类型：mistake, generated, practice',
+    subject_name VARCHAR(50) NOT NULL COMMENT '学科',
+    grade VARCHAR(20) NOT NULL COMMENT '年级',
+    total INT NOT NULL DEFAULT 0 COMMENT '题目数',
+    reviews INT NOT NULL DEFAULT 0 COMMENT '复习次数合计',
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '更新时间',
+
+    PRIMARY KEY (user_id, subject_type, subject_name, grade)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+COMMENT='用户题目计数表（由触发器维护）';
+
+-- 按 用户 × 题目类型 × 知识点标签 计数（错题统计中的知识点排行）
+CREATE TABLE IF NOT EXISTS user_knowledge_counter (
+    user_id VARCHAR(64) NOT NULL COMMENT '用户ID',
+    subject_type VARCHAR(50) NOT NULL COMMENT '题目类型',
+    tag_id INT NOT NULL COMMENT '知识点标签ID',
+    total INT NOT NULL DEFAULT 0 COMMENT '题目数',
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '更新时间',
+
+    PRIMARY KEY (user_id, subject_type, tag_id),
+    INDEX idx_user_type_total (user_id, subject_type, total)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+COMMENT='用户知识点计数表（由触发器维护）';
+
+-- ==============================================================================
+-- 3. 触发器：计数与写入在同一语句/事务中更新
+-- ==============================================================================
+-- 注意：外键级联删除不触发触发器（如直接删除 subject 级联删除 user_exam），
+--       由此产生的偏差由后台对账任务 reconcile_stat_counters() 修复
+DELIMITER $$
+
+-- 关联题目：题目计数、知识点计数 +1；错题记入当天的 learning_stats
+CREATE TRIGGER IF NOT EXISTS trg_user_exam_count_insert
+AFTER INSERT ON user_exam
+FOR EACH ROW
+BEGIN
+    INSERT INTO user_subject_counter (user_id, subject_type, subject_name, grade, total, reviews)
+    SELECT NEW.user_info,
+           COALESCE(s.subject_type, 'practice'),
+           COALESCE(s.subject_name, '未分类'),
+           COALESCE(s.grade, '未分类'),
+           1,
+           COALESCE(s.review_count, 0)
+    FROM subject s
+    WHERE s.subject_id = NEW.subject_id
+    ON DUPLICATE KEY UPDATE total = total + 1, reviews = reviews + VALUES(reviews);
+
+    INSERT INTO user_knowledge_counter (user_id, subject_type, tag_id, total)
+    SELECT NEW.user_info, COALESCE(s.subject_type, 'practice'), skt.tag_id, 1
+    FROM subject s
+    JOIN subject_knowledge_tag skt ON skt.subject_id = s.subject_id
+    WHERE s.subject_id = NEW.subject_id
+    ON DUPLICATE KEY UPDATE total = total + 1;
+
+    -- learning_stats 有指向 user 的外键，用 IGNORE 避免统计写入失败影响保存
+    INSERT IGNORE INTO learning_stats (user_id, subject, date, total_questions, mistake_questions)
+    SELECT NEW.user_info, COALESCE(s.subject_name, '未分类'), CURDATE(), 1,
+           IF(s.subject_type = 'mistake', 1, 0)
+    FROM subject s
+    WHERE s.subject_id = NEW.subject_id
+    ON DUPLICATE KEY UPDATE total_questions = total_questions + 1,
+                            mistake_questions = mistake_questions + VALUES(mistake_questions);
+END$$
+
+-- 取消关联：题目计数、知识点计数 -1（learning_stats 是按天的历史记录，不回退）
+CREATE TRIGGER IF NOT EXISTS trg_user_exam_count_delete
+AFTER DELETE ON user_exam
+FOR EACH ROW
+BEGIN
+    UPDATE user_subject_counter c
+    JOIN subject s ON s.subject_id = OLD.subject_id
+    SET c.total = GREATEST(c.total - 1, 0),
+        c.reviews = GREATEST(c.reviews - COALESCE(s.review_count, 0), 0)
+    WHERE c.user_id = OLD.user_info
+      AND c.subject_type = COALESCE(s.subject_type, 'practice')
+      AND c.subject_name = COALESCE(s.subject_name, '未分类')
+      AND c.grade = COALESCE(s.grade, '未分类');
+
+    UPDATE user_knowledge_counter c
+    JOIN subject s ON s.subject_id = OLD.subject_id
+    JOIN subject_knowledge_tag skt ON skt.subject_id = s.subject_id AND skt.tag_id = c.tag_id
+    SET c.total = GREATEST(c.total - 1, 0)
+    WHERE c.user_id = OLD.user_info
+      AND c.subject_type = COALESCE(s.subject_type, 'practice');
+END$$
+
+-- 题目的类型/学科/年级/复习次数变化：从旧分组减去、加到新分组
+CREATE TRIGGER IF NOT EXISTS trg_subject_count_update
+AFTER UPDATE ON subject
+FOR EACH ROW
+BEGIN
+    IF NOT (OLD.subject_type <=> NEW.subject_type)
+       OR NOT (OLD.subject_name <=> NEW.subject_name)
+       OR NOT (OLD.grade <=> NEW.grade)
+       OR NOT (OLD.review_count <=> NEW.review_count) THEN
+
+        UPDATE user_subject_counter c
+        JOIN user_exam ue ON ue.user_info = c.user_id AND ue.subject_id = OLD.subject_id
+        SET c.total = GREATEST(c.total - 1, 0),
+            c.reviews = GREATEST(c.reviews - COALESCE(OLD.review_count, 0), 0)
+        WHERE c.subject_type = COALESCE(OLD.subject_type, 'practice')
+          AND c.subject_name = COALESCE(OLD.subject_name, '未分类')
+          AND c.grade = COALESCE(OLD.grade, '未分类');
+
+        INSERT INTO user_subject_counter (user_id, subject_type, subject_name, grade, total, reviews)
+        SELECT ue.user_info,
+               COALESCE(NEW.subject_type, 'practice'),
+               COALESCE(NEW.subject_name, '未分类'),
+               COALESCE(NEW.grade, '未分类'),
+               1,
+               COALESCE(NEW.review_count, 0)
+        FROM user_exam ue
+        WHERE ue.subject_id = NEW.subject_id
+        ON DUPLICATE KEY UPDATE total = total + 1, reviews = reviews + VALUES(reviews);
+    END IF;
+
+    IF NOT (OLD.subject_type <=> NEW.subject_type) THEN
+        UPDATE user_knowledge_counter c
+        JOIN user_exam ue ON ue.user_info = c.user_id AND ue.subject_id = OLD.subject_id
+        JOIN subject_knowledge_tag skt ON skt.subject_id = OLD.subject_id AND skt.tag_id = c.tag_id
+        SET c.total = GREATEST(c.total - 1, 0)
+        WHERE c.subject_type = COALESCE(OLD.subject_type, 'practice');
+
+        INSERT INTO user_knowledge_counter (user_id, subject_type, tag_id, total)
+        SELECT ue.user_info, COALESCE(NEW.subject_type, 'practice'), skt.tag_id, 1
+        FROM user_exam ue
+        JOIN subject_knowledge_tag skt ON skt.subject_id = ue.subject_id
+        WHERE ue.subject_id = NEW.subject_id
+        ON DUPLICATE KEY UPDATE total = total + 1;
+    END IF;
+END$$
+
+-- 题目新增/删除知识点标签：对已关联该题目的用户计数 ±1
+CREATE TRIGGER IF NOT EXISTS trg_subject_tag_count_insert
+AFTER INSERT ON subject_knowledge_tag
+FOR EACH ROW
+BEGIN
+    INSERT INTO user_knowledge_counter (user_id, subject_type, tag_id, total)
+    SELECT ue.user_info, COALESCE(s.subject_type, 'practice'), NEW.tag_id, 1
+    FROM user_exam ue
+    JOIN subject s ON s.subject_id = ue.subject_id
+    WHERE ue.subject_id = NEW.subject_id
+    ON DUPLICATE KEY UPDATE total = total + 1;
+END$$
+
+CREATE TRIGGER IF NOT EXISTS trg_subject_tag_count_delete
+AFTER DELETE ON subject_knowledge_tag
+FOR EACH ROW
+BEGIN
+    UPDATE user_knowledge_counter c
+    JOIN user_exam ue ON ue.user_info = c.user_id AND ue.subject_id = OLD.subject_id
+    JOIN subject s ON s.subject_id = OLD.subject_id
+    SET c.total = GREATEST(c.total - 1, 0)
+    WHERE c.tag_id = OLD.tag_id
+      AND c.subject_type = COALESCE(s.subject_type, 'practice');
+END$$
+
+DELIMITER ;
+
+-- ==============================================================================
+-- 4. 回填现有数据的计数（与 reconcile_stat_counters() 的对账语句相同）
+-- ==============================================================================
+INSERT INTO user_subject_counter (user_id, subject_type, subject_name, grade, total, reviews)
+SELECT ue.user_info,
+       COALESCE(s.subject_type, 'practice'),
+       COALESCE(s.subject_name, '未分类'),
+       COALESCE(s.grade, '未分类'),
+       COUNT(*),
+       COALESCE(SUM(s.review_count), 0)
+FROM user_exam ue
+JOIN subject s ON s.subject_id = ue.subject_id
+GROUP BY ue.user_info, COALESCE(s.subject_type, 'practice'),
+         COALESCE(s.subject_name, '未分类'), COALESCE(s.grade, '未分类')
+ON DUPLICATE KEY UPDATE total = VALUES(total), reviews = VALUES(reviews);
+
+INSERT INTO user_knowledge_counter (user_id, subject_type, tag_id, total)
+SELECT ue.user_info, COALESCE(s.subject_type, 'practice'), skt.tag_id, COUNT(*)
+FROM user_exam ue
+JOIN subject s ON s.subject_id = ue.subject_id
+JOIN subject_knowledge_tag skt ON skt.subject_id = s.subject_id
+GROUP BY ue.user_info, COALESCE(s.subject_type, 'practice'), skt.tag_id
+ON DUPLICATE KEY UPDATE total = VALUES(total);
+
+-- ==============================================================================
+-- 5. 知识点标签索引
+-- ==============================================================================
+-- 标签按知识点名称聚合：(tag_name, tag_id) 使 GROUP BY kt.tag_name 只读索引
+-- 现有题目的标签关联由服务启动时的后台任务 backfill_knowledge_tags() 补写
+-- （knowledge_points 中有不规范的旧数据，在 Python 中解析更稳妥）
+ALTER TABLE knowledge_tag ADD INDEX idx_tag_name (tag_name, tag_id);
+
+-- ==============================================================================
+-- 6. 用户错题本映射
+-- ==============================================================================
+-- 每个用户一个错题本；服务端按 user_id 缓存映射，保存错题时通常无需查询
+CREATE TABLE IF NOT EXISTS user_mistake_book (
+    user_id VARCHAR(64) NOT NULL COMMENT '用户ID',
+    exam_id VARCHAR(64) NOT NULL COMMENT '错题本试卷ID',
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间',
+
+    PRIMARY KEY (user_id),
+    UNIQUE KEY uk_exam_id (exam_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+COMMENT='用户错题本映射表';
+
+-- 回填：已有错题本（历史上有 'mistake_book' 和 'mistake' 两种类型）取每个用户最早关联的一个
+INSERT IGNORE INTO user_mistake_book (user_id, exam_id)
+SELECT ue.user_info, MIN(ue.exam_id)
+FROM user_exam ue
+JOIN exam e ON e.exam_id = ue.exam_id
+WHERE e.exam_type IN ('mistake_book', 'mistake')
+GROUP BY ue.user_info;
+
+-- ==============================================================================
+-- 7. 对话历史写入ID
+-- ==============================================================================
+-- 由服务端写入队列生成（UUID）；旧数据为 NULL，唯一索引允许多个 NULL
+ALTER TABLE chat_history ADD COLUMN write_id VARCHAR(64) NULL COMMENT '写入ID（去重用）' AFTER id;
+ALTER TABLE chat_history ADD UNIQUE INDEX uk_write_id (write_id);
+
+-- ==============================================================================
+-- 8. 验证
+-- ==============================================================================
+SHOW INDEX FROM user_exam;
+SHOW INDEX FROM subject;
+SHOW TRIGGERS LIKE 'user_exam';
+SHOW TRIGGERS LIKE 'subject%';
+SHOW INDEX FROM knowledge_tag;
+SELECT * FROM user_subject_counter LIMIT 10;
+SELECT * FROM user_knowledge_counter LIMIT 10;
+SELECT COUNT(*) AS mistake_books FROM user_mistake_book;
+SHOW INDEX FROM chat_history;
+
+-- ==============================================================================
+-- 执行完成！
+-- ==============================================================================
@@ -0,0 +1,188 @@
+-- ==============================================================================
+-- 沐梧AI解题系统 - 数据库表结构升级脚本 (V25.5)
+-- ==============================================================================
+-- 修复：计数表按 用户 × 题目 去重计数
+-- 同一道题可以经不同试卷多次关联到同一用户（user_exam 中多行），列表按 EXISTS 去重，
+-- 计数也必须按 (user_info, subject_id) 去重，否则 total / total_mistakes 大于列表实际条数。
+-- 1. 关联题目：该用户第一次关联该题目时才 +1；取消关联：最后一条关联删除时才 -1
+-- 2. 题目学科/年级/类型/复习次数变化、新增知识点标签：每个用户只加一次（与减去的次数一致）
+-- 3. 按去重后的口径重算现有计数
+-- ==============================================================================
+-- 执行顺序：database_schema_v25.3.sql → 本脚本（由 schema_migrate.py 作为 25.5 执行）
+-- ==============================================================================
+
+USE edu;
+
+-- ==============================================================================
+-- 1. 重建触发器
+-- ==============================================================================
+-- 注意：两个事务同时为同一用户关联同一道题时，彼此看不到对方未提交的行，可能各加一次；
+--       这类偏差和外键级联删除造成的偏差一样，由定期对账任务 reconcile_stat_counters() 修复
+DROP TRIGGER IF EXISTS trg_user_exam_count_insert;
+DROP TRIGGER IF EXISTS trg_user_exam_count_delete;
+DROP TRIGGER IF EXISTS trg_subject_count_update;
+DROP TRIGGER IF EXISTS trg_subject_tag_count_insert;
+
+DELIMITER $$
+
+-- 关联题目：该用户第一次关联该题目时，题目计数、知识点计数 +1，错题记入当天的 learning_stats
+CREATE TRIGGER trg_user_exam_count_insert
+AFTER INSERT ON user_exam
+FOR EACH ROW
+BEGIN
+    IF (SELECT COUNT(*) FROM user_exam
+        WHERE user_info = NEW.user_info AND subject_id = NEW.subject_id) = 1 THEN
+
+        INSERT INTO user_subject_counter (user_id, subject_type, subject_name, grade, total, reviews)
+        SELECT NEW.user_info,
+               COALESCE(s.subject_type, 'practice'),
+               COALESCE(s.subject_name, '未分类'),
+               COALESCE(s.grade, '未分类'),
+               1,
+               COALESCE(s.review_count, 0)
+        FROM subject s
+        WHERE s.subject_id = NEW.subject_id
+        ON DUPLICATE KEY UPDATE total = total + 1, reviews = reviews + VALUES(reviews);
+
+        INSERT INTO user_knowledge_counter (user_id, subject_type, tag_id, total)
+        SELECT NEW.user_info, COALESCE(s.subject_type, 'practice'), skt.tag_id, 1
+        FROM subject s
+        JOIN subject_knowledge_tag skt ON skt.subject_id = s.subject_id
+        WHERE s.subject_id = NEW.subject_id
+        ON DUPLICATE KEY UPDATE total = total + 1;
+
+        -- learning_stats 有指向 user 的外键，用 IGNORE 避免统计写入失败影响保存
+        INSERT IGNORE INTO learning_stats (user_id, subject, date, total_questions, mistake_questions)
+        SELECT NEW.user_info, COALESCE(s.subject_name, '未分类'), CURDATE(), 1,
+               IF(s.subject_type = 'mistake', 1, 0)
+        FROM subject s
+        WHERE s.subject_id = NEW.subject_id
+        ON DUPLICATE KEY UPDATE total_questions = total_questions + 1,
+                                mistake_questions = mistake_questions + VALUES(mistake_questions);
+    END IF;
+END$$
+
+-- 取消关联：该用户对该题目的最后一条关联删除时，题目计数、知识点计数 -1
+CREATE TRIGGER trg_user_exam_count_delete
+AFTER DELETE ON user_exam
+FOR EACH ROW
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM user_exam
+                   WHERE user_info = OLD.user_info AND subject_id = OLD.subject_id) THEN
+
+        UPDATE user_subject_counter c
+        JOIN subject s ON s.subject_id = OLD.subject_id
+        SET c.total = GREATEST(c.total - 1, 0),
+            c.reviews = GREATEST(c.reviews - COALESCE(s.review_count, 0), 0)
+        WHERE c.user_id = OLD.user_info
+          AND c.subject_type = COALESCE(s.subject_type, 'practice')
+          AND c.subject_name = COALESCE(s.subject_name, '未分类')
+          AND c.grade = COALESCE(s.grade, '未分类');
+
+        UPDATE user_knowledge_counter c
+        JOIN subject s ON s.subject_id = OLD.subject_id
+        JOIN subject_knowledge_tag skt ON skt.subject_id = s.subject_id AND skt.tag_id = c.tag_id
+        SET c.total = GREATEST(c.total - 1, 0)
+        WHERE c.user_id = OLD.user_info
+          AND c.subject_type = COALESCE(s.subject_type, 'practice');
+    END IF;
+END$$
+
+-- 题目的类型/学科/年级/复习次数变化：每个关联用户从旧分组减 1、加到新分组 1
+-- （多表 UPDATE 每个计数行只更新一次，INSERT 侧同样按用户去重）
+CREATE TRIGGER trg_subject_count_update
+AFTER UPDATE ON subject
+FOR EACH ROW
+BEGIN
+    IF NOT (OLD.subject_type <=> NEW.subject_type)
+       OR NOT (OLD.subject_name <=> NEW.subject_name)
+       OR NOT (OLD.grade <=> NEW.grade)
+       OR NOT (OLD.review_count <=> NEW.review_count) THEN
+
+        UPDATE user_subject_counter c
+        JOIN (SELECT DISTINCT user_info FROM user_exam WHERE subject_id = OLD.subject_id) ue
+          ON ue.user_info = c.user_id
+        SET c.total = GREATEST(c.total - 1, 0),
+            c.reviews = GREATEST(c.reviews - COALESCE(OLD.review_count, 0), 0)
+        WHERE c.subject_type = COALESCE(OLD.subject_type, 'practice')
+          AND c.subject_name = COALESCE(OLD.subject_name, '未分类')
+          AND c.grade = COALESCE(OLD.grade, '未分类');
+
+        INSERT INTO user_subject_counter (user_id, subject_type, subject_name, grade, total, reviews)
+        SELECT DISTINCT ue.user_info,
+               COALESCE(NEW.subject_type, 'practice'),
+               COALESCE(NEW.subject_name, '未分类'),
+               COALESCE(NEW.grade, '未分类'),
+               1,
+               COALESCE(NEW.review_count, 0)
+        FROM user_exam ue
+        WHERE ue.subject_id = NEW.subject_id
+        ON DUPLICATE KEY UPDATE total = total + 1, reviews = reviews + VALUES(reviews);
+    END IF;
+
+    IF NOT (OLD.subject_type <=> NEW.subject_type) THEN
+        UPDATE user_knowledge_counter c
+        JOIN (SELECT DISTINCT user_info FROM user_exam WHERE subject_id = OLD.subject_id) ue
+          ON ue.user_info = c.user_id
+        JOIN subject_knowledge_tag skt ON skt.subject_id = OLD.subject_id AND skt.tag_id = c.tag_id
+        SET c.total = GREATEST(c.total - 1, 0)
+        WHERE c.subject_type = COALESCE(OLD.subject_type, 'practice');
+
+        INSERT INTO user_knowledge_counter (user_id, subject_type, tag_id, total)
+        SELECT DISTINCT ue.user_info, COALESCE(NEW.subject_type, 'practice'), skt.tag_id, 1
+        FROM user_exam ue
+        JOIN subject_knowledge_tag skt ON skt.subject_id = ue.subject_id
+        WHERE ue.subject_id = NEW.subject_id
+        ON DUPLICATE KEY UPDATE total = total + 1;
+    END IF;
+END$$
+
+-- 题目新增知识点标签：对已关联该题目的每个用户计数 +1
+-- （删除标签的 trg_subject_tag_count_delete 是多表 UPDATE，本来就每个用户只减一次，不需要重建）
+CREATE TRIGGER trg_subject_tag_count_insert
+AFTER INSERT ON subject_knowledge_tag
+FOR EACH ROW
+BEGIN
+    INSERT INTO user_knowledge_counter (user_id, subject_type, tag_id, total)
+    SELECT DISTINCT ue.user_info, COALESCE(s.subject_type, 'practice'), NEW.tag_id, 1
+    FROM user_exam ue
+    JOIN subject s ON s.subject_id = ue.subject_id
+    WHERE ue.subject_id = NEW.subject_id
+    ON DUPLICATE KEY UPDATE total = total + 1;
+END$$
+
+DELIMITER ;
+
+-- ==============================================================================
+-- 2. 按去重口径重算现有计数（与 reconcile_stat_counters() 的对账语句相同）
+-- ==============================================================================
+INSERT INTO user_subject_counter (user_id, subject_type, subject_name, grade, total, reviews)
+SELECT ue.user_info,
+       COALESCE(s.subject_type, 'practice'),
+       COALESCE(s.subject_name, '未分类'),
+       COALESCE(s.grade, '未分类'),
+       COUNT(*),
+       COALESCE(SUM(s.review_count), 0)
+FROM (SELECT DISTINCT user_info, subject_id FROM user_exam) ue
+JOIN subject s ON s.subject_id = ue.subject_id
+GROUP BY ue.user_info, COALESCE(s.subject_type, 'practice'),
+         COALESCE(s.subject_name, '未分类'), COALESCE(s.grade, '未分类')
+ON DUPLICATE KEY UPDATE total = VALUES(total), reviews = VALUES(reviews);
+
+INSERT INTO user_knowledge_counter (user_id, subject_type, tag_id, total)
+SELECT ue.user_info, COALESCE(s.subject_type, 'practice'), skt.tag_id, COUNT(*)
+FROM (SELECT DISTINCT user_info, subject_id FROM user_exam) ue
+JOIN subject s ON s.subject_id = ue.subject_id
+JOIN subject_knowledge_tag skt ON skt.subject_id = s.subject_id
+GROUP BY ue.user_info, COALESCE(s.subject_type, 'practice'), skt.tag_id
+ON DUPLICATE KEY UPDATE total = VALUES(total);
+
+-- ==============================================================================
+-- 3. 验证
+-- ==============================================================================
+SHOW TRIGGERS LIKE 'user_exam';
+SHOW TRIGGERS LIKE 'subject%';
+
+-- ==============================================================================
+-- 执行完成！
+-- ==============================================================================
@@ -0,0 +1,123 @@
+# ==============================================================================
+# deadline.py - 请求级时间预算
+# 功能：接口入口创建截止时间，向下传递给 OCR / 网络检索 / 大模型 / 错题保存 各阶段，
+#       某阶段用完预算时降级（如OCR超时改为纯图片模式），保证在客户端超时前返回
+# 技术：基于 time.monotonic 的剩余时间计算 + asyncio.wait_for
+# ==============================================================================
+
+import os
+import time
+import asyncio
+from typing import Any, Callable, Optional, Set
+
+
+# ==============================================================================
+# 配置（秒）
+# ==============================================================================
+
+# 各接口的总时间预算（小程序客户端超时约30秒）
+MINIAPP_DEADLINE_SECONDS = float(os.getenv("MINIAPP_DEADLINE_SECONDS", "25"))
+CHAT_DEADLINE_SECONDS = float(os.getenv("CHAT_DEADLINE_SECONDS", "120"))
+QUESTION_GENERATE_DEADLINE_SECONDS = float(os.getenv("QUESTION_GENERATE_DEADLINE_SECONDS", "180"))
+
+# OCR / 网络检索 最多占用剩余预算的比例，其余留给大模型
+OCR_BUDGET_SHARE = float(os.getenv("OCR_BUDGET_SHARE", "0.3"))
+SEARCH_BUDGET_SHARE = float(os.getenv("SEARCH_BUDGET_SHARE", "0.3"))
+
+# 大模型调用结束后留给组装响应的时间
+RESPONSE_RESERVE_SECONDS = 1.0
+
+# 剩余时间少于此值时，错题保存（含知识点提取）转入后台，先返回回答
+PERSIST_MIN_SECONDS = float(os.getenv("PERSIST_MIN_SECONDS", "8"))
+
+
+class DeadlineExceeded(TimeoutError):
+    """某阶段开始前或执行中用完了请求的时间预算"""
+
+    def __init__(self, stage: str):
+        super().__init__(f"{stage}超出请求时间预算")
+        self.stage = stage
+
+
+class Deadline:
+    """
+    请求截止时间
+
+    - remaining() 剩余秒数；budget() 计算当前阶段可用的时间
+    - sub() 按比例切出子预算，交给内部还有多个步骤的阶段（如网络检索）
+    """
+
+    def __init__(self, seconds: float, name: str = "request"):
+        self.name = name
+        self.seconds = seconds
+        self._start = time.monotonic()
+        self._expires_at = self._start + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self._expires_at - time.monotonic())
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self._start
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def budget(self, share: float = 1.0, cap: Optional[float] = None, reserve: float = 0.0) -> float:
+        """当前阶段可用时间：(剩余 - 为后续阶段保留的时间) × share，且不超过cap"""
+        available = max(0.0, self.remaining() - reserve) * share
+        return min(available, cap) if cap is not None else available
+
+    def check(self, stage: str):
+        """预算已用完时抛出 DeadlineExceeded"""
+        if self.expired:
+            raise DeadlineExceeded(stage)
+
+    def timeout(self, cap: float, stage: str) -> float:
+        """阻塞调用（如 requests.get）的超时参数：不超过cap，也不超过剩余时间"""
+        self.check(stage)
+        return min(cap, self.remaining())
+
+    def sub(self, share: float, name: Optional[str] = None) -> "Deadline":
+        """按比例切出子预算"""
+        return Deadline(self.budget(share), name or self.name)
+
+
+def stage_timeout(deadline: Optional[Deadline], cap: float, stage: str) -> float:
+    """没有截止时间时使用阶段自身的默认超时"""
+    return cap if deadline is None else deadline.timeout(cap, stage)
+
+
+async def run_within(deadline: Deadline, stage: str, func: Callable[..., Any], *args,
+                     share: float = 1.0, reserve: float = 0.0, **kwargs) -> Any:
+    """
+    在线程池中执行阻塞函数，超出阶段预算时抛出 DeadlineExceeded
+
+    线程无法被强制中止，超时后函数会在后台继续执行完（OCR结果仍会写入缓存）
+    """
+    timeout = deadline.budget(share, reserve=reserve)
+    if timeout <= 0:
+        raise DeadlineExceeded(stage)
+    try:
+        return await asyncio.wait_for(asyncio.to_thread(func, *args, **kwargs), timeout)
+    except asyncio.TimeoutError:
+        print(f"⏱️ [时间预算] {stage}超时（预算 {timeout:.1f}s，已用 {deadline.elapsed():.1f}s）")
+        raise DeadlineExceeded(stage)
+
+
+# 保存后台任务的引用，避免被垃圾回收
+_deferred_tasks: Set["asyncio.Task"] = set()
+
+
+def defer_to_background(func: Callable[..., Any], *args, **kwargs) -> "asyncio.Task":
+    """预算不足时把收尾工作（如错题保存）放到后台执行，不阻塞响应"""
+    async def _run():
+        try:
+            return await asyncio.to_thread(func, *args, **kwargs)
+        except Exception as e:
+            print(f"⚠️ [时间预算] 后台任务执行失败: {e}")
+
+    task = asyncio.get_running_loop().create_task(_run())
+    _deferred_tasks.add(task)
+    task.add_done_callback(_deferred_tasks.discard)
+    return task
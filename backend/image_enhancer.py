@@ -5,10 +5,14 @@
 # 版本：V1.0
 # ==============================================================================
 
+import io
+import base64
+import threading
+
 import cv2
 import numpy as np
-from PIL import Image
-from typing import Optional
+from PIL import Image, ImageOps
+from typing import Any, Dict, Optional, Tuple
 
 
 def pil_to_cv2(pil_img: Image.Image) -> np.ndarray:
@@ -203,6 +207,286 @@ def advanced_image_processing_pipeline(pil_img: Image.Image,
         return pil_img
 
 
+# ==============================================================================
+# 融合版流水线（OCR专用：只处理亮度通道，uint8原地运算）
+# ==============================================================================
+
+# CLAHE对象按线程缓存（cv2.CLAHE实例不是线程安全的，不能跨线程共享）
+_clahe_local = threading.local()
+
+
+def _get_clahe(clip_limit: float, tile_grid_size: Tuple[int, int]) -> "cv2.CLAHE":
+    """获取当前线程缓存的CLAHE实例，参数相同时复用"""
+    cache: Dict[Tuple[float, Tuple[int, int]], "cv2.CLAHE"] = getattr(_clahe_local, "cache", None)
+    if cache is None:
+        cache = _clahe_local.cache = {}
+    key = (clip_limit, tuple(tile_grid_size))
+    clahe = cache.get(key)
+    if clahe is None:
+        clahe = cache[key] = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
+    return clahe
+
+
+def _enhance_luminance(channel: np.ndarray, sharpen_amount: float, clahe_clip_limit: float,
+                       kernel_size: int = 5, sigma: float = 1.0,
+                       tile_grid_size: Tuple[int, int] = (8, 8)) -> np.ndarray:
+    """
+    对单通道uint8图像做 锐化 + CLAHE
+
+    锐化用 addWeighted 直接在uint8上完成（饱和截断等价于clip到[0, 255]），
+    结果写回输入数组，整个过程只额外分配一张模糊图。
+    """
+    blurred = cv2.GaussianBlur(channel, (kernel_size, kernel_size), sigma)
+    # sharpened = (1 + amount) * original - amount * blurred
+    cv2.addWeighted(channel, 1.0 + sharpen_amount, blurred, -sharpen_amount, 0, dst=channel)
+    return _get_clahe(clahe_clip_limit, tile_grid_size).apply(channel)
+
+
+def fast_image_processing_pipeline(pil_img: Image.Image,
+                                   sharpen_amount: float = 1.5,
+                                   clahe_clip_limit: float = 2.0,
+                                   keep_color: bool = False) -> Image.Image:
+    """
+    融合版图像增强流水线（效果与 advanced_image_processing_pipeline 一致，面向OCR）
+
+    与原流水线的区别：
+    - 只在亮度上做锐化和CLAHE，没有 RGB/BGR/LAB 之间的往返转换
+    - 全程uint8运算，不产生float32整图副本
+    - CLAHE实例按线程缓存，不再每次重建
+    - 入口和出口各只做一次格式转换
+
+    Args:
+        pil_img: 输入的Pillow Image对象
+        sharpen_amount: 锐化强度（1.0-2.0），默认1.5
+        clahe_clip_limit: CLAHE对比度限制（1.0-4.0），默认2.0
+        keep_color: False时输出灰度图（OCR不需要颜色）；True时只增强YCbCr的Y通道并保留色彩
+
+    Returns:
+        增强后的Pillow Image对象（灰度 'L' 或 'YCbCr'→'RGB'）
+    """
+    try:
+        if not keep_color:
+            gray = np.array(pil_img.convert("L"))
+            return Image.fromarray(_enhance_luminance(gray, sharpen_amount, clahe_clip_limit))
+
+        ycbcr = np.array(pil_img.convert("YCbCr"))
+        ycbcr[:, :, 0] = _enhance_luminance(
+            np.ascontiguousarray(ycbcr[:, :, 0]), sharpen_amount, clahe_clip_limit
+        )
+        return Image.fromarray(ycbcr, mode="YCbCr").convert("RGB")
+
+    except Exception as e:
+        print(f"!!! [图像增强] 融合流水线处理失败，返回原始图像: {e}")
+        return pil_img
+
+
+# ==============================================================================
+# 快速解码：JPEG草稿模式缩放 + EXIF方向校正 + 内容区域裁剪
+# ==============================================================================
+
+# 送入OCR/大模型的图片最长边
+MAX_IMAGE_DIMENSION = 2000
+
+# 内容区域检测用缩略图的最长边
+CONTENT_PROXY_SIZE = 400
+
+
+def load_image_fast(img: Image.Image, max_dimension: int = MAX_IMAGE_DIMENSION) -> Image.Image:
+    """
+    解码图片并缩放到不超过 max_dimension
+
+    - JPEG在解码前设置草稿模式，由解码器直接按 1/2、1/4、1/8 缩放解码，
+      1200万像素的手机照片不必完整解码后再缩小
+    - 按EXIF方向信息旋转一次
+    - 统一转换为RGB
+
+    注意：草稿模式只对尚未加载像素的图片（刚 Image.open 的）有效
+    """
+    if img.format == "JPEG" and max(img.size) > max_dimension:
+        try:
+            # 按原始宽高比给出目标尺寸，解码器会选择不小于该尺寸的最大缩放比
+            scale = max_dimension / max(img.size)
+            img.draft("RGB", (int(img.width * scale), int(img.height * scale)))
+        except Exception:
+            pass  # 已加载或不支持草稿模式，按普通方式处理
+
+    img = ImageOps.exif_transpose(img)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    if max(img.size) > max_dimension:
+        scale = max_dimension / max(img.size)
+        new_size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        img = img.resize(new_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    return img
+
+
+def find_content_bbox(img: Image.Image, proxy_size: int = CONTENT_PROXY_SIZE) -> Optional[Tuple[int, int, int, int]]:
+    """
+    在缩略图上找到纸面内容的边界框 (x0, y0, x1, y1)
+
+    1. 纸面：亮度接近纸张（P90）的像素占一半以上的行/列，去掉四周的桌面等暗色背景
+    2. 内容：纸面范围内明显比纸张暗的笔迹，去掉空白页边
+    找不到可靠内容时返回None
+    """
+    proxy = img.convert("L")
+    proxy.thumbnail((proxy_size, proxy_size), Image.Resampling.BILINEAR)
+    gray = np.asarray(proxy)
+    scale_x = img.width / gray.shape[1]
+    scale_y = img.height / gray.shape[0]
+
+    paper_level = float(np.percentile(gray, 90))
+    paper = gray >= paper_level * 0.75
+    rows = np.nonzero(paper.mean(axis=1) > 0.5)[0]
+    cols = np.nonzero(paper.mean(axis=0) > 0.5)[0]
+    if len(rows) == 0 or len(cols) == 0:
+        return None
+    py0, py1, px0, px1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+    ink = gray[py0:py1, px0:px1] < paper_level - 50
+    ink_rows = np.nonzero(ink.sum(axis=1) >= 2)[0]
+    ink_cols = np.nonzero(ink.sum(axis=0) >= 2)[0]
+    if len(ink_rows) == 0 or len(ink_cols) == 0:
+        return None
+
+    # 四周保留约2%的留白，避免贴边裁掉笔画
+    pad = max(2, int(0.02 * max(gray.shape)))
+    y0 = max(py0 + ink_rows[0] - pad, 0)
+    y1 = min(py0 + ink_rows[-1] + 1 + pad, gray.shape[0])
+    x0 = max(px0 + ink_cols[0] - pad, 0)
+    x1 = min(px0 + ink_cols[-1] + 1 + pad, gray.shape[1])
+
+    return (int(x0 * scale_x), int(y0 * scale_y),
+            min(img.width, int(np.ceil(x1 * scale_x))), min(img.height, int(np.ceil(y1 * scale_y))))
+
+
+def crop_to_content(img: Image.Image, min_area_ratio: float = 0.1, max_area_ratio: float = 0.9) -> Image.Image:
+    """
+    裁剪到内容区域
+
+    只有裁掉的面积足够多（剩余 < max_area_ratio）才裁剪；
+    剩余面积过小（< min_area_ratio）视为误检，保持原图
+    """
+    try:
+        bbox = find_content_bbox(img)
+    except Exception as e:
+        print(f"⚠️ [图像预处理] 内容区域检测失败: {e}")
+        return img
+    if bbox is None:
+        return img
+
+    area_ratio = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) / float(img.width * img.height)
+    if area_ratio < min_area_ratio or area_ratio > max_area_ratio:
+        return img
+    return img.crop(bbox)
+
+
+def prepare_image_base64(image_base64: str, max_dimension: int = MAX_IMAGE_DIMENSION,
+                         quality: int = 90) -> str:
+    """
+    接口入口的图片预处理：快速解码 + 内容裁剪 + 重新编码为JPEG
+
+    内容裁剪只在这里做一次，之后的拆题、OCR和发送给大模型的都是这张图（OCR不再裁剪）。
+    发生了裁剪时总是返回裁剪结果；只做了缩放且没有变小（或无法解码）时返回原始数据
+    """
+    try:
+        img = Image.open(io.BytesIO(base64.b64decode(image_base64)))
+        original_size = img.size
+        img = load_image_fast(img, max_dimension)
+        resized_size = img.size
+        img = crop_to_content(img)
+        if img.size == original_size:
+            return image_base64
+
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=quality)
+        optimized = base64.b64encode(buffer.getvalue()).decode("ascii")
+        if img.size != resized_size or len(optimized) < len(image_base64):
+            return optimized
+        return image_base64
+    except Exception as e:
+        print(f"⚠️ [图像预处理] 图片压缩失败，使用原图: {e}")
+        return image_base64
+
+
+# ==============================================================================
+# 画质分诊：干净的截图/扫描件不做增强，CPU只花在需要的图片上
+# ==============================================================================
+
+# 分析用缩略图的最长边
+TRIAGE_PROXY_SIZE = 512
+
+# 分诊阈值（在缩略图上测得）
+TRIAGE_SHARP_CLEAN = 1000.0    # 拉普拉斯方差 ≥ 此值：边缘清晰
+TRIAGE_SHARP_BLURRY = 500.0    # 拉普拉斯方差 < 此值：明显模糊
+TRIAGE_SPREAD_CLEAN = 140.0    # 灰度分布跨度（P99.5-P0.5）≥ 此值：对比度充足
+TRIAGE_SPREAD_FLAT = 80.0      # 灰度分布跨度 < 此值：对比度不足
+TRIAGE_NOISE_MAX = 2.0         # 噪声估计 ≥ 此值：不能直接跳过
+
+# 各增强档位的参数（skip 档不处理）
+ENHANCEMENT_PRESETS = {
+    "light": {"sharpen_amount": 0.8, "clahe_clip_limit": 1.5},
+    "full": {"sharpen_amount": 1.5, "clahe_clip_limit": 2.0},
+}
+
+_NOISE_KERNEL = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float32)
+
+
+def assess_image_quality(pil_img: Image.Image, proxy_size: int = TRIAGE_PROXY_SIZE) -> Dict[str, float]:
+    """
+    在缩略图上快速评估画质
+
+    - sharpness: 拉普拉斯方差，越大越清晰
+    - spread: 灰度直方图P0.5到P99.5的跨度，越大对比度越好
+    - noise: 噪声标准差估计（Immerkær算子残差的鲁棒中位数）
+    """
+    proxy = pil_img.convert("L")
+    proxy.thumbnail((proxy_size, proxy_size), Image.Resampling.BILINEAR)
+    gray = np.asarray(proxy)
+
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_32F).var())
+    p_low, p_high = np.percentile(gray, (0.5, 99.5))
+    residual = np.abs(cv2.filter2D(gray.astype(np.float32), -1, _NOISE_KERNEL)[1:-1, 1:-1])
+    noise = float(1.4826 * np.median(residual) / 6.0)
+
+    return {
+        "sharpness": round(sharpness, 1),
+        "spread": float(p_high - p_low),
+        "noise": round(noise, 2),
+    }
+
+
+def choose_enhancement_level(quality: Dict[str, float]) -> str:
+    """根据画质指标选择增强档位：skip / light / full"""
+    if quality["sharpness"] < TRIAGE_SHARP_BLURRY or quality["spread"] < TRIAGE_SPREAD_FLAT:
+        return "full"
+    if (quality["sharpness"] >= TRIAGE_SHARP_CLEAN
+            and quality["spread"] >= TRIAGE_SPREAD_CLEAN
+            and quality["noise"] < TRIAGE_NOISE_MAX):
+        return "skip"
+    return "light"
+
+
+def triaged_image_processing_pipeline(pil_img: Image.Image) -> Tuple[Image.Image, Dict[str, Any]]:
+    """
+    先分诊再增强
+
+    Returns:
+        (处理后的图片, 分诊结果 {"level": ..., "sharpness": ..., "spread": ..., "noise": ...})
+    """
+    try:
+        quality = assess_image_quality(pil_img)
+        level = choose_enhancement_level(quality)
+    except Exception as e:
+        print(f"!!! [图像增强] 画质分诊失败，按完整增强处理: {e}")
+        quality, level = {}, "full"
+
+    decision: Dict[str, Any] = {"level": level, **quality}
+    if level == "skip":
+        return pil_img, decision
+    return fast_image_processing_pipeline(pil_img, **ENHANCEMENT_PRESETS[level]), decision
+
+
 # ==============================================================================
 # 可选：独立测试函数（开发调试用）
 # ==============================================================================
@@ -17,7 +17,9 @@ import os
 import io
 import re
 import uuid
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+import time
+import asyncio
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
 from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
@@ -30,10 +32,25 @@ from PIL import Image
 import tempfile
 
 from dashscope import MultiModalConversation
-from pix2text import Pix2Text
 
 # 【V22.1】导入图像增强模块
-from image_enhancer import advanced_image_processing_pipeline
+from image_enhancer import (
+    triaged_image_processing_pipeline, load_image_fast, prepare_image_base64
+)
+
+# OCR服务层（动态批处理）
+from ocr_service import OCRBatcher, LazyEngine, schedule_background_ocr, ocr_metrics, OCR_SKIPPED_PLACEHOLDER
+from ocr_cache import ocr_cache, image_fingerprint
+from config import SOLVE_MODEL, get_solve_model_config, model_needs_local_ocr
+from model_adapter import MultiModalModelAdapter, collect_chat_response
+from deadline import (
+    Deadline, DeadlineExceeded, run_within, stage_timeout, defer_to_background,
+    CHAT_DEADLINE_SECONDS, MINIAPP_DEADLINE_SECONDS, QUESTION_GENERATE_DEADLINE_SECONDS,
+    OCR_BUDGET_SHARE, SEARCH_BUDGET_SHARE, RESPONSE_RESERVE_SECONDS, PERSIST_MIN_SECONDS,
+)
+from cancellation import (
+    CancelToken, RequestCancelled, disconnect_guard, iterate_until_cancelled, cancel_stats
+)
 
 # 【V23.0 Feature 1】导入数据库和认证模块
 try:
@@ -60,14 +77,42 @@ try:
 except Exception as e:
     print(f"!!! 配置通义千问API Key失败: {e}")
 
-# 初始化 Pix2Text OCR引擎
-print("正在初始化 Pix2Text OCR引擎...")
-try:
-    p2t = Pix2Text(analyzer_config=dict(model_name='mfd'))
-    print("Pix2Text OCR引擎初始化成功。")
-except Exception as e:
-    print(f"!!! Pix2Text初始化失败: {e}")
-    p2t = None
+# Pix2Text OCR引擎：延迟加载，服务启动后在后台线程预热，不阻塞进程启动
+def create_pix2text():
+    from pix2text import Pix2Text  # 导入即加载torch等大依赖，放到预热线程中
+    return Pix2Text(analyzer_config=dict(model_name='mfd'))
+
+p2t = LazyEngine(create_pix2text, name="Pix2Text")
+
+# OCR动态批处理器：并发到达的识别请求合并为一个批次
+ocr_batcher = OCRBatcher(p2t)
+
+# 解题模型：默认 qwen-vl-max（环境变量 SOLVE_MODEL），从 config 只读取该模型的能力标记和接口类型
+# 自带强OCR的模型（config中 ocr_enhanced=True）直接读原图，跳过本地OCR
+SOLVE_MODEL_CONFIG = get_solve_model_config()
+SOLVE_NEEDS_LOCAL_OCR = model_needs_local_ocr(SOLVE_MODEL)
+# local_oss_api / openai_compatible 类型经 model_adapter 调用配置的 api_base；dashscope_api 直接调用 dashscope
+solve_adapter = (
+    MultiModalModelAdapter(SOLVE_MODEL_CONFIG) if SOLVE_MODEL_CONFIG["type"] != "dashscope_api" else None
+)
+print(f"解题模型: {SOLVE_MODEL}（{SOLVE_MODEL_CONFIG['type']}，本地OCR: {'开启' if SOLVE_NEEDS_LOCAL_OCR else '后台运行'}）")
+
+
+@app.on_event("startup")
+async def warm_up_engines():
+    """服务开始监听后在后台预热OCR引擎，请求无需等待模型加载即可接入"""
+    p2t.start_warmup()
+
+
+@app.get("/health")
+def health():
+    """存活与预热状态：OCR引擎未就绪时 status 为 warming_up"""
+    status = p2t.get_status()
+    return {
+        "status": "ok" if status["ready"] else ("degraded" if status["state"] == "failed" else "warming_up"),
+        "ocr_engine": status,
+        "cancellation": cancel_stats.get_stats(),
+    }
 
 # --- 2. FastAPI应用配置 ---
 app.add_middleware(
@@ -176,52 +221,51 @@ def read_root():
 def image_preprocess_v2(img: Image.Image) -> Image.Image:
     """
     对图片进行预处理，优化OCR识别效果
+
+    - JPEG草稿模式直接按目标尺寸解码，并按EXIF方向旋转一次（最长边不超过2000）
+    - 不再裁剪：内容裁剪只在接口入口的 prepare_image_base64 中做一次，OCR与大模型看到同一张图
     """
-    # 转为RGB模式
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
-    
-    # 调整尺寸 - 确保图片不会太小或太大
-    width, height = img.size
-    max_dimension = 2000
-    if max(width, height) > max_dimension:
-        scale = max_dimension / max(width, height)
-        new_width = int(width * scale)
-        new_height = int(height * scale)
-        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-    
-    return img
+    return load_image_fast(img, max_dimension=2000)
 
 # --- OCR识别函数 (使用Pix2Text) ---
-def extract_text_with_pix2text(image: Image.Image) -> str:
+def extract_text_with_pix2text(image: Image.Image, deadline: Optional[Deadline] = None,
+                               cancel_token: Optional[CancelToken] = None) -> str:
     """
     使用Pix2Text识别图片中的文字和公式，返回清洁的LaTeX文本
     
     【V22.1更新】集成智能图像增强流水线：
-    1. 基础预处理（尺寸、格式）
+    1. 基础预处理（快速解码、方向校正、内容裁剪）
     2. 高级画质优化（锐化 + CLAHE对比度增强）
     3. OCR识别（Pix2Text）
-    4. 降级策略：如果增强后OCR失败，则使用原始预处理图像重试
+    4. 降级策略：如果增强后OCR失败，则使用原始预处理图像重试（请求预算已用完时跳过）
     """
-    if p2t is None:
+    if not p2t.wait_ready():
         return "[OCR引擎未初始化]"
     
+    # 基础预处理（快速解码、方向校正），缓存键基于规范化后的图片像素
+    image = image_preprocess_v2(image)
+    
+    # OCR结果缓存：像素完全相同的图片直接复用上次结果（近似匹配需显式开启并经缩略图确认）
+    fingerprint = image_fingerprint(image)
+    cached_text = ocr_cache.lookup(fingerprint)
+    if cached_text is not None:
+        print(f"[OCR缓存] ⚡ 命中缓存，跳过OCR（{len(cached_text)} 个字符）")
+        return cached_text
+    
     try:
-        # 步骤1：基础预处理（统一格式、调整尺寸）
-        print("[OCR流程] 步骤1: 基础预处理")
-        processed_img = image_preprocess_v2(image)
+        # 步骤1：基础预处理已在查缓存前完成
+        processed_img = image
         
-        # 【新增V22.1】步骤2：高级图像增强（锐化 + 对比度增强）
-        print("[OCR流程] 步骤2: 调用高级图像增强流水线")
-        enhanced_img = advanced_image_processing_pipeline(
-            processed_img, 
-            sharpen_amount=1.5,      # 锐化强度（1.0-2.0）
-            clahe_clip_limit=2.0     # 对比度限制（1.0-4.0）
-        )
+        # 【新增V22.1】步骤2：画质分诊 + 图像增强（干净图片跳过，其余按档位锐化 + 对比度增强）
+        print("[OCR流程] 步骤2: 画质分诊并按需增强")
+        enhance_start = time.perf_counter()
+        enhanced_img, decision = triaged_image_processing_pipeline(processed_img)
+        ocr_metrics.record_enhancement(decision, (time.perf_counter() - enhance_start) * 1000)
+        print(f"[OCR流程] 增强档位: {decision['level']}")
         
         # 步骤3：使用增强后的图像进行OCR识别
         print("[OCR流程] 步骤3: 使用增强后的图像进行OCR识别")
-        result = p2t.recognize(enhanced_img)
+        result = ocr_batcher.recognize(enhanced_img, cancel_token)
         
         # 提取文本内容
         if isinstance(result, dict) and 'text' in result:
@@ -236,16 +280,23 @@ def extract_text_with_pix2text(image: Image.Image) -> str:
         ocr_text = ocr_text.strip()
         
         print(f"[OCR识别成功] ✅ 提取了 {len(ocr_text)} 个字符")
+        ocr_cache.store(fingerprint, ocr_text)
         return ocr_text
     
     except Exception as e:
         # 【新增V22.1】降级策略：如果增强后OCR失败，尝试使用原始预处理图像
         print(f"!!! [OCR流程] 使用增强图像识别失败: {e}")
+        if cancel_token is not None and cancel_token.cancelled:
+            print(f"[OCR流程] 🔌 客户端已断开，放弃OCR")
+            return "[OCR已取消]"
+        if deadline is not None and deadline.expired:
+            print(f"[OCR流程] ⏱️ 请求时间预算已用完，跳过降级重试")
+            return "[OCR识别失败]"
         print(f"[OCR流程] 🔄 启动降级策略：尝试使用原始预处理图像...")
         
         try:
             # 使用未经高级增强的 processed_img 重试
-            result = p2t.recognize(processed_img)
+            result = ocr_batcher.recognize(processed_img)
             
             # 提取文本内容
             if isinstance(result, dict) and 'text' in result:
@@ -260,6 +311,7 @@ def extract_text_with_pix2text(image: Image.Image) -> str:
             ocr_text = ocr_text.strip()
             
             print(f"[OCR识别成功] ✅ 降级策略成功，提取了 {len(ocr_text)} 个字符")
+            ocr_cache.store(fingerprint, ocr_text)
             return ocr_text
             
         except Exception as fallback_error:
@@ -267,16 +319,39 @@ def extract_text_with_pix2text(image: Image.Image) -> str:
             print(f"!!! [OCR流程] 降级策略也失败了: {fallback_error}")
             return "[OCR识别失败]"
 
+
+async def ocr_within_budget(image: Image.Image, deadline: Deadline,
+                            cancel_token: Optional[CancelToken] = None) -> str:
+    """在时间预算内完成OCR；超出 OCR_BUDGET_SHARE 份额时改为纯图片模式（模型直接读图）"""
+    try:
+        return await run_within(deadline, "OCR", extract_text_with_pix2text, image, deadline, cancel_token,
+                                share=OCR_BUDGET_SHARE)
+    except DeadlineExceeded:
+        print("⏱️ [时间预算] OCR未在预算内完成，改为纯图片模式")
+        return OCR_SKIPPED_PLACEHOLDER
+
 # --- 统一的AI调用函数 ---
-def call_qwen_vl_max(messages: list, model: str = 'qwen-vl-max', max_tokens: int = 8192) -> dict:
+def call_qwen_vl_max(messages: list, model: str = SOLVE_MODEL, max_tokens: int = 8192,
+                     deadline: Optional[Deadline] = None, cancel_token: Optional[CancelToken] = None) -> dict:
     """
     调用通义千问模型并返回包含'content'和'finish_reason'的字典。
+    传入deadline时，上游请求超时不超过请求剩余的时间预算；
+    传入cancel_token时改为流式调用，客户端断开后立即中止生成。
     """
     print(f"\n--- 正在调用通义千问 '{model}' API，历史记录有 {len(messages)} 条... ---")
+    extra_args = {}
+    if deadline is not None:
+        # 上游HTTP超时不超过请求剩余预算（dashscope默认300秒）
+        extra_args["request_timeout"] = max(1, int(stage_timeout(deadline, 300, "模型调用")))
+    if solve_adapter is not None:
+        return call_solve_adapter(messages, max_tokens, extra_args.get("request_timeout"), cancel_token)
+    if cancel_token is not None:
+        return call_qwen_vl_streaming(messages, model, max_tokens, extra_args, cancel_token)
     response = dashscope.MultiModalConversation.call(
         model=model,
         messages=messages,
-        max_output_tokens=max_tokens
+        max_output_tokens=max_tokens,
+        **extra_args
     )
     
     if response.status_code != 200:
@@ -306,6 +381,61 @@ def call_qwen_vl_max(messages: list, model: str = 'qwen-vl-max', max_tokens: int
     
     return {"content": text_content, "finish_reason": finish_reason, "is_truncated": is_truncated}
 
+
+def call_solve_adapter(messages: list, max_tokens: int, timeout: Optional[float],
+                       cancel_token: Optional[CancelToken]) -> dict:
+    """
+    经 model_adapter 流式调用 OpenAI 兼容接口的解题模型（返回格式同 call_qwen_vl_max），
+    传入cancel_token时客户端断开后关闭上游流
+    """
+    chunks = solve_adapter.call(messages, stream=True, max_tokens=max_tokens, timeout=timeout)
+    if cancel_token is not None:
+        chunks = iterate_until_cancelled(chunks, cancel_token)
+    return collect_chat_response(chunks)
+
+
+def call_qwen_vl_streaming(messages: list, model: str, max_tokens: int, extra_args: dict,
+                           cancel_token: CancelToken) -> dict:
+    """
+    流式调用通义千问：每收到一块都检查客户端是否已断开，
+    断开时关闭上游HTTP流，不再生成剩余内容
+    """
+    responses = dashscope.MultiModalConversation.call(
+        model=model,
+        messages=messages,
+        max_output_tokens=max_tokens,
+        stream=True,
+        incremental_output=True,
+        **extra_args
+    )
+    
+    parts = []
+    finish_reason = None
+    try:
+        for chunk in iterate_until_cancelled(responses, cancel_token):
+            if chunk.status_code != 200:
+                raise Exception(f"通义千问API调用失败: {chunk.message}")
+            choice = chunk.output.choices[0]
+            content_data = choice.message.content
+            if isinstance(content_data, list):
+                parts.extend(part["text"] for part in content_data if part.get("text"))
+            elif isinstance(content_data, str):
+                parts.append(content_data)
+            finish_reason = getattr(choice, "finish_reason", None)
+    except RequestCancelled:
+        cancel_token.record("model_chars_discarded", sum(len(p) for p in parts))
+        raise
+    
+    text_content = "".join(parts)
+    if not text_content:
+        raise ValueError("通义千问未返回有效的文本内容。")
+    
+    return {
+        'content': text_content,
+        'finish_reason': finish_reason,
+        'is_truncated': finish_reason == 'length'
+    }
+
 # --- Pydantic模型，用于校验前端发来的JSON数据 ---
 class ChatRequest(BaseModel):
     session_id: Optional[str] = None
@@ -314,7 +444,14 @@ class ChatRequest(BaseModel):
 
 # --- 【全新】的统一聊天接口 (混合输入架构版) ---
 @app.post("/chat")
-async def chat_with_ai(request: ChatRequest):
+async def chat_with_ai(request: ChatRequest, http_request: Request):
+    """AI解题/批改接口（客户端断开时取消OCR和模型生成）"""
+    async with disconnect_guard(http_request, "/chat") as cancel_token:
+        return await handle_chat(request, cancel_token)
+
+
+async def handle_chat(request: ChatRequest, cancel_token: CancelToken):
+    """/chat 的处理流程"""
     print(f"\n{'#'*70}")
     print(f"# /chat 接口被调用")
     print(f"# session_id: {request.session_id}")
@@ -330,6 +467,7 @@ async def chat_with_ai(request: ChatRequest):
     print(f"[会话检查] 当前活跃会话数: {len(SESSIONS)}")
     
     temp_image_path = None # 初始化临时文件路径变量
+    deadline = Deadline(CHAT_DEADLINE_SECONDS, "/chat")
     try:
         # --- 1. 初始化或加载会话历史 ---
         if is_new_session:
@@ -344,6 +482,10 @@ async def chat_with_ai(request: ChatRequest):
             print(f"[新会话] 创建会话: {session_id}")
             print(f"[新会话] 图片大小: {len(request.image_base_64)} 字符")
             
+            # 快速解码 + 内容裁剪，发送给模型和保存到会话的都是压缩后的图片
+            request.image_base_64 = await asyncio.to_thread(prepare_image_base64, request.image_base_64)
+            print(f"[新会话] 预处理后图片大小: {len(request.image_base_64)} 字符")
+            
             SESSIONS[session_id] = {
                 "history": [], 
                 "title": "新对话",
@@ -375,7 +517,19 @@ async def chat_with_ai(request: ChatRequest):
             print("[混合输入架构] 步骤1: 使用Pix2Text进行OCR识别...")
             image_bytes = base64.b64decode(request.image_base_64)
             image = Image.open(io.BytesIO(image_bytes))
-            ocr_text = extract_text_with_pix2text(image)
+            if SOLVE_NEEDS_LOCAL_OCR:
+                ocr_text = await cancel_token.run(ocr_within_budget(image, deadline, cancel_token), "OCR")
+                SESSIONS[session_id]["ocr_text"] = ocr_text
+            else:
+                # 模型自带强OCR：不等待本地识别，OCR转入后台，结果只用于会话记录和检索
+                print(f"[混合输入架构] ⚡ {SOLVE_MODEL} 自带强OCR，本地OCR转入后台")
+                ocr_text = OCR_SKIPPED_PLACEHOLDER
+                
+                def _save_ocr_text(text: str):
+                    if session_id in SESSIONS:
+                        SESSIONS[session_id]["ocr_text"] = text
+                
+                schedule_background_ocr(extract_text_with_pix2text, image, on_done=_save_ocr_text)
             
             # B路: 保留原始图片
             print("[混合输入架构] 步骤2: 构建混合输入消息...")
@@ -485,7 +639,10 @@ async def chat_with_ai(request: ChatRequest):
         print(f"{'='*60}")
         
         try:
-            ai_response = call_qwen_vl_max(messages_to_send)
+            ai_response = await cancel_token.run(run_within(
+                deadline, "模型调用", call_qwen_vl_max, messages_to_send, SOLVE_MODEL, 8192, deadline, cancel_token,
+                reserve=RESPONSE_RESERVE_SECONDS
+            ), "模型调用")
             full_response = ai_response['content']
             
             print(f"\n{'='*60}")
@@ -581,6 +738,17 @@ async def chat_with_ai(request: ChatRequest):
         print(f"{'!'*70}\n")
         raise
         
+    except DeadlineExceeded as e:
+        print(f"⏱️ [时间预算] /chat 未能在 {CHAT_DEADLINE_SECONDS:.0f} 秒内完成: {e}")
+        raise HTTPException(status_code=504, detail=f"处理超时，请稍后重试（{e}）")
+        
+    except RequestCancelled as e:
+        # 客户端已断开：丢弃未完成的新会话，响应不会被接收
+        print(f"🔌 [请求取消] {e}")
+        if is_new_session:
+            SESSIONS.pop(session_id, None)
+        return JSONResponse(status_code=499, content={"detail": str(e)})
+        
     except Exception as e:
         print(f"\n{'!'*70}")
         print(f"!!! /chat 接口发生未预期的错误")
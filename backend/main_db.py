@@ -12,14 +12,15 @@
 """
 
 import os
+import json
 import base64
 import asyncio
 import tempfile
 from datetime import datetime, timezone, timedelta
-from typing import Optional, List
+from typing import Optional, List, Tuple
 from pathlib import Path
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Depends
-from fastapi.responses import PlainTextResponse, FileResponse, StreamingResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Depends, Request, Query
+from fastapi.responses import PlainTextResponse, FileResponse, StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import dashscope
@@ -31,9 +32,32 @@ from database import (
     UserManager,
     SubjectManager,
     ExamManager,
-    ChatManager,
     MistakeManager,
-    get_db_connection
+    get_db_connection,
+    get_pool_stats,
+    get_batch_pool_stats,
+    build_mistake_list_query,
+    count_user_subjects,
+    keyset_params,
+    next_page_cursor,
+    KEYSET_CONDITION,
+    OWNED_BY_USER_CONDITION,
+    KEYSET_ORDER,
+    link_knowledge_tags,
+    backfill_knowledge_tags,
+    reconcile_stat_counters,
+    persist_mistake
+)
+from blob_store import blob_router, store_image_base64, list_image_fields, release_image
+from write_behind import chat_write_queue
+from session_cache import session_cache, cached_message, CHAT_CONTEXT_MESSAGES
+from query_profiler import get_query_stats
+from database_async import (
+    AsyncChatManager,
+    AsyncMistakeManager,
+    close_async_pool,
+    get_async_pool_stats,
+    get_async_batch_pool_stats
 )
 
 # 导入认证模块
@@ -41,6 +65,14 @@ from auth_api import router as auth_router, get_current_user
 
 # 导入图像增强模块
 from image_enhancer import advanced_image_processing_pipeline
+from task_scheduler import scheduler
+from deadline import (
+    Deadline, DeadlineExceeded, run_within, defer_to_background,
+    CHAT_DEADLINE_SECONDS, RESPONSE_RESERVE_SECONDS, PERSIST_MIN_SECONDS,
+)
+from cancellation import CancelToken, RequestCancelled, disconnect_guard, iterate_until_cancelled, cancel_stats
+from config import SOLVE_MODEL, get_solve_model_config
+from model_adapter import MultiModalModelAdapter, collect_chat_response
 
 # ==============================================================================
 # 初始化
@@ -59,10 +91,50 @@ if dashscope.api_key:
 else:
     print("❌ 警告：未找到API密钥，请检查.env文件")
 
+# 解题模型（/solve、/chat、/api/v2/chat、多页作业）：默认 qwen-vl-max（环境变量 SOLVE_MODEL），
+# 与 main.py / main_simple.py 使用同一个设置
+SOLVE_MODEL_CONFIG = get_solve_model_config()
+solve_adapter = (
+    MultiModalModelAdapter(SOLVE_MODEL_CONFIG) if SOLVE_MODEL_CONFIG["type"] != "dashscope_api" else None
+)
+
 app = FastAPI(title="沐梧AI - 数据库版本", version="V25.1")
 
-# 初始化数据库连接池
-init_database_pool()
+# 统计计数对账间隔（秒），默认每 6 小时一次（修复外键级联删除等触发器覆盖不到的偏差）；
+# 设为 0 关闭。多个进程同时到点时由 MySQL 命名锁保证只有一个执行
+STATS_RECONCILE_INTERVAL_SECONDS = float(os.getenv("STATS_RECONCILE_INTERVAL_SECONDS", "21600"))
+_stats_reconcile_task: Optional[asyncio.Task] = None
+
+
+async def _reconcile_stats_periodically():
+    """定期按基础表对账统计计数（计数由触发器维护，这里只修复偏差）"""
+    while True:
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL_SECONDS)
+        try:
+            await asyncio.to_thread(reconcile_stat_counters)
+        except Exception as e:
+            print(f"⚠️ [统计对账] 失败: {e}")
+
+
+@app.on_event("startup")
+async def warm_up_database_pool():
+    """服务启动后在后台预热数据库连接池（不在导入时阻塞建连），并迁移旧数据中的内联图片、补写知识点标签"""
+    global _stats_reconcile_task
+    init_database_pool()
+    defer_to_background(MistakeManager.migrate_inline_images)
+    defer_to_background(backfill_knowledge_tags)
+    if STATS_RECONCILE_INTERVAL_SECONDS > 0:
+        _stats_reconcile_task = asyncio.create_task(_reconcile_stats_periodically())
+    await chat_write_queue.start()
+
+
+@app.on_event("shutdown")
+async def close_database_pools():
+    """服务关闭时停止对账任务、写完对话写入队列并释放异步连接池"""
+    if _stats_reconcile_task is not None:
+        _stats_reconcile_task.cancel()
+    await chat_write_queue.stop()
+    await close_async_pool()
 
 # CORS配置 - 允许前端跨域访问
 origins = [
@@ -82,6 +154,7 @@ app.add_middleware(
 
 # 注册认证路由
 app.include_router(auth_router)
+app.include_router(blob_router)
 
 # ==============================================================================
 # 数据模型
@@ -161,6 +234,46 @@ def read_root():
         "api_docs": "http://127.0.0.1:8000/docs"
     }
 
+
+@app.get("/health")
+def health():
+    """存活检查与运行统计"""
+    return {
+        "status": "ok",
+        "scheduler": scheduler.get_stats(),
+        "cancellation": cancel_stats.get_stats(),
+        "db_pool": get_pool_stats(),
+        "db_batch_pool": get_batch_pool_stats(),
+        "async_db_pool": get_async_pool_stats(),
+        "async_db_batch_pool": get_async_batch_pool_stats(),
+        "chat_write_queue": chat_write_queue.get_stats(),
+        "chat_session_cache": session_cache.get_stats(),
+    }
+
+
+# 允许查看数据库查询统计的账号（逗号分隔）；未配置时接口关闭（返回404），
+# 统计中含语句指纹、调用方法和 EXPLAIN，不对普通注册用户开放
+DB_QUERY_STATS_ACCOUNTS = {a.strip() for a in os.getenv("DB_QUERY_STATS_ACCOUNTS", "").split(",") if a.strip()}
+
+# 单次返回的方法/语句条数上限
+DB_QUERY_STATS_MAX_TOP = 100
+
+
+@app.get("/health/db-queries")
+def health_db_queries(
+    top: int = Query(20, ge=1, le=DB_QUERY_STATS_MAX_TOP),
+    user: dict = Depends(get_current_user)
+):
+    """
+    数据库查询统计（仅 DB_QUERY_STATS_ACCOUNTS 中的账号）：按调用方法和语句指纹聚合的耗时直方图
+    （按总耗时排序）、借出连接的等待时间，以及最近的慢查询（附 EXPLAIN）
+    """
+    if not DB_QUERY_STATS_ACCOUNTS:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if user["account"] not in DB_QUERY_STATS_ACCOUNTS:
+        raise HTTPException(status_code=403, detail="无权查看数据库查询统计")
+    return get_query_stats(top)
+
 # ==============================================================================
 # AI解题功能（保留原功能，添加认证）
 # ==============================================================================
@@ -189,20 +302,15 @@ async def solve_question(
             ]
         }]
         
-        response = dashscope.MultiModalConversation.call(
-            model='qwen-vl-max',
-            messages=messages
-        )
-        
-        if response.status_code == 200:
-            answer = response.output.choices[0].message.content[0]['text']
-            return {
-                "success": True,
-                "answer": answer,
-                "user_id": user["user_id"]
-            }
-        else:
+        try:
+            answer = call_solve_model(messages)
+        except Exception:
             raise HTTPException(status_code=500, detail="AI解题失败")
+        return {
+            "success": True,
+            "answer": answer,
+            "user_id": user["user_id"]
+        }
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -247,16 +355,11 @@ async def chat_with_image(
             messages = [{'role': 'user', 'content': prompt}]
         
         # 调用AI
-        response = dashscope.MultiModalConversation.call(
-            model='qwen-vl-max',
-            messages=messages
-        )
-        
-        if response.status_code != 200:
+        try:
+            ai_response = call_solve_model(messages)
+        except Exception:
             raise HTTPException(status_code=500, detail="AI调用失败")
         
-        ai_response = response.output.choices[0].message.content[0]['text']
-        
         # 如果是批改模式，检测是否有错题并自动保存
         mistake_saved = False
         knowledge_points = []
@@ -287,86 +390,33 @@ async def chat_with_image(
                 except:
                     knowledge_points = ['未分类']
                 
-                # 保存错题到数据库
-                import uuid
-                import json
+                # 图片存入图片存储，数据库只保存引用
+                image_url = store_image_base64(image_base64)
                 
-                subject_id = str(uuid.uuid4())
-                
-                # 创建subject记录（使用with语句管理数据库连接）
+                # 保存错题到数据库（题目、知识点、错题本关联在一个事务中一次写入）
                 try:
-                    with get_db_connection() as conn:
-                        cursor = conn.cursor()
-                        
-                        # 插入subject表
-                        cursor.execute("""
-                            INSERT INTO subject (
-                                subject_id, subject_title, subject_desc, 
-                                solve, answer, explanation,
-                                subject_type, difficulty, knowledge_points,
-                                subject_name, grade, created_at
-                            ) VALUES (
-                                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW()
-                            )
-                        """, (
-                            subject_id,
-                            "批改发现的错题",  # subject_title
-                            prompt[:200],  # subject_desc（截取prompt前200字）
-                            "",  # solve
-                            "",  # answer
-                            ai_response,  # explanation（AI批改结果）
-                            "mistake",  # subject_type
-                            "中等",  # difficulty
-                            json.dumps(knowledge_points, ensure_ascii=False),  # knowledge_points
-                            knowledge_points[0] if knowledge_points else "未分类",  # subject_name
-                            "未分类",  # grade
-                        ))
-                        
-                        # 获取或创建用户的错题本试卷
-                        cursor.execute("""
-                            SELECT exam_id FROM exam 
-                            WHERE exam_title LIKE %s AND exam_type = 'mistake'
-                            LIMIT 1
-                        """, (f"{user['account']}的错题本%",))
-                        
-                        exam_result = cursor.fetchone()
-                        
-                        if exam_result:
-                            exam_id = exam_result['exam_id']
-                        else:
-                            # 创建新的错题本试卷
-                            exam_id = str(uuid.uuid4())
-                            cursor.execute("""
-                                INSERT INTO exam (exam_id, exam_title, exam_content, exam_type, created_at)
-                                VALUES (%s, %s, %s, 'mistake', NOW())
-                            """, (
-                                exam_id,
-                                f"{user['account']}的错题本",
-                                "自动保存的错题"
-                            ))
-                        
-                        # 插入user_exam关联
-                        cursor.execute("""
-                            INSERT INTO user_exam (
-                                id, user_info, subject_id, exam_id,
-                                answered_at, user_answer, status
-                            ) VALUES (
-                                %s, %s, %s, %s, NOW(), %s, 'wrong'
-                            )
-                        """, (
-                            str(uuid.uuid4()),
-                            user_id,
-                            subject_id,
-                            exam_id,
-                            "错误答案（批改发现）"
-                        ))
-                        
-                        conn.commit()
-                        mistake_saved = True
-                        cursor.close()
-                        
+                    persist_mistake(
+                        user_id,
+                        {
+                            "subject_title": "批改发现的错题",
+                            "subject_desc": prompt[:200],  # 截取prompt前200字
+                            "image_url": image_url,  # 图片存储引用
+                            "solve": "",
+                            "answer": "",
+                            "explanation": ai_response,  # AI批改结果
+                            "difficulty": "中等",
+                            "subject_name": knowledge_points[0] if knowledge_points else "未分类",
+                            "grade": "未分类",
+                        },
+                        knowledge_points=knowledge_points,
+                        user_answer="错误答案（批改发现）",
+                        status="wrong",
+                        book_title=f"{user['account']}的错题本"
+                    )
+                    mistake_saved = True
                 except Exception as e:
                     print(f"[错题保存失败] {str(e)}")
+                    release_image(image_url)
                     import traceback
                     traceback.print_exc()
         
@@ -398,73 +448,31 @@ async def create_mistake(
     """
     user_id = user["user_id"]
     
-    # 创建subject记录
-    import json
-    subject_id = SubjectManager.create_subject(
-        subject_title=mistake.question_text,
-        subject_desc="用户上传的错题",
-        image_url=f"data:image/png;base64,{mistake.image_base64[:100]}...",
-        solve=mistake.ai_analysis
-    )
-    
-    # 更新subject的额外字段
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """UPDATE subject SET 
-               subject_type = %s,
-               subject_name = %s,
-               grade = %s,
-               knowledge_points = %s,
-               answer = %s,
-               explanation = %s
-               WHERE subject_id = %s""",
-            (
-                'mistake',
-                mistake.subject,
-                mistake.grade,
-                json.dumps(mistake.knowledge_points, ensure_ascii=False),
-                mistake.wrong_answer,
-                mistake.ai_analysis,
-                subject_id
-            )
-        )
-        
-        # 获取用户的错题本试卷ID
-        cursor.execute(
-            """SELECT exam_id FROM exam 
-               WHERE exam_type = 'mistake_book' 
-               AND exam_id IN (
-                   SELECT DISTINCT exam_id FROM user_exam WHERE user_info = %s
-               )
-               LIMIT 1""",
-            (user_id,)
-        )
-        
-        exam_result = cursor.fetchone()
-        if not exam_result:
-            # 如果没有错题本，创建一个
-            from database import ExamManager
-            exam_id = ExamManager.create_exam(
-                exam_title=f"{user['account']}的错题本",
-                exam_content="记录所有错题"
-            )
-            cursor.execute(
-                "UPDATE exam SET exam_type = %s WHERE exam_id = %s",
-                ('mistake_book', exam_id)
-            )
-        else:
-            exam_id = exam_result['exam_id']
-        
-        # 关联用户-试卷-题目
-        ExamManager.link_user_exam_subject(user_id, exam_id, subject_id)
-        
-        # 获取创建时间
-        cursor.execute(
-            "SELECT created_at FROM subject WHERE subject_id = %s",
-            (subject_id,)
+    # 题目、知识点、错题本关联在一个事务中一次写入
+    created_at = datetime.now().replace(microsecond=0)
+    image_ref = store_image_base64(mistake.image_base64)
+    try:
+        subject_id = persist_mistake(
+            user_id,
+            {
+                "subject_title": mistake.question_text,
+                "subject_desc": "用户上传的错题",
+                "image_url": image_ref,
+                "solve": mistake.ai_analysis,
+                "subject_name": mistake.subject,
+                "grade": mistake.grade,
+                "answer": mistake.wrong_answer,
+                "explanation": mistake.ai_analysis,
+                "created_at": created_at,
+            },
+            knowledge_points=mistake.knowledge_points,
+            status="wrong",
+            book_title=f"{user['account']}的错题本"
         )
-        created_at = cursor.fetchone()['created_at']
+    except Exception:
+        # 保存失败时撤销本次图片引用
+        release_image(image_ref)
+        raise
     
     return MistakeResponse(
         id=subject_id,
@@ -475,92 +483,78 @@ async def create_mistake(
         subject=mistake.subject,
         grade=mistake.grade,
         knowledge_points=mistake.knowledge_points,
-        created_at=created_at.isoformat() if created_at else datetime.now().isoformat(),
+        created_at=created_at.isoformat(),
         reviewed_count=0
     )
 
+# 列表接口的 offset 参数已废弃（OpenAPI 中标记为 deprecated），新客户端只用 cursor 翻页
+OFFSET_DEPRECATED = "已废弃：请使用上一页返回的 next_cursor 翻页；offset 越大越慢，且不能与 cursor 同时传入"
+
+
+def reject_offset_with_cursor(offset: int, cursor: Optional[str]):
+    """cursor 和 offset 同时传入时返回400（游标分页后再跳过 offset 条会退化为按 offset 扫描）"""
+    if cursor and offset:
+        raise HTTPException(status_code=400, detail="cursor 与 offset 不能同时使用，请只传 cursor")
+
+
 @app.get("/mistakes/")
 async def get_mistakes(
     subject: Optional[str] = None,
     grade: Optional[str] = None,
     limit: int = 100,
-    offset: int = 0,
+    offset: int = Query(0, ge=0, deprecated=True, description=OFFSET_DEPRECATED),
+    cursor: Optional[str] = None,
     user: dict = Depends(get_current_user)
 ):
     """
     获取错题列表（需要认证）
     
     只返回当前用户的错题
+    - 翻页使用上一页返回的 next_cursor（每页耗时与页码无关）
+    - offset 已废弃：仅为兼容旧客户端保留（耗时随 offset 增长），不能与 cursor 同时使用
+    - total 与列表使用同一归属和筛选条件，是逐页翻完能得到的错题数
     """
     user_id = user["user_id"]
+    reject_offset_with_cursor(offset, cursor)
+    
+    try:
+        query, params = build_mistake_list_query(
+            user_id, subject_name=subject, grade=grade, limit=limit, page_cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if offset:
+        query += " OFFSET %s"
+        params.append(offset)
     
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # 构建查询
-        query = """
-            SELECT s.*, ue.answered_at, ue.user_answer, ue.status
-            FROM subject s
-            JOIN user_exam ue ON s.subject_id = ue.subject_id
-            WHERE ue.user_info = %s AND s.subject_type = 'mistake'
-        """
-        params = [user_id]
-        
-        if subject:
-            query += " AND s.subject_name = %s"
-            params.append(subject)
-        
-        if grade:
-            query += " AND s.grade = %s"
-            params.append(grade)
-        
-        query += " ORDER BY s.created_at DESC LIMIT %s OFFSET %s"
-        params.extend([limit, offset])
-        
-        cursor.execute(query, params)
-        mistakes = cursor.fetchall()
-        
-        # 【修复】格式化返回数据，包含完整图片和解析
-        items = []
-        import json
-        for m in mistakes:
-            # 【修复】提取完整的图片base64（移除data URI前缀）
-            image_data = ""
-            if m['image_url']:
-                if m['image_url'].startswith('data:image'):
-                    # 移除 "data:image/jpeg;base64," 前缀
-                    image_data = m['image_url'].split(',', 1)[1] if ',' in m['image_url'] else m['image_url']
-                else:
-                    image_data = m['image_url']
-            
-            # 【调试】打印数据库原始字段
-            print(f"\n[错题查询调试] 错题ID: {m['subject_id']}")
-            print(f"  - subject_title: {m.get('subject_title', 'None')[:50] if m.get('subject_title') else 'None'}")
-            print(f"  - subject_desc: {m.get('subject_desc', 'None')[:50] if m.get('subject_desc') else 'None'}")
-            print(f"  - solve: {m.get('solve', 'None')[:50] if m.get('solve') else 'None'}")
-            print(f"  - explanation: {m.get('explanation', 'None')[:50] if m.get('explanation') else 'None'}")
-            print(f"  - answer: {m.get('answer', 'None')[:50] if m.get('answer') else 'None'}")
-            print(f"  - image_url: {'有图片' if m.get('image_url') else '无图片'}")
-            
-            items.append({
-                "id": m['subject_id'],
-                "image_base64": image_data,  # 【修复】返回完整图片
-                "question_text": m['subject_desc'] or m['subject_title'] or "错题",  # 【修复】使用题目描述
-                "wrong_answer": m['answer'] or "",
-                "ai_analysis": m['solve'] or m['explanation'] or "",  # 【修复】使用完整解析
-                "subject": m['subject_name'] or "未分类",
-                "grade": m['grade'] or "未分类",
-                "knowledge_points": json.loads(m['knowledge_points']) if m['knowledge_points'] else [],
-                "created_at": m['created_at'].isoformat() if m['created_at'] else "",
-                "reviewed_count": 0  # TODO: 从user_exam表统计
-            })
-        
-        return {
-            "total": len(items),
-            "items": items,
-            "offset": offset,
-            "limit": limit
-        }
+        db_cursor = conn.cursor()
+        db_cursor.execute(query, params)
+        mistakes = db_cursor.fetchall()
+        total = count_user_subjects(db_cursor, user_id, 'mistake', subject, grade)
+    
+    items = []
+    for m in mistakes:
+        items.append({
+            "id": m['subject_id'],
+            **list_image_fields(m['image_url']),  # 列表只返回缩略图，原图按 image_url 单独获取
+            "question_text": m['subject_desc'] or m['subject_title'] or "错题",  # 【修复】使用题目描述
+            "wrong_answer": m['answer'] or "",
+            "ai_analysis": m['ai_analysis'] or "",  # 【修复】使用完整解析
+            "subject": m['subject_name'] or "未分类",
+            "grade": m['grade'] or "未分类",
+            "knowledge_points": json.loads(m['knowledge_points']) if m['knowledge_points'] else [],
+            "created_at": m['created_at'].isoformat() if m['created_at'] else "",
+            "reviewed_count": m['review_count'] or 0
+        })
+    
+    return {
+        "total": total,
+        "items": items,
+        "offset": offset,
+        "limit": limit,
+        "next_cursor": next_page_cursor(mistakes, limit)
+    }
 
 @app.delete("/mistakes/{mistake_id}")
 async def delete_mistake(
@@ -600,7 +594,12 @@ async def delete_mistake(
         )
         
         if cursor.fetchone()['count'] == 0:
+            cursor.execute("SELECT image_url FROM subject WHERE subject_id = %s", (mistake_id,))
+            row = cursor.fetchone()
             cursor.execute("DELETE FROM subject WHERE subject_id = %s", (mistake_id,))
+            # 释放题目图片的引用（没有其他题目引用时删除文件）
+            if row:
+                release_image(row['image_url'])
     
     return {"success": True, "message": "删除成功"}
 
@@ -608,73 +607,17 @@ async def delete_mistake(
 async def get_mistakes_stats(user: dict = Depends(get_current_user)):
     """
     获取错题统计信息（需要认证）
+    
+    读取触发器维护的计数表（每个 学科×年级 一行），不再聚合题目表
     """
-    user_id = user["user_id"]
+    stats = MistakeManager.get_mistake_stats(user["user_id"])
     
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # 统计总数
-        cursor.execute(
-            """SELECT COUNT(*) as total FROM user_exam 
-               WHERE user_info = %s AND subject_id IN (
-                   SELECT subject_id FROM subject WHERE subject_type = 'mistake'
-               )""",
-            (user_id,)
-        )
-        total = cursor.fetchone()['total']
-        
-        # 统计学科
-        cursor.execute(
-            """SELECT s.subject_name, COUNT(*) as count
-               FROM subject s
-               JOIN user_exam ue ON s.subject_id = ue.subject_id
-               WHERE ue.user_info = %s AND s.subject_type = 'mistake'
-               GROUP BY s.subject_name""",
-            (user_id,)
-        )
-        subjects = {row['subject_name']: row['count'] for row in cursor.fetchall()}
-        
-        # 统计年级
-        cursor.execute(
-            """SELECT s.grade, COUNT(*) as count
-               FROM subject s
-               JOIN user_exam ue ON s.subject_id = ue.subject_id
-               WHERE ue.user_info = %s AND s.subject_type = 'mistake'
-               GROUP BY s.grade""",
-            (user_id,)
-        )
-        grades = {row['grade']: row['count'] for row in cursor.fetchall()}
-        
-        # 知识点统计
-        import json
-        cursor.execute(
-            """SELECT s.knowledge_points
-               FROM subject s
-               JOIN user_exam ue ON s.subject_id = ue.subject_id
-               WHERE ue.user_info = %s AND s.subject_type = 'mistake'
-               AND s.knowledge_points IS NOT NULL""",
-            (user_id,)
-        )
-        
-        kp_dict = {}
-        for row in cursor.fetchall():
-            if row['knowledge_points']:
-                try:
-                    kps = json.loads(row['knowledge_points'])
-                    for kp in kps:
-                        kp_dict[kp] = kp_dict.get(kp, 0) + 1
-                except:
-                    pass
-        
-        top_kps = sorted(kp_dict.items(), key=lambda x: x[1], reverse=True)[:10]
-        
-        return {
-            "total_mistakes": total,
-            "subjects": subjects,
-            "grades": grades,
-            "top_knowledge_points": top_kps
-        }
+    return {
+        "total_mistakes": stats["overall"]["total_mistakes"],
+        "subjects": {row["subject_name"]: row["count"] for row in stats["by_subject"]},
+        "grades": stats["grades"],
+        "top_knowledge_points": stats["top_knowledge_points"]
+    }
 
 # ==============================================================================
 # 【V25.1】网络辅助出题工具函数
@@ -1142,6 +1085,7 @@ async def generate_questions(
                     subject_id
                 )
             )
+            link_knowledge_tags(cursor, subject_id, all_knowledge_points, subject_str, replace=True)
             
             # 关联用户-试卷-题目
             ExamManager.link_user_exam_subject(user_id, exam_id, subject_id)
@@ -1165,64 +1109,79 @@ async def get_questions(
     subject: Optional[str] = None,
     grade: Optional[str] = None,
     limit: int = 100,
-    offset: int = 0,
+    offset: int = Query(0, ge=0, deprecated=True, description=OFFSET_DEPRECATED),
+    cursor: Optional[str] = None,
     user: dict = Depends(get_current_user)
 ):
     """
     获取生成的题目列表（需要认证）
+    
+    翻页使用上一页返回的 next_cursor；offset 已废弃，仅为兼容旧客户端保留，不能与 cursor 同时使用
     """
     user_id = user["user_id"]
+    reject_offset_with_cursor(offset, cursor)
+    
+    query = """
+        SELECT s.subject_id, s.subject_title, s.subject_desc, s.solve, s.answer,
+               s.explanation, s.knowledge_points, s.difficulty, s.subject_name,
+               s.grade, s.created_at
+        FROM subject s
+        WHERE s.subject_type = 'generated'
+    """ + OWNED_BY_USER_CONDITION
+    params = [user_id]
+    
+    if subject:
+        query += " AND s.subject_name = %s"
+        params.append(subject)
+    
+    if grade:
+        query += " AND s.grade = %s"
+        params.append(grade)
+    
+    if cursor:
+        try:
+            params.extend(keyset_params(cursor))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        query += KEYSET_CONDITION
+    
+    query += KEYSET_ORDER
+    params.append(limit)
+    if offset:
+        query += " OFFSET %s"
+        params.append(offset)
     
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        query = """
-            SELECT s.*
-            FROM subject s
-            JOIN user_exam ue ON s.subject_id = ue.subject_id
-            WHERE ue.user_info = %s AND s.subject_type = 'generated'
-        """
-        params = [user_id]
-        
-        if subject:
-            query += " AND s.subject_name = %s"
-            params.append(subject)
-        
-        if grade:
-            query += " AND s.grade = %s"
-            params.append(grade)
-        
-        query += " ORDER BY s.created_at DESC LIMIT %s OFFSET %s"
-        params.extend([limit, offset])
-        
-        cursor.execute(query, params)
-        questions = cursor.fetchall()
-        
-        import json
-        items = []
-        for q in questions:
-            # 题目内容优先使用 solve（完整内容），其次 subject_desc，最后才是 subject_title
-            content = q['solve'] or q['subject_desc'] or q['subject_title'] or ""
-            
-            items.append({
-                "id": q['subject_id'],
-                "content": content,  # 使用完整题目内容
-                "answer": q['answer'] or "",
-                "explanation": q['explanation'] or "",
-                "knowledge_points": json.loads(q['knowledge_points']) if q['knowledge_points'] else [],
-                "difficulty": q['difficulty'] or "中等",
-                "created_at": q['created_at'].isoformat() if q['created_at'] else "",
-                "subject": q['subject_name'] or "未分类",
-                "grade": q['grade'] or "未分类",
-                "title": q['subject_title'] or ""  # 添加标题字段
-            })
-        
-        return {
-            "total": len(items),
-            "items": items,
-            "offset": offset,
-            "limit": limit
-        }
+        db_cursor = conn.cursor()
+        db_cursor.execute(query, params)
+        questions = db_cursor.fetchall()
+        total = count_user_subjects(db_cursor, user_id, 'generated', subject, grade)
+    
+    items = []
+    for q in questions:
+        # 题目内容优先使用 solve（完整内容），其次 subject_desc，最后才是 subject_title
+        content = q['solve'] or q['subject_desc'] or q['subject_title'] or ""
+        
+        items.append({
+            "id": q['subject_id'],
+            "content": content,  # 使用完整题目内容
+            "answer": q['answer'] or "",
+            "explanation": q['explanation'] or "",
+            "knowledge_points": json.loads(q['knowledge_points']) if q['knowledge_points'] else [],
+            "difficulty": q['difficulty'] or "中等",
+            "created_at": q['created_at'].isoformat() if q['created_at'] else "",
+            "subject": q['subject_name'] or "未分类",
+            "grade": q['grade'] or "未分类",
+            "title": q['subject_title'] or ""  # 添加标题字段
+        })
+    
+    return {
+        "total": total,
+        "items": items,
+        "offset": offset,
+        "limit": limit,
+        "next_cursor": next_page_cursor(questions, limit)
+    }
 
 @app.delete("/questions/{question_id}")
 async def delete_question(
@@ -1628,8 +1587,13 @@ class ChatRequest(BaseModel):
     session_id: Optional[str] = None
     prompt: str
     image_base64: Optional[str] = None
+    image_base64_list: Optional[List[str]] = None  # 多页作业：按页码顺序的图片列表
+    page: Optional[int] = None  # 追问时指定针对第几页（从1开始）
     mode: str = "solve"  # solve 或 review
 
+# 批改结果中表示答案有误的关键词
+MISTAKE_KEYWORDS = ['错误', '不正确', '不对', '有误', '答案错了', '做错了', '有问题', '错了']
+
 class SessionInfo(BaseModel):
     """会话信息"""
     sessionId: str
@@ -1639,12 +1603,226 @@ class SessionInfo(BaseModel):
     imageSrc: Optional[str] = None
     messages: Optional[List[dict]] = []
 
+def save_review_mistake_to_db(user: dict, prompt: str, image_base64: str, ai_response: str) -> Tuple[bool, List[str]]:
+    """
+    批改发现错误时保存错题：提取知识点 → 写入subject → 关联到用户错题本
+
+    Returns:
+        (是否保存成功, 知识点列表)
+    """
+    user_id = user["user_id"]
+    mistake_saved = False
+    knowledge_points = []
+    
+    try:
+        print("[知识点提取] 开始提取知识点...")
+        extract_prompt = f"请从以下批改结果中提取涉及的知识点，以逗号分隔返回，不要其他内容：\n\n{ai_response}"
+        extract_response = dashscope.Generation.call(
+            model='qwen-turbo',
+            prompt=extract_prompt
+        )
+        
+        if extract_response.status_code == 200:
+            kp_text = extract_response.output.text.strip()
+            print(f"[知识点提取] 原始结果: {kp_text}")
+            knowledge_points = [kp.strip() for kp in kp_text.split('，') if kp.strip()]
+            if not knowledge_points:
+                knowledge_points = [kp.strip() for kp in kp_text.split(',') if kp.strip()]
+            print(f"[知识点提取] 提取成功: {knowledge_points}")
+        
+        if not knowledge_points:
+            knowledge_points = ['未分类']
+            print("[知识点提取] 使用默认值: ['未分类']")
+    except Exception as kp_error:
+        print(f"[知识点提取] 提取失败: {kp_error}")
+        knowledge_points = ['未分类']
+    
+    # 保存错题到数据库
+    import uuid
+    import json
+    
+    subject_id = str(uuid.uuid4())
+    
+    print(f"\n{'='*60}")
+    print(f"[错题保存] 开始保存错题到数据库...")
+    print(f"[错题保存] subject_id: {subject_id}")
+    print(f"[错题保存] 知识点: {knowledge_points}")
+    print(f"[错题保存] 用户ID: {user_id}")
+    print(f"[错题保存] 图片长度: {len(image_base64) if image_base64 else 0}")
+    print(f"{'='*60}\n")
+    
+    # 【修复】提取题目信息和解析
+    # 从AI响应中分离出题目描述和解析
+    mistake_title = f"批改于 {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+    question_desc = prompt[:500] if prompt else "上传的作业题目"
+    
+    # 保存完整的AI解析（不截断）
+    full_explanation = ai_response
+    
+    # 图片存入图片存储，数据库只保存引用（blob:<sha256>）
+    image_url = store_image_base64(image_base64)
+    
+    print(f"[错题保存] 题目标题: {mistake_title}")
+    print(f"[错题保存] 题目描述长度: {len(question_desc)}")
+    print(f"[错题保存] 解析长度: {len(full_explanation)}")
+    
+    try:
+        # 题目、知识点、错题本关联在一个事务中一次写入（错题本ID按用户缓存）
+        persist_mistake(
+            user_id,
+            {
+                "subject_id": subject_id,
+                "subject_title": mistake_title,  # 【修复】使用时间戳作为标题
+                "subject_desc": question_desc,  # 【修复】保存题目描述（用户提问或图片说明）
+                "image_url": image_url,  # 【修复】保存题目图片
+                "solve": full_explanation,  # 【修复】保存完整的AI批改结果
+                "explanation": full_explanation,  # explanation字段也保存完整解析
+                "difficulty": "中等",
+                "subject_name": knowledge_points[0] if knowledge_points else "未分类",
+                "grade": "未分类",
+            },
+            knowledge_points=knowledge_points,
+            user_answer="错误答案（批改发现）",
+            status="wrong",
+            book_title=f"{user['account']}的错题本"
+        )
+        mistake_saved = True
+        print(f"\n{'='*60}")
+        print(f"[错题保存] ✅✅✅ 错题保存成功！")
+        print(f"[错题保存] subject_id: {subject_id}")
+        print(f"[错题保存] 知识点: {', '.join(knowledge_points)}")
+        print(f"{'='*60}\n")
+    except Exception as e:
+        print(f"\n{'='*60}")
+        print(f"[错题保存] ❌❌❌ 保存失败！")
+        print(f"[错题保存] 错误: {str(e)}")
+        print(f"{'='*60}\n")
+        import traceback
+        traceback.print_exc()
+        release_image(image_url)
+    
+    return mistake_saved, knowledge_points
+
+
+def call_page_model(image_base64: str, prompt: str) -> str:
+    """多页作业：对单页图片调用配置的解题模型"""
+    return call_solve_model([{
+        'role': 'user',
+        'content': [
+            {'image': f'data:image/jpeg;base64,{image_base64}'},
+            {'text': prompt}
+        ]
+    }])
+
+
+def call_solve_model(messages: list) -> str:
+    """非流式调用配置的解题模型，返回回答文本；调用失败时抛出异常"""
+    if solve_adapter is not None:
+        return collect_chat_response(solve_adapter.call(messages, stream=True))["content"]
+    response = dashscope.MultiModalConversation.call(
+        model=SOLVE_MODEL,
+        messages=messages
+    )
+    if response.status_code != 200:
+        raise Exception(f"AI调用失败: {response.message}")
+    return response.output.choices[0].message.content[0]['text']
+
+
+def call_chat_model_streaming(messages: list, request_timeout: int, cancel_token: CancelToken) -> str:
+    """流式调用配置的解题模型；客户端断开时关闭上游HTTP流，不再生成剩余内容"""
+    if solve_adapter is not None:
+        chunks = iterate_until_cancelled(
+            solve_adapter.call(messages, stream=True, timeout=request_timeout), cancel_token
+        )
+        try:
+            return collect_chat_response(chunks)["content"]
+        except RequestCancelled:
+            raise
+        except Exception:
+            raise HTTPException(status_code=500, detail="AI调用失败")
+    responses = dashscope.MultiModalConversation.call(
+        model=SOLVE_MODEL,
+        messages=messages,
+        stream=True,
+        incremental_output=True,
+        request_timeout=request_timeout
+    )
+    parts = []
+    try:
+        for chunk in iterate_until_cancelled(responses, cancel_token):
+            if chunk.status_code != 200:
+                raise HTTPException(status_code=500, detail="AI调用失败")
+            parts.extend(part["text"] for part in chunk.output.choices[0].message.content if part.get("text"))
+    except RequestCancelled:
+        cancel_token.record("model_chars_discarded", sum(len(p) for p in parts))
+        raise
+    return "".join(parts)
+
+
+async def db_chat_multi_page(request: ChatRequest, session_id: str, session: dict, user: dict) -> dict:
+    """多页作业新会话：各页并发调用大模型（经全局调度器），返回逐页结果和合并后的总回答"""
+    pages = request.image_base64_list
+    print(f"[会话 {session_id}] 多页作业，共 {len(pages)} 页，并发处理...")
+    
+    async def run_page(page: int, image_base64: str) -> dict:
+        ai_response = await scheduler.run_model(call_page_model, image_base64, request.prompt)
+        result = {"page": page, "response": ai_response, "mistake_saved": False, "knowledge_points": []}
+        if request.mode == 'review' and any(keyword in ai_response for keyword in MISTAKE_KEYWORDS):
+            saved, knowledge_points = await scheduler.run_model(
+                save_review_mistake_to_db, user, request.prompt, image_base64, ai_response
+            )
+            result["mistake_saved"] = saved
+            result["knowledge_points"] = knowledge_points
+        print(f"[会话 {session_id}] ✓ 第{page}页完成")
+        return result
+    
+    page_results = await asyncio.gather(*[
+        run_page(i + 1, image_base64) for i, image_base64 in enumerate(pages)
+    ])
+    merged_response = "\n\n".join(f"## 第{r['page']}页\n\n{r['response']}" for r in page_results)
+    
+    # 会话中保存全部页面，追问时可以按页码引用
+    session["pages"] = pages
+    session["messages"].append({
+        'role': 'user',
+        'content': [{'image': f'data:image/jpeg;base64,{p}'} for p in pages] + [{'text': request.prompt}]
+    })
+    session["messages"].append({'role': 'assistant', 'content': merged_response})
+    
+    title = session["title"]
+    if len(request.prompt) > 5:
+        title = request.prompt[:20] + ("..." if len(request.prompt) > 20 else "")
+        session["title"] = title
+    
+    knowledge_points = []
+    for r in page_results:
+        knowledge_points.extend(kp for kp in r["knowledge_points"] if kp not in knowledge_points)
+    
+    return {
+        "success": True,
+        "response": merged_response,
+        "pages": page_results,
+        "session_id": session_id,
+        "title": title,
+        "mistake_saved": any(r["mistake_saved"] for r in page_results),
+        "knowledge_points": knowledge_points
+    }
+
+
 @app.post("/api/db/chat")
-async def db_chat(request: ChatRequest, user: dict = Depends(get_current_user)):
+async def db_chat(request: ChatRequest, http_request: Request, user: dict = Depends(get_current_user)):
     """
     数据库版本的聊天API（支持JSON请求体 + 会话管理）
+    客户端断开时中止模型生成并跳过错题入库
     """
+    async with disconnect_guard(http_request, "/api/db/chat") as cancel_token:
+        return await handle_db_chat(request, user, cancel_token)
+
+
+async def handle_db_chat(request: ChatRequest, user: dict, cancel_token: CancelToken):
+    """/api/db/chat 的处理流程"""
     user_id = user["user_id"]
+    deadline = Deadline(CHAT_DEADLINE_SECONDS, "/api/db/chat")
     
     try:
         # 获取或创建会话
@@ -1667,13 +1845,28 @@ async def db_chat(request: ChatRequest, user: dict = Depends(get_current_user)):
         
         session = chat_sessions[session_id]
         
+        # 多页作业：新会话带多张图片时各页并发处理；只有一页时按单图处理
+        if request.image_base64_list and len(request.image_base64_list) > 1 and not session["messages"]:
+            return await db_chat_multi_page(request, session_id, session, user)
+        if request.image_base64_list and not request.image_base64:
+            request.image_base64 = request.image_base64_list[0]
+        
         # 【修复】如果是第一次发送图片，保存到会话中
         if request.image_base64:
             session["image_base64"] = request.image_base64
             print(f"[会话 {session_id}] 保存图片到会话，长度: {len(request.image_base64)}")
         
         # 【修复】构建AI请求 - 追问时使用会话中的图片
+        # 多页会话：指定页码时附带该页图片，否则全部页面已在历史消息中
         current_image = request.image_base64 or session.get("image_base64")
+        if session.get("pages") and not request.image_base64:
+            if request.page is not None:
+                if not 1 <= request.page <= len(session["pages"]):
+                    raise HTTPException(status_code=400, detail=f"页码超出范围，本会话共 {len(session['pages'])} 页")
+                current_image = session["pages"][request.page - 1]
+            else:
+                current_image = None
+        prompt_text = f"（关于第{request.page}页）{request.prompt}" if session.get("pages") and request.page else request.prompt
         
         if current_image:
             # 有图片：发送图片+文本
@@ -1682,7 +1875,7 @@ async def db_chat(request: ChatRequest, user: dict = Depends(get_current_user)):
                 'role': 'user',
                 'content': [
                     {'image': f'data:image/jpeg;base64,{current_image}'},
-                    {'text': request.prompt}
+                    {'text': prompt_text}
                 ]
             })
             print(f"[会话 {session_id}] 发送消息（带图片）: {request.prompt[:50]}...")
@@ -1691,29 +1884,24 @@ async def db_chat(request: ChatRequest, user: dict = Depends(get_current_user)):
             messages = session.get("messages", []).copy()
             messages.append({
                 'role': 'user',
-                'content': request.prompt
+                'content': prompt_text
             })
             print(f"[会话 {session_id}] 发送消息（纯文本）: {request.prompt[:50]}...")
         
-        # 调用AI
-        response = dashscope.MultiModalConversation.call(
-            model='qwen-vl-max',
-            messages=messages
-        )
-        
-        if response.status_code != 200:
-            raise HTTPException(status_code=500, detail="AI调用失败")
-        
-        ai_response = response.output.choices[0].message.content[0]['text']
+        # 调用AI（上游超时不超过请求剩余预算，客户端断开时中止生成）
+        ai_response = await cancel_token.run(run_within(
+            deadline, "模型调用", call_chat_model_streaming,
+            messages, max(1, int(deadline.timeout(300, "模型调用"))), cancel_token,
+            reserve=RESPONSE_RESERVE_SECONDS
+        ), "模型调用")
         
         # 【优化】如果是批改模式，检测是否有错题并自动保存
         mistake_saved = False
+        mistake_save_deferred = False
         knowledge_points = []
         
         if request.mode == 'review':
-            is_mistake = any(keyword in ai_response for keyword in [
-                '错误', '不正确', '不对', '有误', '答案错了', '做错了', '有问题', '错了'
-            ])
+            is_mistake = any(keyword in ai_response for keyword in MISTAKE_KEYWORDS)
             
             print(f"\n{'='*60}")
             print(f"[错题检测] 是否检测到错误: {is_mistake}")
@@ -1721,156 +1909,25 @@ async def db_chat(request: ChatRequest, user: dict = Depends(get_current_user)):
             print(f"{'='*60}\n")
             
             # 使用 current_image 而不是 request.image_base64，支持追问时也能保存错题
-            if is_mistake and current_image:
-                try:
-                    print("[知识点提取] 开始提取知识点...")
-                    extract_prompt = f"请从以下批改结果中提取涉及的知识点，以逗号分隔返回，不要其他内容：\n\n{ai_response}"
-                    extract_response = dashscope.Generation.call(
-                        model='qwen-turbo',
-                        prompt=extract_prompt
-                    )
-                    
-                    if extract_response.status_code == 200:
-                        kp_text = extract_response.output.text.strip()
-                        print(f"[知识点提取] 原始结果: {kp_text}")
-                        knowledge_points = [kp.strip() for kp in kp_text.split('，') if kp.strip()]
-                        if not knowledge_points:
-                            knowledge_points = [kp.strip() for kp in kp_text.split(',') if kp.strip()]
-                        print(f"[知识点提取] 提取成功: {knowledge_points}")
-                    
-                    if not knowledge_points:
-                        knowledge_points = ['未分类']
-                        print("[知识点提取] 使用默认值: ['未分类']")
-                except Exception as kp_error:
-                    print(f"[知识点提取] 提取失败: {kp_error}")
-                    knowledge_points = ['未分类']
-                
-                # 保存错题到数据库
-                import uuid
-                import json
-                
-                subject_id = str(uuid.uuid4())
-                
-                print(f"\n{'='*60}")
-                print(f"[错题保存] 开始保存错题到数据库...")
-                print(f"[错题保存] subject_id: {subject_id}")
-                print(f"[错题保存] 知识点: {knowledge_points}")
-                print(f"[错题保存] 用户ID: {user_id}")
-                print(f"[错题保存] 图片长度: {len(current_image) if current_image else 0}")
-                print(f"{'='*60}\n")
-                
-                # 【修复】提取题目信息和解析
-                # 从AI响应中分离出题目描述和解析
-                mistake_title = f"批改于 {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-                question_desc = request.prompt[:500] if request.prompt else "上传的作业题目"
-                
-                # 保存完整的AI解析（不截断）
-                full_explanation = ai_response
-                
-                # 构建图片URL（使用data URI格式）
-                image_url = f"data:image/jpeg;base64,{current_image}" if current_image else None
-                
-                print(f"[错题保存] 题目标题: {mistake_title}")
-                print(f"[错题保存] 题目描述长度: {len(question_desc)}")
-                print(f"[错题保存] 解析长度: {len(full_explanation)}")
-                
-                try:
-                    with get_db_connection() as conn:
-                        cursor = conn.cursor()
-                        
-                        # 【修复】插入subject表，包含完整信息
-                        print("[错题保存] 步骤1: 插入subject表（包含题目图片和完整解析）...")
-                        cursor.execute("""
-                            INSERT INTO subject (
-                                subject_id, subject_title, subject_desc, 
-                                image_url, solve, explanation,
-                                subject_type, difficulty, knowledge_points,
-                                subject_name, grade, created_at
-                            ) VALUES (
-                                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW()
-                            )
-                        """, (
-                            subject_id,
-                            mistake_title,  # 【修复】使用时间戳作为标题
-                            question_desc,  # 【修复】保存题目描述（用户提问或图片说明）
-                            image_url,  # 【修复】保存题目图片
-                            full_explanation,  # 【修复】保存完整的AI批改结果
-                            full_explanation,  # explanation字段也保存完整解析
-                            "mistake",
-                            "中等",
-                            json.dumps(knowledge_points, ensure_ascii=False),
-                            knowledge_points[0] if knowledge_points else "未分类",
-                            "未分类",
-                        ))
-                        print("[错题保存] ✅ subject表插入成功（已保存题目图片和完整解析）")
-                        
-                        # 获取或创建用户的错题本试卷
-                        print("[错题保存] 步骤2: 获取或创建错题本...")
-                        cursor.execute("""
-                            SELECT exam_id FROM exam 
-                            WHERE exam_title LIKE %s AND exam_type = 'mistake'
-                            LIMIT 1
-                        """, (f"{user['account']}的错题本%",))
-                        
-                        exam_result = cursor.fetchone()
-                        
-                        if exam_result:
-                            exam_id = exam_result['exam_id']
-                            print(f"[错题保存] ✅ 找到现有错题本: {exam_id}")
-                        else:
-                            exam_id = str(uuid.uuid4())
-                            cursor.execute("""
-                                INSERT INTO exam (exam_id, exam_title, exam_content, exam_type, created_at)
-                                VALUES (%s, %s, %s, 'mistake', NOW())
-                            """, (
-                                exam_id,
-                                f"{user['account']}的错题本",
-                                "自动保存的错题"
-                            ))
-                            print(f"[错题保存] ✅ 创建新错题本: {exam_id}")
-                        
-                        # 插入user_exam关联
-                        print("[错题保存] 步骤3: 插入user_exam关联...")
-                        cursor.execute("""
-                            INSERT INTO user_exam (
-                                id, user_info, subject_id, exam_id,
-                                answered_at, user_answer, status
-                            ) VALUES (
-                                %s, %s, %s, %s, NOW(), %s, 'wrong'
-                            )
-                        """, (
-                            str(uuid.uuid4()),
-                            user_id,
-                            subject_id,
-                            exam_id,
-                            "错误答案（批改发现）"
-                        ))
-                        print("[错题保存] ✅ user_exam关联插入成功")
-                        
-                        conn.commit()
-                        mistake_saved = True
-                        print(f"\n{'='*60}")
-                        print(f"[错题保存] ✅✅✅ 错题保存成功！")
-                        print(f"[错题保存] subject_id: {subject_id}")
-                        print(f"[错题保存] exam_id: {exam_id}")
-                        print(f"[错题保存] 知识点: {', '.join(knowledge_points)}")
-                        print(f"{'='*60}\n")
-                        cursor.close()
-                        
-                except Exception as e:
-                    print(f"\n{'='*60}")
-                    print(f"[错题保存] ❌❌❌ 保存失败！")
-                    print(f"[错题保存] 错误: {str(e)}")
-                    print(f"{'='*60}\n")
-                    import traceback
-                    traceback.print_exc()
+            if is_mistake and current_image and cancel_token.cancelled:
+                print(f"[错题保存] 🔌 客户端已断开，跳过错题入库")
+                cancel_token.record("persist_skipped")
+            elif is_mistake and current_image and deadline.remaining() < PERSIST_MIN_SECONDS:
+                # 预算不足：先返回回答，知识点提取和入库转入后台
+                print(f"[错题保存] ⏱️ 剩余时间 {deadline.remaining():.1f}s，错题保存转入后台")
+                defer_to_background(save_review_mistake_to_db, user, request.prompt, current_image, ai_response)
+                mistake_saved = mistake_save_deferred = True
+            elif is_mistake and current_image:
+                mistake_saved, knowledge_points = save_review_mistake_to_db(
+                    user, request.prompt, current_image, ai_response
+                )
         
         # 【修复】保存对话历史到会话
         session["messages"].append({
             'role': 'user',
             'content': [
                 {'image': f'data:image/jpeg;base64,{current_image}'},
-                {'text': request.prompt}
+                {'text': prompt_text}
             ] if current_image else request.prompt
         })
         session["messages"].append({
@@ -1891,9 +1948,16 @@ async def db_chat(request: ChatRequest, user: dict = Depends(get_current_user)):
             "session_id": session_id,
             "title": title,
             "mistake_saved": mistake_saved,
+            "mistake_save_deferred": mistake_save_deferred,
             "knowledge_points": knowledge_points
         }
     
+    except DeadlineExceeded as e:
+        print(f"⏱️ [时间预算] /api/db/chat 未能在 {CHAT_DEADLINE_SECONDS:.0f} 秒内完成: {e}")
+        raise HTTPException(status_code=504, detail=f"处理超时，请稍后重试（{e}）")
+    except RequestCancelled as e:
+        print(f"🔌 [请求取消] {e}")
+        return JSONResponse(status_code=499, content={"detail": str(e)})
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -1998,7 +2062,7 @@ async def create_chat_session(
     user_id = user["user_id"]
     
     try:
-        session_id = ChatManager.create_session(
+        session_id = await AsyncChatManager.create_session(
             user_id=user_id,
             title=request.title,
             mode=request.mode,
@@ -2024,7 +2088,7 @@ async def get_user_chat_sessions(
     user_id = user["user_id"]
     
     try:
-        sessions = ChatManager.get_user_sessions(user_id, limit)
+        sessions = await AsyncChatManager.get_user_sessions(user_id, limit)
         return {
             "success": True,
             "sessions": sessions,
@@ -2042,15 +2106,20 @@ async def get_chat_history(
 ):
     """获取对话历史"""
     try:
-        # 验证会话所有权
-        session_info = ChatManager.get_session_info(session_id)
+        # 会话校验与历史查询并发执行，校验不通过时丢弃历史
+        session_info, history = await asyncio.gather(
+            AsyncChatManager.get_session_info(session_id),
+            AsyncChatManager.get_session_history(session_id, limit)
+        )
         if not session_info:
             raise HTTPException(status_code=404, detail="会话不存在")
         
         if session_info['user_id'] != user["user_id"]:
             raise HTTPException(status_code=403, detail="无权访问此会话")
         
-        history = ChatManager.get_session_history(session_id, limit)
+        # 合并写入队列中尚未落库的消息
+        history = chat_write_queue.merge_pending_history(session_id, history, limit)
+        
         return {
             "success": True,
             "session_id": session_id,
@@ -2080,26 +2149,49 @@ async def chat_with_history(
     user_id = user["user_id"]
     
     try:
-        # 1. 获取或创建会话
+        # 1. 获取或创建会话，2. 获取最近的历史消息（用于上下文）
+        # 活跃会话的归属和最近消息在 session_cache 中，命中时不访问数据库
         session_id = request.session_id
         if not session_id:
             # 创建新会话
-            session_id = ChatManager.create_session(
+            session_id = await AsyncChatManager.create_session(
                 user_id=user_id,
                 title="新对话",
                 mode=request.mode,
                 subject=request.subject,
                 grade=request.grade
             )
+            session_cache.load(session_id, {
+                "user_id": user_id,
+                "mode": request.mode,
+                "subject": request.subject,
+                "grade": request.grade,
+                "title": "新对话",
+            }, [])
+            history = []
         else:
+            cached = session_cache.get(session_id)
+            if cached is None:
+                session_info, recent = await asyncio.gather(
+                    AsyncChatManager.get_session_info(session_id),
+                    AsyncChatManager.get_recent_history(session_id, limit=CHAT_CONTEXT_MESSAGES)
+                )
+                if not session_info:
+                    raise HTTPException(status_code=403, detail="无权访问此会话")
+                # 合并写入队列中尚未落库的消息
+                history = chat_write_queue.merge_pending_history(
+                    session_id, recent, limit=CHAT_CONTEXT_MESSAGES, recent=True
+                )
+                session_cache.load(session_id, session_info, history)
+                owner_id = session_info['user_id']
+            else:
+                history = cached["messages"]
+                owner_id = cached["user_id"]
+            
             # 验证会话所有权
-            session_info = ChatManager.get_session_info(session_id)
-            if not session_info or session_info['user_id'] != user_id:
+            if owner_id != user_id:
                 raise HTTPException(status_code=403, detail="无权访问此会话")
         
-        # 2. 获取历史消息（用于上下文）
-        history = ChatManager.get_session_history(session_id, limit=10)
-        
         # 3. 构建AI消息（包含历史上下文）
         messages = []
         
@@ -2141,35 +2233,37 @@ async def chat_with_history(
             'content': current_message_content
         })
         
-        # 4. 调用AI
-        response = dashscope.MultiModalConversation.call(
-            model='qwen-vl-max',
-            messages=messages
-        )
-        
-        if response.status_code != 200:
+        # 4. 调用AI（在线程池中执行，不阻塞其他请求的数据库往返）
+        try:
+            ai_response = await asyncio.to_thread(call_solve_model, messages)
+        except Exception:
             raise HTTPException(status_code=500, detail="AI调用失败")
         
-        ai_response = response.output.choices[0].message.content[0]['text']
-        
-        # 5. 保存对话历史
+        # 5. 保存对话历史（放入写入队列，由后台批量写入，不等待数据库）
         # 保存用户消息
-        ChatManager.add_message(
+        user_image_url = f'data:image/jpeg;base64,{request.image_base64[:100]}...' if request.image_base64 else None
+        user_write_id = chat_write_queue.add_message(
             session_id=session_id,
             role='user',
             content=request.prompt,
-            image_url=f'data:image/jpeg;base64,{request.image_base64[:100]}...' if request.image_base64 else None,
+            image_url=user_image_url,
             message_type=message_type
         )
         
         # 保存AI回复
-        ChatManager.add_message(
+        assistant_write_id = chat_write_queue.add_message(
             session_id=session_id,
             role='assistant',
             content=ai_response,
             message_type='text'
         )
         
+        # 同步更新会话缓存，下一轮直接使用
+        session_cache.append_messages(session_id, [
+            cached_message(user_write_id, 'user', request.prompt, user_image_url, message_type),
+            cached_message(assistant_write_id, 'assistant', ai_response),
+        ])
+        
         # 6. 如果是批改模式，检测错题并自动保存
         mistake_saved = False
         mistake_id = None
@@ -2185,7 +2279,7 @@ async def chat_with_history(
                 
                 # 保存错题
                 try:
-                    mistake_id = MistakeManager.save_mistake(
+                    mistake_id = await AsyncMistakeManager.save_mistake(
                         user_id=user_id,
                         subject_title=f"错题_{datetime.now().strftime('%Y%m%d%H%M%S')}",
                         subject_desc=request.prompt[:500],
@@ -2207,7 +2301,8 @@ async def chat_with_history(
         if len(history) == 0:
             # 第一条消息，自动生成标题
             title = request.prompt[:20] + "..." if len(request.prompt) > 20 else request.prompt
-            ChatManager.update_session_title(session_id, title)
+            chat_write_queue.update_session_title(session_id, title)
+            session_cache.set_title(session_id, title)
         
         return {
             "success": True,
@@ -2235,7 +2330,7 @@ async def delete_chat_session(
     """删除对话会话"""
     try:
         # 验证会话所有权
-        session_info = ChatManager.get_session_info(session_id)
+        session_info = await AsyncChatManager.get_session_info(session_id)
         if not session_info:
             raise HTTPException(status_code=404, detail="会话不存在")
         
@@ -2243,7 +2338,8 @@ async def delete_chat_session(
             raise HTTPException(status_code=403, detail="无权删除此会话")
         
         # 软删除
-        success = ChatManager.delete_session(session_id, soft_delete=True)
+        success = await AsyncChatManager.delete_session(session_id, soft_delete=True)
+        session_cache.invalidate(session_id)
         
         return {
             "success": success,
@@ -2282,14 +2378,12 @@ async def save_mistake_manual(
     user_id = user["user_id"]
     
     try:
-        # 如果有图片，可以保存到文件系统（这里暂时跳过）
-        image_url = None
-        
-        subject_id = MistakeManager.save_mistake(
+        # 图片存入图片存储，数据库只保存引用
+        subject_id = await AsyncMistakeManager.save_mistake(
             user_id=user_id,
             subject_title=request.subject_title,
             subject_desc=request.subject_desc,
-            image_url=image_url,
+            image_base64=request.image_base64,
             user_mistake_text=request.user_mistake_text,
             correct_answer=request.correct_answer,
             explanation=request.explanation,
@@ -2314,25 +2408,38 @@ async def get_user_mistakes(
     grade: Optional[str] = None,
     knowledge_point: Optional[str] = None,
     limit: int = 100,
+    cursor: Optional[str] = None,
     user: dict = Depends(get_current_user)
 ):
-    """获取用户错题列表（支持筛选）"""
+    """获取用户错题列表（支持筛选，翻页传入上一页返回的 next_cursor）"""
     user_id = user["user_id"]
     
     try:
-        mistakes = MistakeManager.get_user_mistakes(
-            user_id=user_id,
-            subject_name=subject_name,
-            grade=grade,
-            knowledge_point=knowledge_point,
-            limit=limit
+        mistakes, total = await asyncio.gather(
+            AsyncMistakeManager.get_user_mistakes(
+                user_id=user_id,
+                subject_name=subject_name,
+                grade=grade,
+                knowledge_point=knowledge_point,
+                limit=limit,
+                page_cursor=cursor
+            ),
+            AsyncMistakeManager.count_user_mistakes(
+                user_id=user_id,
+                subject_name=subject_name,
+                grade=grade,
+                knowledge_point=knowledge_point
+            )
         )
         
         return {
             "success": True,
             "mistakes": mistakes,
-            "total": len(mistakes)
+            "total": total,
+            "next_cursor": next_page_cursor(mistakes, limit)
         }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取错题失败: {str(e)}")
 
@@ -2343,7 +2450,7 @@ async def get_mistake_stats(user: dict = Depends(get_current_user)):
     user_id = user["user_id"]
     
     try:
-        stats = MistakeManager.get_mistake_stats(user_id)
+        stats = await AsyncMistakeManager.get_mistake_stats(user_id)
         return {
             "success": True,
             "stats": stats
@@ -2359,7 +2466,7 @@ async def mark_mistake_reviewed(
 ):
     """标记错题为已复习"""
     try:
-        success = MistakeManager.update_review_status(subject_id)
+        success = await AsyncMistakeManager.update_review_status(subject_id)
         return {
             "success": success,
             "message": "复习记录已更新"
@@ -2458,8 +2565,6 @@ async def generate_paper_with_subject_grade(
         print(f"{'='*70}\n")
         
         # 4. 解析题目并保存到数据库
-        question_ids = []
-        
         # 解析AI生成的题目（按"---题目X---"或"题目X："分割）
         import re
         
@@ -2487,58 +2592,49 @@ async def generate_paper_with_subject_grade(
         
         print(f"[题目生成] 解析到 {len(questions_text)} 道题目")
         
-        # 为每道题目创建单独的记录
+        # 为每道题目构建记录，最后一次性批量写入
+        subjects = []
         for idx, question_text in enumerate(questions_text, 1):
-            try:
-                # 提取题目信息
-                title = f"{request.paper_title}_第{idx}题"
-                
-                # 尝试提取知识点
-                knowledge_points = []
-                kp_match = re.search(r'知识点[：:](.*?)(?:\n|$)', question_text)
-                if kp_match:
-                    kp_text = kp_match.group(1).strip()
-                    knowledge_points = [kp.strip() for kp in re.split(r'[,，、]', kp_text) if kp.strip()]
-                
-                # 提取答案
-                answer = ""
-                answer_match = re.search(r'答案[：:](.*?)(?=解析[：:]|知识点[：:]|$)', question_text, re.DOTALL)
-                if answer_match:
-                    answer = answer_match.group(1).strip()
-                
-                # 创建题目记录
-                subject_id = SubjectManager.create_subject(
-                    subject_title=title,
-                    subject_desc=question_text[:500],  # 题目描述（截取前500字符）
-                    solve=question_text,  # 完整题目内容
-                    answer=answer,  # 答案
-                    subject_type="generated",  # 标记为生成的题目
-                    subject_name=request.subject,  # 学科
-                    knowledge_points=json.dumps(knowledge_points, ensure_ascii=False) if knowledge_points else None
-                )
-                question_ids.append(subject_id)
-                
-                # 关联到试卷和用户
-                ExamManager.link_user_exam_subject(user_id, exam_id, subject_id)
-                
-                print(f"[题目生成] ✓ 保存题目 {idx}: {title}")
+            # 提取题目信息
+            title = f"{request.paper_title}_第{idx}题"
             
-            except Exception as e:
-                print(f"[题目生成] ⚠️ 保存题目 {idx} 失败: {e}")
-                continue
+            # 尝试提取知识点
+            knowledge_points = []
+            kp_match = re.search(r'知识点[：:](.*?)(?:\n|$)', question_text)
+            if kp_match:
+                kp_text = kp_match.group(1).strip()
+                knowledge_points = [kp.strip() for kp in re.split(r'[,，、]', kp_text) if kp.strip()]
+            
+            # 提取答案
+            answer = ""
+            answer_match = re.search(r'答案[：:](.*?)(?=解析[：:]|知识点[：:]|$)', question_text, re.DOTALL)
+            if answer_match:
+                answer = answer_match.group(1).strip()
+            
+            subjects.append({
+                "subject_title": title,
+                "subject_desc": question_text[:500],  # 题目描述（截取前500字符）
+                "solve": question_text,  # 完整题目内容
+                "answer": answer,  # 答案
+                "subject_type": "generated",  # 标记为生成的题目
+                "subject_name": request.subject,  # 学科
+                "knowledge_points": knowledge_points
+            })
         
         # 如果没有成功解析任何题目，至少保存完整的AI响应
-        if not question_ids:
+        if not subjects:
             print("[题目生成] ⚠️ 未能解析出单独题目，保存完整响应")
-            subject_id = SubjectManager.create_subject(
-                subject_title=f"{request.paper_title}_完整试卷",
-                subject_desc=ai_response[:1000],
-                solve=ai_response,
-                subject_type="generated",
-                subject_name=request.subject
-            )
-            question_ids.append(subject_id)
-            ExamManager.link_user_exam_subject(user_id, exam_id, subject_id)
+            subjects.append({
+                "subject_title": f"{request.paper_title}_完整试卷",
+                "subject_desc": ai_response[:1000],
+                "solve": ai_response,
+                "subject_type": "generated",
+                "subject_name": request.subject
+            })
+        
+        # 所有题目及其试卷关联在一个事务中批量写入
+        question_ids = SubjectManager.create_subjects_bulk(user_id, exam_id, subjects)
+        print(f"[题目生成] ✓ 已保存 {len(question_ids)} 道题目")
         
         return {
             "success": True,
@@ -13,11 +13,13 @@ import io
 import re
 import uuid
 import json
+import time
+import threading
 import asyncio  # 【V25.0新增】PDF导出需要
 from datetime import datetime
 from pathlib import Path
 from typing import Optional, List, Dict, Literal
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
 from fastapi.responses import PlainTextResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
@@ -28,15 +30,35 @@ from fastapi.responses import JSONResponse
 from PIL import Image
 
 from dashscope import MultiModalConversation
-from pix2text import Pix2Text
 
 # 导入图像增强模块
-from image_enhancer import advanced_image_processing_pipeline
+from image_enhancer import (
+    triaged_image_processing_pipeline, load_image_fast, prepare_image_base64
+)
+
+# OCR服务层（动态批处理）
+from ocr_service import OCRBatcher, LazyEngine, schedule_background_ocr, ocr_metrics, OCR_SKIPPED_PLACEHOLDER
+from ocr_cache import ocr_cache, image_fingerprint
+from task_scheduler import scheduler
+from config import SOLVE_MODEL, get_solve_model_config, model_needs_local_ocr
+from model_adapter import MultiModalModelAdapter, collect_chat_response
+from deadline import (
+    Deadline, DeadlineExceeded, run_within, stage_timeout, defer_to_background,
+    CHAT_DEADLINE_SECONDS, MINIAPP_DEADLINE_SECONDS, QUESTION_GENERATE_DEADLINE_SECONDS,
+    OCR_BUDGET_SHARE, SEARCH_BUDGET_SHARE, RESPONSE_RESERVE_SECONDS, PERSIST_MIN_SECONDS,
+)
+from blob_store import (
+    blob_router, store_image_base64, resolve_image_base64, release_image, blob_url, list_image_fields
+)
+from cancellation import (
+    CancelToken, RequestCancelled, disconnect_guard, iterate_until_cancelled, cancel_stats
+)
 
 # --- 全局变量 ---
 SESSIONS = {}
 DATA_DIR = Path("simple_data")
 MISTAKES_FILE = DATA_DIR / "mistakes.json"
+MISTAKES_FILE_LOCK = threading.Lock()  # 错题文件读-改-写锁
 QUESTIONS_FILE = DATA_DIR / "generated_questions.json"
 
 # 确保数据目录存在
@@ -56,14 +78,46 @@ try:
 except Exception as e:
     print(f"❌ 配置通义千问API Key失败: {e}")
 
-# 初始化 Pix2Text OCR引擎
-print("正在初始化 Pix2Text OCR引擎...")
-try:
-    p2t = Pix2Text(analyzer_config=dict(model_name='mfd'))
-    print("✅ Pix2Text OCR引擎初始化成功")
-except Exception as e:
-    print(f"❌ Pix2Text初始化失败: {e}")
-    p2t = None
+# Pix2Text OCR引擎：延迟加载，服务启动后在后台线程预热，不阻塞进程启动
+def create_pix2text():
+    from pix2text import Pix2Text  # 导入即加载torch等大依赖，放到预热线程中
+    return Pix2Text(analyzer_config=dict(model_name='mfd'))
+
+p2t = LazyEngine(create_pix2text, name="Pix2Text")
+
+# OCR动态批处理器：并发到达的识别请求合并为一个批次
+ocr_batcher = OCRBatcher(p2t)
+
+# 解题模型：默认 qwen-vl-max（环境变量 SOLVE_MODEL），从 config 只读取该模型的能力标记和接口类型
+# 自带强OCR的模型（config中 ocr_enhanced=True）直接读原图，跳过本地OCR
+SOLVE_MODEL_CONFIG = get_solve_model_config()
+SOLVE_NEEDS_LOCAL_OCR = model_needs_local_ocr(SOLVE_MODEL)
+# local_oss_api / openai_compatible 类型经 model_adapter 调用配置的 api_base；dashscope_api 直接调用 dashscope
+solve_adapter = (
+    MultiModalModelAdapter(SOLVE_MODEL_CONFIG) if SOLVE_MODEL_CONFIG["type"] != "dashscope_api" else None
+)
+print(f"解题模型: {SOLVE_MODEL}（{SOLVE_MODEL_CONFIG['type']}，本地OCR: {'开启' if SOLVE_NEEDS_LOCAL_OCR else '后台运行'}）")
+
+
+@app.on_event("startup")
+async def warm_up_engines():
+    """服务开始监听后在后台预热OCR引擎，请求无需等待模型加载即可接入"""
+    p2t.start_warmup()
+    # 旧版错题JSON中内联的base64图片迁移到图片存储
+    await asyncio.to_thread(migrate_inline_images)
+
+
+@app.get("/health")
+def health():
+    """存活与预热状态：OCR引擎未就绪时 status 为 warming_up"""
+    status = p2t.get_status()
+    return {
+        "status": "ok" if status["ready"] else ("degraded" if status["state"] == "failed" else "warming_up"),
+        "ocr_engine": status,
+        "cancellation": cancel_stats.get_stats(),
+    }
+
+app.include_router(blob_router)
 
 # CORS配置
 app.add_middleware(
@@ -83,6 +137,8 @@ class ChatRequest(BaseModel):
     session_id: Optional[str] = None
     prompt: str
     image_base_64: Optional[str] = None
+    image_base_64_list: Optional[List[str]] = None  # 多页作业：按页码顺序的图片列表
+    page: Optional[int] = None  # 追问时指定针对第几页（从1开始），不指定则带上全部页面
 
 # 微信小程序专用请求模型
 class MiniAppRequest(BaseModel):
@@ -149,6 +205,53 @@ def save_mistakes(mistakes: List[Dict]):
     with open(MISTAKES_FILE, 'w', encoding='utf-8') as f:
         json.dump(mistakes, f, ensure_ascii=False, indent=2)
 
+def append_mistake(new_mistake: Dict):
+    """追加一条错题（加锁读-改-写）；保存失败时撤销其图片引用"""
+    try:
+        with MISTAKES_FILE_LOCK:
+            mistakes = load_mistakes()
+            mistakes.append(new_mistake)
+            save_mistakes(mistakes)
+    except Exception:
+        release_image(new_mistake.get("image_ref"))
+        raise
+
+def mistake_for_response(mistake: Dict) -> Dict:
+    """
+    错题记录 → 接口返回格式
+
+    JSON中只保存图片引用（image_ref），返回时还原为 image_base64，并附带 /blobs/ 签名图片地址
+    """
+    item = dict(mistake)
+    image_ref = item.pop("image_ref", None)
+    if image_ref:
+        item["image_base64"] = resolve_image_base64(image_ref)
+        item["image_url"] = blob_url(image_ref)
+    return item
+
+def mistake_for_list(mistake: Dict) -> Dict:
+    """错题记录 → 列表接口格式：只带缩略图，原图在打开错题时通过 image_url 或详情接口获取"""
+    item = dict(mistake)
+    image_ref = item.pop("image_ref", None) or item.pop("image_base64", None)
+    item.update(list_image_fields(image_ref))
+    return item
+
+def migrate_inline_images() -> int:
+    """把旧数据中内联的 image_base64 存入图片存储，JSON中改为保存引用；返回迁移条数"""
+    with MISTAKES_FILE_LOCK:
+        mistakes = load_mistakes()
+        migrated = 0
+        for mistake in mistakes:
+            image_base64 = mistake.get("image_base64")
+            if image_base64 and not mistake.get("image_ref"):
+                mistake["image_ref"] = store_image_base64(image_base64)
+                del mistake["image_base64"]
+                migrated += 1
+        if migrated:
+            save_mistakes(mistakes)
+            print(f"✅ [图片存储] 已迁移 {migrated} 条错题图片，mistakes.json 只保存引用")
+    return migrated
+
 def load_questions() -> List[Dict]:
     """加载生成的题目"""
     if not QUESTIONS_FILE.exists():
@@ -171,38 +274,41 @@ def save_questions(questions: List[Dict]):
 def image_preprocess_v2(img: Image.Image) -> Image.Image:
     """
     对图片进行预处理，优化OCR识别效果
+
+    - JPEG草稿模式直接按目标尺寸解码，并按EXIF方向旋转一次（最长边不超过2000）
+    - 不再裁剪：内容裁剪只在接口入口的 prepare_image_base64 中做一次，OCR与大模型看到同一张图
     """
-    # 转为RGB模式
-    if img.mode != 'RGB':
-        img = img.convert('RGB')
-    
-    # 调整尺寸 - 确保图片不会太小或太大
-    width, height = img.size
-    max_dimension = 2000
-    if max(width, height) > max_dimension:
-        scale = max_dimension / max(width, height)
-        new_width = int(width * scale)
-        new_height = int(height * scale)
-        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-    
-    return img
-
-def extract_text_with_pix2text(image: Image.Image) -> str:
+    return load_image_fast(img, max_dimension=2000)
+
+def extract_text_with_pix2text(image: Image.Image, deadline: Optional[Deadline] = None,
+                               cancel_token: Optional[CancelToken] = None) -> str:
     """
     使用Pix2Text识别图片中的文字和公式
+    增强后识别失败时用未增强的图片重试（请求预算已用完时跳过重试）
     """
-    if p2t is None:
+    if not p2t.wait_ready():
         return "[OCR引擎未初始化]"
     
+    # 基础预处理（快速解码、方向校正），缓存键基于规范化后的图片像素
+    image = image_preprocess_v2(image)
+    
+    # OCR结果缓存：像素完全相同的图片直接复用上次结果（近似匹配需显式开启并经缩略图确认）
+    fingerprint = image_fingerprint(image)
+    cached_text = ocr_cache.lookup(fingerprint)
+    if cached_text is not None:
+        print(f"[OCR缓存] ⚡ 命中缓存，跳过OCR（{len(cached_text)} 个字符）")
+        return cached_text
+    
     try:
-        # 基础预处理
-        processed_img = image_preprocess_v2(image)
+        processed_img = image
         
-        # 高级图像增强
-        enhanced_img = advanced_image_processing_pipeline(processed_img)
+        # 画质分诊 + 按需增强
+        enhance_start = time.perf_counter()
+        enhanced_img, decision = triaged_image_processing_pipeline(processed_img)
+        ocr_metrics.record_enhancement(decision, (time.perf_counter() - enhance_start) * 1000)
         
         # OCR识别
-        result = p2t.recognize(enhanced_img)
+        result = ocr_batcher.recognize(enhanced_img, cancel_token)
         
         # 提取文本内容
         if isinstance(result, dict) and 'text' in result:
@@ -216,13 +322,19 @@ def extract_text_with_pix2text(image: Image.Image) -> str:
         ocr_text = re.sub(r'\n\s*\n\s*\n+', '\n\n', ocr_text)
         ocr_text = ocr_text.strip()
         
+        ocr_cache.store(fingerprint, ocr_text)
+        
         return ocr_text
     
     except Exception as e:
-        # 降级策略
+        # 降级策略（客户端已断开或预算已用完时放弃）
+        if cancel_token is not None and cancel_token.cancelled:
+            return "[OCR已取消]"
+        if deadline is not None and deadline.expired:
+            return "[OCR识别失败]"
         try:
-            processed_img = image_preprocess_v2(image)
-            result = p2t.recognize(processed_img)
+            processed_img = image
+            result = ocr_batcher.recognize(processed_img)
             
             if isinstance(result, dict) and 'text' in result:
                 ocr_text = result['text']
@@ -234,18 +346,43 @@ def extract_text_with_pix2text(image: Image.Image) -> str:
             ocr_text = re.sub(r'\n\s*\n\s*\n+', '\n\n', ocr_text)
             ocr_text = ocr_text.strip()
             
+            ocr_cache.store(fingerprint, ocr_text)
+            
             return ocr_text
         except:
             return "[OCR识别失败]"
 
-def call_qwen_vl_max(messages: list, model: str = 'qwen-vl-max', max_tokens: int = 8192) -> dict:
+
+async def ocr_within_budget(image: Image.Image, deadline: Deadline,
+                            cancel_token: Optional[CancelToken] = None) -> str:
+    """在时间预算内完成OCR；超出 OCR_BUDGET_SHARE 份额时改为纯图片模式（模型直接读图）"""
+    try:
+        return await run_within(deadline, "OCR", extract_text_with_pix2text, image, deadline, cancel_token,
+                                share=OCR_BUDGET_SHARE)
+    except DeadlineExceeded:
+        print("⏱️ [时间预算] OCR未在预算内完成，改为纯图片模式")
+        return OCR_SKIPPED_PLACEHOLDER
+
+def call_qwen_vl_max(messages: list, model: str = SOLVE_MODEL, max_tokens: int = 8192,
+                     deadline: Optional[Deadline] = None, cancel_token: Optional[CancelToken] = None) -> dict:
     """
     调用通义千问模型并返回包含'content'和'finish_reason'的字典
+    传入deadline时，上游请求超时不超过请求剩余的时间预算
+    传入cancel_token时改为流式调用，客户端断开后立即中止生成
     """
+    extra_args = {}
+    if deadline is not None:
+        # 上游HTTP超时不超过请求剩余预算（dashscope默认300秒）
+        extra_args["request_timeout"] = max(1, int(stage_timeout(deadline, 300, "模型调用")))
+    if solve_adapter is not None:
+        return call_solve_adapter(messages, max_tokens, extra_args.get("request_timeout"), cancel_token)
+    if cancel_token is not None:
+        return call_qwen_vl_streaming(messages, model, max_tokens, extra_args, cancel_token)
     response = dashscope.MultiModalConversation.call(
         model=model,
         messages=messages,
-        max_output_tokens=max_tokens
+        max_output_tokens=max_tokens,
+        **extra_args
     )
     
     if response.status_code != 200:
@@ -276,6 +413,61 @@ def call_qwen_vl_max(messages: list, model: str = 'qwen-vl-max', max_tokens: int
         'is_truncated': is_truncated
     }
 
+
+def call_solve_adapter(messages: list, max_tokens: int, timeout: Optional[float],
+                       cancel_token: Optional[CancelToken]) -> dict:
+    """
+    经 model_adapter 流式调用 OpenAI 兼容接口的解题模型（返回格式同 call_qwen_vl_max），
+    传入cancel_token时客户端断开后关闭上游流
+    """
+    chunks = solve_adapter.call(messages, stream=True, max_tokens=max_tokens, timeout=timeout)
+    if cancel_token is not None:
+        chunks = iterate_until_cancelled(chunks, cancel_token)
+    return collect_chat_response(chunks)
+
+
+def call_qwen_vl_streaming(messages: list, model: str, max_tokens: int, extra_args: dict,
+                           cancel_token: CancelToken) -> dict:
+    """
+    流式调用通义千问：每收到一块都检查客户端是否已断开，
+    断开时关闭上游HTTP流，不再生成剩余内容
+    """
+    responses = dashscope.MultiModalConversation.call(
+        model=model,
+        messages=messages,
+        max_output_tokens=max_tokens,
+        stream=True,
+        incremental_output=True,
+        **extra_args
+    )
+    
+    parts = []
+    finish_reason = None
+    try:
+        for chunk in iterate_until_cancelled(responses, cancel_token):
+            if chunk.status_code != 200:
+                raise Exception(f"通义千问API调用失败: {chunk.message}")
+            choice = chunk.output.choices[0]
+            content_data = choice.message.content
+            if isinstance(content_data, list):
+                parts.extend(part["text"] for part in content_data if part.get("text"))
+            elif isinstance(content_data, str):
+                parts.append(content_data)
+            finish_reason = getattr(choice, "finish_reason", None)
+    except RequestCancelled:
+        cancel_token.record("model_chars_discarded", sum(len(p) for p in parts))
+        raise
+    
+    text_content = "".join(parts)
+    if not text_content:
+        raise ValueError("通义千问未返回有效的文本内容。")
+    
+    return {
+        'content': text_content,
+        'finish_reason': finish_reason,
+        'is_truncated': finish_reason == 'length'
+    }
+
 # ==============================================================================
 # 核心API端点
 # ==============================================================================
@@ -322,9 +514,236 @@ def read_root():
 # AI解题和批改功能
 # ==============================================================================
 
+def build_solve_prompt(ocr_text: str, user_prompt: str, is_review_mode: bool) -> str:
+    """构建解题/批改的增强Prompt（OCR文本 + 用户要求）"""
+    if is_review_mode:
+        enhanced_prompt = f"""题目内容如下：
+
+{ocr_text}
+
+【任务要求】
+{user_prompt}
+
+【重要说明】
+你是一个专业的学科辅导AI助手，请认真分析题目，回答要像一位老师在面对面讲解，自然流畅，专注于教学内容本身。
+
+【特别要求】（批改模式 - 请严格按照以下规则添加标记）
+1. **只有在学生的答案存在实质性错误时**（如计算错误、概念理解错误、步骤缺失等），才在回答的开头加上：[MISTAKE_DETECTED]
+2. **如果学生的答案完全正确**（即使步骤可以优化，只要结果和逻辑都对），请在回答的开头加上：[CORRECT]
+3. **请务必精确判断**：小瑕疵、格式问题、表述不够完美等，如果不影响答案正确性，请标记为[CORRECT]
+4. 然后再给出详细的批改意见。
+
+【判断标准】
+- ✅ [CORRECT]：答案正确，逻辑合理，即使有小瑕疵
+- ❌ [MISTAKE_DETECTED]：答案错误、计算有误、概念理解错误、关键步骤缺失
+"""
+    else:
+        enhanced_prompt = f"""题目内容如下：
+
+{ocr_text}
+
+【任务要求】
+{user_prompt}
+
+【重要说明】
+你是一个专业的学科辅导AI助手，请认真分析题目，回答要像一位老师在面对面讲解，自然流畅，专注于教学内容本身。
+"""
+    return enhanced_prompt
+
+
+def save_review_mistake(ocr_text: str, image_base64: str, cleaned_response: str) -> Dict:
+    """
+    批改发现错误时自动保存错题：提取知识点 → 推测学科/年级 → 写入错题本
+
+    Returns:
+        新保存的错题记录
+    """
+    # 使用AI提取知识点
+    print(f"[错题保存] 步骤1: 提取知识点...")
+    knowledge_prompt = f"""请分析以下题目和批改内容，提取出3-5个精确的知识点标签。
+
+题目内容：
+{ocr_text[:500]}
+
+批改内容：
+{cleaned_response[:500]}
+
+要求：
+1. 每个知识点标签要精确到具体概念（如"一元二次方程求根公式"而非"方程"）
+2. 返回格式：每行一个知识点，使用"- "开头
+3. 限制3-5个知识点
+4. 按重要性排序
+
+请直接返回知识点列表："""
+
+    knowledge_messages = [{
+        "role": "user",
+        "content": knowledge_prompt
+    }]
+    
+    knowledge_response = call_qwen_vl_max(knowledge_messages, max_tokens=500)
+    knowledge_text = knowledge_response['content']
+    
+    # 解析知识点
+    detected_knowledge_points = [
+        line.strip().lstrip('- ').lstrip('* ').strip()
+        for line in knowledge_text.split('\n')
+        if line.strip() and (line.strip().startswith('-') or line.strip().startswith('*'))
+    ][:5]  # 限制5个
+    
+    if not detected_knowledge_points:
+        detected_knowledge_points = ["综合题型"]
+    
+    print(f"[错题保存] ✓ 提取到 {len(detected_knowledge_points)} 个知识点:")
+    for kp in detected_knowledge_points:
+        print(f"           - {kp}")
+    
+    # 推测学科和年级
+    subject = "未分类"
+    grade = "未分类"  # 【V25.0新增】
+    
+    if any(keyword in ocr_text for keyword in ["方程", "函数", "几何", "代数", "三角", "x", "y", "="]):
+        subject = "数学"
+    elif any(keyword in ocr_text for keyword in ["单词", "语法", "词汇", "句子", "翻译"]):
+        subject = "英语"
+    elif any(keyword in ocr_text for keyword in ["力", "能量", "速度", "电", "光"]):
+        subject = "物理"
+    elif any(keyword in ocr_text for keyword in ["化学", "元素", "反应", "分子"]):
+        subject = "化学"
+    
+    # 【V25.0新增】简单推测年级
+    if any(keyword in ocr_text for keyword in ["小学", "一年级", "二年级", "三年级", "四年级", "五年级", "六年级"]):
+        grade = "小学"
+    elif any(keyword in ocr_text for keyword in ["初中", "初一", "初二", "初三", "七年级", "八年级", "九年级"]):
+        grade = "初中"
+    elif any(keyword in ocr_text for keyword in ["高中", "高一", "高二", "高三"]):
+        grade = "高中"
+    
+    print(f"[错题保存] ✓ 推测学科: {subject}, 年级: {grade}")
+    
+    # 保存到错题本
+    print(f"[错题保存] 步骤2: 保存到错题本...")
+    new_mistake = {
+        "id": str(uuid.uuid4()),
+        "image_ref": store_image_base64(image_base64),  # 图片存入图片存储，JSON只保存引用
+        "question_text": ocr_text,
+        "wrong_answer": "(从批改中提取)",
+        "ai_analysis": cleaned_response,
+        "subject": subject,
+        "grade": grade,  # 【V25.0新增】
+        "knowledge_points": detected_knowledge_points,
+        "created_at": datetime.now().isoformat(),
+        "reviewed_count": 0
+    }
+    
+    # 多页作业会并发保存，读-改-写整个JSON文件需要加锁
+    append_mistake(new_mistake)
+    
+    print(f"[错题保存] ✅ 错题已自动保存！")
+    print(f"[错题保存] ID: {new_mistake['id'][:8]}...")
+    return new_mistake
+
+
+async def solve_homework_page(page: int, image_base64: str, user_prompt: str,
+                              is_review_mode: bool) -> Dict:
+    """
+    多页作业中单页的处理：OCR → 调用大模型 →（批改发现错误时）保存错题
+    OCR和模型调用都经过全局调度器，多页之间并发执行
+    """
+    image = Image.open(io.BytesIO(base64.b64decode(image_base64)))
+    ocr_task = None
+    if SOLVE_NEEDS_LOCAL_OCR:
+        ocr_text = await scheduler.run_ocr(extract_text_with_pix2text, image)
+    else:
+        ocr_text = OCR_SKIPPED_PLACEHOLDER
+        ocr_task = schedule_background_ocr(extract_text_with_pix2text, image)
+    
+    messages = [{
+        "role": "user",
+        "content": [
+            {'text': build_solve_prompt(ocr_text, user_prompt, is_review_mode)},
+            {'image': f"data:image/png;base64,{image_base64}"}
+        ]
+    }]
+    ai_response = await scheduler.run_model(call_qwen_vl_max, messages)
+    print(f"[多页作业] ✓ 第{page}页完成，回答长度: {len(ai_response['content'])} 字符")
+    
+    result = {
+        "page": page,
+        "response": ai_response['content'],
+        "is_truncated": ai_response.get('is_truncated', False),
+        "mistake_saved": False,
+        "knowledge_points": []
+    }
+    
+    if is_review_mode and "[MISTAKE_DETECTED]" in result["response"]:
+        try:
+            if ocr_task is not None:
+                ocr_text = await ocr_task
+            cleaned_response = result["response"].replace("[MISTAKE_DETECTED]", "").strip()
+            new_mistake = await scheduler.run_model(save_review_mistake, ocr_text, image_base64, cleaned_response)
+            result["mistake_saved"] = True
+            result["knowledge_points"] = new_mistake["knowledge_points"]
+        except Exception as e:
+            print(f"[多页作业] ⚠️ 第{page}页错题保存失败: {e}")
+    
+    return result
+
+
+def merge_page_responses(page_results: List[Dict]) -> str:
+    """把各页回答按页码合并为一份总回答"""
+    return "\n\n".join(f"## 第{r['page']}页\n\n{r['response']}" for r in page_results)
+
+
+async def chat_multi_page(request: ChatRequest, session_id: str) -> JSONResponse:
+    """多页作业新会话：各页并发处理，返回逐页结果和合并后的总回答"""
+    # 各页快速解码 + 内容裁剪，之后的OCR、模型调用和会话记录都使用压缩后的图片
+    pages = list(await asyncio.gather(*[
+        asyncio.to_thread(prepare_image_base64, image_base64) for image_base64 in request.image_base_64_list
+    ]))
+    is_review_mode = any(keyword in request.prompt for keyword in ["批改", "改", "检查", "对错"])
+    print(f"[多页作业] 共 {len(pages)} 页，并发处理（批改模式: {is_review_mode}）")
+    
+    page_results = await asyncio.gather(*[
+        solve_homework_page(i + 1, image_base64, request.prompt, is_review_mode)
+        for i, image_base64 in enumerate(pages)
+    ])
+    merged_response = merge_page_responses(page_results)
+    
+    SESSIONS[session_id] = {
+        "history": [
+            {"role": "user", "content": request.prompt},
+            {"role": "assistant", "content": merged_response}
+        ],
+        "title": "新对话",
+        "image_base_64": pages[0],
+        "pages": pages
+    }
+    
+    knowledge_points = []
+    for r in page_results:
+        knowledge_points.extend(kp for kp in r["knowledge_points"] if kp not in knowledge_points)
+    
+    return JSONResponse(content={
+        "session_id": session_id,
+        "title": "新对话",
+        "response": merged_response,
+        "pages": page_results,
+        "is_truncated": any(r["is_truncated"] for r in page_results),
+        "mistake_saved": any(r["mistake_saved"] for r in page_results),
+        "knowledge_points": knowledge_points
+    })
+
+
 @app.post("/chat")
-async def chat_with_ai(request: ChatRequest):
-    """AI智能解题和批改接口"""
+async def chat_with_ai(request: ChatRequest, http_request: Request):
+    """AI智能解题和批改接口（客户端断开时取消OCR、模型生成和错题保存）"""
+    async with disconnect_guard(http_request, "/chat") as cancel_token:
+        return await handle_chat(request, cancel_token)
+
+
+async def handle_chat(request: ChatRequest, cancel_token: CancelToken):
+    """/chat 的处理流程"""
     print(f"\n{'#'*70}")
     print(f"# /chat 接口被调用")
     print(f"# session_id: {request.session_id}")
@@ -334,6 +753,19 @@ async def chat_with_ai(request: ChatRequest):
     
     session_id = request.session_id or str(uuid.uuid4())
     is_new_session = session_id not in SESSIONS
+    ocr_task = None  # 后台OCR任务（跳过本地OCR时使用）
+    deadline = Deadline(CHAT_DEADLINE_SECONDS, "/chat")
+    
+    # 多页作业：只有一页时按普通单图会话处理
+    if request.image_base_64_list and len(request.image_base_64_list) == 1 and not request.image_base_64:
+        request.image_base_64 = request.image_base_64_list[0]
+    if is_new_session and request.image_base_64_list and len(request.image_base_64_list) > 1:
+        try:
+            return await chat_multi_page(request, session_id)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            raise HTTPException(status_code=500, detail=str(e))
     
     print(f"[会话检查] session_id: {session_id[:16]}...")
     print(f"[会话检查] is_new_session: {is_new_session}")
@@ -353,6 +785,10 @@ async def chat_with_ai(request: ChatRequest):
             print(f"[新会话] 创建会话: {session_id}")
             print(f"[新会话] 图片大小: {len(request.image_base_64)} 字符")
             
+            # 快速解码 + 内容裁剪，发送给模型和保存到会话的都是压缩后的图片
+            request.image_base_64 = await asyncio.to_thread(prepare_image_base64, request.image_base_64)
+            print(f"[新会话] 预处理后图片大小: {len(request.image_base_64)} 字符")
+            
             SESSIONS[session_id] = {
                 "history": [], 
                 "title": "新对话",
@@ -381,7 +817,13 @@ async def chat_with_ai(request: ChatRequest):
             print("[混合输入架构] 步骤1: 使用Pix2Text进行OCR识别...")
             image_bytes = base64.b64decode(request.image_base_64)
             image = Image.open(io.BytesIO(image_bytes))
-            ocr_text = extract_text_with_pix2text(image)
+            if SOLVE_NEEDS_LOCAL_OCR:
+                ocr_text = await cancel_token.run(ocr_within_budget(image, deadline, cancel_token), "OCR")
+            else:
+                # 模型自带强OCR：不等待本地识别，OCR转入后台，保存错题时再取结果
+                print(f"[混合输入架构] ⚡ {SOLVE_MODEL} 自带强OCR，本地OCR转入后台")
+                ocr_text = OCR_SKIPPED_PLACEHOLDER
+                ocr_task = schedule_background_ocr(extract_text_with_pix2text, image)
             
             print("[混合输入架构] 步骤2: 构建混合输入消息...")
             
@@ -390,38 +832,7 @@ async def chat_with_ai(request: ChatRequest):
             print(f"[混合输入架构] 是否批改模式: {is_review_mode}")
             
             # 构建增强Prompt
-            if is_review_mode:
-                enhanced_prompt = f"""题目内容如下：
-
-{ocr_text}
-
-【任务要求】
-{request.prompt}
-
-【重要说明】
-你是一个专业的学科辅导AI助手，请认真分析题目，回答要像一位老师在面对面讲解，自然流畅，专注于教学内容本身。
-
-【特别要求】（批改模式 - 请严格按照以下规则添加标记）
-1. **只有在学生的答案存在实质性错误时**（如计算错误、概念理解错误、步骤缺失等），才在回答的开头加上：[MISTAKE_DETECTED]
-2. **如果学生的答案完全正确**（即使步骤可以优化，只要结果和逻辑都对），请在回答的开头加上：[CORRECT]
-3. **请务必精确判断**：小瑕疵、格式问题、表述不够完美等，如果不影响答案正确性，请标记为[CORRECT]
-4. 然后再给出详细的批改意见。
-
-【判断标准】
-- ✅ [CORRECT]：答案正确，逻辑合理，即使有小瑕疵
-- ❌ [MISTAKE_DETECTED]：答案错误、计算有误、概念理解错误、关键步骤缺失
-"""
-            else:
-                enhanced_prompt = f"""题目内容如下：
-
-{ocr_text}
-
-【任务要求】
-{request.prompt}
-
-【重要说明】
-你是一个专业的学科辅导AI助手，请认真分析题目，回答要像一位老师在面对面讲解，自然流畅，专注于教学内容本身。
-"""
+            enhanced_prompt = build_solve_prompt(ocr_text, request.prompt, is_review_mode)
             
             # 构建混合输入消息
             messages_to_send.append({
@@ -449,13 +860,18 @@ async def chat_with_ai(request: ChatRequest):
                 print(f"[错误] 会话历史为空！")
                 raise HTTPException(status_code=500, detail="会话历史为空，请重新开始对话")
             
-            # 第一条消息：用户的首次提问 + 图片
+            # 第一条消息：用户的首次提问 + 图片（多页作业可指定页码，否则带上全部页面）
+            session_pages = SESSIONS[session_id].get("pages") or [original_image_base64]
+            if request.page is not None:
+                if not 1 <= request.page <= len(session_pages):
+                    raise HTTPException(status_code=400, detail=f"页码超出范围，本会话共 {len(session_pages)} 页")
+                session_pages = [session_pages[request.page - 1]]
+            
             first_user_message = history[0]
             messages_to_send = [{
                 "role": "user",
-                "content": [
-                    {'text': first_user_message["content"]},
-                    {'image': f"data:image/png;base64,{original_image_base64}"}
+                "content": [{'text': first_user_message["content"]}] + [
+                    {'image': f"data:image/png;base64,{page_image}"} for page_image in session_pages
                 ]
             }]
             
@@ -464,7 +880,8 @@ async def chat_with_ai(request: ChatRequest):
                 messages_to_send.append(msg)
             
             # 添加当前的追问
-            messages_to_send.append({"role": "user", "content": request.prompt})
+            followup_prompt = f"（关于第{request.page}页）{request.prompt}" if request.page is not None else request.prompt
+            messages_to_send.append({"role": "user", "content": followup_prompt})
             
             print(f"[追问模式] ✅ 对话历史重建完成！总消息数: {len(messages_to_send)}")
 
@@ -474,7 +891,10 @@ async def chat_with_ai(request: ChatRequest):
         print(f"[AI调用] 准备调用通义千问...")
         print(f"{'='*60}")
         
-        ai_response = call_qwen_vl_max(messages_to_send)
+        ai_response = await cancel_token.run(run_within(
+            deadline, "模型调用", call_qwen_vl_max, messages_to_send, SOLVE_MODEL, 8192, deadline, cancel_token,
+            reserve=RESPONSE_RESERVE_SECONDS
+        ), "模型调用")
         full_response = ai_response['content']
         
         print(f"\n{'='*60}")
@@ -486,6 +906,7 @@ async def chat_with_ai(request: ChatRequest):
         
         # --- 4. 自动保存错题（如果是批改模式且发现错误）---
         mistake_saved = False
+        mistake_save_deferred = False
         detected_knowledge_points = []
         
         if is_new_session:
@@ -502,93 +923,28 @@ async def chat_with_ai(request: ChatRequest):
                     # 清理AI回复中的特殊标记
                     cleaned_response = full_response.replace("[MISTAKE_DETECTED]", "").strip()
                     
-                    # 使用AI提取知识点
-                    print(f"[错题保存] 步骤1: 提取知识点...")
-                    knowledge_prompt = f"""请分析以下题目和批改内容，提取出3-5个精确的知识点标签。
-
-题目内容：
-{ocr_text[:500]}
-
-批改内容：
-{cleaned_response[:500]}
-
-要求：
-1. 每个知识点标签要精确到具体概念（如"一元二次方程求根公式"而非"方程"）
-2. 返回格式：每行一个知识点，使用"- "开头
-3. 限制3-5个知识点
-4. 按重要性排序
-
-请直接返回知识点列表："""
-
-                    knowledge_messages = [{
-                        "role": "user",
-                        "content": knowledge_prompt
-                    }]
-                    
-                    knowledge_response = call_qwen_vl_max(knowledge_messages, max_tokens=500)
-                    knowledge_text = knowledge_response['content']
+                    # 题目文本用于知识点提取和错题检索，后台OCR未完成时在预算内等待
+                    if ocr_task is not None:
+                        try:
+                            ocr_text = await asyncio.wait_for(
+                                asyncio.shield(ocr_task), deadline.budget(OCR_BUDGET_SHARE)
+                            )
+                        except asyncio.TimeoutError:
+                            print(f"[错题保存] ⏱️ 后台OCR未在预算内完成，题目文本使用占位说明")
                     
-                    # 解析知识点
-                    import re
-                    detected_knowledge_points = [
-                        line.strip().lstrip('- ').lstrip('* ').strip()
-                        for line in knowledge_text.split('\n')
-                        if line.strip() and (line.strip().startswith('-') or line.strip().startswith('*'))
-                    ][:5]  # 限制5个
-                    
-                    if not detected_knowledge_points:
-                        detected_knowledge_points = ["综合题型"]
-                    
-                    print(f"[错题保存] ✓ 提取到 {len(detected_knowledge_points)} 个知识点:")
-                    for kp in detected_knowledge_points:
-                        print(f"           - {kp}")
-                    
-                    # 推测学科和年级
-                    subject = "未分类"
-                    grade = "未分类"  # 【V25.0新增】
-                    
-                    if any(keyword in ocr_text for keyword in ["方程", "函数", "几何", "代数", "三角", "x", "y", "="]):
-                        subject = "数学"
-                    elif any(keyword in ocr_text for keyword in ["单词", "语法", "词汇", "句子", "翻译"]):
-                        subject = "英语"
-                    elif any(keyword in ocr_text for keyword in ["力", "能量", "速度", "电", "光"]):
-                        subject = "物理"
-                    elif any(keyword in ocr_text for keyword in ["化学", "元素", "反应", "分子"]):
-                        subject = "化学"
-                    
-                    # 【V25.0新增】简单推测年级
-                    if any(keyword in ocr_text for keyword in ["小学", "一年级", "二年级", "三年级", "四年级", "五年级", "六年级"]):
-                        grade = "小学"
-                    elif any(keyword in ocr_text for keyword in ["初中", "初一", "初二", "初三", "七年级", "八年级", "九年级"]):
-                        grade = "初中"
-                    elif any(keyword in ocr_text for keyword in ["高中", "高一", "高二", "高三"]):
-                        grade = "高中"
-                    
-                    print(f"[错题保存] ✓ 推测学科: {subject}, 年级: {grade}")
-                    
-                    # 保存到错题本
-                    print(f"[错题保存] 步骤2: 保存到错题本...")
-                    mistakes = load_mistakes()
-                    
-                    new_mistake = {
-                        "id": str(uuid.uuid4()),
-                        "image_base64": request.image_base_64,
-                        "question_text": ocr_text,
-                        "wrong_answer": "(从批改中提取)",
-                        "ai_analysis": cleaned_response,
-                        "subject": subject,
-                        "grade": grade,  # 【V25.0新增】
-                        "knowledge_points": detected_knowledge_points,
-                        "created_at": datetime.now().isoformat(),
-                        "reviewed_count": 0
-                    }
-                    
-                    mistakes.append(new_mistake)
-                    save_mistakes(mistakes)
-                    
-                    mistake_saved = True
-                    print(f"[错题保存] ✅ 错题已自动保存！")
-                    print(f"[错题保存] ID: {new_mistake['id'][:8]}...")
+                    if cancel_token.cancelled:
+                        # 客户端已断开：没有人会看到保存结果，跳过知识点提取和保存
+                        print(f"[错题保存] 🔌 客户端已断开，跳过错题保存")
+                        cancel_token.record("persist_skipped")
+                    elif deadline.remaining() < PERSIST_MIN_SECONDS:
+                        # 预算不足：先返回回答，知识点提取和保存转入后台
+                        print(f"[错题保存] ⏱️ 剩余时间 {deadline.remaining():.1f}s，错题保存转入后台")
+                        defer_to_background(save_review_mistake, ocr_text, request.image_base_64, cleaned_response)
+                        mistake_save_deferred = mistake_saved = True
+                    else:
+                        new_mistake = save_review_mistake(ocr_text, request.image_base_64, cleaned_response)
+                        detected_knowledge_points = new_mistake["knowledge_points"]
+                        mistake_saved = True
                     print(f"{'='*60}\n")
                     
                 except Exception as e:
@@ -619,6 +975,7 @@ async def chat_with_ai(request: ChatRequest):
             "response": full_response,
             "is_truncated": is_truncated,
             "mistake_saved": mistake_saved,
+            "mistake_save_deferred": mistake_save_deferred,
             "knowledge_points": detected_knowledge_points if mistake_saved else []
         }
         
@@ -635,6 +992,17 @@ async def chat_with_ai(request: ChatRequest):
         print(f"{'!'*70}\n")
         raise
         
+    except DeadlineExceeded as e:
+        print(f"⏱️ [时间预算] /chat 未能在 {CHAT_DEADLINE_SECONDS:.0f} 秒内完成: {e}")
+        raise HTTPException(status_code=504, detail=f"处理超时，请稍后重试（{e}）")
+    
+    except RequestCancelled as e:
+        # 客户端已断开：丢弃未完成的新会话，响应不会被接收
+        print(f"🔌 [请求取消] {e}")
+        if is_new_session:
+            SESSIONS.pop(session_id, None)
+        return JSONResponse(status_code=499, content={"detail": str(e)})
+        
     except Exception as e:
         print(f"\n{'!'*70}")
         print(f"!!! /chat 接口发生错误")
@@ -654,11 +1022,9 @@ async def chat_with_ai(request: ChatRequest):
 @app.post("/mistakes/", response_model=MistakeResponse)
 def create_mistake(mistake: MistakeCreate):
     """创建新错题"""
-    mistakes = load_mistakes()
-    
     new_mistake = {
         "id": str(uuid.uuid4()),
-        "image_base64": mistake.image_base64,
+        "image_ref": store_image_base64(mistake.image_base64),  # 图片存入图片存储，JSON只保存引用
         "question_text": mistake.question_text,
         "wrong_answer": mistake.wrong_answer,
         "ai_analysis": mistake.ai_analysis,
@@ -669,11 +1035,10 @@ def create_mistake(mistake: MistakeCreate):
         "reviewed_count": 0
     }
     
-    mistakes.append(new_mistake)
-    save_mistakes(mistakes)
+    append_mistake(new_mistake)
     
     print(f"✅ 新增错题: ID={new_mistake['id']}, 科目={mistake.subject}, 年级={mistake.grade}")
-    return new_mistake
+    return mistake_for_response(new_mistake)
 
 @app.get("/mistakes/")
 def get_mistakes(
@@ -706,7 +1071,7 @@ def get_mistakes(
     
     return {
         "total": total,
-        "items": mistakes,
+        "items": [mistake_for_list(m) for m in mistakes],
         "offset": offset,
         "limit": limit
     }
@@ -714,29 +1079,36 @@ def get_mistakes(
 @app.get("/mistakes/{mistake_id}")
 def get_mistake(mistake_id: str):
     """获取单个错题详情"""
-    mistakes = load_mistakes()
-    mistake = next((m for m in mistakes if m["id"] == mistake_id), None)
-    
-    if not mistake:
-        raise HTTPException(status_code=404, detail="错题不存在")
-    
-    # 增加查看次数
-    mistake["reviewed_count"] = mistake.get("reviewed_count", 0) + 1
-    save_mistakes(mistakes)
+    # 查看次数 +1 是读-改-写，与新增/删除共用文件锁
+    with MISTAKES_FILE_LOCK:
+        mistakes = load_mistakes()
+        mistake = next((m for m in mistakes if m["id"] == mistake_id), None)
+        
+        if not mistake:
+            raise HTTPException(status_code=404, detail="错题不存在")
+        
+        # 增加查看次数
+        mistake["reviewed_count"] = mistake.get("reviewed_count", 0) + 1
+        save_mistakes(mistakes)
     
-    return mistake
+    return mistake_for_response(mistake)
 
 @app.delete("/mistakes/{mistake_id}")
 def delete_mistake(mistake_id: str):
     """删除错题"""
-    mistakes = load_mistakes()
-    initial_len = len(mistakes)
-    mistakes = [m for m in mistakes if m["id"] != mistake_id]
-    
-    if len(mistakes) == initial_len:
-        raise HTTPException(status_code=404, detail="错题不存在")
+    with MISTAKES_FILE_LOCK:
+        mistakes = load_mistakes()
+        removed = [m for m in mistakes if m["id"] == mistake_id]
+        mistakes = [m for m in mistakes if m["id"] != mistake_id]
+        
+        if not removed:
+            raise HTTPException(status_code=404, detail="错题不存在")
+        
+        save_mistakes(mistakes)
     
-    save_mistakes(mistakes)
+    # 释放图片引用（没有其他错题引用时删除文件）
+    for m in removed:
+        release_image(m.get("image_ref"))
     print(f"🗑️ 删除错题: ID={mistake_id}")
     return {"message": "删除成功"}
 
@@ -779,7 +1151,8 @@ def get_mistakes_stats():
 # 【V25.0新增】网络辅助出题工具函数
 # ==============================================================================
 
-async def search_web_for_questions(subject: str, knowledge_points: List[str], difficulty: str) -> str:
+async def search_web_for_questions(subject: str, knowledge_points: List[str], difficulty: str,
+                                   deadline: Optional[Deadline] = None) -> str:
     """
     【V25.0增强】网络深度爬取辅助出题功能
     
@@ -794,6 +1167,7 @@ async def search_web_for_questions(subject: str, knowledge_points: List[str], di
         subject: 学科
         knowledge_points: 知识点列表
         difficulty: 难度级别
+        deadline: 检索阶段的时间预算，用完后停止爬取详情页，使用已获取的内容
     
     Returns:
         结构化的题目数据（包含图片）
@@ -820,7 +1194,7 @@ async def search_web_for_questions(subject: str, knowledge_points: List[str], di
         
         # ---- 步骤1: 搜索题库网站 ----
         search_url = f"https://www.baidu.com/s?wd={requests.utils.quote(search_query)}"
-        response = requests.get(search_url, headers=headers, timeout=10)
+        response = requests.get(search_url, headers=headers, timeout=stage_timeout(deadline, 10, "网络检索"))
         response.encoding = 'utf-8'
         soup = BeautifulSoup(response.text, 'html.parser')
         
@@ -884,11 +1258,14 @@ async def search_web_for_questions(subject: str, knowledge_points: List[str], di
         questions_data = []
         
         for url in question_urls[:3]:  # 只爬取前3个，避免过慢
+            if deadline is not None and deadline.remaining() < 1:
+                print(f"[深度爬取] ⏱️ 检索预算已用完，停止爬取详情页")
+                break
             try:
                 print(f"[深度爬取] 正在访问: {url[:50]}...")
                 
                 # 访问详情页
-                detail_response = requests.get(url, headers=headers, timeout=8)
+                detail_response = requests.get(url, headers=headers, timeout=stage_timeout(deadline, 8, "网络检索"))
                 detail_response.encoding = 'utf-8'
                 detail_soup = BeautifulSoup(detail_response.text, 'html.parser')
                 
@@ -965,18 +1342,19 @@ async def search_web_for_questions(subject: str, knowledge_points: List[str], di
         else:
             # 降级：返回搜索摘要
             print(f"[深度爬取] ⚠️ 未能爬取到题目，降级为摘要模式")
-            return await _fallback_simple_search(subject, knowledge_points, difficulty, headers)
+            return await _fallback_simple_search(subject, knowledge_points, difficulty, headers, deadline)
             
     except Exception as e:
         print(f"[深度爬取] ❌ 爬取失败: {e}")
         # 降级策略
         try:
-            return await _fallback_simple_search(subject, knowledge_points, difficulty, headers)
+            return await _fallback_simple_search(subject, knowledge_points, difficulty, headers, deadline)
         except:
             raise
 
 
-async def _fallback_simple_search(subject: str, knowledge_points: List[str], difficulty: str, headers: dict) -> str:
+async def _fallback_simple_search(subject: str, knowledge_points: List[str], difficulty: str, headers: dict,
+                                  deadline: Optional[Deadline] = None) -> str:
     """
     【V25.0增强】降级策略：简单摘要搜索
     即使无法爬取到具体题目，也提供有用的题型指导
@@ -991,7 +1369,7 @@ async def _fallback_simple_search(subject: str, knowledge_points: List[str], dif
     print(f"[降级搜索] 搜索关键词: {search_query}")
     
     try:
-        response = requests.get(search_url, headers=headers, timeout=10)
+        response = requests.get(search_url, headers=headers, timeout=stage_timeout(deadline, 10, "网络检索"))
         response.encoding = 'utf-8'
         soup = BeautifulSoup(response.text, 'html.parser')
         
@@ -1066,6 +1444,7 @@ async def generate_questions(request: QuestionGenerateRequest):
     - 支持图表生成（SVG、Markdown表格）
     - 支持网络辅助出题（可选）
     """
+    deadline = Deadline(QUESTION_GENERATE_DEADLINE_SECONDS, "/questions/generate")
     mistakes = load_mistakes()
     
     # 获取指定的错题
@@ -1096,7 +1475,8 @@ async def generate_questions(request: QuestionGenerateRequest):
             web_reference_text = await search_web_for_questions(
                 subject=subject_str,
                 knowledge_points=list(set(all_knowledge_points)),
-                difficulty=request.difficulty
+                difficulty=request.difficulty,
+                deadline=deadline.sub(SEARCH_BUDGET_SHARE, "网络检索")
             )
             print(f"[网络辅助出题] ✓ 获取到参考资料，长度: {len(web_reference_text)} 字符")
         except Exception as e:
@@ -1255,10 +1635,12 @@ async def generate_questions(request: QuestionGenerateRequest):
     try:
         # 调用通义千问API
         messages = [{"role": "user", "content": prompt}]
-        response = dashscope.Generation.call(
+        response = await run_within(
+            deadline, "出题模型调用", dashscope.Generation.call,
             model="qwen-plus",
             messages=messages,
-            result_format='message'
+            result_format='message',
+            request_timeout=max(1, int(deadline.timeout(300, "出题模型调用")))
         )
         
         if response.status_code != 200:
@@ -1319,6 +1701,9 @@ async def generate_questions(request: QuestionGenerateRequest):
             "questions": generated_questions
         }
         
+    except DeadlineExceeded as e:
+        print(f"⏱️ 生成题目超时: {e}")
+        raise HTTPException(status_code=504, detail=f"生成题目超时，请减少题目数量后重试（{e}）")
     except Exception as e:
         print(f"❌ 生成题目失败: {e}")
         raise HTTPException(status_code=500, detail=f"生成题目失败: {str(e)}")
@@ -1745,7 +2130,7 @@ async def export_pdf(request: ExportRequest):
 # ==============================================================================
 
 @app.post("/process_image_for_miniapp")
-async def process_image_for_miniapp(request: MiniAppRequest):
+async def process_image_for_miniapp(request: MiniAppRequest, http_request: Request):
     """
     【微信小程序专用接口】处理单张图片的解题或批改
     
@@ -1763,23 +2148,37 @@ async def process_image_for_miniapp(request: MiniAppRequest):
         成功: {"status": "success", "result": "AI生成的Markdown文本..."}
         失败: {"status": "error", "message": "错误信息"}
     """
-    
+    async with disconnect_guard(http_request, "/process_image_for_miniapp") as cancel_token:
+        return await handle_miniapp_request(request, cancel_token)
+
+
+async def handle_miniapp_request(request: MiniAppRequest, cancel_token: CancelToken) -> JSONResponse:
+    """小程序接口的处理流程"""
     print(f"\n{'='*70}")
     print(f"[小程序API] 收到请求")
     print(f"[小程序API] 模式: {request.mode}")
     print(f"[小程序API] 图片大小: {len(request.image_base_64)} 字符")
     print(f"{'='*70}\n")
     
+    # 小程序客户端超时较短：整个请求在 MINIAPP_DEADLINE_SECONDS 内返回
+    deadline = Deadline(MINIAPP_DEADLINE_SECONDS, "miniapp")
+    
     try:
         # ---- 步骤1: Base64解码图片 ----
         print("[小程序API] 步骤1: 解码Base64图片...")
+        request.image_base_64 = await asyncio.to_thread(prepare_image_base64, request.image_base_64)
         image_bytes = base64.b64decode(request.image_base_64)
         image = Image.open(io.BytesIO(image_bytes))
         print(f"[小程序API] ✓ 图片解码成功, 尺寸: {image.size}")
         
         # ---- 步骤2: OCR识别 ----
         print("[小程序API] 步骤2: 执行OCR识别...")
-        ocr_text = extract_text_with_pix2text(image)
+        if SOLVE_NEEDS_LOCAL_OCR:
+            ocr_text = await cancel_token.run(ocr_within_budget(image, deadline, cancel_token), "OCR")
+        else:
+            # 模型自带强OCR：直接读原图，本地OCR在后台完成（写入OCR缓存）
+            ocr_text = OCR_SKIPPED_PLACEHOLDER
+            schedule_background_ocr(extract_text_with_pix2text, image)
         print(f"[小程序API] ✓ OCR识别完成, 提取文本长度: {len(ocr_text)} 字符")
         print(f"[小程序API] OCR文本预览: {ocr_text[:100]}...")
         
@@ -1826,7 +2225,10 @@ async def process_image_for_miniapp(request: MiniAppRequest):
         
         # ---- 步骤5: 调用通义千问AI ----
         print("[小程序API] 步骤5: 调用通义千问AI...")
-        ai_response = call_qwen_vl_max(messages)
+        ai_response = await cancel_token.run(run_within(
+            deadline, "模型调用", call_qwen_vl_max, messages, SOLVE_MODEL, 8192, deadline, cancel_token,
+            reserve=RESPONSE_RESERVE_SECONDS
+        ), "模型调用")
         result_text = ai_response['content']
         print(f"[小程序API] ✓ AI回答生成成功")
         print(f"[小程序API] 回答长度: {len(result_text)} 字符")
@@ -1842,6 +2244,20 @@ async def process_image_for_miniapp(request: MiniAppRequest):
             "result": result_text
         })
         
+    except DeadlineExceeded as e:
+        print(f"[小程序API] ⏱️ 未能在 {MINIAPP_DEADLINE_SECONDS:.0f} 秒内完成: {e}")
+        return JSONResponse(
+            status_code=504,
+            content={
+                "status": "error",
+                "message": f"处理超时，请稍后重试（{e}）"
+            }
+        )
+        
+    except RequestCancelled as e:
+        print(f"[小程序API] 🔌 {e}")
+        return JSONResponse(status_code=499, content={"status": "cancelled", "message": str(e)})
+        
     except Exception as e:
         # ---- 错误处理 ----
         error_message = str(e)
@@ -5,7 +5,7 @@
 功能：
 - 将JSON格式的错题数据迁移到MySQL数据库
 - 将JSON格式的生成题目迁移到MySQL数据库
-- 为默认用户创建试卷并关联题目
+- 为默认用户创建试卷并关联题目（按批批量写入，每批一个事务）
 ==============================================================================
 """
 
@@ -29,6 +29,9 @@ DATA_DIR = Path("simple_data")
 MISTAKES_FILE = DATA_DIR / "mistakes.json"
 QUESTIONS_FILE = DATA_DIR / "generated_questions.json"
 
+# 每批写入的题目数（每批一个事务）
+MIGRATE_BATCH_SIZE = int(os.getenv("MIGRATE_BATCH_SIZE", "500"))
+
 # 默认测试用户
 DEFAULT_USER_ACCOUNT = "demo_user"
 DEFAULT_USER_PASSWORD = "demo123456"
@@ -57,6 +60,21 @@ def load_json_file(file_path: Path) -> List[Dict[str, Any]]:
 # 数据迁移函数
 # ==============================================================================
 
+def bulk_insert_subjects(user_id: str, exam_id: str, subjects: List[Dict[str, Any]],
+                         status: str, label: str) -> int:
+    """按批批量写入题目及关联（每批一个事务），返回成功写入的数量"""
+    success_count = 0
+    for start in range(0, len(subjects), MIGRATE_BATCH_SIZE):
+        batch = subjects[start:start + MIGRATE_BATCH_SIZE]
+        try:
+            success_count += len(SubjectManager.create_subjects_bulk(user_id, exam_id, batch, status=status))
+        except Exception as e:
+            print(f"  ⚠️  迁移{label}失败 (#{start + 1}-#{start + len(batch)}): {e}")
+            continue
+        print(f"  进度: {start + len(batch)}/{len(subjects)} - 已迁移 {success_count} 条")
+    return success_count
+
+
 def migrate_mistakes_to_subjects(user_id: str, exam_id: str) -> int:
     """
     迁移错题数据到subject表
@@ -77,72 +95,34 @@ def migrate_mistakes_to_subjects(user_id: str, exam_id: str) -> int:
         print("⚠️  没有错题数据需要迁移")
         return 0
     
-    success_count = 0
-    
-    for i, mistake in enumerate(mistakes, 1):
-        try:
-            # 提取错题信息
-            question_text = mistake.get('question_text', '(无文字识别)')
-            ai_analysis = mistake.get('ai_analysis', '')
-            subject_name = mistake.get('subject', '未分类')
-            grade = mistake.get('grade', '未分类')
-            knowledge_points = mistake.get('knowledge_points', [])
-            
-            # 构建题目内容（包含错误答案和分析）
-            subject_title = f"{question_text}\n\n【我的错误答案】\n{mistake.get('wrong_answer', '(未记录)')}"
-            subject_desc = f"这是一道错题，需要重点复习"
-            
-            # 如果有图片，保存图片URL（这里简化处理，实际应该上传到云存储）
-            image_base64 = mistake.get('image_base64', '')
-            image_url = f"data:image/png;base64,{image_base64[:50]}..." if image_base64 else None
-            
-            # 创建题目记录
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                
-                # 生成subject_id
-                from uuid import uuid4
-                subject_id = str(uuid4())
-                
-                # 插入subject表
-                cursor.execute(
-                    """INSERT INTO subject (
-                        subject_id, subject_title, subject_desc, image_url, solve,
-                        subject_type, difficulty, knowledge_points, subject_name, grade,
-                        answer, explanation
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
-                    (
-                        subject_id,
-                        subject_title,
-                        subject_desc,
-                        image_url,
-                        ai_analysis,  # solve字段存储AI分析
-                        'mistake',  # 题目类型：错题
-                        '中等',  # 默认难度
-                        json.dumps(knowledge_points, ensure_ascii=False),  # JSON格式
-                        subject_name,
-                        grade,
-                        mistake.get('wrong_answer', ''),  # 用户的错误答案
-                        ai_analysis  # 解析
-                    )
-                )
-                
-                # 关联用户-试卷-题目
-                record_id = str(uuid4())
-                cursor.execute(
-                    """INSERT INTO user_exam (id, user_info, subject_id, exam_id, status)
-                       VALUES (%s, %s, %s, %s, %s)""",
-                    (record_id, user_id, subject_id, exam_id, 'incorrect')
-                )
-                
-                success_count += 1
-                
-                if i % 10 == 0 or i == len(mistakes):
-                    print(f"  进度: {i}/{len(mistakes)} - 已迁移 {success_count} 条")
+    subjects = []
+    for mistake in mistakes:
+        # 提取错题信息
+        question_text = mistake.get('question_text', '(无文字识别)')
+        ai_analysis = mistake.get('ai_analysis', '')
         
-        except Exception as e:
-            print(f"  ⚠️  迁移错题失败 (#{i}): {e}")
-            continue
+        # 构建题目内容（包含错误答案和分析）
+        subject_title = f"{question_text}\n\n【我的错误答案】\n{mistake.get('wrong_answer', '(未记录)')}"
+        
+        # 如果有图片，保存图片URL（这里简化处理，实际应该上传到云存储）
+        image_base64 = mistake.get('image_base64', '')
+        image_url = f"data:image/png;base64,{image_base64[:50]}..." if image_base64 else None
+        
+        subjects.append({
+            "subject_title": subject_title,
+            "subject_desc": "这是一道错题，需要重点复习",
+            "image_url": image_url,
+            "solve": ai_analysis,  # solve字段存储AI分析
+            "subject_type": 'mistake',  # 题目类型：错题
+            "difficulty": '中等',  # 默认难度
+            "knowledge_points": json.dumps(mistake.get('knowledge_points', []), ensure_ascii=False),  # JSON格式
+            "subject_name": mistake.get('subject', '未分类'),
+            "grade": mistake.get('grade', '未分类'),
+            "answer": mistake.get('wrong_answer', ''),  # 用户的错误答案
+            "explanation": ai_analysis  # 解析
+        })
+    
+    success_count = bulk_insert_subjects(user_id, exam_id, subjects, 'incorrect', "错题")
     
     print(f"\n✅ 错题迁移完成: {success_count}/{len(mistakes)} 条成功")
     return success_count
@@ -168,63 +148,24 @@ def migrate_questions_to_subjects(user_id: str, exam_id: str) -> int:
         print("⚠️  没有生成题目需要迁移")
         return 0
     
-    success_count = 0
-    
-    for i, question in enumerate(questions, 1):
-        try:
-            # 提取题目信息
-            content = question.get('content', '')
-            answer = question.get('answer', '')
-            explanation = question.get('explanation', '')
-            knowledge_points = question.get('knowledge_points', [])
-            difficulty = question.get('difficulty', '中等')
-            subject_name = question.get('subject', '数学')  # 默认数学
-            
-            # 创建题目记录
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                
-                # 生成subject_id
-                from uuid import uuid4
-                subject_id = str(uuid4())
-                
-                # 插入subject表
-                cursor.execute(
-                    """INSERT INTO subject (
-                        subject_id, subject_title, subject_desc, solve,
-                        subject_type, difficulty, knowledge_points, subject_name,
-                        answer, explanation
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
-                    (
-                        subject_id,
-                        content,  # 题目内容
-                        'AI生成的练习题',
-                        answer,  # solve字段存储答案
-                        'generated',  # 题目类型：生成题
-                        difficulty,
-                        json.dumps(knowledge_points, ensure_ascii=False),
-                        subject_name,
-                        answer,
-                        explanation
-                    )
-                )
-                
-                # 关联用户-试卷-题目
-                record_id = str(uuid4())
-                cursor.execute(
-                    """INSERT INTO user_exam (id, user_info, subject_id, exam_id, status)
-                       VALUES (%s, %s, %s, %s, %s)""",
-                    (record_id, user_id, subject_id, exam_id, 'unanswered')
-                )
-                
-                success_count += 1
-                
-                if i % 10 == 0 or i == len(questions):
-                    print(f"  进度: {i}/{len(questions)} - 已迁移 {success_count} 条")
+    subjects = []
+    for question in questions:
+        # 提取题目信息
+        answer = question.get('answer', '')
         
-        except Exception as e:
-            print(f"  ⚠️  迁移题目失败 (#{i}): {e}")
-            continue
+        subjects.append({
+            "subject_title": question.get('content', ''),  # 题目内容
+            "subject_desc": 'AI生成的练习题',
+            "solve": answer,  # solve字段存储答案
+            "subject_type": 'generated',  # 题目类型：生成题
+            "difficulty": question.get('difficulty', '中等'),
+            "knowledge_points": json.dumps(question.get('knowledge_points', []), ensure_ascii=False),
+            "subject_name": question.get('subject', '数学'),  # 默认数学
+            "answer": answer,
+            "explanation": question.get('explanation', '')
+        })
+    
+    success_count = bulk_insert_subjects(user_id, exam_id, subjects, 'unanswered', "题目")
     
     print(f"\n✅ 题目迁移完成: {success_count}/{len(questions)} 条成功")
     return success_count
@@ -13,7 +13,7 @@ import os
 import json
 import httpx
 import dashscope
-from typing import List, Dict, Any, Generator, Optional
+from typing import List, Dict, Any, Generator, Iterable, Optional
 from config import get_active_model_config, get_knowledge_extraction_config
 
 
@@ -131,7 +131,8 @@ class MultiModalModelAdapter:
         messages: List[Dict],
         stream: bool = True,
         temperature: Optional[float] = None,
-        max_tokens: Optional[int] = None
+        max_tokens: Optional[int] = None,
+        timeout: Optional[float] = None
     ) -> Generator[Dict, None, None]:
         """
         统一的模型调用接口
@@ -141,6 +142,7 @@ class MultiModalModelAdapter:
             stream: 是否使用流式响应
             temperature: 温度参数
             max_tokens: 最大生成token数
+            timeout: OpenAI兼容API的HTTP超时（秒），默认300
         
         Yields:
             Dict: 响应chunk，格式统一为 {"content": str, "finish_reason": str}
@@ -149,7 +151,7 @@ class MultiModalModelAdapter:
             yield from self._call_dashscope(messages, stream, temperature, max_tokens)
         
         elif self.model_type in ["local_oss_api", "openai_compatible"]:
-            yield from self._call_openai_compatible(messages, stream, temperature, max_tokens)
+            yield from self._call_openai_compatible(messages, stream, temperature, max_tokens, timeout)
         
         else:
             raise ValueError(f"不支持的模型类型: {self.model_type}")
@@ -236,7 +238,8 @@ class MultiModalModelAdapter:
         messages: List[Dict],
         stream: bool,
         temperature: Optional[float],
-        max_tokens: Optional[int]
+        max_tokens: Optional[int],
+        timeout: Optional[float] = None
     ) -> Generator[Dict, None, None]:
         """
         调用OpenAI兼容API（用于本地部署的开源模型）
@@ -267,7 +270,7 @@ class MultiModalModelAdapter:
                 "Content-Type": "application/json"
             }
             
-            with httpx.Client(timeout=300.0) as client:
+            with httpx.Client(timeout=timeout or 300.0) as client:
                 if stream:
                     # 流式请求
                     with client.stream(
@@ -336,6 +339,36 @@ class MultiModalModelAdapter:
             }
 
 
+def collect_chat_response(chunks: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    把适配器返回的响应块拼成完整回答
+
+    Returns:
+        {"content": str, "finish_reason": str, "is_truncated": bool}（与 call_qwen_vl_max 的返回格式一致）
+
+    Raises:
+        Exception: 响应块中带有 error 时
+        ValueError: 没有返回任何文本时
+    """
+    parts = []
+    finish_reason = None
+    for chunk in chunks:
+        if chunk.get("error"):
+            raise Exception(f"模型调用失败: {chunk['error']}")
+        if chunk.get("content"):
+            parts.append(chunk["content"])
+        finish_reason = chunk.get("finish_reason") or finish_reason
+
+    text_content = "".join(parts)
+    if not text_content:
+        raise ValueError("模型未返回有效的文本内容。")
+    return {
+        "content": text_content,
+        "finish_reason": finish_reason,
+        "is_truncated": finish_reason == "length",
+    }
+
+
 # ==============================================================================
 # 文本模型适配器（用于知识点提取等）
 # ==============================================================================
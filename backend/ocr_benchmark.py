@@ -0,0 +1,310 @@
+"""
+==============================================================================
+沐梧AI解题系统 - OCR与图像增强基准测试
+==============================================================================
+功能：
+- 用错题图片生成器构建带标准答案文本的合成语料（叠加噪声/模糊/倾斜/JPEG压缩）
+- 对每个增强档位（不增强 / light / full / 自动分诊）运行 解码 → 增强 → OCR
+- 输出各阶段延迟分位数、吞吐量和字符错误率（CER），结果保存为JSON
+
+运行方式：
+    python ocr_benchmark.py                 # 完整测试（需要 pix2text）
+    python ocr_benchmark.py --no-ocr        # 只测解码和增强阶段
+    python ocr_benchmark.py --limit 5 --repeat 3
+==============================================================================
+"""
+
+import io
+import sys
+import json
+import time
+import random
+import tempfile
+import unicodedata
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+# 确保能导入本地模块
+sys.path.insert(0, str(Path(__file__).parent))
+
+from image_enhancer import (
+    load_image_fast,
+    crop_to_content,
+    fast_image_processing_pipeline,
+    triaged_image_processing_pipeline,
+    ENHANCEMENT_PRESETS,
+)
+from mistake_image_generator import QUESTION_BANK, generate_mistake_image
+
+# ==============================================================================
+# 配置
+# ==============================================================================
+
+# 报告输出目录（与模型评测报告放在一起）
+REPORTS_DIR = Path(__file__).parent / "evaluation_reports"
+
+# 增强档位：名称 → 增强函数（None 表示只做解码和裁剪）
+PROFILES: Dict[str, Optional[Callable[[Image.Image], Image.Image]]] = {
+    "none": None,
+    "light": lambda img: fast_image_processing_pipeline(img, **ENHANCEMENT_PRESETS["light"]),
+    "full": lambda img: fast_image_processing_pipeline(img, **ENHANCEMENT_PRESETS["full"]),
+    "triage": lambda img: triaged_image_processing_pipeline(img)[0],
+}
+
+
+# ==============================================================================
+# 合成语料
+# ==============================================================================
+
+def _add_noise(img: Image.Image, rng: random.Random, sigma: float = 12.0) -> Image.Image:
+    arr = np.asarray(img, dtype=np.float32)
+    noise = np.random.default_rng(rng.randrange(2 ** 32)).normal(0, sigma, arr.shape)
+    return Image.fromarray(np.clip(arr + noise, 0, 255).astype(np.uint8))
+
+
+def _skew(img: Image.Image, rng: random.Random, max_angle: float = 4.0) -> Image.Image:
+    angle = rng.uniform(1.0, max_angle) * rng.choice([-1, 1])
+    return img.rotate(angle, resample=Image.Resampling.BICUBIC, expand=True, fillcolor=(255, 255, 255))
+
+
+def _jpeg(img: Image.Image, quality: int = 25) -> Image.Image:
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return Image.open(io.BytesIO(buffer.getvalue())).convert("RGB")
+
+
+# 退化方式：名称 → (图片, 随机数生成器) → 退化后的图片
+DEGRADATIONS: Dict[str, Callable[[Image.Image, random.Random], Image.Image]] = {
+    "clean": lambda img, rng: img,
+    "noise": _add_noise,
+    "blur": lambda img, rng: img.filter(ImageFilter.GaussianBlur(1.5)),
+    "skew": _skew,
+    "jpeg": lambda img, rng: _jpeg(img),
+    "photo": lambda img, rng: _jpeg(_add_noise(_skew(img, rng, 2.0).filter(ImageFilter.GaussianBlur(1.0)), rng, 8.0), 40),
+}
+
+
+def ground_truth_text(subject: str, difficulty: str, question: Dict[str, str]) -> str:
+    """错题图片上绘制的全部文字（与 generate_mistake_image 的绘制内容一致）"""
+    return "\n".join([
+        "错题记录",
+        f"科目：{subject}  |  难度：{difficulty}",
+        "题目：",
+        question["question"],
+        f"你的答案：{question['wrong_answer']}",
+        f"正确答案：{question['correct_answer']}",
+        "详细分析：",
+        question["analysis"],
+    ])
+
+
+def build_corpus(limit: Optional[int] = None, seed: int = 42) -> List[Dict[str, Any]]:
+    """
+    生成语料：每道题生成一张错题图片，再按每种退化方式各生成一份JPEG
+
+    Returns:
+        [{"id", "subject", "difficulty", "degradation", "jpeg_bytes", "ground_truth"}]
+    """
+    rng = random.Random(seed)
+    questions = [
+        (subject, difficulty, question)
+        for subject, levels in QUESTION_BANK.items()
+        for difficulty, items in levels.items()
+        for question in items
+    ]
+    if limit:
+        questions = questions[:limit]
+
+    corpus = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for idx, (subject, difficulty, question) in enumerate(questions):
+            path = Path(tmp_dir) / f"mistake_{idx}.jpg"
+            generate_mistake_image(subject, difficulty, question, str(path))
+            base = Image.open(path).convert("RGB")
+
+            for name, degrade in DEGRADATIONS.items():
+                buffer = io.BytesIO()
+                degrade(base, rng).save(buffer, format="JPEG", quality=92)
+                corpus.append({
+                    "id": f"{idx}-{name}",
+                    "subject": subject,
+                    "difficulty": difficulty,
+                    "degradation": name,
+                    "jpeg_bytes": buffer.getvalue(),
+                    "ground_truth": ground_truth_text(subject, difficulty, question),
+                })
+    return corpus
+
+
+# ==============================================================================
+# 指标
+# ==============================================================================
+
+def normalize_text(text: str) -> str:
+    """去掉空白、LaTeX定界符和表情符号，只比较可见字符"""
+    text = text.replace("$", "")
+    return "".join(
+        ch for ch in unicodedata.normalize("NFKC", text)
+        if not ch.isspace() and unicodedata.category(ch) != "So"
+    )
+
+
+def levenshtein(a: str, b: str) -> int:
+    """编辑距离（逐字符）"""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def character_error_rate(prediction: str, reference: str) -> float:
+    """字符错误率 = 编辑距离 / 标准答案字符数"""
+    reference = normalize_text(reference)
+    if not reference:
+        return 0.0
+    return levenshtein(normalize_text(prediction), reference) / len(reference)
+
+
+def latency_summary(samples_ms: List[float]) -> Dict[str, float]:
+    """延迟分位数（毫秒）"""
+    if not samples_ms:
+        return {}
+    arr = np.asarray(samples_ms)
+    return {
+        "mean": round(float(arr.mean()), 2),
+        "p50": round(float(np.percentile(arr, 50)), 2),
+        "p90": round(float(np.percentile(arr, 90)), 2),
+        "p99": round(float(np.percentile(arr, 99)), 2),
+        "max": round(float(arr.max()), 2),
+    }
+
+
+# ==============================================================================
+# 测试执行
+# ==============================================================================
+
+def load_ocr_engine():
+    """加载Pix2Text（与线上配置一致）"""
+    from pix2text import Pix2Text
+    return Pix2Text(analyzer_config=dict(model_name='mfd'))
+
+
+def _result_text(result: Any) -> str:
+    if isinstance(result, dict) and "text" in result:
+        return result["text"]
+    return result if isinstance(result, str) else str(result)
+
+
+def run_profile(name: str, corpus: List[Dict[str, Any]], engine: Any = None, repeat: int = 1) -> Dict[str, Any]:
+    """对整个语料运行一个增强档位，返回延迟、吞吐量和CER"""
+    enhance = PROFILES[name]
+    stages: Dict[str, List[float]] = {"decode": [], "enhance": [], "ocr": [], "total": []}
+    cer_by_degradation: Dict[str, List[float]] = {}
+
+    wall_start = time.perf_counter()
+    for _ in range(repeat):
+        for item in corpus:
+            t0 = time.perf_counter()
+            img = crop_to_content(load_image_fast(Image.open(io.BytesIO(item["jpeg_bytes"]))))
+            t1 = time.perf_counter()
+            if enhance is not None:
+                img = enhance(img)
+            t2 = time.perf_counter()
+
+            stages["decode"].append((t1 - t0) * 1000)
+            stages["enhance"].append((t2 - t1) * 1000)
+
+            if engine is not None:
+                text = _result_text(engine.recognize(img))
+                t3 = time.perf_counter()
+                stages["ocr"].append((t3 - t2) * 1000)
+                cer_by_degradation.setdefault(item["degradation"], []).append(
+                    character_error_rate(text, item["ground_truth"])
+                )
+            else:
+                t3 = t2
+            stages["total"].append((t3 - t0) * 1000)
+    wall_seconds = time.perf_counter() - wall_start
+
+    report = {
+        "latency_ms": {stage: latency_summary(samples) for stage, samples in stages.items() if samples},
+        "throughput_images_per_s": round(len(stages["total"]) / wall_seconds, 2) if wall_seconds > 0 else None,
+    }
+    if cer_by_degradation:
+        all_cer = [c for values in cer_by_degradation.values() for c in values]
+        report["cer"] = {
+            "mean": round(float(np.mean(all_cer)), 4),
+            "by_degradation": {k: round(float(np.mean(v)), 4) for k, v in cer_by_degradation.items()},
+        }
+    return report
+
+
+def run_benchmark(limit: Optional[int] = None, repeat: int = 1, with_ocr: bool = True,
+                  profiles: Optional[List[str]] = None, seed: int = 42) -> Dict[str, Any]:
+    """生成语料并依次运行各增强档位，返回完整报告"""
+    print("📦 正在生成合成语料...")
+    corpus = build_corpus(limit=limit, seed=seed)
+    print(f"✅ 语料生成完成：{len(corpus)} 张图片")
+
+    engine = None
+    if with_ocr:
+        print("⏳ 正在加载 Pix2Text...")
+        engine = load_ocr_engine()
+        # 预热一次，避免首次推理的初始化耗时计入统计
+        engine.recognize(crop_to_content(load_image_fast(Image.open(io.BytesIO(corpus[0]["jpeg_bytes"])))))
+
+    results = {}
+    for name in profiles or list(PROFILES):
+        print(f"🔄 运行档位: {name}")
+        results[name] = run_profile(name, corpus, engine, repeat)
+
+    return {
+        "generated_at": datetime.now().isoformat(timespec="seconds"),
+        "corpus": {
+            "images": len(corpus),
+            "degradations": list(DEGRADATIONS),
+            "seed": seed,
+            "repeat": repeat,
+        },
+        "ocr_enabled": engine is not None,
+        "profiles": results,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="OCR与图像增强基准测试")
+    parser.add_argument("--limit", type=int, default=None, help="最多使用多少道题（每道题生成多张退化图片）")
+    parser.add_argument("--repeat", type=int, default=1, help="每个档位重复运行的次数")
+    parser.add_argument("--profile", action="append", choices=list(PROFILES), help="只运行指定档位（可重复）")
+    parser.add_argument("--no-ocr", action="store_true", help="不运行OCR，只测解码和增强阶段")
+    parser.add_argument("--seed", type=int, default=42, help="退化参数的随机种子")
+    parser.add_argument("--output", type=str, default=None, help="JSON报告输出路径")
+    args = parser.parse_args()
+
+    report = run_benchmark(
+        limit=args.limit,
+        repeat=args.repeat,
+        with_ocr=not args.no_ocr,
+        profiles=args.profile,
+        seed=args.seed,
+    )
+
+    output_path = Path(args.output) if args.output else (
+        REPORTS_DIR / f"ocr_benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    )
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    output_path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    print(f"\n📄 报告已保存: {output_path}")
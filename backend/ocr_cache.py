@@ -0,0 +1,382 @@
+# ==============================================================================
+# ocr_cache.py - OCR结果缓存
+# 功能：同一张题目照片重复上传时不再重复OCR
+# 技术：规范化图片像素的SHA-256精确键；可选的近似匹配（dHash + pHash 只产生候选，
+#       再用256×256灰度缩略图逐像素确认），内存LRU + SQLite磁盘两级缓存（磁盘层有条目上限）
+# ==============================================================================
+
+import os
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+# ==============================================================================
+# 配置
+# ==============================================================================
+
+OCR_CACHE_DIR = Path(os.getenv("OCR_CACHE_DIR", "ocr_cache"))
+OCR_CACHE_DB = OCR_CACHE_DIR / "ocr_cache.db"
+
+# 内存层最多保存的条目数
+OCR_CACHE_MEMORY_SIZE = int(os.getenv("OCR_CACHE_MEMORY_SIZE", "512"))
+
+# 磁盘层最多保存的条目数，超出后按最近使用时间淘汰最旧的条目
+OCR_CACHE_DISK_MAX_ENTRIES = int(os.getenv("OCR_CACHE_DISK_MAX_ENTRIES", "20000"))
+
+# 近似匹配（重新压缩的同一张照片）默认关闭：版式相同的不同题目感知哈希几乎一样，
+# 开启后感知哈希只用于挑选候选，必须再通过缩略图逐像素确认
+OCR_CACHE_NEAR_MATCH = os.getenv("OCR_CACHE_NEAR_MATCH", "0") == "1"
+
+# 两个感知哈希都在此汉明距离以内才成为候选（64位哈希）
+OCR_CACHE_MAX_DISTANCE = int(os.getenv("OCR_CACHE_MAX_DISTANCE", "4"))
+
+# 确认阶段：缩略图中灰度差超过 OCR_CACHE_CONFIRM_PIXEL_DIFF 的像素不超过该个数。
+# 题干只差一两个字符时也只有少数像素不同，所以默认一个都不允许（JPEG重新压缩不会产生这么大的差）
+OCR_CACHE_CONFIRM_PIXEL_DIFF = int(os.getenv("OCR_CACHE_CONFIRM_PIXEL_DIFF", "32"))
+OCR_CACHE_CONFIRM_MAX_PIXELS = int(os.getenv("OCR_CACHE_CONFIRM_MAX_PIXELS", "0"))
+
+# 每次近似查找最多确认的候选数
+OCR_CACHE_MAX_CANDIDATES = 3
+
+# OCR流水线版本号：预处理/增强参数变化后递增，旧缓存自动失效
+OCR_CACHE_VERSION = 5
+
+THUMB_SIZE = (256, 256)
+
+
+class Fingerprint(NamedTuple):
+    """图片指纹：digest 为精确键，其余字段只用于近似匹配"""
+    digest: str
+    dhash: int
+    phash: int
+    thumb: bytes  # 256×256 灰度像素
+
+
+# ==============================================================================
+# 哈希
+# ==============================================================================
+
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _normalize(image: Image.Image, size: Tuple[int, int]) -> np.ndarray:
+    """灰度化 + 缩放到指定尺寸，返回float32数组"""
+    gray = image.convert("L") if image.mode != "L" else image
+    return np.asarray(gray.resize(size, Image.Resampling.BOX), dtype=np.float32)
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    """将布尔数组按位打包为整数"""
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """生成 n×n 的DCT-II正交变换矩阵"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0, :] /= np.sqrt(2.0)
+    return matrix.astype(np.float32)
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def dhash(image: Image.Image) -> int:
+    """差值哈希：9×8灰度图中相邻像素的明暗关系（64位）"""
+    pixels = _normalize(image, (9, 8))
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(image: Image.Image) -> int:
+    """感知哈希：32×32灰度图DCT后取左上8×8低频，与中位数比较（64位）"""
+    pixels = _normalize(image, (32, 32))
+    low_freq = (_DCT_32 @ pixels @ _DCT_32.T)[:8, :8]
+    return _bits_to_int(low_freq > np.median(low_freq[1:].ravel()))
+
+
+def image_digest(image: Image.Image) -> str:
+    """规范化图片（RGB像素 + 尺寸）的SHA-256，像素完全相同才会相等"""
+    rgb = image.convert("RGB") if image.mode != "RGB" else image
+    h = hashlib.sha256(f"{rgb.width}x{rgb.height}:".encode())
+    h.update(rgb.tobytes())
+    return h.hexdigest()
+
+
+def image_fingerprint(image: Image.Image) -> Fingerprint:
+    """计算图片指纹"""
+    thumb = _normalize(image, THUMB_SIZE).round().astype(np.uint8).tobytes()
+    return Fingerprint(image_digest(image), dhash(image), phash(image), thumb)
+
+
+def thumbnails_match(a: bytes, b: bytes) -> bool:
+    """确认两张候选图是否同一张：缩略图中明显不同的像素个数不超过阈值"""
+    if len(a) != len(b):
+        return False
+    diff = np.abs(np.frombuffer(a, dtype=np.uint8).astype(np.int16)
+                  - np.frombuffer(b, dtype=np.uint8).astype(np.int16))
+    return int(np.count_nonzero(diff > OCR_CACHE_CONFIRM_PIXEL_DIFF)) <= OCR_CACHE_CONFIRM_MAX_PIXELS
+
+
+def _hamming(values: np.ndarray, target: int) -> np.ndarray:
+    """批量计算uint64数组与目标值的汉明距离"""
+    xor = np.bitwise_xor(values, np.uint64(target))
+    return _POPCOUNT_TABLE[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _to_signed(value: int) -> int:
+    """SQLite INTEGER是有符号64位，存储前转换"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+def _nearest(dhashes: np.ndarray, phashes: np.ndarray, fp: Fingerprint, max_distance: int) -> List[int]:
+    """感知哈希候选：两个距离都不超过容差，按距离之和从近到远"""
+    if len(dhashes) == 0:
+        return []
+    d = _hamming(dhashes, fp.dhash)
+    p = _hamming(phashes, fp.phash)
+    candidates = np.nonzero((d <= max_distance) & (p <= max_distance))[0]
+    order = candidates[np.argsort((d + p)[candidates], kind="stable")]
+    return [int(i) for i in order[:OCR_CACHE_MAX_CANDIDATES]]
+
+
+# ==============================================================================
+# 两级缓存
+# ==============================================================================
+
+class OCRResultCache:
+    """
+    OCR结果缓存
+
+    - 内存层：OrderedDict实现的LRU，键为图片digest
+    - 磁盘层：SQLite持久化，按digest精确查找；超过 disk_max_entries 时淘汰最久未使用的条目
+    - 近似匹配（可选）：启动时把感知哈希载入内存索引，候选再用缩略图确认；
+      只有开启时才在磁盘上保存缩略图
+    """
+
+    def __init__(self, db_path: Path = OCR_CACHE_DB,
+                 memory_size: int = OCR_CACHE_MEMORY_SIZE,
+                 max_distance: int = OCR_CACHE_MAX_DISTANCE,
+                 disk_max_entries: int = OCR_CACHE_DISK_MAX_ENTRIES,
+                 near_match: bool = OCR_CACHE_NEAR_MATCH):
+        self.db_path = Path(db_path)
+        self.memory_size = memory_size
+        self.max_distance = max_distance
+        self.disk_max_entries = disk_max_entries
+        self.near_match = near_match
+        self._memory: "OrderedDict[str, Tuple[Fingerprint, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._disk_count = 0
+        # 近似匹配索引：digest列表与两个哈希数组一一对应，digest不重复
+        self._disk_digests: List[str] = []
+        self._disk_dhash = np.empty(0, dtype=np.uint64)
+        self._disk_phash = np.empty(0, dtype=np.uint64)
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "near_hits": 0, "near_rejected": 0,
+                       "misses": 0, "stores": 0, "evicted": 0}
+
+        try:
+            self._open_disk_tier()
+        except Exception as e:
+            print(f"⚠️ [OCR缓存] 磁盘缓存不可用，仅使用内存缓存: {e}")
+            self._conn = None
+
+    def _open_disk_tier(self):
+        """打开SQLite，清理旧版本条目并载入近似匹配索引"""
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # 旧表只按感知哈希作键，会把版式相同的不同题目当成同一张，直接丢弃
+        self._conn.execute("DROP TABLE IF EXISTS ocr_result")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS ocr_entry (
+                   digest TEXT NOT NULL,
+                   version INTEGER NOT NULL,
+                   dhash INTEGER NOT NULL,
+                   phash INTEGER NOT NULL,
+                   thumb BLOB NOT NULL,
+                   text TEXT NOT NULL,
+                   used_at REAL NOT NULL,
+                   PRIMARY KEY (digest, version)
+               )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_ocr_entry_used_at ON ocr_entry (used_at)")
+        self._conn.execute("DELETE FROM ocr_entry WHERE version <> ?", (OCR_CACHE_VERSION,))
+        self._conn.commit()
+        self._evict_disk()
+        self._load_index()
+        print(f"✅ [OCR缓存] 磁盘缓存已加载: {self._disk_count} 条")
+
+    def _load_index(self):
+        """从磁盘重建条目数和近似匹配索引"""
+        if self.near_match:
+            rows = self._conn.execute(
+                "SELECT digest, dhash, phash FROM ocr_entry WHERE version = ?", (OCR_CACHE_VERSION,)
+            ).fetchall()
+            self._disk_digests = [r[0] for r in rows]
+            self._disk_dhash = np.array([_to_unsigned(r[1]) for r in rows], dtype=np.uint64)
+            self._disk_phash = np.array([_to_unsigned(r[2]) for r in rows], dtype=np.uint64)
+            self._disk_count = len(rows)
+        else:
+            self._disk_count = self._conn.execute(
+                "SELECT COUNT(*) FROM ocr_entry WHERE version = ?", (OCR_CACHE_VERSION,)
+            ).fetchone()[0]
+
+    def _evict_disk(self) -> int:
+        """超过上限时删除最久未使用的条目（多删10%，避免每次写入都触发淘汰）"""
+        count = self._conn.execute("SELECT COUNT(*) FROM ocr_entry").fetchone()[0]
+        if count <= self.disk_max_entries:
+            return 0
+        excess = count - self.disk_max_entries + self.disk_max_entries // 10
+        self._conn.execute(
+            "DELETE FROM ocr_entry WHERE rowid IN "
+            "(SELECT rowid FROM ocr_entry ORDER BY used_at LIMIT ?)", (excess,)
+        )
+        self._conn.commit()
+        self._stats["evicted"] += excess
+        print(f"🧹 [OCR缓存] 磁盘缓存超过 {self.disk_max_entries} 条，淘汰 {excess} 条")
+        return excess
+
+    def _match_memory(self, fp: Fingerprint) -> Optional[str]:
+        if fp.digest in self._memory:
+            return fp.digest
+        if not self.near_match or not self._memory:
+            return None
+        keys = list(self._memory.keys())
+        entries = [self._memory[k][0] for k in keys]
+        candidates = _nearest(np.array([e.dhash for e in entries], dtype=np.uint64),
+                              np.array([e.phash for e in entries], dtype=np.uint64),
+                              fp, self.max_distance)
+        for idx in candidates:
+            if thumbnails_match(entries[idx].thumb, fp.thumb):
+                self._stats["near_hits"] += 1
+                return keys[idx]
+            self._stats["near_rejected"] += 1
+        return None
+
+    def _match_disk(self, fp: Fingerprint) -> Optional[Tuple[Fingerprint, str]]:
+        if self._conn is None:
+            return None
+        row = self._conn.execute(
+            "SELECT text FROM ocr_entry WHERE digest = ? AND version = ?", (fp.digest, OCR_CACHE_VERSION)
+        ).fetchone()
+        if row:
+            self._touch(fp.digest)
+            return fp, row[0]
+        if not self.near_match:
+            return None
+
+        for idx in _nearest(self._disk_dhash, self._disk_phash, fp, self.max_distance):
+            digest = self._disk_digests[idx]
+            row = self._conn.execute(
+                "SELECT dhash, phash, thumb, text FROM ocr_entry WHERE digest = ? AND version = ?",
+                (digest, OCR_CACHE_VERSION)
+            ).fetchone()
+            if not row:
+                continue
+            thumb = zlib.decompress(row[2]) if row[2] else b""
+            if thumbnails_match(thumb, fp.thumb):
+                self._stats["near_hits"] += 1
+                self._touch(digest)
+                return Fingerprint(digest, _to_unsigned(row[0]), _to_unsigned(row[1]), thumb), row[3]
+            self._stats["near_rejected"] += 1
+        return None
+
+    def _touch(self, digest: str):
+        """更新最近使用时间，供磁盘淘汰排序"""
+        self._conn.execute(
+            "UPDATE ocr_entry SET used_at = ? WHERE digest = ? AND version = ?",
+            (time.time(), digest, OCR_CACHE_VERSION)
+        )
+        self._conn.commit()
+
+    def _remember(self, fp: Fingerprint, text: str):
+        self._memory[fp.digest] = (fp, text)
+        self._memory.move_to_end(fp.digest)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def lookup(self, fp: Fingerprint) -> Optional[str]:
+        """按指纹查找（精确匹配；开启近似匹配时候选需通过缩略图确认），未命中返回None"""
+        with self._lock:
+            key = self._match_memory(fp)
+            if key is not None:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return self._memory[key][1]
+
+            try:
+                hit = self._match_disk(fp)
+            except Exception as e:
+                print(f"⚠️ [OCR缓存] 磁盘查询失败: {e}")
+                hit = None
+
+            if hit is not None:
+                self._remember(*hit)
+                self._stats["disk_hits"] += 1
+                return hit[1]
+
+            self._stats["misses"] += 1
+            return None
+
+    def store(self, fp: Fingerprint, text: str):
+        """写入两级缓存"""
+        with self._lock:
+            self._remember(fp, text)
+            self._stats["stores"] += 1
+
+            if self._conn is None:
+                return
+            try:
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO ocr_entry (digest, version, dhash, phash, thumb, text, used_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (fp.digest, OCR_CACHE_VERSION, _to_signed(fp.dhash), _to_signed(fp.phash),
+                     zlib.compress(fp.thumb) if self.near_match else b"", text, time.time())
+                )
+                if cursor.rowcount == 0:
+                    # 已存在：只更新结果，索引不变
+                    self._conn.execute(
+                        "UPDATE ocr_entry SET text = ?, used_at = ? WHERE digest = ? AND version = ?",
+                        (text, time.time(), fp.digest, OCR_CACHE_VERSION)
+                    )
+                    self._conn.commit()
+                    return
+                self._conn.commit()
+                self._disk_count += 1
+                if self.near_match:
+                    self._disk_digests.append(fp.digest)
+                    self._disk_dhash = np.append(self._disk_dhash, np.uint64(fp.dhash))
+                    self._disk_phash = np.append(self._disk_phash, np.uint64(fp.phash))
+                if self._disk_count > self.disk_max_entries and self._evict_disk():
+                    self._load_index()
+            except Exception as e:
+                print(f"⚠️ [OCR缓存] 磁盘写入失败: {e}")
+
+    def get_stats(self) -> Dict[str, int]:
+        """缓存命中统计"""
+        stats = dict(self._stats)
+        stats["memory_entries"] = len(self._memory)
+        stats["disk_entries"] = int(self._disk_count)
+        stats["near_match"] = self.near_match
+        return stats
+
+
+# 全局缓存实例（main.py / main_simple.py 共用）
+ocr_cache = OCRResultCache()
@@ -0,0 +1,453 @@
+# ==============================================================================
+# ocr_service.py - OCR服务层
+# 功能：把短时间内并发到达的OCR请求聚合成批次，统一交给Pix2Text处理
+# 技术：后台批处理线程 + Future结果回传（动态批处理 Dynamic Batching）
+# ==============================================================================
+
+import os
+import time
+import queue
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+# ==============================================================================
+# 配置（可通过环境变量调整）
+# ==============================================================================
+
+# 单个批次最多包含的图片数
+OCR_BATCH_MAX_SIZE = int(os.getenv("OCR_BATCH_MAX_SIZE", "8"))
+
+# 第一张图片到达后最多等待多久再开始处理（毫秒）
+OCR_BATCH_MAX_WAIT_MS = float(os.getenv("OCR_BATCH_MAX_WAIT_MS", "10"))
+
+# 跳过本地OCR时写入Prompt的题目占位说明（模型直接读原图）
+OCR_SKIPPED_PLACEHOLDER = "（题目见图片，请直接识别图片中的题目内容）"
+
+# OCR引擎尚未就绪时，请求最多等待多久（秒）
+OCR_ENGINE_WAIT_SECONDS = float(os.getenv("OCR_ENGINE_WAIT_SECONDS", "120"))
+
+# OCR引擎加载失败后，至少间隔多久才重新尝试加载（秒）
+OCR_ENGINE_RETRY_SECONDS = float(os.getenv("OCR_ENGINE_RETRY_SECONDS", "60"))
+
+
+# ==============================================================================
+# Pix2Text 批量识别
+# ==============================================================================
+
+def _resolve_batch_components(engine: Any) -> Tuple[Any, Any, Any]:
+    """
+    找到Pix2Text内部的 公式检测器 / 公式识别器 / 文字识别器
+
+    兼容两种内部结构：
+    - 1.x: engine.text_formula_ocr.{mfd, latex_ocr, text_ocr}
+    - 0.x: engine.{analyzer, latex_model, text_ocr}
+
+    Returns:
+        (detector, recognizer, text_ocr)，任何一个缺失时返回None
+    """
+    holder = getattr(engine, "text_formula_ocr", None) or engine
+    detector = getattr(holder, "mfd", None) or getattr(holder, "analyzer", None)
+    recognizer = getattr(holder, "latex_ocr", None) or getattr(holder, "latex_model", None)
+    text_ocr = getattr(holder, "text_ocr", None)
+
+    if not (hasattr(detector, "detect") and hasattr(recognizer, "recognize") and hasattr(text_ocr, "ocr")):
+        return None, None, None
+    return detector, recognizer, text_ocr
+
+
+def _box_bounds(box: Any) -> Tuple[int, int, int, int]:
+    """将检测框（4x2顶点数组或[x0, y0, x1, y1]）转换为 (x0, y0, x1, y1)"""
+    pts = np.asarray(box, dtype=np.float32).reshape(-1, 2)
+    x0, y0 = pts.min(axis=0)
+    x1, y1 = pts.max(axis=0)
+    return int(x0), int(y0), int(x1), int(y1)
+
+
+def _merge_by_reading_order(elements: List[Tuple[int, int, int, int, str, bool]]) -> str:
+    """
+    按阅读顺序合并文字行和公式
+
+    Args:
+        elements: [(x0, y0, x1, y1, text, is_isolated_formula), ...]
+    """
+    elements = sorted(elements, key=lambda e: (e[1], e[0]))
+    lines: List[List[Tuple[int, int, int, int, str, bool]]] = []
+
+    for elem in elements:
+        center_y = (elem[1] + elem[3]) / 2
+        if lines and not elem[5] and not lines[-1][0][5]:
+            line_y0 = min(e[1] for e in lines[-1])
+            line_y1 = max(e[3] for e in lines[-1])
+            if line_y0 <= center_y <= line_y1:
+                lines[-1].append(elem)
+                continue
+        lines.append([elem])
+
+    return "\n".join(
+        " ".join(e[4] for e in sorted(line, key=lambda e: e[0]))
+        for line in lines
+    )
+
+
+def recognize_batch(engine: Any, images: List[Image.Image]) -> List[Any]:
+    """
+    批量识别多张图片
+
+    处理流程：
+    1. 公式检测器一次前向处理整个批次
+    2. 收集所有图片中的公式区域，公式识别器一次批量识别
+    3. 遮盖公式区域后逐张做文字识别，再按阅读顺序合并
+
+    单张图片也走同一流程，保证同一张图无论与哪些图片同批，识别结果都一致；
+    只有引擎不支持批量接口时，才对所有图片逐张调用 engine.recognize。
+
+    Args:
+        engine: Pix2Text实例
+        images: PIL图片列表
+
+    Returns:
+        与images一一对应的识别结果列表
+    """
+    detector, recognizer, text_ocr = _resolve_batch_components(engine)
+    if detector is None:
+        return [engine.recognize(img) for img in images]
+
+    rgb_images = [img if img.mode == "RGB" else img.convert("RGB") for img in images]
+
+    # 步骤1：批量公式检测
+    detections = detector.detect(rgb_images)
+    if len(detections) != len(rgb_images) or not all(isinstance(d, list) for d in detections):
+        raise ValueError("公式检测器未返回逐图结果")
+
+    # 步骤2：批量公式识别
+    crops: List[Image.Image] = []
+    owners: List[Tuple[int, Tuple[int, int, int, int], bool]] = []
+    for idx, (img, dets) in enumerate(zip(rgb_images, detections)):
+        for det in dets:
+            bounds = _box_bounds(det["box"])
+            crops.append(img.crop(bounds))
+            owners.append((idx, bounds, det.get("type") == "isolated"))
+
+    formulas = recognizer.recognize(crops, batch_size=len(crops)) if crops else []
+
+    elements: List[List[Tuple[int, int, int, int, str, bool]]] = [[] for _ in rgb_images]
+    for (idx, bounds, isolated), formula in zip(owners, formulas):
+        latex = formula.get("text", "") if isinstance(formula, dict) else str(formula)
+        wrapped = f"$${latex}$$" if isolated else f"${latex}$"
+        elements[idx].append((*bounds, wrapped, isolated))
+
+    # 步骤3：遮盖公式后识别文字
+    for idx, img in enumerate(rgb_images):
+        canvas = np.array(img)
+        for owner_idx, (x0, y0, x1, y1), _ in owners:
+            if owner_idx == idx:
+                canvas[y0:y1, x0:x1] = 255
+        for line in text_ocr.ocr(canvas):
+            text = line.get("text", "").strip()
+            if text:
+                elements[idx].append((*_box_bounds(line["position"]), text, False))
+
+    return [_merge_by_reading_order(elems) for elems in elements]
+
+
+# ==============================================================================
+# 延迟加载的OCR引擎
+# ==============================================================================
+
+class LazyEngine:
+    """
+    延迟创建的重型引擎（如Pix2Text）
+
+    - 导入模块时不加载模型，服务启动后调用 start_warmup() 在后台线程预热
+    - get() 等待引擎就绪（带超时），预热尚未开始时自动触发
+    - 加载失败会记录原因（健康检查可见），retry_seconds 后允许重新加载
+    """
+
+    def __init__(self, factory: Callable[[], Any], name: str,
+                 retry_seconds: float = OCR_ENGINE_RETRY_SECONDS):
+        self.name = name
+        self.retry_seconds = retry_seconds
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._attempt_done: Optional[threading.Event] = None
+        self._instance: Any = None
+        self._state = "pending"  # pending / loading / ready / failed
+        self._error: Optional[str] = None
+        self._failed_at = 0.0
+        self._load_ms: Optional[float] = None
+
+    @property
+    def is_ready(self) -> bool:
+        return self._state == "ready"
+
+    def start_warmup(self) -> bool:
+        """在后台线程开始加载；已就绪、正在加载或处于失败冷却期时返回False"""
+        with self._lock:
+            if self._state in ("ready", "loading"):
+                return False
+            if self._state == "failed" and time.monotonic() - self._failed_at < self.retry_seconds:
+                return False
+            self._state = "loading"
+            self._attempt_done = threading.Event()
+            done = self._attempt_done
+
+        threading.Thread(target=self._load, args=(done,), name=f"{self.name}-warmup", daemon=True).start()
+        return True
+
+    def _load(self, done: threading.Event):
+        print(f"⏳ [{self.name}] 后台加载中...")
+        start = time.perf_counter()
+        try:
+            instance = self._factory()
+        except Exception as e:
+            with self._lock:
+                self._state = "failed"
+                self._error = f"{type(e).__name__}: {e}"
+                self._failed_at = time.monotonic()
+            print(f"❌ [{self.name}] 加载失败: {e}")
+        else:
+            with self._lock:
+                self._instance = instance
+                self._state = "ready"
+                self._error = None
+                self._load_ms = (time.perf_counter() - start) * 1000
+            print(f"✅ [{self.name}] 加载完成，耗时 {self._load_ms:.0f}ms")
+        finally:
+            done.set()
+
+    def get(self, timeout: float = OCR_ENGINE_WAIT_SECONDS) -> Any:
+        """返回引擎实例，未就绪时等待加载完成；超时或加载失败抛出RuntimeError"""
+        if self._state == "ready":
+            return self._instance
+
+        self.start_warmup()
+        done = self._attempt_done
+        if done is not None:
+            done.wait(timeout)
+
+        if self._state != "ready":
+            detail = f"，{self._error}" if self._error else ""
+            raise RuntimeError(f"{self.name} 未就绪（状态: {self._state}{detail}）")
+        return self._instance
+
+    def wait_ready(self, timeout: float = OCR_ENGINE_WAIT_SECONDS) -> bool:
+        """等待引擎就绪，返回是否可用"""
+        try:
+            self.get(timeout)
+            return True
+        except RuntimeError as e:
+            print(f"⚠️ [{self.name}] {e}")
+            return False
+
+    def get_status(self) -> Dict[str, Any]:
+        """预热状态（用于健康检查）"""
+        return {
+            "name": self.name,
+            "state": self._state,
+            "ready": self.is_ready,
+            "load_ms": round(self._load_ms, 1) if self._load_ms is not None else None,
+            "error": self._error,
+        }
+
+
+# ==============================================================================
+# 动态批处理器
+# ==============================================================================
+
+class OCRBatcher:
+    """
+    OCR动态批处理器
+
+    - 调用方提交单张图片，拿到属于自己的Future
+    - 后台线程在 max_wait_ms 内收集最多 max_batch_size 张图片，作为一个批次识别
+    - 批量识别失败时逐张重试（同一识别流程），单张失败只影响对应的调用方
+    - engine 可以是 LazyEngine，批次开始时才取出实例（等待预热完成）
+    """
+
+    def __init__(self, engine: Any,
+                 max_batch_size: int = OCR_BATCH_MAX_SIZE,
+                 max_wait_ms: float = OCR_BATCH_MAX_WAIT_MS):
+        self.engine = engine
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._queue: "queue.Queue[Tuple[Image.Image, Future]]" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "batches": 0,
+            "images": 0,
+            "largest_batch": 0,
+            "batched_calls": 0,
+            "fallback_calls": 0,
+        }
+
+    def _ensure_worker(self):
+        """首次提交时启动后台线程"""
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="ocr-batcher", daemon=True)
+                self._worker.start()
+
+    def submit(self, image: Image.Image) -> Future:
+        """提交一张图片，返回识别结果的Future"""
+        future: Future = Future()
+        self._ensure_worker()
+        self._queue.put((image, future))
+        return future
+
+    def recognize(self, image: Image.Image, cancel_token: Any = None) -> Any:
+        """
+        同步识别（阻塞当前线程直到所在批次完成）
+
+        传入 CancelToken 时，请求取消会撤回仍在排队的任务（已进入批次的无法中断），
+        此时抛出 concurrent.futures.CancelledError
+        """
+        future = self.submit(image)
+        if cancel_token is not None:
+            def _cancel_queued():
+                if future.cancel():
+                    cancel_token.record("ocr_jobs_cancelled")
+            cancel_token.add_callback(_cancel_queued)
+        return future.result()
+
+    async def recognize_async(self, image: Image.Image) -> Any:
+        """异步识别（不阻塞事件循环）"""
+        return await asyncio.wrap_future(self.submit(image))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """批处理统计信息"""
+        stats = dict(self._stats)
+        stats["avg_batch_size"] = round(stats["images"] / stats["batches"], 2) if stats["batches"] else 0.0
+        stats["queue_depth"] = self._queue.qsize()
+        stats["max_batch_size"] = self.max_batch_size
+        stats["max_wait_ms"] = self.max_wait * 1000
+        return stats
+
+    def _collect_batch(self) -> List[Tuple[Image.Image, Future]]:
+        """阻塞等待第一张图片，然后在等待窗口内继续收集"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        """后台线程主循环"""
+        while True:
+            batch = self._collect_batch()
+            batch = [(img, fut) for img, fut in batch if fut.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            self._stats["batches"] += 1
+            self._stats["images"] += len(batch)
+            self._stats["largest_batch"] = max(self._stats["largest_batch"], len(batch))
+
+            try:
+                engine = self.engine.get() if isinstance(self.engine, LazyEngine) else self.engine
+            except RuntimeError as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+
+            try:
+                results = recognize_batch(engine, [img for img, _ in batch])
+                self._stats["batched_calls"] += 1
+                for (_, fut), result in zip(batch, results):
+                    fut.set_result(result)
+            except Exception as e:
+                print(f"⚠️ [OCR批处理] 批量识别失败，逐张重试: {e}")
+                self._stats["fallback_calls"] += 1
+                for img, fut in batch:
+                    try:
+                        fut.set_result(recognize_batch(engine, [img])[0])
+                    except Exception as single_error:
+                        fut.set_exception(single_error)
+
+
+# ==============================================================================
+# OCR指标
+# ==============================================================================
+
+class OCRMetrics:
+    """记录OCR前处理的分诊决策（skip / light / full）及耗时"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._levels: Dict[str, int] = {"skip": 0, "light": 0, "full": 0}
+        self._enhance_ms_total = 0.0
+        self._last_decision: Optional[Dict[str, Any]] = None
+
+    def record_enhancement(self, decision: Dict[str, Any], elapsed_ms: float):
+        """记录一次分诊决策和前处理耗时"""
+        with self._lock:
+            level = decision.get("level", "full")
+            self._levels[level] = self._levels.get(level, 0) + 1
+            self._enhance_ms_total += elapsed_ms
+            self._last_decision = {**decision, "elapsed_ms": round(elapsed_ms, 1)}
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = sum(self._levels.values())
+            return {
+                "enhancement_levels": dict(self._levels),
+                "avg_enhance_ms": round(self._enhance_ms_total / total, 1) if total else 0.0,
+                "last_decision": self._last_decision,
+            }
+
+
+# 全局OCR指标（main.py / main_simple.py 共用）
+ocr_metrics = OCRMetrics()
+
+
+# ==============================================================================
+# 后台OCR（模型自带强OCR时，本地识别只用于入库/检索）
+# ==============================================================================
+
+# 保存未完成任务的引用，避免被垃圾回收
+_background_ocr_tasks: Set["asyncio.Task"] = set()
+
+
+def schedule_background_ocr(ocr_func: Callable[[Image.Image], str], image: Image.Image,
+                            on_done: Optional[Callable[[str], None]] = None) -> "asyncio.Task":
+    """
+    在线程池中异步执行OCR，不阻塞当前请求
+
+    Args:
+        ocr_func: OCR函数（如 extract_text_with_pix2text）
+        image: 待识别图片
+        on_done: 识别成功后的回调，参数为识别文本
+
+    Returns:
+        asyncio.Task，需要OCR结果时可以 await
+    """
+    async def _run() -> str:
+        text = await asyncio.to_thread(ocr_func, image)
+        if on_done is not None:
+            try:
+                on_done(text)
+            except Exception as e:
+                print(f"⚠️ [后台OCR] 回调执行失败: {e}")
+        return text
+
+    task = asyncio.get_running_loop().create_task(_run())
+    _background_ocr_tasks.add(task)
+    task.add_done_callback(_background_ocr_tasks.discard)
+    return task
@@ -0,0 +1,385 @@
+# ==============================================================================
+# query_profiler.py - 数据库查询耗时统计与慢查询日志
+# 功能：get_db_connection 借出的连接经此包装，记录每条语句的指纹、调用方法、
+#       影响行数、借出连接的等待时间和执行时间；超过阈值的语句记为慢查询并抓取 EXPLAIN
+# 技术：连接/游标代理 + 按调用方法和语句指纹聚合的直方图
+# ==============================================================================
+
+import os
+import re
+import sys
+import json
+import time
+import threading
+from collections import deque
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+
+# 是否开启统计（关闭时 get_db_connection 直接返回原始连接）
+DB_PROFILING = os.getenv("DB_PROFILING", "1") == "1"
+
+# 慢查询阈值（毫秒）
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "200"))
+
+# 是否为慢查询抓取 EXPLAIN；同一指纹在间隔内只抓取一次（秒）
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "1") == "1"
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL", "300"))
+
+# 内存中保留的最近慢查询条数
+SLOW_QUERY_RECENT = int(os.getenv("SLOW_QUERY_RECENT", "100"))
+
+# 慢查询日志文件（JSON行；为空时只打印）
+SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG", "")
+
+# 直方图桶上界（毫秒），最后一个桶收集更慢的语句
+HISTOGRAM_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# 可以 EXPLAIN 的语句
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+_THIS_FILE = __file__
+_SKIP_FILES = (_THIS_FILE, "contextlib.py")
+
+
+# ==============================================================================
+# 语句指纹与调用方
+# ==============================================================================
+
+_COMMENT_PATTERN = re.compile(r"/\*.*?\*/|--[^\n]*", re.S)
+_STRING_PATTERN = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_NUMBER_PATTERN = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_PATTERN = re.compile(r"%s|%\(\w+\)s")
+_IN_LIST_PATTERN = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.I)
+_VALUES_PATTERN = re.compile(r"\bVALUES\s*\([^)]*\)(?:\s*,\s*\([^)]*\))*", re.I)
+_SPACE_PATTERN = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(sql: str) -> str:
+    """
+    语句指纹：去掉注释、字面量和参数占位符，合并空白
+
+    同一条参数化语句的不同参数、不同长度的 IN 列表 / VALUES 列表得到相同指纹
+    """
+    text = _COMMENT_PATTERN.sub(" ", sql)
+    text = _STRING_PATTERN.sub("?", text)
+    text = _PLACEHOLDER_PATTERN.sub("?", text)
+    text = _NUMBER_PATTERN.sub("?", text)
+    text = _IN_LIST_PATTERN.sub("IN (...)", text)
+    text = _VALUES_PATTERN.sub("VALUES (...)", text)
+    return _SPACE_PATTERN.sub(" ", text).strip()[:500]
+
+
+def find_caller(depth: int = 1) -> str:
+    """借出连接的函数（跳过本模块和 contextlib 的栈帧），格式为 模块.类.方法"""
+    frame = sys._getframe(depth + 1)
+    while frame is not None and frame.f_code.co_filename.endswith(_SKIP_FILES):
+        frame = frame.f_back
+    if frame is None:
+        return "unknown"
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}.{frame.f_code.co_qualname}"
+
+
+def _is_explainable(sql: str) -> bool:
+    head = sql.lstrip().split(None, 1)
+    # 多语句批量发送的不做 EXPLAIN
+    return bool(head) and head[0].upper() in _EXPLAINABLE and ";" not in sql.strip().rstrip(";")
+
+
+# ==============================================================================
+# 统计
+# ==============================================================================
+
+class _Histogram:
+    """耗时直方图（固定桶）"""
+
+    __slots__ = ("counts", "count", "total_ms", "max_ms")
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms: float):
+        for i, bound in enumerate(HISTOGRAM_BUCKETS_MS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, p: float) -> float:
+        """按桶估算分位数（返回所在桶的上界，最后一个桶返回最大值）"""
+        if not self.count:
+            return 0.0
+        target = self.count * p
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return float(HISTOGRAM_BUCKETS_MS[i]) if i < len(HISTOGRAM_BUCKETS_MS) else round(self.max_ms, 2)
+        return round(self.max_ms, 2)
+
+    def to_dict(self) -> Dict[str, Any]:
+        labels = [f"<={b}ms" for b in HISTOGRAM_BUCKETS_MS] + [f">{HISTOGRAM_BUCKETS_MS[-1]}ms"]
+        return {
+            "count": self.count,
+            "total_ms": round(self.total_ms, 2),
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 2),
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "buckets": {label: n for label, n in zip(labels, self.counts) if n},
+        }
+
+
+class QueryProfiler:
+    """
+    查询统计
+
+    - 按调用方法聚合：执行时间直方图、影响行数、借出连接次数和等待时间、错误数
+    - 按语句指纹聚合：执行时间直方图、行数、调用方法
+    - 超过 slow_threshold_ms 的语句写入慢查询记录（附 EXPLAIN）
+    """
+
+    def __init__(self, slow_threshold_ms: float = SLOW_QUERY_THRESHOLD_MS):
+        self.slow_threshold_ms = slow_threshold_ms
+        self._lock = threading.Lock()
+        self._methods: Dict[str, Dict[str, Any]] = {}
+        self._fingerprints: Dict[str, Dict[str, Any]] = {}
+        self._slow: deque = deque(maxlen=SLOW_QUERY_RECENT)
+        self._explained_at: Dict[str, float] = {}
+        self._totals = {"statements": 0, "slow": 0, "errors": 0, "checkouts": 0}
+
+    def _method(self, caller: str) -> Dict[str, Any]:
+        stats = self._methods.get(caller)
+        if stats is None:
+            stats = self._methods[caller] = {
+                "latency": _Histogram(),
+                "rows": 0,
+                "errors": 0,
+                "slow": 0,
+                "checkouts": 0,
+                "checkout_wait": _Histogram(),
+            }
+        return stats
+
+    def record_checkout(self, caller: str, wait_ms: float):
+        with self._lock:
+            stats = self._method(caller)
+            stats["checkouts"] += 1
+            stats["checkout_wait"].add(wait_ms)
+            self._totals["checkouts"] += 1
+
+    def record(self, sql: str, caller: str, elapsed_ms: float, rows: int, error: bool = False) -> bool:
+        """记录一条语句，返回是否为慢查询"""
+        fp = fingerprint(sql)
+        slow = elapsed_ms >= self.slow_threshold_ms
+        with self._lock:
+            self._totals["statements"] += 1
+            method = self._method(caller)
+            method["latency"].add(elapsed_ms)
+            method["rows"] += max(rows, 0)
+
+            fp_stats = self._fingerprints.get(fp)
+            if fp_stats is None:
+                fp_stats = self._fingerprints[fp] = {"latency": _Histogram(), "rows": 0, "callers": set()}
+            fp_stats["latency"].add(elapsed_ms)
+            fp_stats["rows"] += max(rows, 0)
+            fp_stats["callers"].add(caller)
+
+            if error:
+                method["errors"] += 1
+                self._totals["errors"] += 1
+            if slow:
+                method["slow"] += 1
+                self._totals["slow"] += 1
+        return slow
+
+    def should_explain(self, sql: str) -> bool:
+        """同一指纹在 SLOW_QUERY_EXPLAIN_INTERVAL 内只 EXPLAIN 一次"""
+        if not SLOW_QUERY_EXPLAIN or not _is_explainable(sql):
+            return False
+        fp = fingerprint(sql)
+        now = time.monotonic()
+        with self._lock:
+            last = self._explained_at.get(fp)
+            if last is not None and now - last < SLOW_QUERY_EXPLAIN_INTERVAL:
+                return False
+            self._explained_at[fp] = now
+        return True
+
+    def log_slow(self, sql: str, caller: str, elapsed_ms: float, rows: int,
+                 checkout_wait_ms: float, explain: Optional[List[Dict[str, Any]]]):
+        entry = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "caller": caller,
+            "fingerprint": fingerprint(sql),
+            "elapsed_ms": round(elapsed_ms, 2),
+            "rows": rows,
+            "checkout_wait_ms": round(checkout_wait_ms, 2),
+            "explain": explain,
+        }
+        with self._lock:
+            self._slow.append(entry)
+        print(f"🐢 [慢查询] {elapsed_ms:.1f}ms {caller} rows={rows}: {entry['fingerprint'][:200]}")
+        if SLOW_QUERY_LOG:
+            try:
+                path = Path(SLOW_QUERY_LOG)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+            except OSError as e:
+                print(f"⚠️ [慢查询] 写入日志失败: {e}")
+
+    def get_stats(self, top: int = 20) -> Dict[str, Any]:
+        """按总耗时排序的方法 / 语句统计和最近的慢查询"""
+        with self._lock:
+            methods = [
+                {
+                    "method": caller,
+                    **s["latency"].to_dict(),
+                    "rows": s["rows"],
+                    "errors": s["errors"],
+                    "slow": s["slow"],
+                    "checkouts": s["checkouts"],
+                    "checkout_wait": s["checkout_wait"].to_dict(),
+                }
+                for caller, s in self._methods.items()
+            ]
+            queries = [
+                {
+                    "fingerprint": fp,
+                    **s["latency"].to_dict(),
+                    "rows": s["rows"],
+                    "callers": sorted(s["callers"]),
+                }
+                for fp, s in self._fingerprints.items()
+            ]
+            recent_slow = list(self._slow)
+            totals = dict(self._totals)
+
+        methods.sort(key=lambda m: m["total_ms"], reverse=True)
+        queries.sort(key=lambda q: q["total_ms"], reverse=True)
+        return {
+            "enabled": DB_PROFILING,
+            "slow_threshold_ms": self.slow_threshold_ms,
+            **totals,
+            "methods": methods[:top],
+            "queries": queries[:top],
+            "recent_slow": recent_slow,
+        }
+
+    def reset(self):
+        with self._lock:
+            self._methods.clear()
+            self._fingerprints.clear()
+            self._slow.clear()
+            self._explained_at.clear()
+            self._totals = {"statements": 0, "slow": 0, "errors": 0, "checkouts": 0}
+
+
+# 全局统计实例
+query_profiler = QueryProfiler()
+
+
+# ==============================================================================
+# 连接 / 游标代理
+# ==============================================================================
+
+class ProfiledCursor:
+    """记录 execute / executemany 耗时的游标代理，其余属性透传给原始游标"""
+
+    def __init__(self, cursor, connection: "ProfiledConnection"):
+        self._cursor = cursor
+        self._profiled_conn = connection
+
+    def _timed(self, method, sql: str, args, explainable: bool):
+        conn = self._profiled_conn
+        start = time.perf_counter()
+        try:
+            result = method(sql, args)
+        except Exception:
+            query_profiler.record(sql, conn.caller, (time.perf_counter() - start) * 1000, 0, error=True)
+            raise
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        rows = self._cursor.rowcount
+        if query_profiler.record(sql, conn.caller, elapsed_ms, rows):
+            explain = conn.explain(sql, args) if explainable and query_profiler.should_explain(sql) else None
+            query_profiler.log_slow(sql, conn.caller, elapsed_ms, rows, conn.checkout_wait_ms, explain)
+        return result
+
+    def execute(self, query: str, args=None):
+        return self._timed(self._cursor.execute, query, args, explainable=True)
+
+    def executemany(self, query: str, args):
+        # executemany 的参数是多组，不做 EXPLAIN
+        return self._timed(self._cursor.executemany, query, args, explainable=False)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cursor.close()
+
+
+class ProfiledConnection:
+    """借出连接的代理：cursor() 返回 ProfiledCursor，其余属性透传给原始连接"""
+
+    def __init__(self, conn, caller: str, checkout_wait_ms: float):
+        self._conn = conn
+        self.caller = caller
+        self.checkout_wait_ms = checkout_wait_ms
+
+    def cursor(self, *args, **kwargs):
+        return ProfiledCursor(self._conn.cursor(*args, **kwargs), self)
+
+    def explain(self, sql: str, args) -> Optional[List[Dict[str, Any]]]:
+        """在同一连接上用新游标执行 EXPLAIN（原游标的结果已全部读取，不受影响）"""
+        try:
+            cursor = self._conn.cursor()
+            try:
+                cursor.execute("EXPLAIN " + sql, args)
+                return [dict(row) if isinstance(row, dict) else list(row) for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+        except Exception as e:
+            return [{"error": str(e)}]
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def profile_connection(conn, checkout_wait_ms: float, caller: Optional[str] = None):
+    """
+    包装借出的连接并记录借出等待时间（关闭统计时原样返回）
+
+    caller 由借出连接的上下文管理器在进入内部辅助函数之前解析好传入；
+    未传入时假定直接在 get_db_connection 生成器中被调用
+    """
+    if not DB_PROFILING:
+        return conn
+    if caller is None:
+        # 跳过 get_db_connection 生成器本身，再向上跳过 contextlib 找到借出连接的方法
+        caller = find_caller(depth=2)
+    query_profiler.record_checkout(caller, checkout_wait_ms)
+    return ProfiledConnection(conn, caller, checkout_wait_ms)
+
+
+def get_query_stats(top: int = 20) -> Dict[str, Any]:
+    return query_profiler.get_stats(top)
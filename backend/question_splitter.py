@@ -3,6 +3,7 @@
 # 核心策略：从"像素聚合"到"结构化布局分析"
 # 三步走：强力聚合 → 题号检测 → 精细归属
 # 解决问题：防止一道题被分割成多个碎片
+# 用途：/api/solve 多题图片按题拆分，逐题并发OCR + 解答
 # ==============================================================================
 
 import cv2
@@ -389,6 +390,37 @@ def find_question_boxes(image: Image.Image,
     return final_boxes
 
 
+# ==============================================================================
+# 流水线入口：按题裁剪
+# ==============================================================================
+
+def split_question_images(image: Image.Image,
+                          min_question_height: int = 50,
+                          padding: int = 10) -> List[Tuple[Tuple[int, int, int, int], Image.Image]]:
+    """
+    检测题目区域并裁剪出每道题的图片
+
+    参数:
+        image: PIL格式输入图像
+        min_question_height: 最小题目高度
+        padding: 裁剪时在题目框四周额外保留的像素
+
+    返回:
+        [(题目框(x, y, w, h), 题目图片), ...]，按从上到下排序；
+        只检测到一个区域时返回整张原图
+    """
+    boxes = find_question_boxes(image, min_question_height=min_question_height)
+    if len(boxes) <= 1:
+        return [((0, 0, image.width, image.height), image)]
+
+    crops = []
+    for x, y, w, h in boxes:
+        x0, y0 = max(0, x - padding), max(0, y - padding)
+        x1, y1 = min(image.width, x + w + padding), min(image.height, y + h + padding)
+        crops.append(((x, y, w, h), image.crop((x0, y0, x1, y1))))
+    return crops
+
+
 # ==============================================================================
 # 可视化调试
 # ==============================================================================
@@ -0,0 +1,358 @@
+"""
+==============================================================================
+沐梧AI解题系统 - 数据库结构迁移工具
+==============================================================================
+功能：
+- 按版本顺序执行结构变更，已执行的版本记录在 schema_migration 表中，重复运行不会重复执行
+- 已有的手工升级脚本（database_schema_upgrade.sql / v25.2 / v25.3）登记为 25.1~25.3，
+  逐条执行，"已存在"类错误（1050/1060/1061/1359/1826 等）视为已执行
+- 25.4 起的索引变更用 AddIndex 声明：先查 information_schema，已存在则跳过，
+  列不一致时报错而不是静默重建；索引在线创建（ALGORITHM=INPLACE, LOCK=NONE）
+- 同一时间只允许一个进程执行迁移（GET_LOCK）
+
+运行方式：
+    python schema_migrate.py status                  # 查看各版本状态
+    python schema_migrate.py plan                    # 列出待执行的语句（不执行）
+    python schema_migrate.py up                      # 执行全部待执行版本
+    python schema_migrate.py up --to 25.3            # 执行到指定版本
+    python schema_migrate.py up --database edu_bench # 对其他库执行（如基准测试库）
+==============================================================================
+"""
+
+import sys
+import time
+import hashlib
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+import pymysql
+
+# 确保能导入本地模块
+sys.path.insert(0, str(Path(__file__).parent))
+
+from database import DB_CONFIG
+
+# ==============================================================================
+# 配置
+# ==============================================================================
+
+SCRIPT_DIR = Path(__file__).parent
+
+# 迁移锁名称和等待时间（秒）
+MIGRATION_LOCK_NAME = "muwu_schema_migrate"
+MIGRATION_LOCK_TIMEOUT = 10
+
+# 手工脚本中可以忽略的"已存在/不存在"类错误
+IGNORABLE_ERRORS = {
+    1050: "表已存在",
+    1060: "字段已存在",
+    1061: "索引已存在",
+    1068: "主键已存在",
+    1091: "字段/索引不存在",
+    1359: "触发器已存在",
+    1826: "外键已存在",
+}
+
+MIGRATION_TABLE_DDL = """
+    CREATE TABLE IF NOT EXISTS schema_migration (
+        version VARCHAR(32) NOT NULL COMMENT '版本号',
+        name VARCHAR(200) NOT NULL COMMENT '说明',
+        checksum CHAR(64) NOT NULL COMMENT '迁移内容的 SHA-256',
+        applied_at DATETIME DEFAULT CURRENT_TIMESTAMP COMMENT '执行时间',
+        duration_ms INT DEFAULT 0 COMMENT '执行耗时（毫秒）',
+        PRIMARY KEY (version)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+    COMMENT='数据库结构迁移记录'
+"""
+
+
+class MigrationError(Exception):
+    """迁移无法继续（如同名索引的列与声明不一致）"""
+
+
+# ==============================================================================
+# 迁移步骤
+# ==============================================================================
+
+class AddIndex:
+    """添加索引（已存在且列一致时跳过）"""
+
+    def __init__(self, table: str, name: str, columns: Sequence[str], unique: bool = False):
+        self.table = table
+        self.name = name
+        self.columns = tuple(columns)
+        self.unique = unique
+
+    def describe(self) -> str:
+        kind = "UNIQUE INDEX" if self.unique else "INDEX"
+        return f"ALTER TABLE `{self.table}` ADD {kind} `{self.name}` ({', '.join(self.columns)})"
+
+    def existing_columns(self, cursor) -> Optional[tuple]:
+        """当前库中该索引的列（不存在时返回 None）"""
+        cursor.execute(
+            """SELECT COLUMN_NAME FROM information_schema.STATISTICS
+               WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+               ORDER BY SEQ_IN_INDEX""",
+            (self.table, self.name)
+        )
+        rows = cursor.fetchall()
+        return tuple(row['COLUMN_NAME'] for row in rows) if rows else None
+
+    def statements(self) -> List[str]:
+        return [f"{self.describe()}, ALGORITHM=INPLACE, LOCK=NONE"]
+
+    def apply(self, cursor) -> bool:
+        """创建索引，返回是否有变更"""
+        existing = self.existing_columns(cursor)
+        if existing == self.columns:
+            return False
+        if existing is not None:
+            raise MigrationError(
+                f"{self.table}.{self.name} 已存在但列为 {existing}，与声明的 {self.columns} 不一致，请人工处理"
+            )
+        for statement in self.statements():
+            cursor.execute(statement)
+        return True
+
+    def revert(self, cursor) -> bool:
+        """删除索引（基准测试用于恢复"变更前"状态），返回是否有变更"""
+        if self.existing_columns(cursor) is None:
+            return False
+        cursor.execute(f"ALTER TABLE `{self.table}` DROP INDEX `{self.name}`")
+        return True
+
+
+class SqlFile:
+    """逐条执行手工升级脚本（支持 DELIMITER，跳过 USE，忽略"已存在"类错误）"""
+
+    def __init__(self, filename: str):
+        self.path = SCRIPT_DIR / filename
+
+    def describe(self) -> str:
+        return self.path.read_text(encoding="utf-8")
+
+    def statements(self) -> List[str]:
+        statements: List[str] = []
+        delimiter = ";"
+        buffer: List[str] = []
+        for line in self.describe().splitlines():
+            stripped = line.strip()
+            if not stripped or stripped.startswith("--"):
+                continue
+            if stripped.upper().startswith("DELIMITER "):
+                delimiter = stripped.split(None, 1)[1]
+                continue
+            buffer.append(line)
+            if stripped.endswith(delimiter):
+                statement = "\n".join(buffer).strip()
+                statements.append(statement[:-len(delimiter)].strip())
+                buffer = []
+        if buffer and "\n".join(buffer).strip():
+            statements.append("\n".join(buffer).strip())
+        # 迁移在连接指定的库中执行，脚本中的 USE 不生效
+        return [s for s in statements if not s.upper().startswith("USE ")]
+
+    def apply(self, cursor) -> bool:
+        changed = False
+        for statement in self.statements():
+            try:
+                cursor.execute(statement)
+                while cursor.nextset():
+                    pass
+                changed = True
+            except pymysql.err.MySQLError as e:
+                code = e.args[0] if e.args else None
+                if code not in IGNORABLE_ERRORS:
+                    raise
+                print(f"  ↪️  跳过（{IGNORABLE_ERRORS[code]}）: {statement.splitlines()[0][:80]}")
+        return changed
+
+
+class Migration:
+    """一个版本的迁移：按顺序执行的步骤"""
+
+    def __init__(self, version: str, name: str, steps: List[Any]):
+        self.version = version
+        self.name = name
+        self.steps = steps
+
+    @property
+    def checksum(self) -> str:
+        digest = hashlib.sha256()
+        for step in self.steps:
+            digest.update(step.describe().encode("utf-8"))
+        return digest.hexdigest()
+
+    @property
+    def sort_key(self) -> tuple:
+        return tuple(int(part) for part in self.version.split("."))
+
+
+# ==============================================================================
+# 迁移列表（按版本顺序；已发布的版本不要修改，新的变更追加新版本）
+# ==============================================================================
+
+# 热点连接的复合索引（db_benchmark 逐个测量添加前后的查询延迟）
+HOT_JOIN_INDEXES = [
+    # 按用户查关联题目：列表、权限校验、删除
+    AddIndex("user_exam", "idx_user_subject", ("user_info", "subject_id")),
+    # 按题目类型过滤后按 (created_at, subject_id) 倒序翻页
+    AddIndex("subject", "idx_type_created", ("subject_type", "created_at", "subject_id")),
+    # 会话历史 / 最近N条上下文：按会话过滤后按时间排序，不再 filesort
+    AddIndex("chat_history", "idx_session_created", ("session_id", "created_at", "id")),
+    # 会话列表：按用户过滤未删除的会话后按更新时间倒序
+    AddIndex("chat_session", "idx_user_updated", ("user_id", "is_deleted", "updated_at")),
+]
+
+MIGRATIONS = [
+    Migration("25.1", "subject/exam/user_exam 扩展字段与基础索引", [SqlFile("database_schema_upgrade.sql")]),
+    Migration("25.2", "对话历史、知识点标签、学习统计", [SqlFile("database_schema_v25.2.sql")]),
+    Migration("25.3", "分页索引、计数表与触发器、错题本映射、写入ID", [SqlFile("database_schema_v25.3.sql")]),
+    Migration("25.4", "热点连接的复合索引", HOT_JOIN_INDEXES),
+    Migration("25.5", "计数触发器按 用户×题目 去重", [SqlFile("database_schema_v25.5.sql")]),
+]
+
+
+def find_migration(version: str) -> Migration:
+    for migration in MIGRATIONS:
+        if migration.version == version:
+            return migration
+    raise MigrationError(f"未知的迁移版本: {version}")
+
+
+# ==============================================================================
+# 执行
+# ==============================================================================
+
+def connect(database: Optional[str] = None):
+    """迁移专用连接（不经过连接池，DDL 可能执行较久）"""
+    config = dict(DB_CONFIG)
+    config['read_timeout'] = None
+    config['write_timeout'] = None
+    if database:
+        config['database'] = database
+    return pymysql.connect(**config)
+
+
+def ensure_migration_table(cursor):
+    cursor.execute(MIGRATION_TABLE_DDL)
+
+
+def get_applied(cursor) -> Dict[str, Dict[str, Any]]:
+    """已执行的版本 → 记录"""
+    cursor.execute("SELECT version, name, checksum, applied_at, duration_ms FROM schema_migration")
+    return {row['version']: row for row in cursor.fetchall()}
+
+
+def pending_migrations(applied: Dict[str, Any], target: Optional[str] = None) -> List[Migration]:
+    """未执行的版本（target 之后的不包含）"""
+    limit = find_migration(target).sort_key if target else None
+    return [
+        m for m in sorted(MIGRATIONS, key=lambda m: m.sort_key)
+        if m.version not in applied and (limit is None or m.sort_key <= limit)
+    ]
+
+
+def apply_migration(cursor, migration: Migration) -> float:
+    """执行一个版本并记录，返回耗时（毫秒）"""
+    start = time.perf_counter()
+    for step in migration.steps:
+        changed = step.apply(cursor)
+        label = step.describe() if isinstance(step, AddIndex) else step.path.name
+        print(f"  {'✅' if changed else '⏭️ '} {label}{'' if changed else '（已存在）'}")
+    duration_ms = (time.perf_counter() - start) * 1000
+    cursor.execute(
+        """INSERT INTO schema_migration (version, name, checksum, duration_ms)
+           VALUES (%s, %s, %s, %s)
+           ON DUPLICATE KEY UPDATE name = VALUES(name), checksum = VALUES(checksum),
+                                   applied_at = NOW(), duration_ms = VALUES(duration_ms)""",
+        (migration.version, migration.name, migration.checksum, int(duration_ms))
+    )
+    return duration_ms
+
+
+def migrate(database: Optional[str] = None, target: Optional[str] = None) -> List[str]:
+    """执行待执行的版本，返回执行了的版本号"""
+    conn = connect(database)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT GET_LOCK(%s, %s) AS locked", (MIGRATION_LOCK_NAME, MIGRATION_LOCK_TIMEOUT))
+        if not cursor.fetchone()['locked']:
+            raise MigrationError("另一个进程正在执行迁移")
+        try:
+            ensure_migration_table(cursor)
+            applied = get_applied(cursor)
+            warn_changed(applied)
+            done = []
+            for migration in pending_migrations(applied, target):
+                print(f"🔧 执行迁移 {migration.version}: {migration.name}")
+                duration_ms = apply_migration(cursor, migration)
+                print(f"✅ 迁移 {migration.version} 完成 ({duration_ms:.0f}ms)")
+                done.append(migration.version)
+            if not done:
+                print("✅ 数据库结构已是最新")
+            return done
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK_NAME,))
+    finally:
+        conn.close()
+
+
+def warn_changed(applied: Dict[str, Dict[str, Any]]):
+    """已执行版本的内容被修改时提示（不会重新执行）"""
+    for migration in MIGRATIONS:
+        record = applied.get(migration.version)
+        if record and record['checksum'] != migration.checksum:
+            print(f"⚠️  迁移 {migration.version} 在执行后被修改过（不会重新执行，新变更请追加新版本）")
+
+
+def print_status(database: Optional[str] = None):
+    conn = connect(database)
+    try:
+        cursor = conn.cursor()
+        ensure_migration_table(cursor)
+        applied = get_applied(cursor)
+    finally:
+        conn.close()
+    warn_changed(applied)
+    for migration in sorted(MIGRATIONS, key=lambda m: m.sort_key):
+        record = applied.get(migration.version)
+        state = f"已执行 {record['applied_at']} ({record['duration_ms']}ms)" if record else "待执行"
+        print(f"  {migration.version:<6} {migration.name:<36} {state}")
+
+
+def print_plan(database: Optional[str] = None, target: Optional[str] = None):
+    conn = connect(database)
+    try:
+        cursor = conn.cursor()
+        ensure_migration_table(cursor)
+        applied = get_applied(cursor)
+    finally:
+        conn.close()
+    for migration in pending_migrations(applied, target):
+        print(f"-- {migration.version}: {migration.name}")
+        for step in migration.steps:
+            for statement in step.statements():
+                print(statement + ";")
+        print()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="数据库结构迁移")
+    parser.add_argument("command", choices=["status", "plan", "up"], help="status / plan / up")
+    parser.add_argument("--database", help=f"目标库（默认 {DB_CONFIG['database']}）")
+    parser.add_argument("--to", dest="target", help="执行到指定版本（含）")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "status":
+            print_status(args.database)
+        elif args.command == "plan":
+            print_plan(args.database, args.target)
+        else:
+            migrate(args.database, args.target)
+    except MigrationError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
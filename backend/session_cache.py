@@ -0,0 +1,121 @@
+# ==============================================================================
+# session_cache.py - 活跃对话会话的进程内缓存
+# 功能：缓存会话归属（用户）、模式和最近N条消息，连续对话时不再每轮查询
+#       会话信息和历史消息；写入时更新，删除时失效
+# 技术：OrderedDict 实现的LRU + 过期时间（多进程部署时限制其他进程删除会话后的陈旧时间）
+# ==============================================================================
+
+import os
+import time
+import threading
+from datetime import datetime
+from collections import OrderedDict, deque
+from typing import Any, Dict, Iterable, List, Optional
+
+
+# 缓存的会话数上限
+CHAT_SESSION_CACHE_SIZE = int(os.getenv("CHAT_SESSION_CACHE_SIZE", "1000"))
+
+# 缓存条目的有效期（秒）
+CHAT_SESSION_CACHE_TTL = float(os.getenv("CHAT_SESSION_CACHE_TTL", "600"))
+
+# 作为对话上下文的最近消息数
+CHAT_CONTEXT_MESSAGES = int(os.getenv("CHAT_CONTEXT_MESSAGES", "10"))
+
+
+def cached_message(write_id: str, role: str, content: str,
+                   image_url: Optional[str] = None, message_type: str = "text") -> Dict[str, Any]:
+    """刚写入的消息（格式同 get_recent_history 的结果）"""
+    return {
+        "id": None,
+        "write_id": write_id,
+        "role": role,
+        "content": content,
+        "image_url": image_url,
+        "message_type": message_type,
+        "created_at": datetime.now().replace(microsecond=0),
+    }
+
+
+class HotSessionCache:
+    """
+    活跃会话缓存
+
+    条目内容：user_id / mode / subject / grade / title，以及最近 N 条消息（按时间升序）
+    - load() 在未命中时用数据库结果填充
+    - append_messages() / set_title() 在写入时更新
+    - invalidate() 在删除会话时调用
+    """
+
+    def __init__(self, max_size: int = CHAT_SESSION_CACHE_SIZE,
+                 ttl: float = CHAT_SESSION_CACHE_TTL,
+                 context_size: int = CHAT_CONTEXT_MESSAGES):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.context_size = context_size
+        self._items: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "invalidations": 0}
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """返回会话条目（消息为列表副本）；未命中或已过期返回 None"""
+        with self._lock:
+            entry = self._items.get(session_id)
+            if entry is not None and time.monotonic() - entry["loaded_at"] > self.ttl:
+                del self._items[session_id]
+                self._stats["expired"] += 1
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._items.move_to_end(session_id)
+            self._stats["hits"] += 1
+            return {**entry, "messages": list(entry["messages"])}
+
+    def load(self, session_id: str, info: Dict[str, Any], messages: Iterable[Dict[str, Any]]):
+        """用会话信息和最近消息填充缓存"""
+        entry = {
+            "user_id": info["user_id"],
+            "mode": info.get("mode"),
+            "subject": info.get("subject"),
+            "grade": info.get("grade"),
+            "title": info.get("title"),
+            "messages": deque(messages, maxlen=self.context_size),
+            "loaded_at": time.monotonic(),
+        }
+        with self._lock:
+            self._items[session_id] = entry
+            self._items.move_to_end(session_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def append_messages(self, session_id: str, messages: List[Dict[str, Any]]):
+        """写入消息后追加到缓存（会话不在缓存中时忽略）"""
+        with self._lock:
+            entry = self._items.get(session_id)
+            if entry is not None:
+                entry["messages"].extend(messages)
+
+    def set_title(self, session_id: str, title: str):
+        with self._lock:
+            entry = self._items.get(session_id)
+            if entry is not None:
+                entry["title"] = title
+
+    def invalidate(self, session_id: str):
+        with self._lock:
+            if self._items.pop(session_id, None) is not None:
+                self._stats["invalidations"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._items)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        return stats
+
+
+# 全局会话缓存
+session_cache = HotSessionCache()
@@ -0,0 +1,84 @@
+# ==============================================================================
+# task_scheduler.py - 全局任务调度器
+# 功能：统一限制 OCR / 大模型调用 的并发数，多题拆分、多页作业等并发场景共用
+# 技术：按任务类型划分的 asyncio.Semaphore + 线程池执行阻塞调用
+# ==============================================================================
+
+import os
+import asyncio
+from typing import Any, Callable, Dict
+
+
+# ==============================================================================
+# 配置
+# ==============================================================================
+
+# 同时进行的OCR任务数（CPU/GPU密集，过多只会互相争抢）
+OCR_CONCURRENCY = int(os.getenv("OCR_CONCURRENCY", "4"))
+
+# 同时进行的大模型调用数（受API限流约束）
+MODEL_CALL_CONCURRENCY = int(os.getenv("MODEL_CALL_CONCURRENCY", "8"))
+
+
+class TaskScheduler:
+    """
+    全局任务调度器
+
+    - run_ocr / run_model 在线程池中执行阻塞函数，并受对应并发上限约束
+    - 所有接口共享同一组上限，单个请求的并发拆分不会挤占整个服务
+    """
+
+    def __init__(self, ocr_limit: int = OCR_CONCURRENCY, model_limit: int = MODEL_CALL_CONCURRENCY):
+        self._limits = {"ocr": max(1, ocr_limit), "model": max(1, model_limit)}
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._stats = {
+            kind: {"running": 0, "waiting": 0, "completed": 0, "failed": 0}
+            for kind in self._limits
+        }
+
+    def _semaphore(self, kind: str) -> asyncio.Semaphore:
+        """首次使用时在当前事件循环中创建信号量"""
+        if kind not in self._semaphores:
+            self._semaphores[kind] = asyncio.Semaphore(self._limits[kind])
+        return self._semaphores[kind]
+
+    async def _run(self, kind: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        stats = self._stats[kind]
+        stats["waiting"] += 1
+        acquired = False
+        try:
+            async with self._semaphore(kind):
+                stats["waiting"] -= 1
+                acquired = True
+                stats["running"] += 1
+                try:
+                    result = await asyncio.to_thread(func, *args, **kwargs)
+                    stats["completed"] += 1
+                    return result
+                except Exception:
+                    stats["failed"] += 1
+                    raise
+                finally:
+                    stats["running"] -= 1
+        finally:
+            if not acquired:
+                stats["waiting"] -= 1
+
+    async def run_ocr(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """执行OCR任务"""
+        return await self._run("ocr", func, *args, **kwargs)
+
+    async def run_model(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """执行大模型调用"""
+        return await self._run("model", func, *args, **kwargs)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """各类任务的并发上限和当前状态"""
+        return {
+            kind: {"limit": self._limits[kind], **stats}
+            for kind, stats in self._stats.items()
+        }
+
+
+# 全局调度器实例
+scheduler = TaskScheduler()
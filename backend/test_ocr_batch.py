@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+OCR批处理一致性测试脚本
+验证同一张图片单独识别与和其他图片同批识别的结果完全一致，以及批处理器的分批和结果顺序
+
+使用方法：
+    python test_ocr_batch.py                      # 使用模拟引擎（不需要加载模型）
+    python test_ocr_batch.py img1.png img2.jpg    # 使用真实Pix2Text识别给定图片
+"""
+
+import sys
+from typing import Any, List
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from ocr_service import OCRBatcher, recognize_batch
+
+
+def print_section(title):
+    """打印分隔符"""
+    print("\n" + "="*70)
+    print(f"  {title}")
+    print("="*70 + "\n")
+
+
+# ==============================================================================
+# 模拟引擎：按图片中的黑色方块产生确定性的检测/识别结果，并记录每次调用的批大小
+# ==============================================================================
+
+class FakeDetector:
+    """把每张图片左半边的黑块当作公式"""
+
+    def __init__(self, fail_on_batch: bool = False):
+        self.batch_sizes: List[int] = []
+        self.fail_on_batch = fail_on_batch
+
+    def detect(self, images: List[Image.Image]) -> List[list]:
+        self.batch_sizes.append(len(images))
+        if self.fail_on_batch and len(images) > 1:
+            raise RuntimeError("模拟批量检测失败")
+        results = []
+        for img in images:
+            arr = np.array(img.convert("L"))
+            dets = []
+            for x0, y0, x1, y1 in _dark_blocks(arr):
+                if x0 < arr.shape[1] // 2:
+                    dets.append({"box": [x0, y0, x1, y1], "type": "isolated" if y1 - y0 > 30 else "embedding"})
+            results.append(dets)
+        return results
+
+
+class FakeRecognizer:
+    def __init__(self):
+        self.batch_sizes: List[int] = []
+
+    def recognize(self, crops: List[Image.Image], batch_size: int = 1) -> List[dict]:
+        self.batch_sizes.append(len(crops))
+        return [{"text": f"x^{{{c.width}}}"} for c in crops]
+
+
+class FakeTextOCR:
+    """遮盖公式后剩下的黑块当作文字行"""
+
+    def ocr(self, canvas: np.ndarray) -> List[dict]:
+        gray = canvas.mean(axis=2) if canvas.ndim == 3 else canvas
+        return [
+            {"text": f"text{x1 - x0}", "position": [[x0, y0], [x1, y0], [x1, y1], [x0, y1]]}
+            for x0, y0, x1, y1 in _dark_blocks(gray)
+        ]
+
+
+class FakeEngine:
+    def __init__(self, fail_on_batch: bool = False):
+        self.mfd = FakeDetector(fail_on_batch)
+        self.latex_ocr = FakeRecognizer()
+        self.text_ocr = FakeTextOCR()
+
+    def recognize(self, img: Image.Image) -> str:
+        raise AssertionError("支持批量接口时不应调用 engine.recognize")
+
+
+def _dark_blocks(gray: np.ndarray) -> List[List[int]]:
+    """按行扫描出黑色矩形块（测试图片中的块互不相交）"""
+    mask = gray < 128
+    blocks, seen = [], np.zeros_like(mask)
+    for y, x in zip(*np.nonzero(mask & ~seen)):
+        if seen[y, x]:
+            continue
+        x1 = x
+        while x1 < mask.shape[1] and mask[y, x1]:
+            x1 += 1
+        y1 = y
+        while y1 < mask.shape[0] and mask[y1, x]:
+            y1 += 1
+        seen[y:y1, x:x1] = True
+        blocks.append([int(x), int(y), int(x1), int(y1)])
+    return blocks
+
+
+def make_sample(seed: int) -> Image.Image:
+    """生成带若干“公式块”和“文字块”的测试图片"""
+    rng = np.random.default_rng(seed)
+    img = Image.new("RGB", (400, 300), "white")
+    draw = ImageDraw.Draw(img)
+    for row in range(4):
+        y = 20 + row * 70
+        for col in range(2):
+            x = 20 + col * 200
+            w, h = int(rng.integers(40, 150)), int(rng.integers(15, 50))
+            draw.rectangle([x, y, x + w - 1, y + h - 1], fill="black")
+    return img
+
+
+# ==============================================================================
+# 测试（可直接运行，也可由 pytest 收集）
+# ==============================================================================
+
+def single_results(images: List[Image.Image]) -> List[Any]:
+    """逐张识别的结果（作为批量结果的对照）"""
+    engine = FakeEngine()
+    return [recognize_batch(engine, [img])[0] for img in images]
+
+
+def test_batch_matches_single():
+    """整批识别与逐张识别结果逐张一致，且按输入顺序返回"""
+    images = [make_sample(seed) for seed in range(5)]
+    expected = single_results(images)
+    assert len(set(expected)) == len(expected), "样本图片的识别结果应互不相同，否则无法验证顺序"
+
+    engine = FakeEngine()
+    assert recognize_batch(engine, images) == expected
+    # 一次检测、一次公式识别处理整个批次
+    assert engine.mfd.batch_sizes == [5]
+    assert len(engine.latex_ocr.batch_sizes) == 1
+
+    # 打乱输入顺序，结果跟着图片走
+    order = [3, 0, 4, 1, 2]
+    assert recognize_batch(FakeEngine(), [images[i] for i in order]) == [expected[i] for i in order]
+
+
+def test_batcher_groups_requests():
+    """批处理器把排队的请求按 max_batch_size 分批，每个调用方拿到自己图片的结果"""
+    images = [make_sample(seed) for seed in range(8)]
+    expected = single_results(images)
+
+    engine = FakeEngine()
+    batcher = OCRBatcher(engine, max_batch_size=4, max_wait_ms=200)
+    futures = [batcher.submit(img) for img in images]
+    results = [f.result(timeout=10) for f in futures]
+
+    assert results == expected
+    assert engine.mfd.batch_sizes == [4, 4]
+    stats = batcher.get_stats()
+    assert stats["batches"] == 2 and stats["largest_batch"] == 4 and stats["fallback_calls"] == 0
+
+
+def test_batcher_fallback_keeps_order():
+    """批量识别失败时逐张重试，结果仍与各自的图片对应"""
+    images = [make_sample(seed) for seed in range(3)]
+    expected = single_results(images)
+
+    engine = FakeEngine(fail_on_batch=True)
+    batcher = OCRBatcher(engine, max_batch_size=3, max_wait_ms=200)
+    futures = [batcher.submit(img) for img in images]
+
+    assert [f.result(timeout=10) for f in futures] == expected
+    assert engine.mfd.batch_sizes == [3, 1, 1, 1]
+    assert batcher.get_stats()["fallback_calls"] == 1
+
+
+def run_pix2text(paths: List[str]) -> bool:
+    """真实Pix2Text：给定图片的单张与批量结果是否一致"""
+    print_section("Pix2Text 单张 vs 批量")
+    from pix2text import Pix2Text
+    engine = Pix2Text(analyzer_config=dict(model_name='mfd'))
+    images = [Image.open(p).convert("RGB") for p in paths]
+    batched = recognize_batch(engine, images)
+    ok = True
+    for idx, img in enumerate(images):
+        single = recognize_batch(engine, [img])[0]
+        same = single == batched[idx]
+        ok = ok and same
+        print(f"{'✅' if same else '❌'} 图片{idx + 1}: 单张与批量结果{'一致' if same else '不一致'}")
+    return ok
+
+
+def run_fake_tests() -> bool:
+    ok = True
+    for test in (test_batch_matches_single, test_batcher_groups_requests, test_batcher_fallback_keeps_order):
+        print_section(test.__doc__)
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            ok = False
+            print(f"❌ {test.__name__}: {e}")
+    return ok
+
+
+def main():
+    ok = run_pix2text(sys.argv[1:]) if len(sys.argv) > 1 else run_fake_tests()
+    print_section("测试结果")
+    print("✅ 全部通过" if ok else "❌ 存在失败")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
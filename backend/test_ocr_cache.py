@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+OCR结果缓存测试脚本
+验证版式相同的不同题目不会互相命中、同一张图重复存储不产生重复索引、磁盘层有条目上限
+
+使用方法：python test_ocr_cache.py
+"""
+
+import io
+import sys
+import tempfile
+from pathlib import Path
+
+from PIL import Image, ImageDraw
+
+from ocr_cache import OCRResultCache, image_fingerprint
+
+
+def print_section(title):
+    """打印分隔符"""
+    print("\n" + "="*70)
+    print(f"  {title}")
+    print("="*70 + "\n")
+
+
+def make_worksheet(lines) -> Image.Image:
+    """同一版式（标题、题号、作答横线）的打印题目，只有题干文字不同"""
+    img = Image.new("RGB", (1200, 1600), "white")
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([40, 40, 1160, 140], outline="black", width=4)
+    draw.text((60, 70), "Unit 3  Quadratic Functions", fill="black")
+    for i, line in enumerate(lines):
+        y = 200 + i * 120
+        draw.text((60, y), f"{i + 1}. {line}", fill="black")
+        draw.line([60, y + 80, 1140, y + 80], fill="black", width=2)
+    return img
+
+
+def recompress(img: Image.Image, quality: int = 85) -> Image.Image:
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=quality)
+    return Image.open(io.BytesIO(buf.getvalue())).convert("RGB")
+
+
+PAPER_A = ["Solve x^2 - 5x + 6 = 0", "Find the vertex of y = x^2 + 4x", "Factor 2x^2 - 8"]
+PAPER_B = ["Solve x^2 + 3x - 4 = 0", "Find the vertex of y = x^2 - 6x", "Factor 3x^2 - 27"]
+
+
+def check_same_layout(near_match: bool):
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = OCRResultCache(Path(tmp) / "c.db", near_match=near_match)
+        a, b = make_worksheet(PAPER_A), make_worksheet(PAPER_B)
+        fa, fb = image_fingerprint(a), image_fingerprint(b)
+        print(f"dhash距离={bin(fa.dhash ^ fb.dhash).count('1')}, phash距离={bin(fa.phash ^ fb.phash).count('1')}")
+
+        cache.store(fa, "paper A")
+        assert cache.lookup(fb) is None, "题目B命中了题目A的结果（内存层）"
+        assert cache.lookup(fa) == "paper A"
+
+        # 重新打开（只查磁盘层）
+        reopened = OCRResultCache(Path(tmp) / "c.db", near_match=near_match)
+        assert reopened.lookup(fb) is None, "题目B命中了题目A的结果（磁盘层）"
+        assert reopened.lookup(fa) == "paper A"
+
+
+def test_same_layout_exact_only():
+    """版式相同的不同题目（仅精确匹配）"""
+    check_same_layout(near_match=False)
+
+
+def test_same_layout_near_match():
+    """版式相同的不同题目（开启近似匹配）"""
+    check_same_layout(near_match=True)
+
+
+def test_near_match_recompressed():
+    """开启近似匹配时，重新压缩的同一张图可以命中"""
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = OCRResultCache(Path(tmp) / "c.db", near_match=True)
+        a = make_worksheet(PAPER_A)
+        cache.store(image_fingerprint(a), "paper A")
+        reopened = OCRResultCache(Path(tmp) / "c.db", near_match=True)
+        assert reopened.lookup(image_fingerprint(recompress(a))) == "paper A"
+
+
+def test_restore_and_eviction():
+    """重复存储不重复索引，磁盘层按上限淘汰"""
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = OCRResultCache(Path(tmp) / "c.db", near_match=True, disk_max_entries=10)
+        fp = image_fingerprint(make_worksheet(PAPER_A))
+        for _ in range(5):
+            cache.store(fp, "paper A")
+        assert cache.get_stats()["disk_entries"] == 1
+        assert len(cache._disk_digests) == 1
+
+        for i in range(30):
+            cache.store(image_fingerprint(make_worksheet([f"Question {i}"])), f"q{i}")
+        stats = cache.get_stats()
+        assert stats["disk_entries"] <= 10 and stats["evicted"] > 0
+        assert len(cache._disk_digests) == stats["disk_entries"]
+        assert len(set(cache._disk_digests)) == len(cache._disk_digests)
+
+
+def main():
+    ok = True
+    for test in (test_same_layout_exact_only, test_same_layout_near_match,
+                 test_near_match_recompressed, test_restore_and_eviction):
+        print_section(test.__doc__)
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            ok = False
+            print(f"❌ {test.__name__}: {e}")
+    print_section("测试结果")
+    print("✅ 全部通过" if ok else "❌ 存在失败")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+查询统计（query_profiler）调用方归属测试脚本
+不连接数据库：连接池换成返回固定结果的假连接，验证统计里记录的是真正借出连接的方法
+
+使用方法：python test_query_profiler.py
+"""
+
+import sys
+from contextlib import contextmanager
+
+import database
+from database import MistakeManager, get_batch_connection
+from query_profiler import DB_PROFILING, query_profiler
+
+
+def print_section(title):
+    """打印分隔符"""
+    print("\n" + "="*70)
+    print(f"  {title}")
+    print("="*70 + "\n")
+
+
+class FakeCursor:
+    rowcount = 1
+
+    def execute(self, sql, args=None):
+        return 1
+
+    def fetchone(self):
+        return {"total": 3}
+
+    def fetchall(self):
+        return [{"total": 3}]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def cursor(self, *args, **kwargs):
+        return FakeCursor()
+
+
+class FakePool:
+    def get_connection(self, timeout=None):
+        return FakeConnection()
+
+    def return_connection(self, conn, broken=False):
+        pass
+
+
+def batch_writer():
+    with get_batch_connection() as conn:
+        conn.cursor().execute("SELECT 1")
+
+
+@contextmanager
+def fake_pools():
+    """把两个连接池换成假连接池，并清空统计"""
+    saved = database._db_pool, database._db_batch_pool
+    database._db_pool, database._db_batch_pool = FakePool(), FakePool()
+    query_profiler.reset()
+    try:
+        yield
+    finally:
+        database._db_pool, database._db_batch_pool = saved
+
+
+def methods() -> set:
+    return {m["method"] for m in query_profiler.get_stats(top=100)["methods"]}
+
+
+def test_manager_method_is_caller():
+    """MistakeManager 方法记为调用方"""
+    if not DB_PROFILING:
+        return
+    with fake_pools():
+        assert MistakeManager.count_user_mistakes("u1") == 3
+        found = methods()
+    print(f"调用方: {sorted(found)}")
+    assert "database.MistakeManager.count_user_mistakes" in found
+    assert not any(m.startswith("database._checkout") or m.startswith("database.get_") for m in found)
+
+
+def test_batch_connection_caller():
+    """多语句连接同样记录真正的调用方"""
+    if not DB_PROFILING:
+        return
+    with fake_pools():
+        batch_writer()
+        found = methods()
+    print(f"调用方: {sorted(found)}")
+    assert found == {f"{__name__}.batch_writer"}
+
+
+def main():
+    if not DB_PROFILING:
+        print("DB_PROFILING=0，跳过")
+        return
+    ok = True
+    for test in (test_manager_method_is_caller, test_batch_connection_caller):
+        print_section(test.__doc__)
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            ok = False
+            print(f"❌ {test.__name__}: {e}")
+    print_section("测试结果")
+    print("✅ 全部通过" if ok else "❌ 存在失败")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
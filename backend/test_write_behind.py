@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+对话写入队列（write_behind）崩溃恢复测试脚本
+不连接数据库：批量写入改为追加到临时目录下的 table.jsonl，按 write_id 去重后视为 chat_history 表
+
+使用方法：python test_write_behind.py
+"""
+
+import os
+import sys
+import json
+import asyncio
+import tempfile
+import multiprocessing as mp
+from pathlib import Path
+
+from write_behind import ChatWriteQueue
+
+
+def print_section(title):
+    """打印分隔符"""
+    print("\n" + "="*70)
+    print(f"  {title}")
+    print("="*70 + "\n")
+
+
+class FileBackedQueue(ChatWriteQueue):
+    """写入 table.jsonl 代替数据库"""
+
+    def __init__(self, workdir: Path, worker_id: str, batch_size: int = 200):
+        super().__init__(workdir / "chat_writes.log", batch_size=batch_size,
+                         flush_interval=0.01, worker_id=worker_id)
+        self.table_path = workdir / "table.jsonl"
+
+    async def _write_batch(self, batch):
+        with open(self.table_path, "a", encoding="utf-8") as f:
+            for op in batch:
+                if op["op"] == "message":
+                    f.write(json.dumps({"write_id": op["write_id"], "content": op["content"]}) + "\n")
+
+
+def load_table(workdir: Path) -> dict:
+    """INSERT IGNORE 语义：同一 write_id 只保留第一次写入"""
+    rows = {}
+    path = workdir / "table.jsonl"
+    if path.exists():
+        for line in path.read_text(encoding="utf-8").splitlines():
+            row = json.loads(line)
+            rows.setdefault(row["write_id"], row["content"])
+    return rows
+
+
+def crashing_worker(workdir: str, worker_id: str, total: int, flushed: int, result_path: str):
+    """写入 total 条消息，其中前 flushed 条刷写成功，然后不经清理直接退出（模拟崩溃）"""
+    queue = FileBackedQueue(Path(workdir), worker_id, batch_size=max(flushed, 1))
+    ids = [queue.add_message("s1", "user", f"{worker_id}-{i}") for i in range(total)]
+    if flushed:
+        asyncio.run(queue.flush_once())
+    Path(result_path).write_text(json.dumps(ids), encoding="utf-8")
+    os._exit(1)
+
+
+def run_crashed_worker(workdir: Path, worker_id: str, total: int, flushed: int) -> list:
+    result_path = workdir / f"{worker_id}.ids"
+    proc = mp.Process(target=crashing_worker, args=(str(workdir), worker_id, total, flushed, str(result_path)))
+    proc.start()
+    proc.join()
+    return json.loads(result_path.read_text(encoding="utf-8"))
+
+
+async def drain(queue: ChatWriteQueue):
+    await queue.start()
+    await queue.stop()
+
+
+def test_replay_after_crash():
+    """崩溃进程未提交的写入，由新进程（不同进程号）接管并写入，且不重复"""
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        ids = run_crashed_worker(workdir, "crashed", total=10, flushed=4)
+        print(f"崩溃前已写入 {len(load_table(workdir))} 条，日志中共 {len(ids)} 条")
+
+        survivor = FileBackedQueue(workdir, "survivor")
+        asyncio.run(drain(survivor))
+
+        assert set(load_table(workdir)) == set(ids)
+        assert survivor.get_stats()["recovered"] == 6
+        assert not (workdir / "chat_writes.crashed.log").exists(), "遗留日志未删除"
+
+
+def test_live_worker_untouched():
+    """存活进程的日志不会被接管；一个进程清空自己的日志不影响其他进程"""
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        a = FileBackedQueue(workdir, "a")
+        b = FileBackedQueue(workdir, "b")
+        a.add_message("s1", "user", "a-0")
+        b_id = b.add_message("s2", "user", "b-0")
+
+        # a 写完并清空自己的日志；b 的写入仍在 b 的日志中
+        asyncio.run(a.flush_once())
+        assert b_id in (workdir / "chat_writes.b.log").read_text(encoding="utf-8")
+        assert a.get_stats()["log_bytes"] == 0
+
+        # b 仍在运行（持有锁），新进程 c 不接管 b 的日志
+        c = FileBackedQueue(workdir, "c")
+        c.add_message("s3", "user", "c-0")
+        assert c.get_stats()["recovered"] == 0
+        assert (workdir / "chat_writes.b.log").exists()
+
+        asyncio.run(b.flush_once())
+        assert b_id in load_table(workdir)
+
+
+def test_restart_same_worker_id():
+    """固定 worker 编号重启后续用自己的日志，只重放检查点之后的操作"""
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        ids = run_crashed_worker(workdir, "w1", total=5, flushed=2)
+        restarted = FileBackedQueue(workdir, "w1")
+        asyncio.run(drain(restarted))
+        assert set(load_table(workdir)) == set(ids)
+        assert restarted.get_stats()["recovered"] == 3
+
+
+def main():
+    ok = True
+    for test in (test_replay_after_crash, test_live_worker_untouched, test_restart_same_worker_id):
+        print_section(test.__doc__)
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            ok = False
+            print(f"❌ {test.__name__}: {e}")
+    print_section("测试结果")
+    print("✅ 全部通过" if ok else "❌ 存在失败")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
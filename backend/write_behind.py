@@ -0,0 +1,411 @@
+# ==============================================================================
+# write_behind.py - 对话历史的异步写入队列（write-behind）
+# 功能：对话接口把消息和会话标题的写入放入队列后立即返回，
+#       后台任务把多个请求的写入合并成批量语句写入数据库
+# 技术：本地追加日志（进程崩溃后重放未提交的写入）+ 批量 INSERT IGNORE（write_id 去重）
+#       + 后台定时刷写与指数退避重试
+#       多 worker 部署时每个进程一个日志（flock 标记存活），启动时接管已退出进程遗留的日志
+# ==============================================================================
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from database_async import get_async_cursor
+
+try:
+    import fcntl
+except ImportError:  # Windows 开发环境：不加锁，也不接管其他进程的日志（只能单进程运行）
+    fcntl = None
+
+
+# 追加日志路径；每个进程实际写 chat_writes.<worker>.log（同名 .ckpt 文件记录已提交的序号）
+WRITE_BEHIND_LOG = Path(os.getenv(
+    "WRITE_BEHIND_LOG", str(Path(__file__).parent / "write_behind" / "chat_writes.log")
+))
+
+# 本进程日志的标识（默认进程号；固定的 worker 编号可以让重启后的进程直接续用自己的日志）
+WRITE_BEHIND_WORKER_ID = os.getenv("WRITE_BEHIND_WORKER_ID") or str(os.getpid())
+
+# 每批最多写入的操作数
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "200"))
+
+# 收到写入后等待多久再刷写（秒），用于合并同一时间窗口内多个请求的写入
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", "0.2"))
+
+# 刷写失败后的最长重试间隔（秒）
+WRITE_BEHIND_MAX_BACKOFF = float(os.getenv("WRITE_BEHIND_MAX_BACKOFF", "30"))
+
+# 每次追加日志后 fsync（默认只 flush 到操作系统，可抵御进程崩溃；需要抵御断电时设为1）
+WRITE_BEHIND_FSYNC = os.getenv("WRITE_BEHIND_FSYNC", "0") == "1"
+
+
+def worker_log_path(base: Path, worker_id: str) -> Path:
+    """chat_writes.log -> chat_writes.<worker_id>.log"""
+    return base.with_name(f"{base.stem}.{worker_id}{base.suffix}")
+
+
+def _try_lock(f) -> bool:
+    """对日志文件加排他锁（不等待）；文件被存活进程持有时返回 False"""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def read_log(log_path: Path) -> Tuple[int, List[Dict[str, Any]]]:
+    """读取检查点（log_path 同名 .ckpt 文件）和日志中的全部操作"""
+    try:
+        committed = int(log_path.with_suffix(".ckpt").read_text(encoding="utf-8").strip() or 0)
+    except (OSError, ValueError):
+        committed = 0
+    ops = []
+    if log_path.exists():
+        with open(log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    ops.append(json.loads(line))
+                except ValueError:
+                    # 崩溃时写了一半的最后一行
+                    continue
+    return committed, ops
+
+
+class ChatWriteQueue:
+    """
+    对话历史写入队列
+
+    - add_message / update_session_title 只追加本地日志并入队，不访问数据库
+    - 后台任务按批写入：消息用 executemany 批量 INSERT IGNORE，标题按会话只写最后一次
+    - 每条消息带唯一的 write_id，重放已提交过的日志不会产生重复消息
+    - pending_messages() 返回尚未写入数据库的消息，读取历史时合并，保证读到自己刚写的内容
+    - 每个进程只读写、截断自己的日志和检查点；启动时把已退出进程（日志上没有锁）
+      未提交的操作追加到自己的日志后删除其日志
+    """
+
+    def __init__(self, log_path: Path = WRITE_BEHIND_LOG,
+                 batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+                 flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL,
+                 worker_id: str = WRITE_BEHIND_WORKER_ID):
+        self.base_log_path = Path(log_path)
+        self.log_path = worker_log_path(self.base_log_path, worker_id)
+        self.checkpoint_path = self.log_path.with_suffix(".ckpt")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._pending: List[Dict[str, Any]] = []
+        self._seq = 0
+        self._committed_seq = 0
+        self._log = None
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self._stats = {
+            "enqueued": 0,
+            "flushed": 0,
+            "batches": 0,
+            "failures": 0,
+            "recovered": 0,
+            "last_flush_ms": 0.0,
+            "last_error": None,
+        }
+
+    # ---------------- 日志与恢复 ----------------
+
+    def _write_checkpoint(self, seq: int):
+        tmp_path = self.checkpoint_path.with_suffix(".ckpt.tmp")
+        tmp_path.write_text(str(seq), encoding="utf-8")
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _recover(self):
+        """
+        打开并锁定本进程的日志，把其中序号大于检查点的操作（上次退出时尚未提交）重新入队，
+        再接管已退出进程遗留的日志
+        """
+        self.log_path.parent.mkdir(parents=True, exist_ok=True)
+        # 恢复过程对整个目录加锁：新进程的日志在加锁之前不会被当作遗留日志接管
+        with open(self.log_path.parent / ".recover.lock", "a") as recover_lock:
+            if fcntl is not None:
+                fcntl.flock(recover_lock.fileno(), fcntl.LOCK_EX)
+
+            log = open(self.log_path, "a", encoding="utf-8")
+            if not _try_lock(log):
+                log.close()
+                raise RuntimeError(f"写入日志 {self.log_path} 正被其他进程使用（WRITE_BEHIND_WORKER_ID 重复？）")
+            self._log = log
+
+            committed, ops = read_log(self.log_path)
+            self._committed_seq = committed
+            self._seq = max([committed] + [op["seq"] for op in ops])
+            self._pending = [op for op in ops if op["seq"] > committed]
+
+            self._adopt_orphans()
+
+        if self._pending:
+            self._stats["recovered"] = len(self._pending)
+            print(f"♻️ [写入队列] 从日志恢复 {len(self._pending)} 条未提交的写入")
+
+    def _adopt_orphans(self):
+        """
+        接管已退出进程的日志：未提交的操作追加到本进程日志后，删除原日志和检查点
+
+        追加完成后、删除前崩溃时，这些操作会在两份日志中各重放一次，由 write_id 去重
+        """
+        candidates = [self.base_log_path] + sorted(
+            self.base_log_path.parent.glob(f"{self.base_log_path.stem}.*{self.base_log_path.suffix}")
+        )
+        for path in candidates:
+            if path == self.log_path:
+                continue
+            try:
+                orphan = open(path, "r", encoding="utf-8")
+            except OSError:
+                continue
+            with orphan:
+                # 加锁失败：所属进程仍在运行；链接数为0：已被其他进程接管并删除
+                if fcntl is None or not _try_lock(orphan) or os.fstat(orphan.fileno()).st_nlink == 0:
+                    continue
+                committed, ops = read_log(path)
+                ops = [op for op in ops if op["seq"] > committed]
+                for op in ops:
+                    self._write_log(op)
+                self._log.flush()
+                os.fsync(self._log.fileno())
+                for stale in (path, path.with_suffix(".ckpt")):
+                    try:
+                        stale.unlink()
+                    except FileNotFoundError:
+                        pass
+            if ops:
+                self._pending.extend(ops)
+                print(f"♻️ [写入队列] 接管已退出进程的日志 {path.name}：{len(ops)} 条未提交的写入")
+
+    def _write_log(self, op: Dict[str, Any]):
+        """分配本日志内的序号并追加一行（调用方持有锁）"""
+        self._seq += 1
+        op["seq"] = self._seq
+        self._log.write(json.dumps(op, ensure_ascii=False) + "\n")
+
+    def _append(self, op: Dict[str, Any]):
+        with self._lock:
+            if self._log is None:
+                self._recover()
+            op["enqueued_at"] = time.time()
+            self._write_log(op)
+            self._log.flush()
+            if WRITE_BEHIND_FSYNC:
+                os.fsync(self._log.fileno())
+            self._pending.append(op)
+            self._stats["enqueued"] += 1
+        self._notify()
+
+    def _notify(self):
+        if self._loop is None or self._wakeup is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._wakeup.set()
+        else:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    # ---------------- 入队 ----------------
+
+    def add_message(
+        self,
+        session_id: str,
+        role: str,
+        content: str,
+        image_url: Optional[str] = None,
+        image_base64: Optional[str] = None,
+        message_type: str = "text"
+    ) -> str:
+        """添加一条对话消息（异步写入），返回 write_id"""
+        write_id = str(uuid.uuid4())
+        self._append({
+            "op": "message",
+            "write_id": write_id,
+            "session_id": session_id,
+            "role": role,
+            "content": content,
+            "image_url": image_url,
+            "image_base64": image_base64,
+            "message_type": message_type,
+            # 入队时间即消息时间，刷写延迟不影响历史顺序
+            "created_at": datetime.now().isoformat(sep=" ", timespec="seconds"),
+        })
+        return write_id
+
+    def update_session_title(self, session_id: str, title: str):
+        """更新会话标题（异步写入）"""
+        self._append({"op": "title", "session_id": session_id, "title": title})
+
+    def pending_messages(self, session_id: str) -> List[Dict[str, Any]]:
+        """该会话尚未写入数据库的消息（格式同 get_session_history 的结果）"""
+        with self._lock:
+            ops = [op for op in self._pending if op["op"] == "message" and op["session_id"] == session_id]
+        return [
+            {
+                "id": None,
+                "write_id": op["write_id"],
+                "role": op["role"],
+                "content": op["content"],
+                "image_url": op["image_url"],
+                "message_type": op["message_type"],
+                "created_at": datetime.fromisoformat(op["created_at"]),
+            }
+            for op in ops
+        ]
+
+    def merge_pending_history(self, session_id: str, history: List[Dict[str, Any]],
+                              limit: int, recent: bool = False) -> List[Dict[str, Any]]:
+        """
+        把未写入的消息追加到数据库历史之后（按 write_id 去重，结果与写入后查询一致）
+
+        recent=True 时保留最后 limit 条（对应 get_recent_history），否则保留最前 limit 条
+        """
+        seen = {row.get("write_id") for row in history}
+        pending = [msg for msg in self.pending_messages(session_id) if msg["write_id"] not in seen]
+        merged = list(history) + pending
+        return merged[-limit:] if recent else merged[:limit]
+
+    # ---------------- 刷写 ----------------
+
+    async def _write_batch(self, batch: List[Dict[str, Any]]):
+        """一个事务写入一批操作"""
+        messages = [
+            (op["write_id"], op["session_id"], op["role"], op["content"], op["image_url"],
+             op["image_base64"], op["message_type"], op["created_at"])
+            for op in batch if op["op"] == "message"
+        ]
+        titles: Dict[str, str] = {}
+        for op in batch:
+            if op["op"] == "title":
+                titles[op["session_id"]] = op["title"]
+
+        async with get_async_cursor() as cursor:
+            conn = cursor.connection
+            await conn.begin()
+            try:
+                if messages:
+                    # IGNORE：重放时 write_id 重复、或会话已被物理删除的消息直接跳过
+                    await cursor.executemany(
+                        """INSERT IGNORE INTO chat_history
+                           (write_id, session_id, role, content, image_url, image_base64, message_type, created_at)
+                           VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+                        messages
+                    )
+                if titles:
+                    await cursor.executemany(
+                        "UPDATE chat_session SET title = %s WHERE session_id = %s",
+                        [(title, session_id) for session_id, title in titles.items()]
+                    )
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+
+    async def flush_once(self) -> int:
+        """写入队首的一批操作，返回写入的数量（队列为空时返回0）"""
+        with self._lock:
+            batch = self._pending[:self.batch_size]
+        if not batch:
+            return 0
+
+        start = time.perf_counter()
+        await self._write_batch(batch)
+
+        with self._lock:
+            # 刷写期间只会在队尾追加，队首即本批操作
+            del self._pending[:len(batch)]
+            self._committed_seq = batch[-1]["seq"]
+            self._write_checkpoint(self._committed_seq)
+            if not self._pending:
+                # 全部已提交，清空日志
+                self._log.seek(0)
+                self._log.truncate()
+            self._stats["flushed"] += len(batch)
+            self._stats["batches"] += 1
+            self._stats["last_flush_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        return len(batch)
+
+    async def _run(self):
+        backoff = self.flush_interval
+        while True:
+            await self._wakeup.wait()
+            # 等待一个时间窗口，把这段时间内各请求的写入合并为一批
+            await asyncio.sleep(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                while await self.flush_once():
+                    pass
+                backoff = self.flush_interval
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._stats["failures"] += 1
+                self._stats["last_error"] = str(e)
+                print(f"⚠️ [写入队列] 刷写失败，{backoff:.1f}秒后重试: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, WRITE_BEHIND_MAX_BACKOFF)
+                self._wakeup.set()
+
+    async def start(self):
+        """启动后台刷写任务（服务启动时调用）；有从日志恢复的写入时立即刷写"""
+        with self._lock:
+            if self._log is None:
+                self._recover()
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        if self._pending:
+            self._wakeup.set()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 5.0):
+        """停止后台任务并尽量写完队列；写不完的保留在日志中，下次启动时重放"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            async def _drain():
+                while await self.flush_once():
+                    pass
+            await asyncio.wait_for(_drain(), timeout)
+        except Exception as e:
+            print(f"⚠️ [写入队列] 关闭时仍有 {len(self._pending)} 条未写入（已保留在日志中）: {e}")
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    # ---------------- 监控 ----------------
+
+    def get_stats(self) -> Dict[str, Any]:
+        """队列深度、最早一条的等待时间（延迟）和刷写统计"""
+        with self._lock:
+            oldest = self._pending[0]["enqueued_at"] if self._pending else None
+            stats = dict(self._stats)
+            stats["depth"] = len(self._pending)
+            stats["lag_ms"] = round((time.time() - oldest) * 1000, 1) if oldest else 0.0
+            stats["committed_seq"] = self._committed_seq
+            stats["log_path"] = str(self.log_path)
+            stats["log_bytes"] = self.log_path.stat().st_size if self.log_path.exists() else 0
+        return stats
+
+
+# 全局写入队列
+chat_write_queue = ChatWriteQueue()
@@ -28,7 +28,9 @@ declare global {
 
 interface Mistake {
   id: string;
-  image_base64: string;
+  image_base64?: string;  // 仅旧数据（未迁移到图片存储）在列表中返回完整图片
+  thumbnail_base64?: string;  // 列表缩略图
+  image_url?: string | null;  // 原图地址，点击缩略图时才加载
   question_text: string;
   wrong_answer: string;
   ai_analysis: string;
@@ -539,11 +541,13 @@ const SimpleMistakeBook: React.FC = () => {
                   }}
                 >
                   {/* 图片 */}
-                  {mistake.image_base64 && (
+                  {(mistake.thumbnail_base64 || mistake.image_base64) && (
                     <img
-                      src={`data:image/jpeg;base64,${mistake.image_base64}`}
+                      src={`data:image/jpeg;base64,${mistake.thumbnail_base64 || mistake.image_base64}`}
                       alt="错题图片"
+                      title={mistake.image_url ? '点击查看原图' : undefined}
                       style={{ width: '100%', height: '200px', objectFit: 'cover' }}
+                      onClick={() => mistake.image_url && window.open(`${API_BASE_URL}${mistake.image_url}`, '_blank')}
                     />
                   )}
 
@@ -9,7 +9,7 @@
  * ==============================================================================
  */
 
-const API_BASE_URL = 'http://127.0.0.1:8000';
+export const API_BASE_URL = 'http://127.0.0.1:8000';
 
 /**
  * 获取存储的访问令牌